@@ -0,0 +1,200 @@
+import asyncio
+import itertools
+import logging
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+
+import grpc
+
+from proto import broker_pb2, broker_pb2_grpc
+
+logger = logging.getLogger(__name__)
+
+
+class BrokerChannelPool:
+    '''
+    A few grpc.aio channels to the broker, each its own HTTP/2 connection, handed out
+    round robin. Every channel multiplexes any number of concurrent calls, so a handful
+    of them serve all requests of the gateway; more than one spreads the load over
+    connections (and broker-side pollers). Idle connections are kept alive with pings so
+    they survive NATs and load balancers and a dead broker is noticed between requests.
+    Channels must be created and used on the event loop of the gateway.
+    '''
+    CHANNELS = 4
+    KEEPALIVE = 30.0          # seconds between keepalive pings
+    KEEPALIVE_TIMEOUT = 10.0  # seconds without a ping ack before the connection is dropped
+
+    def __init__(self, address: str, channels: int = CHANNELS, keepalive: float = KEEPALIVE,
+                 keepalive_timeout: float = KEEPALIVE_TIMEOUT):
+        options = [
+            # Without a local subchannel pool, channels with the same target share one connection
+            ("grpc.use_local_subchannel_pool", 1),
+            ("grpc.keepalive_time_ms", int(keepalive * 1000)),
+            ("grpc.keepalive_timeout_ms", int(keepalive_timeout * 1000)),
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.max_pings_without_data", 0),
+        ]
+        self.address = address
+        self.channels = [grpc.aio.insecure_channel(address, options=options) for _ in range(channels)]
+        self.stubs = [broker_pb2_grpc.BrokerStub(channel) for channel in self.channels]
+        self._next = itertools.cycle(self.stubs)
+
+    def stub(self) -> broker_pb2_grpc.BrokerStub:
+        return next(self._next)
+
+    async def close(self):
+        await asyncio.gather(*(channel.close() for channel in self.channels))
+
+
+class AsyncPooledStream:
+    '''
+    grpc.aio version of PooledStream: one long-lived pull MessageStream for a topic, run
+    as a task. Its credit follows the requests waiting on it, messages nobody took within
+    HOLD seconds are released back to the broker, and it reconnects with backoff if the
+    broker goes away. Only touched on the event loop, so nothing is locked.
+    '''
+    HOLD = 1.0                # seconds an unclaimed message is kept before it is released
+    RECONNECT_BACKOFF = 0.5   # seconds, doubled up to MAX_BACKOFF on repeated failures
+    MAX_BACKOFF = 10.0
+
+    def __init__(self, pool: BrokerChannelPool, topic: str):
+        self.pool = pool
+        self.topic = topic
+        # (arrived at, message) of delivered messages no request took yet, oldest first
+        self._ready: Deque[Tuple[float, object]] = deque()
+        self._waiting = 0   # messages waiting requests still want
+        self._granted = 0   # credit granted on the current broker stream and not used yet
+        self._arrived = asyncio.Condition()
+        self._outbound = asyncio.Queue()
+        self._closed = False
+        self._call = None
+        self._loop = asyncio.get_running_loop()
+        self._task = self._loop.create_task(self._run())
+
+    async def get_many(self, max_messages: int, wait_seconds: float):
+        '''
+        Yields up to max_messages messages as they arrive, until wait_seconds elapsed.
+        '''
+        deadline = self._loop.time() + wait_seconds
+        wanted = max_messages
+        self._want(wanted)
+        try:
+            while wanted:
+                if not self._ready:
+                    async with self._arrived:
+                        try:
+                            await asyncio.wait_for(
+                                self._arrived.wait_for(lambda: self._ready or self._closed),
+                                deadline - self._loop.time(),
+                            )
+                        except asyncio.TimeoutError:
+                            return
+                    if not self._ready:
+                        return
+                _, msg = self._ready.popleft()
+                wanted -= 1
+                self._want(-1)
+                yield msg
+        finally:
+            self._want(-wanted)
+
+    def _want(self, count: int):
+        # Called whenever waiting requests or unclaimed messages changed
+        self._waiting += count
+        credit = max(self._waiting - len(self._ready), 0) - self._granted
+        if credit:
+            self._granted += credit
+            self._outbound.put_nowait(broker_pb2.NodeMessage(pull=broker_pb2.Pull(credit=credit)))
+
+    def _unclaimed(self) -> List[str]:
+        # Ids of messages nobody took within HOLD, handed back to the broker
+        cutoff = self._loop.time() - self.HOLD
+        stale = []
+        while self._ready and self._ready[0][0] <= cutoff:
+            stale.append(self._ready.popleft()[1].message_id)
+        if stale:
+            self._want(0)
+        return stale
+
+    async def _node_messages(self, outbound: asyncio.Queue):
+        yield broker_pb2.NodeMessage(subscribe=broker_pb2.Subscribe(topic=self.topic, pull=True))
+        while True:
+            for message_id in self._unclaimed():
+                yield broker_pb2.NodeMessage(release=broker_pb2.Release(message_id=message_id))
+            try:
+                yield await asyncio.wait_for(outbound.get(), self.HOLD)
+            except asyncio.TimeoutError:
+                continue
+
+    async def _run(self):
+        backoff = self.RECONNECT_BACKOFF
+        while True:
+            # A new broker stream starts without credit, grant what is still wanted
+            self._outbound = asyncio.Queue()
+            self._granted = 0
+            self._want(0)
+            self._call = self.pool.stub().MessageStream(self._node_messages(self._outbound))
+            try:
+                async for msg in self._call:
+                    backoff = self.RECONNECT_BACKOFF
+                    self._granted -= 1
+                    self._ready.append((self._loop.time(), msg))
+                    self._want(0)
+                    async with self._arrived:
+                        self._arrived.notify()
+            except grpc.RpcError as e:
+                logger.warning("Broker stream for topic %s failed: %s, reconnecting", self.topic, e.code())
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.MAX_BACKOFF)
+
+    async def close(self):
+        self._closed = True
+        async with self._arrived:
+            self._arrived.notify_all()
+        self._task.cancel()
+        if self._call is not None:
+            self._call.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+class AsyncBrokerStreamPool:
+    '''
+    grpc.aio version of BrokerStreamPool: one persistent pull stream per topic on the
+    channel pool, HTTP consumers wait on it as coroutines instead of holding a thread
+    each.
+    '''
+
+    def __init__(self, pool: BrokerChannelPool):
+        self.pool = pool
+        self._streams: Dict[str, AsyncPooledStream] = {}
+
+    def _stream(self, topic: str) -> AsyncPooledStream:
+        # Only touched on the event loop, so no lock is needed
+        stream = self._streams.get(topic)
+        if stream is None:
+            stream = self._streams[topic] = AsyncPooledStream(self.pool, topic)
+        return stream
+
+    async def get(self, topic: str, timeout: float):
+        '''
+        Returns the next message of a topic, or None if none arrived within timeout.
+        '''
+        messages = self.get_many(topic, 1, max(timeout, 0))
+        try:
+            return await anext(messages, None)
+        finally:
+            await messages.aclose()
+
+    def get_many(self, topic: str, max_messages: int, wait_seconds: float):
+        '''
+        Yields up to max_messages messages as they arrive, until wait_seconds elapsed.
+        '''
+        return self._stream(topic).get_many(max_messages, wait_seconds)
+
+    async def close(self):
+        streams = list(self._streams.values())
+        self._streams.clear()
+        await asyncio.gather(*(stream.close() for stream in streams))
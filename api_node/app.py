@@ -1,90 +1,84 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, stream_with_context
+from werkzeug.exceptions import MethodNotAllowed, NotFound
 import grpc
-from uuid import UUID
+import os
 
 # Import gRPC stubs
-from proto import broker_pb2, broker_pb2_grpc
+from proto import broker_pb2_grpc
+from api_node import routes
+from api_node.stream_pool import BrokerStreamPool
+from broker.replication import ReplicatedBrokerStub
+from broker.sharding import ShardedBrokerStub
 
+# Serves the route handlers of api_node.routes, shared with the asyncio gateway
 app = Flask(__name__)
 
 # Create gRPC channel + stub (reuse this across requests)
-channel = grpc.insecure_channel("localhost:50051")  # Broker address
-stub = broker_pb2_grpc.BrokerStub(channel)
-
-
-@app.route("/produce", methods=["POST"])
-def produce():
-    data = request.json.get("data")
-    if not data:
-        return jsonify({"error": "No data provided"}), 400
-
-    resp = stub.Publish(broker_pb2.PublishRequest(
-        topic="default",   # TODO: add real topics later
-        payload=data
-    ))
-    return jsonify({"message_id": resp.message_id}), 200
-
-
-@app.route("/consume", methods=["GET"])
-def consume():
-    # For now, just pull one message off the stream
-    def node_messages():
-        yield broker_pb2.NodeMessage(
-            heartbeat=broker_pb2.Heartbeat(timestamp=0)
-        )
-
-    response_iter = stub.MessageStream(node_messages())
-    try:
-        msg = next(response_iter)   # Get first message
-        return jsonify({
-            "message_id": msg.message_id,
-            "topic": msg.topic,
-            "payload": msg.payload,
-            "timestamp": msg.timestamp
-        }), 200
-    except StopIteration:
-        return jsonify({"message": None}), 200
-
-
-@app.route('/acknowledge', methods=['POST'])
-def acknowledge():
-    message_id_str = request.json.get('message_id')
-    if not message_id_str:
-        return jsonify({"error": "No message_id provided"}), 400
-    try:
-        UUID(message_id_str)  # validate format
-    except ValueError:
-        return jsonify({"error": "Invalid UUID format"}), 400
-
-    resp = stub.Ack(broker_pb2.AckRequest(message_id=message_id_str))
-    if not resp.success:
-        return jsonify({"error": "Message ID not found or not in-flight"}), 404
-    return jsonify({"status": "acknowledged"}), 200
-
-
-@app.route('/dead_letter', methods=['GET'])
-def dead_letter():
-    resp = stub.GetDeadLetter(broker_pb2.Empty())
-    messages = [{
-        "message_id": m.message_id,
-        "topic": m.topic,
-        "payload": m.payload,
-        "timestamp": m.timestamp
-    } for m in resp.messages]
-    return jsonify(messages), 200
-
-
-@app.route("/debug/show_all", methods=['GET'])
-def debug_show_all():
-    resp = stub.GetAllMessages(broker_pb2.Empty())
-    messages = [{
-        "message_id": m.message_id,
-        "topic": m.topic,
-        "payload": m.data,
-        "enqueued_at": m.enqueued_at
-    } for m in resp.messages]
-    return jsonify(messages), 200
+BROKER_ADDRESS = os.environ.get("BROKER_ADDRESS", "localhost:50051")
+# Shard addresses of a multi-process broker (comma separated), requests then go
+# straight to the owning shard instead of through the broker's router
+BROKER_SHARDS = [address for address in os.environ.get("BROKER_SHARDS", "").split(",") if address]
+# Broker addresses of a replicated cluster (comma separated), requests go to its leader
+BROKER_REPLICAS = [address for address in os.environ.get("BROKER_REPLICAS", "").split(",") if address]
+if BROKER_SHARDS:
+    stub = ShardedBrokerStub([grpc.insecure_channel(address) for address in BROKER_SHARDS])
+elif BROKER_REPLICAS:
+    stub = ReplicatedBrokerStub([grpc.insecure_channel(address) for address in BROKER_REPLICAS])
+else:
+    stub = broker_pb2_grpc.BrokerStub(grpc.insecure_channel(BROKER_ADDRESS))
+# Persistent broker streams shared by all consumers of this node
+stream_pool = BrokerStreamPool(stub)
+
+
+def perform(operation):
+    # Broker operations of the shared route handlers, blocking this request's thread
+    if isinstance(operation, routes.Poll):
+        return stream_pool.get(operation.topic, operation.wait_seconds)
+    call = getattr(stub, operation.method)(operation.request)
+    return list(call) if isinstance(operation, routes.Pages) else call
+
+
+def to_flask(response: routes.Response):
+    if isinstance(response, routes.MessageStream):
+        def generate():
+            for msg in stream_pool.get_many(response.topic, response.max_messages, response.wait_seconds):
+                yield response.line(msg)
+
+        return Response(stream_with_context(generate()), response.status, response.headers)
+    return Response(response.body, response.status, response.headers)
+
+
+def view(handler):
+    def serve():
+        req = routes.Request(request.method, request.path, request.args, request.headers, request.get_data())
+        return to_flask(routes.run(handler(req), perform))
+    return serve
+
+
+for path, (method, handler) in routes.ROUTES.items():
+    app.add_url_rule(path, handler.__name__, view(handler), methods=[method])
+
+
+@app.errorhandler(routes.HTTPError)
+def http_error(e):
+    return to_flask(routes.error_response(e))
+
+
+@app.errorhandler(grpc.RpcError)
+def broker_error(e):
+    return to_flask(routes.broker_error(e))
+
+
+@app.errorhandler(NotFound)
+def not_found(e):
+    return to_flask(routes.json_response({"error": "Not found"}, 404))
+
+
+@app.errorhandler(MethodNotAllowed)
+def method_not_allowed(e):
+    return to_flask(routes.json_response({"error": "Method not allowed"}, 405, {"Allow": ", ".join(e.valid_methods)}))
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # The debugger runs arbitrary code for whoever can reach it, only enable it locally
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1")
@@ -0,0 +1,217 @@
+import argparse
+import asyncio
+import logging
+import os
+from urllib.parse import parse_qsl
+
+import grpc
+from werkzeug.datastructures import Headers, MultiDict
+
+from api_node import routes
+from api_node.aio_pool import AsyncBrokerStreamPool, BrokerChannelPool
+from api_node.routes import HTTPError, MessageStream, Request, Response, json_response
+
+logger = logging.getLogger(__name__)
+
+
+class Gateway:
+    """
+    ASGI application serving the API node's HTTP API on asyncio, for production
+    deployments of the API node (api_node.app is Flask's development server). Both serve
+    the route handlers of api_node.routes.
+    Every request is a coroutine: broker calls go through grpc.aio stubs of a small
+    channel pool and consumers wait on pooled broker streams, so thousands of concurrent
+    producers and long-polling consumers share a few multiplexed broker connections
+    instead of each holding a worker thread.
+    At most max_concurrency requests are handled at once, the rest wait for a slot and are
+    turned away with 503 if none frees up within request_timeout. Every broker call and
+    long poll is bounded by request_timeout as well.
+    Point it at a single broker, or the router of a multi-process broker.
+    """
+    MAX_CONCURRENCY = 1000
+    REQUEST_TIMEOUT = 30.0  # seconds
+
+    def __init__(self, broker_address: str, channels: int = BrokerChannelPool.CHANNELS,
+                 max_concurrency: int = MAX_CONCURRENCY, request_timeout: float = REQUEST_TIMEOUT,
+                 keepalive: float = BrokerChannelPool.KEEPALIVE):
+        self.broker_address = broker_address
+        self.channel_count = channels
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+        self.keepalive = keepalive
+        # Created on the server's event loop, at startup or on the first request
+        self.channels: BrokerChannelPool = None
+        self.stream_pool: AsyncBrokerStreamPool = None
+        self._slots: asyncio.Semaphore = None
+
+    def start(self):
+        if self.channels is None:
+            self.channels = BrokerChannelPool(self.broker_address, self.channel_count, self.keepalive)
+            self.stream_pool = AsyncBrokerStreamPool(self.channels)
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        if self.channels is not None:
+            await self.stream_pool.close()
+            await self.channels.close()
+            self.channels = None
+
+    @property
+    def stub(self):
+        return self.channels.stub()
+
+    # ---- ASGI ----
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            self.start()
+            response = await self._handle(scope, receive)
+            try:
+                await self._send(response, send)
+            finally:
+                if isinstance(response, MessageStream):
+                    self._slots.release()
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _handle(self, scope, receive) -> Response:
+        # A streaming response keeps its slot until it was sent, the caller releases it then
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.request_timeout)
+        except asyncio.TimeoutError:
+            return json_response({"error": "Too many concurrent requests"}, 503, {"Retry-After": "1"})
+        response = None
+        try:
+            route = routes.ROUTES.get(scope["path"].rstrip("/") or "/")
+            if route is None:
+                response = json_response({"error": "Not found"}, 404)
+            elif scope["method"] != route[0]:
+                response = json_response({"error": "Method not allowed"}, 405, {"Allow": route[0]})
+            else:
+                request = self._request(scope, await self._read_body(receive))
+                response = await routes.run_async(route[1](request), self._perform)
+        except HTTPError as e:
+            response = routes.error_response(e)
+        except grpc.RpcError as e:
+            response = routes.broker_error(e)
+        except Exception:
+            logger.exception("Unhandled error serving %s %s", scope["method"], scope["path"])
+            response = json_response({"error": "Internal server error"}, 500)
+        finally:
+            if not isinstance(response, MessageStream):
+                self._slots.release()
+        return response
+
+    @staticmethod
+    async def _read_body(receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise HTTPError(400, "Client disconnected")
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    @staticmethod
+    def _request(scope, body: bytes) -> Request:
+        query = scope.get("query_string", b"").decode("latin-1")
+        return Request(
+            scope["method"],
+            scope["path"],
+            MultiDict(parse_qsl(query, keep_blank_values=True)),
+            Headers([(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope.get("headers", [])]),
+            body,
+        )
+
+    def _wait(self, seconds: float) -> float:
+        # Long polls end in time for the request timeout
+        return min(seconds, self.request_timeout)
+
+    async def _perform(self, operation):
+        # Broker operations of the shared route handlers, each bounded by request_timeout
+        if isinstance(operation, routes.Poll):
+            return await self.stream_pool.get(operation.topic, self._wait(operation.wait_seconds))
+        call = getattr(self.stub, operation.method)(operation.request, timeout=self.request_timeout)
+        if isinstance(operation, routes.Pages):
+            return [page async for page in call]
+        return await call
+
+    async def _send(self, response: Response, send):
+        headers = [(name.lower().encode("latin-1"), str(value).encode("latin-1")) for name, value in response.headers.items()]
+        if not isinstance(response, MessageStream):
+            headers.append((b"content-length", str(len(response.body)).encode("latin-1")))
+            await send({"type": "http.response.start", "status": response.status, "headers": headers})
+            await send({"type": "http.response.body", "body": response.body})
+            return
+        await send({"type": "http.response.start", "status": response.status, "headers": headers})
+        messages = self.stream_pool.get_many(response.topic, response.max_messages, self._wait(response.wait_seconds))
+        try:
+            async for msg in messages:
+                await send({"type": "http.response.body", "body": response.line(msg), "more_body": True})
+        except grpc.RpcError as e:
+            # Too late for an error status, the stream just ends early
+            logger.warning("Streamed response ended by a broker error: %s", e.code())
+        finally:
+            await messages.aclose()
+        await send({"type": "http.response.body", "body": b""})
+
+
+def broker_address() -> str:
+    """
+    $BROKER_ADDRESS. The gateway's grpc.aio stubs do not route to shards or replicas
+    themselves, so BROKER_SHARDS and BROKER_REPLICAS are refused instead of ignored.
+    """
+    for name in ("BROKER_SHARDS", "BROKER_REPLICAS"):
+        if os.environ.get(name):
+            raise ValueError(f"{name} is not supported by the gateway: set BROKER_ADDRESS to the router of a "
+                             f"multi-process broker or the leader of a replicated one, or serve api_node.app")
+    return os.environ.get("BROKER_ADDRESS", "localhost:50051")
+
+
+# For ASGI servers: uvicorn api_node.gateway:app
+app = Gateway(broker_address())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Production API node: the HTTP API on an ASGI server, talking to the broker "
+                    "over a pool of multiplexed grpc.aio channels.",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--broker", default=broker_address(),
+                        help="broker address, or the router of a multi-process broker (default: $BROKER_ADDRESS)")
+    parser.add_argument("--channels", type=int, default=BrokerChannelPool.CHANNELS,
+                        help="gRPC connections to the broker shared by all requests")
+    parser.add_argument("--max-concurrency", type=int, default=Gateway.MAX_CONCURRENCY,
+                        help="requests handled at once, later ones wait for a slot")
+    parser.add_argument("--request-timeout", type=float, default=Gateway.REQUEST_TIMEOUT,
+                        help="seconds a request may wait for a slot, a broker call or a long poll")
+    parser.add_argument("--keep-alive", type=int, default=5,
+                        help="seconds idle HTTP connections are kept open")
+    parser.add_argument("--grpc-keepalive", type=float, default=BrokerChannelPool.KEEPALIVE,
+                        help="seconds between keepalive pings on the broker connections")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    try:
+        import uvicorn
+    except ImportError:
+        parser.error("the gateway runs on uvicorn: pip install uvicorn (or serve api_node.gateway:app "
+                     "with another ASGI server)")
+    gateway = Gateway(args.broker, args.channels, args.max_concurrency, args.request_timeout, args.grpc_keepalive)
+    # grpc.aio needs the standard asyncio event loop
+    uvicorn.run(gateway, host=args.host, port=args.port, loop="asyncio", timeout_keep_alive=args.keep_alive,
+                log_level=args.log_level.lower())
@@ -0,0 +1,84 @@
+import base64
+
+from broker.compression import decompress
+from proto import broker_pb2
+
+# Conversions between the HTTP API's JSON and broker messages, shared by the Flask
+# app and the asyncio gateway
+
+DEFAULT_TOPIC = "default"
+CONSUME_WAIT_SECONDS = 1.0  # default time /consume waits for a message to arrive
+STREAM_MAX_MESSAGES = 100   # default message limit of /consume_stream
+STREAM_WAIT_SECONDS = 10.0  # default long-poll duration of /consume_stream
+
+OCTET_STREAM = "application/octet-stream"
+SCHEDULE_ERROR = "priority, delay_seconds, deliver_at and ttl_seconds must be numbers"
+FIELDS_ERROR = "data, topic and compression must be strings"
+
+
+def schedule_fields(source):
+    # priority, delay_seconds, deliver_at and ttl_seconds of a publish, from a JSON object
+    # or the query string; None if one of them is not a number
+    try:
+        return {
+            "priority": int(source.get("priority", 0)),
+            "delay_seconds": float(source.get("delay_seconds", 0)),
+            "deliver_at": float(source.get("deliver_at", 0)),
+            "ttl_seconds": float(source.get("ttl_seconds", 0)),
+        }
+    except (TypeError, ValueError):
+        return None
+
+
+def publish_request(item, schedule, idempotency_key: str = None):
+    # PublishRequest of a JSON message; its idempotency_key unless one is given.
+    # None if data, topic or compression is not a string
+    if not all(isinstance(item.get(field, ""), str) for field in ("data", "topic", "compression")):
+        return None
+    if idempotency_key is None:
+        idempotency_key = str(item.get("idempotency_key", ""))
+    return broker_pb2.PublishRequest(
+        topic=item.get("topic", DEFAULT_TOPIC),
+        payload=item["data"],
+        compression=item.get("compression", ""),
+        partition_key=str(item.get("partition_key", "")),
+        idempotency_key=idempotency_key,
+        **schedule
+    )
+
+
+def message_to_json(msg):
+    result = {
+        "message_id": msg.message_id,
+        "topic": msg.topic,
+        "payload": msg.data,
+        "enqueued_at": msg.enqueued_at,
+        "priority": msg.priority,
+        "partition": msg.partition,
+        "partition_key": msg.partition_key
+    }
+    if msg.WhichOneof("body") == "data_bytes":
+        payload = msg.data_bytes
+        if msg.encoding:
+            # Compressed payloads may have been published as text, which comes back as UTF-8
+            payload = decompress(payload, msg.encoding)
+            try:
+                result["payload"] = payload.decode("utf-8")
+                return result
+            except UnicodeDecodeError:
+                pass
+        # JSON cannot carry bytes, binary payloads are base64 encoded
+        result["payload"] = base64.b64encode(payload).decode("ascii")
+        result["payload_encoding"] = "base64"
+    return result
+
+
+def raw_headers(msg):
+    # Message metadata of a raw consume, sent as headers next to the payload body
+    return {
+        "X-Message-Id": msg.message_id,
+        "X-Topic": msg.topic,
+        "X-Enqueued-At": repr(msg.enqueued_at),
+        "X-Priority": str(msg.priority),
+        "X-Partition": str(msg.partition),
+    }
@@ -0,0 +1,397 @@
+import json
+from typing import Dict, NamedTuple
+from uuid import UUID
+
+import grpc
+from werkzeug.datastructures import Headers, MIMEAccept, MultiDict
+from werkzeug.http import parse_accept_header, parse_options_header
+
+from api_node.messages import (
+    CONSUME_WAIT_SECONDS, DEFAULT_TOPIC, FIELDS_ERROR, OCTET_STREAM, SCHEDULE_ERROR, STREAM_MAX_MESSAGES,
+    STREAM_WAIT_SECONDS, message_to_json, publish_request, raw_headers, schedule_fields,
+)
+from broker.compression import HTTP_ENCODINGS, decompress
+from broker.listing import decode_cursor
+from proto import broker_pb2
+
+# The HTTP API's route handlers, shared by the Flask app (api_node.app) and the asyncio
+# gateway (api_node.gateway) so the two front ends serve the same API.
+# A handler is a generator: it yields the broker operations it needs (Call, Pages, Poll),
+# gets their results sent back (or their exception thrown in) and returns its Response;
+# handlers without broker calls just return it.
+# The Flask app performs the operations blocking, the gateway awaits them.
+
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str, headers: Dict[str, str] = None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+class Request:
+    '''
+    The parts of an HTTP request the handlers use, with the body read in full.
+    '''
+    def __init__(self, method: str, path: str, args: MultiDict, headers: Headers, body: bytes):
+        self.method = method
+        self.path = path
+        self.args = args
+        self.headers = headers
+        self.body = body
+
+    @property
+    def mimetype(self) -> str:
+        return parse_options_header(self.headers.get("Content-Type", ""))[0].lower()
+
+    @property
+    def accept_mimetypes(self) -> MIMEAccept:
+        return parse_accept_header(self.headers.get("Accept"), MIMEAccept)
+
+    @property
+    def accept_encodings(self):
+        return parse_accept_header(self.headers.get("Accept-Encoding"))
+
+    def json(self):
+        try:
+            return json.loads(self.body) if self.body else None
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            raise HTTPError(400, "Invalid JSON body")
+
+    def json_object(self) -> dict:
+        body = self.json()
+        if not isinstance(body, dict):
+            raise HTTPError(400, "Expected a JSON object")
+        return body
+
+
+class Response:
+    def __init__(self, body: bytes = b"", status: int = 200, content_type: str = None, headers: Dict[str, str] = None):
+        self.body = body
+        self.status = status
+        self.headers = dict(headers or {})
+        if content_type:
+            self.headers["Content-Type"] = content_type
+
+
+class MessageStream(Response):
+    '''
+    Response streaming up to max_messages of a topic as newline delimited JSON, one line
+    per message as soon as it arrives, until wait_seconds elapsed. The front end waits
+    on its stream pool for the messages while sending the body.
+    '''
+    def __init__(self, topic: str, max_messages: int, wait_seconds: float):
+        super().__init__(content_type=NDJSON)
+        self.topic = topic
+        self.max_messages = max_messages
+        self.wait_seconds = wait_seconds
+
+    @staticmethod
+    def line(msg) -> bytes:
+        return (json.dumps(message_to_json(msg)) + "\n").encode("utf-8")
+
+
+def json_response(value, status: int = 200, headers: Dict[str, str] = None) -> Response:
+    return Response(json.dumps(value).encode("utf-8"), status, JSON, headers)
+
+
+def error_response(e: HTTPError) -> Response:
+    return json_response({"error": e.message}, e.status, e.headers)
+
+
+def broker_error(e: grpc.RpcError) -> Response:
+    # Requests the broker rejected (e.g. an unknown compression codec) are client errors
+    if e.code() == grpc.StatusCode.INVALID_ARGUMENT:
+        return json_response({"error": e.details()}, 400)
+    if e.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+        return json_response({"error": "Broker did not answer in time"}, 504)
+    return json_response({"error": f"Broker unavailable: {e.code().name}"}, 502)
+
+
+# ---- Broker operations yielded by the handlers ----
+class Call(NamedTuple):
+    # Unary RPC, results in its response
+    method: str
+    request: object
+
+
+class Pages(NamedTuple):
+    # Server streaming RPC, results in the list of its responses
+    method: str
+    request: object
+
+
+class Poll(NamedTuple):
+    # Next message of a topic from the stream pool, None if none arrived within wait_seconds
+    topic: str
+    wait_seconds: float
+
+
+def run(steps, perform) -> Response:
+    '''
+    Runs a handler's steps, perform(operation) does each broker operation blocking.
+    '''
+    if isinstance(steps, Response):
+        return steps
+    result, error = None, None
+    while True:
+        try:
+            operation = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as done:
+            return done.value
+        try:
+            result, error = perform(operation), None
+        except Exception as e:
+            result, error = None, e
+
+
+async def run_async(steps, perform) -> Response:
+    '''
+    Runs a handler's steps, perform(operation) is a coroutine doing each broker operation.
+    '''
+    if isinstance(steps, Response):
+        return steps
+    result, error = None, None
+    while True:
+        try:
+            operation = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as done:
+            return done.value
+        try:
+            result, error = await perform(operation), None
+        except Exception as e:
+            result, error = None, e
+
+
+# ---- Producer API ----
+def produce(request: Request):
+    # Retries with the same Idempotency-Key header (or idempotency_key) get the first
+    # publish's message_id back instead of publishing a duplicate
+    if request.mimetype == OCTET_STREAM:
+        # Raw body is the payload, forwarded to the broker without decoding
+        if not request.body:
+            raise HTTPError(400, "No data provided")
+        schedule = schedule_fields(request.args)
+        if schedule is None:
+            raise HTTPError(400, SCHEDULE_ERROR)
+        resp = yield Call("Publish", broker_pb2.PublishRequest(
+            topic=request.args.get("topic", DEFAULT_TOPIC),
+            payload_bytes=request.body,
+            compression=request.args.get("compression", ""),
+            partition_key=request.args.get("partition_key", ""),
+            idempotency_key=request.headers.get("Idempotency-Key", request.args.get("idempotency_key", "")),
+            **schedule
+        ))
+        return json_response({"message_id": resp.message_id})
+
+    body = request.json_object()
+    if not body.get("data"):
+        raise HTTPError(400, "No data provided")
+    schedule = schedule_fields(body)
+    if schedule is None:
+        raise HTTPError(400, SCHEDULE_ERROR)
+    publish = publish_request(
+        body, schedule, request.headers.get("Idempotency-Key", str(body.get("idempotency_key", "")))
+    )
+    if publish is None:
+        raise HTTPError(400, FIELDS_ERROR)
+    resp = yield Call("Publish", publish)
+    return json_response({"message_id": resp.message_id})
+
+
+def produce_batch(request: Request):
+    items = request.json_object().get("messages")
+    if not isinstance(items, list) or not items:
+        raise HTTPError(400, "No messages provided")
+
+    # Invalid items are reported individually, the rest go to the broker in one call
+    results = [None] * len(items)
+    to_publish = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get("data"):
+            results[i] = {"error": "No data provided"}
+            continue
+        schedule = schedule_fields(item)
+        if schedule is None:
+            results[i] = {"error": SCHEDULE_ERROR}
+            continue
+        publish = publish_request(item, schedule)
+        if publish is None:
+            results[i] = {"error": FIELDS_ERROR}
+            continue
+        to_publish.append((i, publish))
+
+    if to_publish:
+        resp = yield Call("PublishBatch", broker_pb2.PublishBatchRequest(
+            messages=[req for _, req in to_publish]
+        ))
+        for (i, _), result in zip(to_publish, resp.results):
+            results[i] = {"message_id": result.message_id}
+    return json_response({"results": results})
+
+
+# ---- Consumer API ----
+def message_to_raw(request: Request, msg) -> Response:
+    headers = raw_headers(msg)
+    if msg.WhichOneof("body") != "data_bytes":
+        return Response(msg.data.encode("utf-8"), content_type=OCTET_STREAM, headers=headers)
+    body = msg.data_bytes
+    if msg.encoding:
+        # Clients that accept the codec get the stored bytes, everyone else the original payload
+        content_encoding = HTTP_ENCODINGS[msg.encoding]
+        if request.accept_encodings.quality(content_encoding) > 0:
+            headers["Content-Encoding"] = content_encoding
+        else:
+            body = decompress(body, msg.encoding)
+    return Response(body, content_type=OCTET_STREAM, headers=headers)
+
+
+def consume(request: Request):
+    # Served from the pooled broker streams; waits up to wait_seconds for a message.
+    wait_seconds = request.args.get("wait_seconds", CONSUME_WAIT_SECONDS, type=float)
+    msg = yield Poll(request.args.get("topic", DEFAULT_TOPIC), wait_seconds)
+    if request.accept_mimetypes.best_match([JSON, OCTET_STREAM]) == OCTET_STREAM:
+        # Raw consumers get the payload as the body, message metadata in headers
+        return message_to_raw(request, msg) if msg is not None else Response(status=204)
+    if msg is None:
+        return json_response({"message": None})
+    return json_response(message_to_json(msg))
+
+
+def consume_stream(request: Request):
+    # Long-poll that streams up to max_messages as newline delimited JSON,
+    # one line per message as soon as it arrives, until wait_seconds elapsed.
+    max_messages = request.args.get("max_messages", STREAM_MAX_MESSAGES, type=int)
+    wait_seconds = request.args.get("wait_seconds", STREAM_WAIT_SECONDS, type=float)
+    if max_messages <= 0:
+        raise HTTPError(400, "max_messages must be positive")
+    return MessageStream(request.args.get("topic", DEFAULT_TOPIC), max_messages, wait_seconds)
+
+
+# ---- Control plane ----
+def _message_id(body: dict) -> str:
+    message_id = body.get("message_id")
+    if not message_id:
+        raise HTTPError(400, "No message_id provided")
+    try:
+        UUID(str(message_id))  # validate format
+    except ValueError:
+        raise HTTPError(400, "Invalid UUID format")
+    return str(message_id)
+
+
+def acknowledge(request: Request):
+    message_id = _message_id(request.json_object())
+    resp = yield Call("Ack", broker_pb2.AckRequest(message_id=message_id))
+    if not resp.success:
+        raise HTTPError(404, "Message ID not found or not in-flight")
+    return json_response({"status": "acknowledged"})
+
+
+def acknowledge_batch(request: Request):
+    message_ids = request.json_object().get("message_ids")
+    if not isinstance(message_ids, list) or not message_ids:
+        raise HTTPError(400, "No message_ids provided")
+
+    resp = yield Call("AckBatch", broker_pb2.AckBatchRequest(message_ids=[str(m) for m in message_ids]))
+    return json_response({"results": [
+        {"message_id": r.message_id, "acknowledged": r.success} for r in resp.results
+    ]})
+
+
+def touch(request: Request):
+    body = request.json_object()
+    message_id = _message_id(body)
+    try:
+        visibility_timeout = int(body.get("visibility_timeout", 0))
+    except (TypeError, ValueError):
+        raise HTTPError(400, "visibility_timeout must be a number")
+    resp = yield Call("Touch", broker_pb2.TouchRequest(
+        message_id=message_id,
+        visibility_timeout=visibility_timeout,
+    ))
+    if not resp.success:
+        raise HTTPError(404, "Message ID not found or not in-flight")
+    return json_response({"status": "extended"})
+
+
+def dead_letter(request: Request):
+    # Read from the broker a page at a time. With a limit, the cursor to continue
+    # after the last returned message comes back in the X-Next-Cursor header.
+    limit = request.args.get("limit", 0, type=int)
+    if limit < 0:
+        raise HTTPError(400, "limit must not be negative")
+    cursor = request.args.get("cursor", "")
+    try:
+        decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPError(400, str(e))
+    pages = yield Pages("StreamDeadLetter", broker_pb2.ListRequest(
+        topic=request.args.get("topic", ""),
+        cursor=cursor,
+        limit=limit,
+    ))
+    messages = []
+    next_cursor = ""
+    for page in pages:
+        messages.extend(message_to_json(m) for m in page.messages)
+        next_cursor = "" if page.end else page.next_cursor
+    return json_response(messages, headers={"X-Next-Cursor": next_cursor} if next_cursor else None)
+
+
+def redrive_dead_letter(request: Request):
+    # Moves the given message_ids, or the oldest dead messages of the topic (every
+    # topic if omitted), back to their queue; limit caps how many
+    body = request.json() or {}
+    if not isinstance(body, dict):
+        raise HTTPError(400, "Expected a JSON object")
+    message_ids = body.get("message_ids", [])
+    if not isinstance(message_ids, list):
+        raise HTTPError(400, "message_ids must be a list")
+    try:
+        limit = int(body.get("limit", 0))
+    except (TypeError, ValueError):
+        raise HTTPError(400, "limit must be a number")
+
+    resp = yield Call("RedriveDeadLetter", broker_pb2.RedriveRequest(
+        topic=body.get("topic", ""),
+        message_ids=[str(m) for m in message_ids],
+        limit=limit,
+    ))
+    return json_response({"redriven": resp.redriven})
+
+
+def debug_show_all(request: Request):
+    resp = yield Call("GetAllMessages", broker_pb2.TopicRequest(topic=request.args.get("topic", "")))
+    return json_response([message_to_json(m) for m in resp.messages])
+
+
+def topics(request: Request):
+    resp = yield Call("ListTopics", broker_pb2.Empty())
+    return json_response(list(resp.topics))
+
+
+def metrics(request: Request):
+    resp = yield Call("GetStats", broker_pb2.Empty())
+    return Response(resp.text.encode("utf-8"), content_type="text/plain; version=0.0.4")
+
+
+# Path -> (HTTP method, handler)
+ROUTES = {
+    "/produce": ("POST", produce),
+    "/produce_batch": ("POST", produce_batch),
+    "/consume": ("GET", consume),
+    "/consume_stream": ("GET", consume_stream),
+    "/acknowledge": ("POST", acknowledge),
+    "/acknowledge_batch": ("POST", acknowledge_batch),
+    "/touch": ("POST", touch),
+    "/dead_letter": ("GET", dead_letter),
+    "/dead_letter/redrive": ("POST", redrive_dead_letter),
+    "/debug/show_all": ("GET", debug_show_all),
+    "/topics": ("GET", topics),
+    "/metrics": ("GET", metrics),
+}
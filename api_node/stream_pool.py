@@ -0,0 +1,173 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Tuple
+
+import grpc
+
+from proto import broker_pb2
+
+logger = logging.getLogger(__name__)
+
+
+class PooledStream:
+    '''
+    One long-lived pull MessageStream to the broker for a topic.
+    The broker only delivers what HTTP requests are waiting for: the stream keeps its
+    credit at the number of waiting requests (minus messages already here for them),
+    a request that gives up takes its credit back. A message that arrives after its
+    request gave up goes to the next one, or back to the broker with a Release frame
+    once nobody took it for HOLD seconds, so nothing sits out its visibility timeout
+    in the API node. The stream reconnects with backoff if the broker goes away.
+    '''
+    HOLD = 1.0                # seconds an unclaimed message is kept before it is released
+    RECONNECT_BACKOFF = 0.5   # seconds, doubled up to MAX_BACKOFF on repeated failures
+    MAX_BACKOFF = 10.0
+
+    def __init__(self, stub, topic: str):
+        self.stub = stub
+        self.topic = topic
+        # (arrived at, message) of delivered messages no request took yet, oldest first
+        self._ready: Deque[Tuple[float, object]] = deque()
+        self._waiting = 0   # messages waiting requests still want
+        self._granted = 0   # credit granted on the current broker stream and not used yet
+        self._cond = threading.Condition()
+        self._outbound = queue.Queue()
+        self._call = None
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f"broker-stream-{topic}")
+        self._thread.start()
+
+    def get_many(self, max_messages: int, wait_seconds: float):
+        '''
+        Yields up to max_messages messages as they arrive, until wait_seconds elapsed.
+        '''
+        deadline = time.monotonic() + wait_seconds
+        wanted = max_messages
+        with self._cond:
+            self._want(wanted)
+        try:
+            while wanted:
+                with self._cond:
+                    while not self._ready:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0 or self._closed.is_set():
+                            return
+                        self._cond.wait(remaining)
+                    _, msg = self._ready.popleft()
+                    wanted -= 1
+                    self._want(-1)
+                yield msg
+        finally:
+            with self._cond:
+                self._want(-wanted)
+
+    def _want(self, count: int):
+        # Called with the lock held whenever waiting requests or unclaimed messages changed
+        self._waiting += count
+        credit = max(self._waiting - len(self._ready), 0) - self._granted
+        if credit:
+            self._granted += credit
+            self._outbound.put(broker_pb2.NodeMessage(pull=broker_pb2.Pull(credit=credit)))
+
+    def _unclaimed(self):
+        # Ids of messages nobody took within HOLD, handed back to the broker
+        cutoff = time.monotonic() - self.HOLD
+        with self._cond:
+            stale = []
+            while self._ready and self._ready[0][0] <= cutoff:
+                stale.append(self._ready.popleft()[1].message_id)
+            if stale:
+                self._want(0)
+        return stale
+
+    def _node_messages(self, outbound: queue.Queue):
+        yield broker_pb2.NodeMessage(subscribe=broker_pb2.Subscribe(topic=self.topic, pull=True))
+        while True:
+            for message_id in self._unclaimed():
+                yield broker_pb2.NodeMessage(release=broker_pb2.Release(message_id=message_id))
+            try:
+                node_msg = outbound.get(timeout=self.HOLD)
+            except queue.Empty:
+                continue
+            if node_msg is None:
+                return
+            yield node_msg
+
+    def _run(self):
+        backoff = self.RECONNECT_BACKOFF
+        while not self._closed.is_set():
+            with self._cond:
+                # A new broker stream starts without credit, grant what is still wanted
+                self._outbound = outbound = queue.Queue()
+                self._granted = 0
+                self._want(0)
+            self._call = self.stub.MessageStream(self._node_messages(outbound))
+            try:
+                for msg in self._call:
+                    backoff = self.RECONNECT_BACKOFF
+                    with self._cond:
+                        self._granted -= 1
+                        self._ready.append((time.monotonic(), msg))
+                        self._want(0)
+                        self._cond.notify()
+            except grpc.RpcError as e:
+                if self._closed.is_set():
+                    return
+                logger.warning("Broker stream for topic %s failed: %s, reconnecting", self.topic, e.code())
+            outbound.put(None)
+            self._closed.wait(backoff)
+            backoff = min(backoff * 2, self.MAX_BACKOFF)
+
+    def close(self):
+        self._closed.set()
+        with self._cond:
+            self._cond.notify_all()
+        self._outbound.put(None)
+        if self._call is not None:
+            self._call.cancel()
+
+
+class BrokerStreamPool:
+    '''
+    Keeps one persistent broker stream per topic and multiplexes HTTP consumers onto
+    it. Streams are opened on the first request for a topic, an HTTP request only
+    waits on its topic's stream instead of setting up its own gRPC stream. One stream
+    per topic keeps the topic's delivery order.
+    Acks still go through the unary Ack RPC.
+    '''
+
+    def __init__(self, stub):
+        # BrokerStub, or ShardedBrokerStub for a multi-process broker
+        self.stub = stub
+        self._streams: Dict[str, PooledStream] = {}
+        self._lock = threading.Lock()
+
+    def _stream(self, topic: str) -> PooledStream:
+        stream = self._streams.get(topic)
+        if stream is None:
+            with self._lock:
+                stream = self._streams.get(topic)
+                if stream is None:
+                    stream = self._streams[topic] = PooledStream(self.stub, topic)
+        return stream
+
+    def get(self, topic: str, timeout: float):
+        '''
+        Returns the next message of a topic, or None if none arrived within timeout.
+        '''
+        return next(self.get_many(topic, 1, max(timeout, 0)), None)
+
+    def get_many(self, topic: str, max_messages: int, wait_seconds: float):
+        '''
+        Yields up to max_messages messages as they arrive, until wait_seconds elapsed.
+        '''
+        return self._stream(topic).get_many(max_messages, wait_seconds)
+
+    def close(self):
+        with self._lock:
+            for stream in self._streams.values():
+                stream.close()
+            self._streams.clear()
@@ -0,0 +1,511 @@
+"""
+Load generator and latency benchmark for the broker.
+
+Starts an in-process broker (and optionally the Flask API node) on local ports,
+runs a producer/consumer workload against it and prints a JSON report with
+throughput, latency percentiles and peak RSS so runs can be compared across commits.
+
+    python -m benchmarks.broker_bench --messages 20000 --producers 4 --consumers 4
+    python -m benchmarks.broker_bench --transport http --message-size 1024
+    python -m benchmarks.broker_bench --ack-ratio 0.8 --consumer-failure-rate 0.01
+    python -m benchmarks.broker_bench --shards 4 --topics 8 --producers 8 --consumers 8
+    python -m benchmarks.broker_bench --replicas 3 --producers 8
+"""
+import argparse
+import asyncio
+import http.client
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent import futures
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List
+
+import grpc
+
+from proto import broker_pb2, broker_pb2_grpc
+
+
+@dataclass
+class WorkloadConfig:
+    transport: str = "grpc"          # "grpc" drives the Broker service, "http" the Flask API node
+    server: str = "threaded"         # broker server mode: "threaded" or "aio"
+    storage: str = "sqlite"          # persistence backend: "sqlite" or "log"
+    compact_storage: bool = False    # array backed ready queues in the broker
+    max_queue_bytes: int = 0         # broker memory budget per topic queue, 0 = unbounded
+    partitions: int = 1              # partitions per topic in the broker
+    partition_keys: int = 0          # distinct partition keys messages are spread over, 0 = unkeyed
+    consumer_group: str = ""         # gRPC consumers subscribe in this group, empty = no group
+    shards: int = 0                  # >0 runs a multi-process broker with this many shard processes
+    replicas: int = 0                # >0 runs a replicated cluster of this many broker processes
+    quorum: int = 0                  # brokers of the cluster that confirm a publish, 0 = a majority
+    topics: int = 1                  # messages are spread over this many topics, consumers split between them
+    broker_workers: int = 32         # thread pool size of the threaded server
+    messages: int = 10000            # messages published in total
+    message_size: int = 256          # payload size in bytes
+    producers: int = 2
+    consumers: int = 2
+    publish_batch: int = 1           # >1 publishes with PublishBatch / /produce_batch
+    prefetch: int = 32               # stream prefetch window of each gRPC consumer
+    topic: str = "bench"
+    ack_ratio: float = 1.0           # probability that a delivery is acked, the rest are redelivered
+    consumer_failure_rate: float = 0.0  # probability per delivery that a consumer drops its stream
+    visibility_timeout: int = 2      # seconds before an unacked delivery is redelivered
+    max_duration: float = 120.0      # seconds before the run is stopped even if incomplete
+
+
+@dataclass
+class Recorder:
+    '''
+    Thread safe collection of raw timings, summarised once the run is over.
+    '''
+    published: int = 0
+    deliveries: int = 0
+    deliver_latency: List[float] = field(default_factory=list)
+    ack_latency: List[float] = field(default_factory=list)
+    delivered_ids: set = field(default_factory=set)
+    acked_ids: set = field(default_factory=set)
+    consumer_failures: int = 0
+    dead_lettered: int = 0
+    errors: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def on_published(self, count: int):
+        with self.lock:
+            self.published += count
+
+    def on_delivered(self, message_id: str, published_at: float):
+        now = time.time()
+        with self.lock:
+            self.deliveries += 1
+            if message_id not in self.delivered_ids:
+                self.delivered_ids.add(message_id)
+                self.deliver_latency.append(now - published_at)
+
+    def on_acked(self, message_id: str, published_at: float):
+        now = time.time()
+        with self.lock:
+            if message_id not in self.acked_ids:
+                self.acked_ids.add(message_id)
+                self.ack_latency.append(now - published_at)
+
+    def done(self, total: int) -> bool:
+        # Messages that ran out of retries never get acked, they finish in the dead letter queue
+        with self.lock:
+            return len(self.acked_ids) + self.dead_lettered >= total
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(q):
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)] * 1000
+
+    return {
+        "p50_ms": at(0.50),
+        "p99_ms": at(0.99),
+        "p999_ms": at(0.999),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def topic_name(config: WorkloadConfig, i: int) -> str:
+    return f"{config.topic}-{i % config.topics}" if config.topics > 1 else config.topic
+
+
+def make_payload(size: int) -> str:
+    stamp = f"{time.time():.6f}|"
+    return stamp + "x" * max(size - len(stamp), 0)
+
+
+def published_at(payload: str) -> float:
+    return float(payload.split("|", 1)[0])
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+# ---- in-process servers ----
+
+def service_options(config: WorkloadConfig, data_path: str) -> dict:
+    return dict(
+        compact_storage=config.compact_storage,
+        max_queue_bytes=config.max_queue_bytes or None,
+        spill_dir=data_path + ".spill",
+        partitions=config.partitions,
+    )
+
+
+def start_broker(config: WorkloadConfig, data_path: str, port: int):
+    '''
+    Starts a broker on localhost:port and returns a function that stops it.
+    '''
+    if config.server == "aio":
+        from broker.aio_broker import AsyncBrokerServicer
+
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+        holder = {}
+
+        async def run():
+            server = grpc.aio.server()
+            broker_pb2_grpc.add_BrokerServicer_to_server(
+                AsyncBrokerServicer(config.storage, data_path, **service_options(config, data_path)), server
+            )
+            server.add_insecure_port(f"localhost:{port}")
+            await server.start()
+            holder["server"] = server
+            started.set()
+            await server.wait_for_termination()
+
+        threading.Thread(target=loop.run_until_complete, args=(run(),), daemon=True).start()
+        started.wait()
+        return lambda: asyncio.run_coroutine_threadsafe(holder["server"].stop(0), loop).result()
+
+    from broker.broker import BrokerServicer
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=config.broker_workers))
+    broker_pb2_grpc.add_BrokerServicer_to_server(
+        BrokerServicer(config.storage, data_path, **service_options(config, data_path)), server
+    )
+    server.add_insecure_port(f"localhost:{port}")
+    server.start()
+    return lambda: server.stop(0)
+
+
+def worker_args(config: WorkloadConfig) -> List[str]:
+    args = ["--server", config.server, "--partitions", str(config.partitions), "--log-level", "WARNING"]
+    if config.compact_storage:
+        args.append("--compact-storage")
+    if config.max_queue_bytes:
+        args += ["--max-queue-bytes", str(config.max_queue_bytes)]
+    return args
+
+
+def start_shards(config: WorkloadConfig, data_dir: str, port: int):
+    '''
+    Starts a multi-process broker with shards on the ports after `port`, returns the
+    shard addresses and a function that stops it.
+    '''
+    from broker.supervisor import Supervisor
+
+    supervisor = Supervisor(config.shards, port, data_dir, config.storage, worker_args(config))
+    supervisor.start()
+    for address in supervisor.addresses:
+        with grpc.insecure_channel(address) as channel:
+            grpc.channel_ready_future(channel).result(timeout=30)
+    return supervisor.addresses, supervisor.stop
+
+
+def start_cluster(config: WorkloadConfig, data_dir: str, port: int):
+    '''
+    Starts a replicated cluster on `port` and the following ports and waits until it
+    elected a leader. Returns the replica addresses and a function that stops it.
+    '''
+    from broker.cluster import Cluster
+    from broker.replication import ReplicatedBrokerStub
+
+    cluster = Cluster(config.replicas, port, data_dir, config.storage, worker_args(config), config.quorum or None)
+    cluster.start()
+    channels = [grpc.insecure_channel(address) for address in cluster.addresses]
+    deadline = time.monotonic() + 60
+    while ReplicatedBrokerStub(channels).find_leader() is None and time.monotonic() < deadline:
+        time.sleep(0.2)
+    for channel in channels:
+        channel.close()
+    return cluster.addresses, cluster.stop
+
+
+def broker_stub(config: WorkloadConfig, addresses: List[str]):
+    from broker.replication import ReplicatedBrokerStub
+    from broker.sharding import ShardedBrokerStub
+
+    channels = [grpc.insecure_channel(address) for address in addresses]
+    if config.replicas:
+        return channels, ReplicatedBrokerStub(channels)
+    if len(channels) == 1:
+        return channels, broker_pb2_grpc.BrokerStub(channels[0])
+    return channels, ShardedBrokerStub(channels)
+
+
+def start_api_node(config: WorkloadConfig, broker_addresses: List[str], port: int):
+    # The API node reads the broker address at import time
+    if config.replicas:
+        os.environ["BROKER_REPLICAS"] = ",".join(broker_addresses)
+    elif len(broker_addresses) > 1:
+        os.environ["BROKER_SHARDS"] = ",".join(broker_addresses)
+    else:
+        os.environ["BROKER_ADDRESS"] = broker_addresses[0]
+    from werkzeug.serving import make_server
+    from api_node.app import app
+
+    server = make_server("localhost", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.shutdown
+
+
+# ---- gRPC workload ----
+
+class GrpcDriver:
+    def __init__(self, config: WorkloadConfig, recorder: Recorder, addresses: List[str]):
+        self.config = config
+        self.recorder = recorder
+        self.channels, self.stub = broker_stub(config, addresses)
+        self._consumer_ids = itertools.count()
+
+    def _request(self, i: int):
+        keys = self.config.partition_keys
+        return broker_pb2.PublishRequest(
+            topic=topic_name(self.config, i),
+            payload=make_payload(self.config.message_size),
+            partition_key=f"key-{i % keys}" if keys else "",
+        )
+
+    def produce(self, count: int):
+        sent = 0
+        while sent < count:
+            n = min(self.config.publish_batch, count - sent)
+            try:
+                if n == 1:
+                    self.stub.Publish(self._request(sent))
+                else:
+                    self.stub.PublishBatch(broker_pb2.PublishBatchRequest(messages=[
+                        self._request(sent + i) for i in range(n)
+                    ]))
+            except grpc.RpcError:
+                with self.recorder.lock:
+                    self.recorder.errors += 1
+                continue
+            sent += n
+            self.recorder.on_published(n)
+
+    def consume(self, stop: threading.Event):
+        topic = topic_name(self.config, next(self._consumer_ids))
+        while not stop.is_set():
+            subscribe = broker_pb2.NodeMessage(subscribe=broker_pb2.Subscribe(
+                topic=topic,
+                prefetch=self.config.prefetch,
+                visibility_timeout=self.config.visibility_timeout,
+                consumer_group=self.config.consumer_group,
+            ))
+            call = self.stub.MessageStream(_keep_open(subscribe, stop))
+            try:
+                for msg in call:
+                    sent_at = published_at(msg.data)
+                    self.recorder.on_delivered(msg.message_id, sent_at)
+                    if random.random() < self.config.consumer_failure_rate:
+                        # Simulated consumer crash: drop the stream without acking
+                        with self.recorder.lock:
+                            self.recorder.consumer_failures += 1
+                        call.cancel()
+                        break
+                    if random.random() < self.config.ack_ratio:
+                        if self.stub.Ack(broker_pb2.AckRequest(message_id=msg.message_id)).success:
+                            self.recorder.on_acked(msg.message_id, sent_at)
+                    if stop.is_set():
+                        call.cancel()
+                        break
+            except grpc.RpcError:
+                pass
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+
+
+def _keep_open(subscribe, stop: threading.Event):
+    # Sends the subscription, then keeps the request side open until the run stops
+    yield subscribe
+    while not stop.wait(0.5):
+        pass
+
+
+# ---- HTTP workload ----
+
+class HttpDriver:
+    def __init__(self, config: WorkloadConfig, recorder: Recorder, port: int):
+        self.config = config
+        self.recorder = recorder
+        self.port = port
+        self._consumer_ids = itertools.count()
+
+    def _request(self, conn, method, path, body=None):
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+        resp = conn.getresponse()
+        return resp.status, json.loads(resp.read() or b"null")
+
+    def produce(self, count: int):
+        conn = http.client.HTTPConnection("localhost", self.port)
+        sent = 0
+        while sent < count:
+            n = min(self.config.publish_batch, count - sent)
+            if n == 1:
+                status, _ = self._request(conn, "POST", "/produce", {
+                    "topic": topic_name(self.config, sent), "data": make_payload(self.config.message_size)
+                })
+            else:
+                status, _ = self._request(conn, "POST", "/produce_batch", {"messages": [
+                    {"topic": topic_name(self.config, sent + i), "data": make_payload(self.config.message_size)}
+                    for i in range(n)
+                ]})
+            if status != 200:
+                with self.recorder.lock:
+                    self.recorder.errors += 1
+                continue
+            sent += n
+            self.recorder.on_published(n)
+        conn.close()
+
+    def consume(self, stop: threading.Event):
+        conn = http.client.HTTPConnection("localhost", self.port)
+        topic = topic_name(self.config, next(self._consumer_ids))
+        while not stop.is_set():
+            status, msg = self._request(conn, "GET", f"/consume?topic={topic}&wait_seconds=0.5")
+            if status != 200 or not msg or "message_id" not in msg:
+                continue
+            sent_at = published_at(msg["payload"])
+            self.recorder.on_delivered(msg["message_id"], sent_at)
+            if random.random() < self.config.ack_ratio:
+                status, _ = self._request(conn, "POST", "/acknowledge", {"message_id": msg["message_id"]})
+                if status == 200:
+                    self.recorder.on_acked(msg["message_id"], sent_at)
+        conn.close()
+
+    def close(self):
+        pass
+
+
+# ---- runner ----
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(config: WorkloadConfig) -> dict:
+    workdir = tempfile.mkdtemp(prefix="broker-bench-")
+    data_path = os.path.join(workdir, "message_queue.db" if config.storage == "sqlite" else "message_log")
+    broker_port = free_port()
+    if config.shards:
+        addresses, stop_shards = start_shards(config, os.path.join(workdir, "shards"), broker_port)
+        stoppers = [stop_shards]
+    elif config.replicas:
+        addresses, stop_cluster = start_cluster(config, os.path.join(workdir, "cluster"), broker_port)
+        stoppers = [stop_cluster]
+    else:
+        addresses = [f"localhost:{broker_port}"]
+        stoppers = [start_broker(config, data_path, broker_port)]
+    recorder = Recorder()
+    if config.transport == "http":
+        http_port = free_port()
+        stoppers.append(start_api_node(config, addresses, http_port))
+        driver = HttpDriver(config, recorder, http_port)
+    else:
+        driver = GrpcDriver(config, recorder, addresses)
+
+    stop = threading.Event()
+    per_producer = [config.messages // config.producers] * config.producers
+    per_producer[0] += config.messages - sum(per_producer)
+    consumers = [threading.Thread(target=driver.consume, args=(stop,), daemon=True) for _ in range(config.consumers)]
+    producers = [threading.Thread(target=driver.produce, args=(n,), daemon=True) for n in per_producer]
+
+    start = time.time()
+    for t in consumers + producers:
+        t.start()
+    for t in producers:
+        t.join(config.max_duration)
+    publish_duration = time.time() - start
+    deadline = start + config.max_duration
+    control_channels, control_stub = broker_stub(config, addresses)
+    while not recorder.done(config.messages) and time.time() < deadline:
+        time.sleep(0.2)
+        dead = control_stub.GetDeadLetter(broker_pb2.TopicRequest(topic=config.topic if config.topics == 1 else ""))
+        with recorder.lock:
+            recorder.dead_lettered = len(dead.messages)
+    for channel in control_channels:
+        channel.close()
+    duration = time.time() - start
+    stop.set()
+    for t in consumers:
+        t.join(2)
+    driver.close()
+    for stopper in reversed(stoppers):
+        stopper()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    with recorder.lock:
+        return {
+            "commit": git_commit(),
+            "config": asdict(config),
+            "complete": len(recorder.acked_ids) + recorder.dead_lettered >= config.messages,
+            "published": recorder.published,
+            "delivered_unique": len(recorder.delivered_ids),
+            "deliveries": recorder.deliveries,
+            "redeliveries": recorder.deliveries - len(recorder.delivered_ids),
+            "acked": len(recorder.acked_ids),
+            "dead_lettered": recorder.dead_lettered,
+            "consumer_failures": recorder.consumer_failures,
+            "errors": recorder.errors,
+            "duration_s": duration,
+            "publish_throughput_msg_s": recorder.published / publish_duration if publish_duration else 0.0,
+            "ack_throughput_msg_s": len(recorder.acked_ids) / duration if duration else 0.0,
+            "publish_to_deliver": percentiles(recorder.deliver_latency),
+            "publish_to_ack": percentiles(recorder.ack_latency),
+            # ru_maxrss is KiB on Linux, bytes on macOS
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+        }
+
+
+def parse_args(argv=None):
+    defaults = WorkloadConfig()
+    parser = argparse.ArgumentParser(description="Broker load generator and latency benchmark")
+    for name, value in asdict(defaults).items():
+        flag = "--" + name.replace("_", "-")
+        if name == "transport":
+            parser.add_argument(flag, choices=["grpc", "http"], default=value)
+        elif name == "server":
+            parser.add_argument(flag, choices=["threaded", "aio"], default=value)
+        elif name == "storage":
+            parser.add_argument(flag, choices=["sqlite", "log"], default=value)
+        elif isinstance(value, bool):
+            parser.add_argument(flag, action="store_true", default=value)
+        else:
+            parser.add_argument(flag, type=type(value), default=value)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+    output = args.output
+    del args.output
+    return WorkloadConfig(**vars(args)), output
+
+
+def main(argv=None):
+    config, output = parse_args(argv)
+    report = run(config)
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Concurrency stress benchmark for MessageStorage.
+
+Producer and consumer threads hammer one storage instance directly (no gRPC), with
+consumers randomly requeueing deliveries instead of acking them while a reader thread
+keeps snapshotting the queues. Afterwards every message must have been acked exactly
+once. Runs once per thread count and prints a JSON report with the throughput of each,
+exiting with status 1 if any message was lost or acked twice. The exactly once
+property itself is covered by tests/test_message_storage.py, this measures throughput.
+
+    python -m benchmarks.storage_stress --messages 200000 --threads 1,2,4,8
+    python -m benchmarks.storage_stress --compact-storage --topics 1
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import List
+from uuid import uuid4
+
+from broker.message_storage import MessageStorage
+from broker.models import Message
+
+
+@dataclass
+class StressConfig:
+    messages: int = 100000
+    topics: int = 4
+    partitions: int = 1
+    requeue_rate: float = 0.05     # probability that a delivery is requeued instead of acked
+    compact_storage: bool = False
+    max_duration: float = 120.0
+
+
+def run(config: StressConfig, threads: int) -> dict:
+    storage = MessageStorage(compact=config.compact_storage, partitions=config.partitions)
+    topics = [f"stress-{i}" for i in range(config.topics)]
+    acked: List[List[str]] = [[] for _ in range(threads)]
+    deliveries = [0] * threads
+    produced = threading.Event()
+    stop = threading.Event()
+
+    def produce(worker: int):
+        rng = random.Random(worker)
+        for i in range(worker, config.messages, threads):
+            storage.enqueue(Message(id=uuid4(), data=f"{i}", topic=rng.choice(topics)))
+
+    def consume(worker: int):
+        rng = random.Random(-worker - 1)
+        while not stop.is_set():
+            idle = True
+            for topic in topics:
+                message = storage.dequeue(topic)
+                if message is None:
+                    continue
+                idle = False
+                deliveries[worker] += 1
+                if rng.random() < config.requeue_rate:
+                    storage.requeue_from_inflight(message.id)
+                elif storage.acknowledge(message.id):
+                    acked[worker].append(message.data)
+            if idle and produced.is_set():
+                if not any(storage.topic(topic).has_ready() or storage.topic(topic).in_flight_count() for topic in topics):
+                    return
+
+    def snapshot():
+        # Iterates queues and in-flight maps while they are being mutated
+        while not stop.is_set():
+            storage.get_all_messages()
+            storage.get_dead_letter()
+            time.sleep(0.01)
+
+    producers = [threading.Thread(target=produce, args=(i,)) for i in range(threads)]
+    consumers = [threading.Thread(target=consume, args=(i,)) for i in range(threads)]
+    reader = threading.Thread(target=snapshot, daemon=True)
+    started = time.perf_counter()
+    for thread in producers + consumers + [reader]:
+        thread.start()
+    for thread in producers:
+        thread.join()
+    produced.set()
+    deadline = time.monotonic() + config.max_duration
+    for thread in consumers:
+        thread.join(max(deadline - time.monotonic(), 0))
+    elapsed = time.perf_counter() - started
+    stop.set()
+
+    all_acked = [data for worker in acked for data in worker]
+    unique = set(all_acked)
+    return {
+        "threads": threads,
+        "seconds": elapsed,
+        "messages_per_second": len(all_acked) / elapsed if elapsed else 0.0,
+        "deliveries": sum(deliveries),
+        "acked": len(all_acked),
+        "lost": config.messages - len(unique),
+        "duplicated": len(all_acked) - len(unique),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    for name, value in asdict(StressConfig()).items():
+        flag = "--" + name.replace("_", "-")
+        if isinstance(value, bool):
+            parser.add_argument(flag, action="store_true", default=value)
+        else:
+            parser.add_argument(flag, type=type(value), default=value)
+    parser.add_argument("--threads", default="1,2,4,8",
+                        help="comma separated producer/consumer thread counts, one run each")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args(argv)
+    threads = [int(count) for count in args.threads.split(",")]
+    output = args.output
+    del args.threads, args.output
+    return StressConfig(**vars(args)), threads, output
+
+
+def main(argv=None):
+    config, thread_counts, output = parse_args(argv)
+    report = {
+        "config": asdict(config),
+        "python": sys.version.split()[0],
+        "runs": [run(config, threads) for threads in thread_counts],
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    failed = any(r["lost"] or r["duplicated"] for r in report["runs"])
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+
+import grpc
+
+from broker.aio_message_service import AsyncMessageService
+from broker.broker import BrokerServicer, exit_deposed, message_to_proto
+from broker.consumer_stream import AsyncConsumerStream
+from broker.replication import ReplicationError, ReplicationServicer
+from proto import broker_pb2, broker_pb2_grpc
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBrokerServicer(BrokerServicer):
+    """
+    grpc.aio version of BrokerServicer. Publishes, deliveries and acks go through the
+    persistence queue, which blocks when it is full, so they run on the default
+    executor and a backed up disk never stalls the event loop. Calls that only read
+    or touch in-memory storage run inline. Streams wait for credit and messages as
+    coroutines, an idle stream costs no thread.
+    """
+
+    def __init__(self, persistence_backend: str = "sqlite", data_path: str = None, replication: dict = None,
+                 **service_options):
+        super().__init__(persistence_backend, data_path, replication, **service_options)
+        self._loop = asyncio.get_running_loop()
+        self.aio_service = AsyncMessageService(self.message_service, self._loop)
+
+    def _offload(self, func, *args):
+        return self._loop.run_in_executor(None, func, *args)
+
+    # ---- Producer API ----
+    async def Publish(self, request, context):
+        if self._turned_away(context):
+            return broker_pb2.PublishResponse()
+        response, seq = await self._offload(self._publish, request, context)
+        if seq is not None and self.replication is not None:
+            committed = await self._offload(self.replication.wait_for_quorum, seq)
+            if self._unconfirmed(context, committed):
+                return broker_pb2.PublishResponse()
+        return response
+
+    async def PublishBatch(self, request, context):
+        if self._turned_away(context):
+            return broker_pb2.PublishBatchResponse()
+        response, seq = await self._offload(self._publish_batch, request, context)
+        if seq is not None and self.replication is not None:
+            committed = await self._offload(self.replication.wait_for_quorum, seq)
+            if self._unconfirmed(context, committed):
+                return broker_pb2.PublishBatchResponse()
+        return response
+
+    # ---- Streaming API (for consumers / API nodes) ----
+    async def MessageStream(self, request_iterator, context):
+        if self._turned_away(context):
+            return
+        stream = AsyncConsumerStream(self._loop)
+        self._open_stream(stream)
+        reader = asyncio.create_task(self._read_node_messages_async(request_iterator, stream))
+        try:
+            while await stream.wait_for_credit_async():
+                message = await self._consume(stream)
+                if message is None:
+                    await self.aio_service.wait_for_messages(stream.topic, partitions=stream.partitions)
+                    continue
+                stream.delivered(str(message.id), message.deliver_at or message.enqueued_at)
+                with self._deliveries_lock:
+                    self._deliveries[str(message.id)] = stream
+                yield message_to_proto(
+                    message,
+                    visibility_timeout=stream.visibility_timeout or self.message_service.REQUEUE_TIMEOUT,
+                )
+        finally:
+            reader.cancel()
+            self._close_stream(stream)
+
+    async def _consume(self, stream: AsyncConsumerStream):
+        future = self._offload(self.message_service.consume, stream.topic, stream.visibility_timeout, stream.partitions)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The stream went away while a message was being taken for it, put it back unused
+            future.add_done_callback(self._put_back)
+            raise
+
+    def _put_back(self, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            self.message_service.release(future.result().id)
+
+    async def _read_node_messages_async(self, request_iterator, stream: AsyncConsumerStream):
+        try:
+            async for node_msg in request_iterator:
+                # Acks are persisted, frames are still handled one at a time in order
+                await self._offload(self._handle_node_message, node_msg, stream)
+        except grpc.RpcError:
+            self._close_stream(stream)
+
+    # ---- Unary control plane ----
+    async def Ack(self, request, context):
+        return await self._offload(BrokerServicer.Ack, self, request, context)
+
+    async def AckBatch(self, request, context):
+        return await self._offload(BrokerServicer.AckBatch, self, request, context)
+
+    async def Touch(self, request, context):
+        return BrokerServicer.Touch(self, request, context)
+
+    async def GetDeadLetter(self, request, context):
+        return BrokerServicer.GetDeadLetter(self, request, context)
+
+    async def StreamDeadLetter(self, request, context):
+        for page in BrokerServicer.StreamDeadLetter(self, request, context):
+            yield page
+
+    async def RedriveDeadLetter(self, request, context):
+        return await self._offload(BrokerServicer.RedriveDeadLetter, self, request, context)
+
+    async def GetAllMessages(self, request, context):
+        return BrokerServicer.GetAllMessages(self, request, context)
+
+    async def StreamAllMessages(self, request, context):
+        for page in BrokerServicer.StreamAllMessages(self, request, context):
+            yield page
+
+    async def ListTopics(self, request, context):
+        return BrokerServicer.ListTopics(self, request, context)
+
+    async def GetStats(self, request, context):
+        return BrokerServicer.GetStats(self, request, context)
+
+
+class AsyncReplicationServicer(ReplicationServicer):
+    """
+    grpc.aio version of ReplicationServicer. Applying a batch waits for the local
+    persistence commit, so it runs on the default executor.
+    """
+
+    async def Replicate(self, request_iterator, context):
+        loop = asyncio.get_running_loop()
+        async for batch in request_iterator:
+            try:
+                yield await loop.run_in_executor(None, self.node.apply, batch)
+            except ReplicationError as e:
+                await context.abort(grpc.StatusCode.FAILED_PRECONDITION, str(e))
+
+    async def RequestVote(self, request, context):
+        return self.node.vote(request)
+
+    async def GetReplicaStatus(self, request, context):
+        return self.node.status()
+
+
+async def serve_aio(persistence_backend: str = "sqlite", port: int = 50051, data_path: str = None,
+                    replication: dict = None, **service_options):
+    server = grpc.aio.server()
+    servicer = AsyncBrokerServicer(persistence_backend, data_path, replication, **service_options)
+    broker_pb2_grpc.add_BrokerServicer_to_server(servicer, server)
+    if servicer.replication is not None:
+        broker_pb2_grpc.add_ReplicationServicer_to_server(AsyncReplicationServicer(servicer.replication), server)
+    server.add_insecure_port(f"[::]:{port}")
+    await server.start()
+    logger.info("Broker gRPC aio server started on :%s", port)
+    try:
+        if servicer.replication is None:
+            await server.wait_for_termination()
+        else:
+            # A replica that lost its leadership exits so it can be restarted as a follower
+            servicer.replication.start()
+            while not servicer.replication.deposed.is_set():
+                await asyncio.sleep(1.0)
+    finally:
+        await server.stop(0)
+    if servicer.replication is not None and servicer.replication.deposed.is_set():
+        exit_deposed(servicer)
@@ -0,0 +1,64 @@
+import asyncio
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+
+from broker.message_service import MessageService
+from broker.models import DEFAULT_TOPIC
+
+
+class AsyncMessageService:
+    '''
+    asyncio front for a MessageService.
+    Consumers waiting for a topic are parked as futures and woken one per enqueued
+    message instead of each holding a thread blocked on a condition. Everything else
+    (publishes, deliveries, acks) may block on the persistence queue, AsyncBrokerServicer
+    runs those on an executor.
+    '''
+    def __init__(self, message_service: MessageService, loop: asyncio.AbstractEventLoop):
+        self.service = message_service
+        self._loop = loop
+        # topic -> (future, partitions it waits for, None = any)
+        self._waiters: Dict[str, Deque[Tuple[asyncio.Future, List[int] | None]]] = {}
+        self.service.storage.listeners.append(self._on_enqueue)
+
+    def _on_enqueue(self, topic: str, partition: int | None, count: int | None):
+        # May run on any thread (requeue worker, persistence recovery), hop onto the loop
+        self._loop.call_soon_threadsafe(self._wake, topic, partition, count)
+
+    def _wake(self, topic: str, partition: int | None, count: int | None):
+        '''
+        Wakes up to `count` waiters reading `partition` (every waiter of the topic when
+        partition and count are None).
+        '''
+        waiters = self._waiters.get(topic)
+        if not waiters:
+            return
+        if count is None:
+            count = len(waiters)
+        skipped = deque()
+        while waiters and count > 0:
+            waiter, partitions = waiters.popleft()
+            if waiter.done():
+                continue
+            if partition is not None and partitions is not None and partition not in partitions:
+                skipped.append((waiter, partitions))
+                continue
+            waiter.set_result(True)
+            count -= 1
+        waiters.extendleft(reversed(skipped))
+
+    async def wait_for_messages(self, topic: str = DEFAULT_TOPIC, timeout: float = None,
+                                partitions: List[int] = None) -> bool:
+        if self.service.storage.topic(topic).has_ready(partitions):
+            return True
+        waiter = self._loop.create_future()
+        self._waiters.setdefault(topic, deque()).append((waiter, partitions))
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return False
+        except asyncio.CancelledError:
+            # A wake-up handed to a cancelled waiter would be lost, pass it on
+            if waiter.done() and not waiter.cancelled():
+                self._wake(topic, None, 1)
+            raise
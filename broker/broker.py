@@ -1,86 +1,497 @@
+import argparse
+import asyncio
 import grpc
 from concurrent import futures
+import logging
+import os
+import threading
 import time
 
+from broker.compression import DEFAULT_THRESHOLD
+from broker.consumer_groups import ConsumerGroups
+from broker.consumer_stream import ConsumerStream
 from broker.message_service import MessageService
+from broker.message_storage import MessageStorage
+from broker.replication import EXIT_DEPOSED, ReplicationNode, ReplicationServicer
 from proto import broker_pb2, broker_pb2_grpc
 from broker.models import MessageState
 
+logger = logging.getLogger(__name__)
 
-def message_to_proto(msg, topic="default", visibility_timeout=30):
+
+def message_to_proto(msg, visibility_timeout=30):
     """Helper to convert internal Message → BrokerMessage (proto)."""
-    print(f"Converting message to proto: {msg}")
-    return broker_pb2.BrokerMessage(
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Converting message to proto: %s", msg)
+    proto = broker_pb2.BrokerMessage(
         message_id=str(msg.id),
-        topic=topic,
-        data=str(msg.data),
+        topic=msg.topic,
         enqueued_at=msg.enqueued_at or 0.0,
         retries=msg.retries,
         state=int(msg.state),
         visibility_timeout=visibility_timeout,
+        priority=msg.priority,
+        partition=msg.partition,
+        partition_key=msg.partition_key,
     )
+    # Binary and compressed payloads go out in the bytes field untouched, everything else as text
+    if isinstance(msg.data, (bytes, bytearray, memoryview)):
+        proto.data_bytes = bytes(msg.data)
+        proto.encoding = msg.encoding
+    else:
+        proto.data = str(msg.data)
+    return proto
+
+
+def payload_from_proto(request):
+    """Payload of a PublishRequest: bytes for payload_bytes, str for payload."""
+    if request.WhichOneof("body") == "payload_bytes":
+        return request.payload_bytes
+    return request.payload
+
+
+def publish_options(request):
+    """produce() options of a PublishRequest: compression, priority, delivery time, partition, idempotency key and TTL."""
+    deliver_at = request.deliver_at or None
+    if deliver_at is None and request.delay_seconds > 0:
+        deliver_at = time.time() + request.delay_seconds
+    return {
+        "compression": request.compression,
+        "priority": request.priority,
+        "deliver_at": deliver_at,
+        "partition_key": request.partition_key,
+        "idempotency_key": request.idempotency_key,
+        "ttl": request.ttl_seconds or None,
+    }
 
 
 class BrokerServicer(broker_pb2_grpc.BrokerServicer):
-    def __init__(self):
-        self.message_service = MessageService()
+    IDLE_WAIT = 1.0  # seconds a stream blocks before re-checking that it is still open
+
+    def __init__(self, persistence_backend: str = "sqlite", data_path: str = None, replication: dict = None,
+                 **service_options):
+        # service_options are passed on to MessageService (compact_storage, max_queue_bytes, ...)
+        # Brokers of a replicated cluster load their backlog once they are elected leader
+        self.message_service = MessageService(
+            persistence_backend=persistence_backend, data_path=data_path, replay=replication is None,
+            **service_options
+        )
+        # ReplicationNode options (node, peers, quorum, state_path) when this broker is part of a cluster
+        self.replication = None
+        if replication is not None:
+            self.replication = ReplicationNode(self.message_service, **replication)
+        # Stream each in-flight message was pushed on, so acks arriving on any path
+        # (stream, Ack, AckBatch) and expiries hand the credit back to that stream
+        self._deliveries = {}
+        self._deliveries_lock = threading.Lock()
+        self.message_service.expiry_listeners.append(self._release)
+        # Open consumer streams, reported per stream by GetStats
+        self._streams = set()
+        metrics = self.message_service.metrics
+        self._groups = ConsumerGroups(self.message_service.storage.partitions, self._rebalanced)
+        self._rebalances = metrics.counter(
+            "broker_consumer_group_rebalances_total", "Partition reassignments of consumer groups", ["topic", "group"]
+        )
+        metrics.gauge(
+            "broker_consumer_group_members", "Streams in each consumer group", ["topic", "group"],
+            callback=self._groups.members,
+        )
+        metrics.gauge(
+            "broker_stream_delivery_lag_seconds",
+            "Time the last message delivered on a stream waited since it was enqueued", ["stream", "topic"],
+            callback=lambda: {(str(s.stream_id), s.topic): s.delivery_lag for s in list(self._streams)},
+        )
+        metrics.gauge(
+            "broker_stream_unacked_messages", "Messages delivered on a stream and not yet acked", ["stream", "topic"],
+            callback=lambda: {(str(s.stream_id), s.topic): len(s.unacked) for s in list(self._streams)},
+        )
+
+    def _release(self, message_id: str):
+        with self._deliveries_lock:
+            stream = self._deliveries.pop(message_id, None)
+        if stream is not None:
+            stream.release(message_id)
+
+    def _rebalanced(self, topic: str, group: str):
+        self._rebalances.inc(topic=topic, group=group)
+        # Waiting streams re-check with their new partitions
+        self.message_service.storage.wake(topic)
+
+    def _open_stream(self, stream: ConsumerStream):
+        self._streams.add(stream)
+        logger.debug("Consumer stream %s opened", stream.stream_id)
+
+    def _close_stream(self, stream: ConsumerStream):
+        stream.close()
+        if stream.group:
+            self._groups.leave(stream)
+        if stream in self._streams:
+            self._streams.discard(stream)
+            logger.debug("Consumer stream %s closed", stream.stream_id)
+        with self._deliveries_lock:
+            for message_id in list(stream.unacked):
+                if self._deliveries.get(message_id) is stream:
+                    del self._deliveries[message_id]
+
+    def _turned_away(self, context) -> bool:
+        """
+        True, with UNAVAILABLE set on the call, when this broker is a replica that is not
+        the leader. Clients find the leader through GetReplicaStatus.
+        """
+        if self.replication is None or self.replication.is_leader():
+            return False
+        context.set_code(grpc.StatusCode.UNAVAILABLE)
+        context.set_details(f"Not the leader, current leader: {self.replication.leader or 'unknown'}")
+        return True
+
+    def _unconfirmed(self, context, committed: bool) -> bool:
+        if committed:
+            return False
+        context.set_code(grpc.StatusCode.UNAVAILABLE)
+        context.set_details("Publish not confirmed by a quorum of replicas")
+        return True
 
     # ---- Producer API ----
     def Publish(self, request, context):
-        msg_id = self.message_service.produce(request.payload)
-        return broker_pb2.PublishResponse(message_id=str(msg_id))
+        if self._turned_away(context):
+            return broker_pb2.PublishResponse()
+        response, seq = self._publish(request, context)
+        if seq is not None and self.replication is not None:
+            if self._unconfirmed(context, self.replication.wait_for_quorum(seq)):
+                return broker_pb2.PublishResponse()
+        return response
+
+    def _publish(self, request, context):
+        """
+        The response and the persistence position the quorum has to reach, None when
+        nothing was written (a rejected publish or a duplicate).
+        """
+        try:
+            msg_id, seq = self.message_service.publish(
+                payload_from_proto(request), topic=request.topic, **publish_options(request)
+            )
+        except ValueError as e:
+            # Unknown compression codec, priority out of range or negative TTL
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return broker_pb2.PublishResponse(), None
+        return broker_pb2.PublishResponse(message_id=str(msg_id)), seq
+
+    def PublishBatch(self, request, context):
+        if self._turned_away(context):
+            return broker_pb2.PublishBatchResponse()
+        response, seq = self._publish_batch(request, context)
+        if seq is not None and self.replication is not None:
+            if self._unconfirmed(context, self.replication.wait_for_quorum(seq)):
+                return broker_pb2.PublishBatchResponse()
+        return response
+
+    def _publish_batch(self, request, context):
+        try:
+            msg_ids, seq = self.message_service.publish_batch(
+                [(payload_from_proto(item), item.topic, publish_options(item)) for item in request.messages]
+            )
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return broker_pb2.PublishBatchResponse(), None
+        return broker_pb2.PublishBatchResponse(
+            results=[broker_pb2.PublishResponse(message_id=str(msg_id)) for msg_id in msg_ids]
+        ), seq
 
     # ---- Streaming API (for consumers / API nodes) ----
     def MessageStream(self, request_iterator, context):
         """
         Bidirectional stream:
-          - Receives NodeMessage (acks, heartbeats) from API node
-          - Yields BrokerMessage when available
+          - Receives NodeMessage (subscribe, acks, heartbeats) from API node
+          - Pushes BrokerMessage of the subscribed topic as soon as messages are
+            enqueued, up to the stream's prefetch window; acks on the stream
+            refill the window. Pull streams get one message per credit granted
+            instead, and may release messages they did not use.
         """
-        for node_msg in request_iterator:
-            if node_msg.HasField("ack"):
-                self.message_service.acknowledge(node_msg.ack.message_id)
-            elif node_msg.HasField("heartbeat"):
-                # In production: update client liveness
-                pass
-
-            # For now: yield one message if available
-            message = self.message_service.consume()
-            if message:
-                yield message_to_proto(message)
+        if self._turned_away(context):
+            return
+        stream = ConsumerStream()
+        self._open_stream(stream)
+        context.add_callback(lambda: self._close_stream(stream))
+        reader = threading.Thread(
+            target=self._read_node_messages, args=(request_iterator, stream), daemon=True
+        )
+        reader.start()
+
+        while context.is_active() and not stream.closed:
+            if not stream.wait_for_credit(timeout=self.IDLE_WAIT):
+                continue
+            message = self.message_service.consume(stream.topic, stream.visibility_timeout, stream.partitions)
+            if message is None:
+                self.message_service.wait_for_messages(stream.topic, self.IDLE_WAIT, stream.partitions)
+                continue
+            stream.delivered(str(message.id), message.deliver_at or message.enqueued_at)
+            with self._deliveries_lock:
+                self._deliveries[str(message.id)] = stream
+            yield message_to_proto(
+                message,
+                visibility_timeout=stream.visibility_timeout or self.message_service.REQUEUE_TIMEOUT,
+            )
+
+    def _read_node_messages(self, request_iterator, stream: ConsumerStream):
+        try:
+            for node_msg in request_iterator:
+                self._handle_node_message(node_msg, stream)
+        except grpc.RpcError:
+            self._close_stream(stream)
+
+    def _handle_node_message(self, node_msg, stream: ConsumerStream):
+        if node_msg.HasField("subscribe"):
+            stream.subscribe(
+                topic=node_msg.subscribe.topic,
+                prefetch=node_msg.subscribe.prefetch or None,
+                visibility_timeout=node_msg.subscribe.visibility_timeout or None,
+                pull=node_msg.subscribe.pull,
+            )
+            if node_msg.subscribe.consumer_group:
+                self._groups.join(stream, stream.topic, node_msg.subscribe.consumer_group)
+            elif stream.group:
+                self._groups.leave(stream)
+            return
+        if not stream.subscribed:
+            # Clients that never subscribe read the default topic
+            stream.subscribe()
+        if node_msg.HasField("ack"):
+            self.message_service.acknowledge(node_msg.ack.message_id)
+            self._release(node_msg.ack.message_id)
+        elif node_msg.HasField("pull"):
+            stream.grant(node_msg.pull.credit)
+        elif node_msg.HasField("release"):
+            self.message_service.release(node_msg.release.message_id)
+            self._release(node_msg.release.message_id)
+        elif node_msg.HasField("touch"):
+            self.message_service.touch(
+                node_msg.touch.message_id, node_msg.touch.visibility_timeout or None
+            )
+        elif node_msg.HasField("heartbeat"):
+            # In production: update client liveness
+            pass
 
     # ---- Ack RPC (for REST /acknowledge) ----
     def Ack(self, request, context):
+        if self._turned_away(context):
+            return broker_pb2.AckResponse()
         success = self.message_service.acknowledge(request.message_id)
+        self._release(request.message_id)
         return broker_pb2.AckResponse(success=success)
 
+    def AckBatch(self, request, context):
+        if self._turned_away(context):
+            return broker_pb2.AckBatchResponse()
+        results = self.message_service.acknowledge_batch(request.message_ids)
+        for message_id in request.message_ids:
+            self._release(message_id)
+        return broker_pb2.AckBatchResponse(results=[
+            broker_pb2.AckResult(message_id=message_id, success=success)
+            for message_id, success in zip(request.message_ids, results)
+        ])
+
+    # ---- Visibility extension RPC (for REST /touch) ----
+    def Touch(self, request, context):
+        if self._turned_away(context):
+            return broker_pb2.TouchResponse()
+        success = self.message_service.touch(request.message_id, request.visibility_timeout or None)
+        return broker_pb2.TouchResponse(success=success)
+
     # ---- Dead letter queue ----
     def GetDeadLetter(self, request, context):
-        dead_msgs = self.message_service.get_dead_letter()
+        if self._turned_away(context):
+            return broker_pb2.DeadLetterResponse()
+        dead_msgs = self.message_service.get_dead_letter(request.topic or None)
         return broker_pb2.DeadLetterResponse(
             messages=[message_to_proto(m) for m in dead_msgs]
         )
 
+    def StreamDeadLetter(self, request, context):
+        """
+        Dead letter queue a page per response, so a queue of any size is never
+        serialized as a whole.
+        """
+        if self._turned_away(context):
+            return
+        yield from self._stream_pages(self.message_service.list_dead_letter, request, context)
+
+    def RedriveDeadLetter(self, request, context):
+        if self._turned_away(context):
+            return broker_pb2.RedriveResponse()
+        redriven = self.message_service.redrive_dead_letter(
+            request.topic or None, list(request.message_ids) or None, request.limit or None
+        )
+        return broker_pb2.RedriveResponse(redriven=redriven)
+
     # ---- Debug all messages ----
     def GetAllMessages(self, request, context):
-        all_msgs = self.message_service.get_all_messages()
+        if self._turned_away(context):
+            return broker_pb2.AllMessagesResponse()
+        all_msgs = self.message_service.get_all_messages(request.topic or None)
         return broker_pb2.AllMessagesResponse(
             messages=[message_to_proto(m) for m in all_msgs]
         )
 
+    def StreamAllMessages(self, request, context):
+        if self._turned_away(context):
+            return
+        yield from self._stream_pages(self.message_service.list_messages, request, context)
 
-def serve():
+    def _stream_pages(self, listing, request, context):
+        try:
+            pages = listing(request.topic or None, request.cursor, request.page_size or None, request.limit or None)
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return
+        for messages, next_cursor, end in pages:
+            yield broker_pb2.MessagePage(
+                messages=[message_to_proto(m) for m in messages], next_cursor=next_cursor, end=end
+            )
+
+    def ListTopics(self, request, context):
+        if self._turned_away(context):
+            return broker_pb2.TopicsResponse()
+        return broker_pb2.TopicsResponse(topics=self.message_service.get_topics())
+
+    # ---- Metrics ----
+    def GetStats(self, request, context):
+        metrics = self.message_service.metrics
+        return broker_pb2.StatsResponse(
+            text=metrics.render(),
+            samples=[
+                broker_pb2.MetricSample(name=name, labels=labels, value=value)
+                for name, labels, value in metrics.collect()
+            ],
+        )
+
+
+def serve(persistence_backend: str = "sqlite", port: int = 50051, data_path: str = None, replication: dict = None,
+          **service_options):
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    broker_pb2_grpc.add_BrokerServicer_to_server(BrokerServicer(), server)
-    server.add_insecure_port("[::]:50051")
+    servicer = BrokerServicer(persistence_backend, data_path, replication, **service_options)
+    broker_pb2_grpc.add_BrokerServicer_to_server(servicer, server)
+    if servicer.replication is not None:
+        broker_pb2_grpc.add_ReplicationServicer_to_server(ReplicationServicer(servicer.replication), server)
+    server.add_insecure_port(f"[::]:{port}")
     server.start()
-    print("Broker gRPC server started on :50051")
+    logger.info("Broker gRPC server started on :%s", port)
+    # A replica that lost its leadership exits so it can be restarted as a follower
+    deposed = threading.Event()
+    if servicer.replication is not None:
+        deposed = servicer.replication.deposed
+        servicer.replication.start()
     try:
-        while True:
-            time.sleep(86400)
+        while not deposed.wait(86400):
+            pass
     except KeyboardInterrupt:
-        server.stop(0)
+        pass
+    server.stop(0)
+    if deposed.is_set():
+        exit_deposed(servicer)
+
+
+def exit_deposed(servicer: BrokerServicer):
+    """
+    Ends the process of a replaced leader. Its queues are stale and handler threads may
+    still be blocked on them, so the process exits without waiting for them; it rejoins
+    as a follower when restarted.
+    """
+    servicer.message_service.persistence_service.close()
+    logging.shutdown()
+    os._exit(EXIT_DEPOSED)
 
 
 if __name__ == "__main__":
-    serve()
+    parser = argparse.ArgumentParser(description="Message queue broker")
+    parser.add_argument("--storage", choices=["sqlite", "log"], default="sqlite",
+                        help="persistence backend: sqlite database or append-only segment log")
+    parser.add_argument("--server", choices=["threaded", "aio"], default="threaded",
+                        help="threaded grpc.server or asyncio grpc.aio server")
+    parser.add_argument("--port", type=int, default=50051)
+    parser.add_argument("--data-path", default=None,
+                        help="sqlite database file or segment log directory (backend default if omitted)")
+    parser.add_argument("--compact-storage", action="store_true",
+                        help="keep queued messages in packed arrays instead of one object per message")
+    parser.add_argument("--max-queue-bytes", type=int, default=None,
+                        help="memory budget of each topic's queue, the rest is paged out to disk")
+    parser.add_argument("--spill-dir", default=MessageStorage.SPILL_DIR,
+                        help="directory for paged out messages")
+    parser.add_argument("--compression", default="none", choices=["none", "zlib", "lzma"],
+                        help="default codec for payloads above --compression-threshold")
+    parser.add_argument("--compression-threshold", type=int, default=DEFAULT_THRESHOLD,
+                        help="payloads smaller than this many bytes are stored uncompressed")
+    parser.add_argument("--topic-compression", action="append", default=[], metavar="TOPIC=CODEC",
+                        help="codec for one topic, overriding --compression (repeatable)")
+    parser.add_argument("--partitions", type=int, default=1,
+                        help="partitions per topic, keyed messages keep their order within one")
+    parser.add_argument("--max-dead-letter", type=int, default=MessageService.MAX_DEAD_LETTER,
+                        help="dead messages kept per topic, the oldest are dropped beyond (0 = unbounded)")
+    parser.add_argument("--dedup-window", type=float, default=MessageService.DEDUP_WINDOW,
+                        help="seconds a publish's idempotency key deduplicates retries of it")
+    parser.add_argument("--dedup-max-keys", type=int, default=MessageService.DEDUP_MAX_KEYS,
+                        help="idempotency keys kept in memory, the least recently used are dropped beyond")
+    parser.add_argument("--retention", default="", metavar="SPEC",
+                        help="default retention of acknowledged messages and TTL of queued ones, e.g. "
+                             "'max_age=7d,max_bytes=1G,ttl=1h' or 'delete_on_ack' (default: keep everything)")
+    parser.add_argument("--topic-retention", action="append", default=[], metavar="TOPIC=SPEC",
+                        help="retention for one topic, overriding --retention (repeatable)")
+    parser.add_argument("--shard", type=int, default=None,
+                        help="index of this broker when run as a shard by broker.supervisor")
+    parser.add_argument("--replicas", default=None, metavar="HOST:PORT,...",
+                        help="addresses of every broker of a replicated cluster, this one included, "
+                             "in the same order on all of them (see broker.cluster)")
+    parser.add_argument("--replica-id", type=int, default=0,
+                        help="index of this broker's address in --replicas")
+    parser.add_argument("--quorum", type=int, default=None,
+                        help="brokers, the leader included, that must have a publish before it is "
+                             "acknowledged (default: a majority; fewer can lose publishes on failover)")
+    parser.add_argument("--replica-state", default=None,
+                        help="file for this replica's election state (default: next to --data-path)")
+    parser.add_argument("--log-level", default="INFO",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=args.log_level,
+        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+    )
+    service_options = dict(
+        compact_storage=args.compact_storage,
+        max_queue_bytes=args.max_queue_bytes,
+        spill_dir=args.spill_dir,
+        compression=args.compression,
+        compression_threshold=args.compression_threshold,
+        topic_compression=dict(item.split("=", 1) for item in args.topic_compression),
+        partitions=args.partitions,
+        shard=args.shard,
+        max_dead_letter=args.max_dead_letter,
+        dedup_window=args.dedup_window,
+        dedup_max_keys=args.dedup_max_keys,
+        retention=args.retention,
+        topic_retention=dict(item.split("=", 1) for item in args.topic_retention),
+    )
+    replication = None
+    if args.replicas:
+        replicas = args.replicas.split(",")
+        replication = dict(
+            node=replicas[args.replica_id],
+            peers=replicas,
+            quorum=args.quorum,
+            state_path=args.replica_state or f"{args.data_path or 'broker'}.replica.json",
+        )
+    if args.server == "aio":
+        from broker.aio_broker import serve_aio
+        try:
+            asyncio.run(serve_aio(
+                persistence_backend=args.storage, port=args.port, data_path=args.data_path,
+                replication=replication, **service_options
+            ))
+        except KeyboardInterrupt:
+            pass
+    else:
+        serve(
+            persistence_backend=args.storage, port=args.port, data_path=args.data_path,
+            replication=replication, **service_options
+        )
@@ -0,0 +1,72 @@
+import argparse
+import logging
+import os
+import sys
+from typing import List
+
+from broker.supervisor import Supervisor
+
+logger = logging.getLogger(__name__)
+
+
+class Cluster(Supervisor):
+    '''
+    Runs a replicated broker cluster on one machine: `replicas` broker processes on
+    base_port .. base_port + replicas - 1 that elect a leader among themselves and
+    replicate its persistence log (see broker.replication). Every replica has its own
+    persistence file and election state in data_dir. Replicas that exit, a leader that
+    was replaced included, are restarted and rejoin as followers.
+    '''
+    WORKER = "Replica"
+
+    def __init__(self, replicas: int, base_port: int = 50051, data_dir: str = "./cluster",
+                 storage: str = "sqlite", worker_args: List[str] = None, quorum: int = None):
+        super().__init__(replicas, base_port, data_dir, storage, worker_args)
+        self.quorum = quorum
+
+    def port(self, replica: int) -> int:
+        return self.base_port + replica
+
+    def _command(self, replica: int) -> List[str]:
+        suffix = ".db" if self.storage == "sqlite" else ""
+        command = [
+            sys.executable, "-m", "broker.broker",
+            *self.worker_args,
+            "--storage", self.storage,
+            "--port", str(self.port(replica)),
+            "--data-path", os.path.join(self.data_dir, f"replica-{replica}{suffix}"),
+            "--spill-dir", os.path.join(self.data_dir, f"replica-{replica}.spill"),
+            "--replicas", ",".join(self.addresses),
+            "--replica-id", str(replica),
+        ]
+        if self.quorum:
+            command += ["--quorum", str(self.quorum)]
+        return command
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replicated broker cluster on localhost: one broker process per replica on --port and "
+                    "the following ports. Arguments not listed here (e.g. --compact-storage) are passed on "
+                    "to every replica.",
+    )
+    parser.add_argument("--replicas", type=int, default=3, help="number of broker processes")
+    parser.add_argument("--port", type=int, default=50051, help="port of the first replica")
+    parser.add_argument("--data-dir", default="./cluster", help="directory for the replicas' persistence files")
+    parser.add_argument("--storage", choices=["sqlite", "log"], default="sqlite")
+    parser.add_argument("--quorum", type=int, default=None,
+                        help="brokers that must have a publish before it is acknowledged (default: a majority)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args, worker_args = parser.parse_known_args()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    cluster = Cluster(args.replicas, args.port, args.data_dir, args.storage,
+                      worker_args + ["--log-level", args.log_level], args.quorum)
+    cluster.start()
+    logger.info("Replica addresses: BROKER_REPLICAS=%s", ",".join(cluster.addresses))
+    try:
+        cluster.monitor()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        cluster.stop()
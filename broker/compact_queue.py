@@ -0,0 +1,192 @@
+import threading
+from array import array
+from typing import Dict, Iterator, List
+from uuid import UUID
+
+from broker.compression import CODEC_IDS, CODECS
+from broker.models import Message
+
+# Payload kinds
+DATA_STR = 0
+DATA_BYTES = 1
+DATA_OBJECT = 2   # anything else, kept as a reference outside the arena
+
+# Message fields most messages leave at their default, only stored for the ones that set them
+SPARSE_FIELDS = ("partition_key", "idempotency_key", "deliver_at", "expires_at")
+
+
+class CompactMessageQueue:
+    '''
+    Ready queue of one topic and priority stored as parallel arrays instead of one Message object
+    per entry. Ids are packed as 16 raw bytes, payloads are appended to a shared bytes
+    arena and the remaining fields live in typed arrays, so a queued message costs
+    roughly 43 bytes plus its payload. SPARSE_FIELDS are kept in dicts for the messages
+    that set them, the partition is the queue's own.
+    Supports the deque operations MessageStorage uses (append, extend, popleft, [0],
+    len, iteration); Message objects are only built when a message leaves the queue.
+    Consumed entries are skipped with a head index and the arrays are compacted once
+    more than half of them is dead.
+    '''
+    COMPACT_MIN = 1024   # dead entries tolerated before compacting
+
+    def __init__(self, topic: str, priority: int = 0, partition: int = 0):
+        self.topic = topic
+        self.priority = priority
+        self.partition = partition
+        self._ids = bytearray()
+        self._enqueued_at = array("d")
+        self._retries = array("I")
+        self._states = array("B")
+        self._kinds = array("B")
+        self._encodings = array("B")   # CODEC_IDS of the payload's compression codec
+        self._offsets = array("Q")
+        self._lengths = array("I")
+        self._arena = bytearray()
+        self._arena_base = 0      # arena offset of _arena[0], offsets are absolute
+        self._objects: Dict[int, object] = {}   # absolute sequence -> non str/bytes payload
+        # field -> absolute sequence -> value, for the messages that set the field
+        self._sparse: Dict[str, Dict[int, object]] = {name: {} for name in SPARSE_FIELDS}
+        self._dropped = 0         # entries removed by compaction, turns indexes into sequences
+        self._head = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._states) - self._head
+
+    def __bool__(self) -> bool:
+        return len(self._states) > self._head
+
+    def __getitem__(self, index: int) -> Message:
+        with self._lock:
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError("queue index out of range")
+            return self._load(self._head + index)
+
+    def __iter__(self) -> Iterator[Message]:
+        # Copies the live part of every column under the lock, then builds the messages
+        # column-wise without going through _load for each entry
+        with self._lock:
+            head = self._head
+            ids = bytes(self._ids[head * 16:])
+            arena = bytes(self._arena)
+            base = self._arena_base
+            objects = dict(self._objects)
+            sparse = {name: dict(values) for name, values in self._sparse.items() if values}
+            first = self._dropped + head
+            columns = (
+                self._enqueued_at[head:], self._retries[head:], self._states[head:],
+                self._kinds[head:], self._encodings[head:], self._offsets[head:], self._lengths[head:],
+            )
+        topic, priority, partition = self.topic, self.priority, self.partition
+        messages = []
+        for i, (enqueued_at, retries, state, kind, encoding, offset, length) in enumerate(zip(*columns)):
+            seq = first + i
+            if kind == DATA_OBJECT:
+                data = objects[seq]
+            else:
+                data = arena[offset - base:offset - base + length]
+                if kind == DATA_STR:
+                    data = data.decode("utf-8")
+            messages.append(Message(
+                id=UUID(bytes=ids[i * 16:i * 16 + 16]),
+                data=data,
+                enqueued_at=enqueued_at or None,
+                retries=retries,
+                state=state,
+                topic=topic,
+                encoding=CODECS[encoding],
+                priority=priority,
+                partition=partition,
+                **{name: values[seq] for name, values in sparse.items() if seq in values},
+            ))
+        return iter(messages)
+
+    def append(self, message: Message):
+        with self._lock:
+            self._store(message)
+
+    def extend(self, messages: List[Message]):
+        with self._lock:
+            for message in messages:
+                self._store(message)
+
+    def popleft(self) -> Message:
+        with self._lock:
+            if self._head >= len(self._states):
+                raise IndexError("pop from an empty queue")
+            message = self._load(self._head)
+            seq = self._dropped + self._head
+            self._objects.pop(seq, None)
+            for values in self._sparse.values():
+                values.pop(seq, None)
+            self._head += 1
+            if self._head >= self.COMPACT_MIN and self._head * 2 >= len(self._states):
+                self._compact()
+            return message
+
+    def _store(self, message: Message):
+        seq = self._dropped + len(self._states)
+        data = message.data
+        if isinstance(data, str):
+            kind, payload = DATA_STR, data.encode("utf-8")
+        elif isinstance(data, (bytes, bytearray, memoryview)):
+            kind, payload = DATA_BYTES, data
+        else:
+            kind, payload = DATA_OBJECT, b""
+            self._objects[seq] = data
+        for name, values in self._sparse.items():
+            value = getattr(message, name)
+            if value:
+                values[seq] = value
+        self._ids += message.id.bytes
+        self._enqueued_at.append(message.enqueued_at or 0.0)
+        self._retries.append(message.retries)
+        self._states.append(int(message.state))
+        self._kinds.append(kind)
+        self._encodings.append(CODEC_IDS[message.encoding])
+        self._offsets.append(self._arena_base + len(self._arena))
+        self._lengths.append(len(payload))
+        self._arena += payload
+
+    def _load(self, index: int) -> Message:
+        seq = self._dropped + index
+        kind = self._kinds[index]
+        if kind == DATA_OBJECT:
+            data = self._objects[seq]
+        else:
+            start = self._offsets[index] - self._arena_base
+            data = bytes(self._arena[start:start + self._lengths[index]])
+            if kind == DATA_STR:
+                data = data.decode("utf-8")
+        return Message(
+            id=UUID(bytes=bytes(self._ids[index * 16:index * 16 + 16])),
+            data=data,
+            enqueued_at=self._enqueued_at[index] or None,
+            retries=self._retries[index],
+            state=self._states[index],
+            topic=self.topic,
+            encoding=CODECS[self._encodings[index]],
+            priority=self.priority,
+            partition=self.partition,
+            **{name: values[seq] for name, values in self._sparse.items() if seq in values},
+        )
+
+    def _compact(self):
+        head = self._head
+        if head == len(self._states):
+            arena_end = self._arena_base + len(self._arena)
+            del self._arena[:]
+            self._arena_base = arena_end
+        else:
+            del self._arena[:self._offsets[head] - self._arena_base]
+            self._arena_base = self._offsets[head]
+        del self._ids[:head * 16]
+        for column in (
+            self._enqueued_at, self._retries, self._states, self._kinds, self._encodings,
+            self._offsets, self._lengths,
+        ):
+            del column[:head]
+        self._dropped += head
+        self._head = 0
@@ -0,0 +1,83 @@
+import lzma
+import zlib
+from typing import Dict
+
+# Codec names as carried in Message.encoding and BrokerMessage.encoding, "" = uncompressed
+IDENTITY = ""
+ZLIB = "zlib"
+LZMA = "lzma"
+
+CODECS = (IDENTITY, ZLIB, LZMA)
+# Compact one byte ids used by the segment log and compact queues
+CODEC_IDS = {codec: i for i, codec in enumerate(CODECS)}
+# HTTP content codings of each codec, for Accept-Encoding / Content-Encoding
+HTTP_ENCODINGS = {ZLIB: "deflate", LZMA: "x-lzma"}
+
+ZLIB_LEVEL = 6
+DEFAULT_THRESHOLD = 1024  # bytes, smaller payloads are not worth compressing
+
+
+def compress(data: bytes, codec: str) -> bytes:
+    if codec == ZLIB:
+        return zlib.compress(data, ZLIB_LEVEL)
+    if codec == LZMA:
+        return lzma.compress(data)
+    if codec == IDENTITY:
+        return data
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == ZLIB:
+        return zlib.decompress(data)
+    if codec == LZMA:
+        return lzma.decompress(data)
+    if codec == IDENTITY:
+        return data
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def parse_codec(name: str) -> str:
+    '''
+    Maps a user supplied codec name ("none", "identity", "zlib", "lzma") to a codec.
+    '''
+    name = (name or "").strip().lower()
+    if name in ("", "none", "identity"):
+        return IDENTITY
+    if name not in CODECS:
+        raise ValueError(f"Unknown compression codec: {name}")
+    return name
+
+
+class CompressionPolicy:
+    '''
+    Decides which codec a published payload is compressed with: the codec requested
+    with the message, else the topic's codec, else the default. Payloads below
+    `threshold` bytes are stored as they are.
+    '''
+    def __init__(self, default_codec: str = IDENTITY, threshold: int = DEFAULT_THRESHOLD,
+                 topic_codecs: Dict[str, str] = None):
+        self.default_codec = parse_codec(default_codec)
+        self.threshold = threshold
+        self.topic_codecs = {topic: parse_codec(codec) for topic, codec in (topic_codecs or {}).items()}
+
+    def codec_for(self, topic: str, requested: str = None) -> str:
+        if requested:
+            return parse_codec(requested)
+        return self.topic_codecs.get(topic, self.default_codec)
+
+    def apply(self, data, topic: str, requested: str = None):
+        '''
+        Returns (payload, codec, raw size). Compressed payloads are bytes, text is
+        compressed as UTF-8; payloads that do not get smaller are kept uncompressed.
+        '''
+        codec = self.codec_for(topic, requested)
+        if codec == IDENTITY or not isinstance(data, (str, bytes, bytearray, memoryview)):
+            return data, IDENTITY, 0
+        raw = data.encode("utf-8") if isinstance(data, str) else bytes(data)
+        if len(raw) < self.threshold:
+            return data, IDENTITY, len(raw)
+        compressed = compress(raw, codec)
+        if len(compressed) >= len(raw):
+            return data, IDENTITY, len(raw)
+        return compressed, codec, len(raw)
@@ -0,0 +1,70 @@
+import logging
+import threading
+from typing import Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ConsumerGroups:
+    '''
+    Partition assignment of consumer groups.
+    The streams of a group subscribed to a topic share its partitions: member i of n
+    (ordered by join time) owns the partitions p with p % n == i, so every partition
+    has exactly one owner in the group and keyed messages are consumed in order.
+    Partitions are reassigned whenever a member joins or leaves. Streams outside any
+    group read every partition.
+    `on_rebalance(topic, group)` is called after the members got their new partitions.
+    '''
+    def __init__(self, partitions: int, on_rebalance: Callable[[str, str], None] = None):
+        self.partitions = partitions
+        self.on_rebalance = on_rebalance
+        self._members: Dict[Tuple[str, str], List] = {}
+        self._lock = threading.Lock()
+
+    def join(self, stream, topic: str, group: str):
+        with self._lock:
+            # A stream re-subscribing elsewhere hands its partitions back to its old group
+            old = self._remove(stream)
+            if old == (topic, group):
+                old = None
+            stream.group = group
+            self._members.setdefault((topic, group), []).append(stream)
+            if old is not None:
+                self._rebalance(*old)
+            self._rebalance(topic, group)
+        if old is not None:
+            self._rebalanced(*old)
+        self._rebalanced(topic, group)
+
+    def leave(self, stream):
+        with self._lock:
+            key = self._remove(stream)
+            stream.group = ""
+            stream.assign(None)
+            if key is not None:
+                self._rebalance(*key)
+        if key is not None:
+            self._rebalanced(*key)
+
+    def members(self) -> Dict[Tuple[str, str], int]:
+        with self._lock:
+            return {key: len(members) for key, members in self._members.items()}
+
+    def _remove(self, stream) -> Tuple[str, str] | None:
+        for key, members in self._members.items():
+            if stream in members:
+                members.remove(stream)
+                if not members:
+                    del self._members[key]
+                return key
+        return None
+
+    def _rebalance(self, topic: str, group: str):
+        members = self._members.get((topic, group), [])
+        for i, member in enumerate(members):
+            member.assign([p for p in range(self.partitions) if p % len(members) == i])
+        logger.info("Rebalanced group %s of topic %s over %d members", group, topic, len(members))
+
+    def _rebalanced(self, topic: str, group: str):
+        if self.on_rebalance is not None:
+            self.on_rebalance(topic, group)
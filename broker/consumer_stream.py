@@ -0,0 +1,139 @@
+import asyncio
+import itertools
+import threading
+import time
+from typing import List, Set
+
+from broker.models import DEFAULT_TOPIC
+
+
+class ConsumerStream:
+    '''
+    Flow control state of one consumer stream.
+    The broker may push up to `prefetch` unacknowledged messages, every message
+    delivered on this stream that is acked (on any path) or expires hands one
+    credit back.
+    A stream subscribed with pull ignores the window and only gets the messages it
+    asks for: every Pull frame adds (or takes back) credit, every delivery uses one.
+    Nothing is delivered until the stream is subscribed, so the first frame from the
+    client decides which topic it reads. Streams in a consumer group only read the
+    partitions assigned to them (see ConsumerGroups), the others read every partition.
+    '''
+    DEFAULT_PREFETCH = 1
+    _ids = itertools.count(1)
+
+    def __init__(self):
+        self.stream_id = next(self._ids)
+        self.topic = DEFAULT_TOPIC
+        self.prefetch = self.DEFAULT_PREFETCH
+        self.visibility_timeout = None
+        self.subscribed = False
+        self.pull = False
+        # Credit granted with Pull frames minus messages delivered since. Goes negative when
+        # the client takes back credit the broker already used.
+        self.pull_credit = 0
+        self.group = ""
+        self.partitions: List[int] | None = None   # None = every partition
+        self.unacked: Set[str] = set()
+        self.closed = False
+        self.delivery_lag = 0.0   # seconds the last delivered message waited since it was enqueued
+        self._cond = threading.Condition()
+
+    @property
+    def credit(self) -> int:
+        if self.pull:
+            return self.pull_credit
+        return self.prefetch - len(self.unacked)
+
+    def subscribe(self, topic: str = None, prefetch: int = None, visibility_timeout: float = None,
+                  pull: bool = False):
+        with self._cond:
+            self.topic = topic or DEFAULT_TOPIC
+            if prefetch is not None:
+                self.prefetch = max(prefetch, 0)
+            self.visibility_timeout = visibility_timeout
+            self.pull = pull
+            self.subscribed = True
+            self._changed()
+
+    def grant(self, credit: int):
+        '''
+        Adds credit to a pull stream, a negative grant takes credit back.
+        '''
+        with self._cond:
+            self.pull_credit += credit
+            self._changed()
+
+    def assign(self, partitions: List[int] | None):
+        with self._cond:
+            self.partitions = partitions
+            self._changed()
+
+    def wait_for_credit(self, timeout: float = None) -> bool:
+        '''
+        Blocks until the stream may receive another message.
+        Returns False if the timeout expired or the stream was closed.
+        '''
+        with self._cond:
+            self._cond.wait_for(lambda: self.closed or self._can_deliver(), timeout)
+            return not self.closed and self._can_deliver()
+
+    def _can_deliver(self) -> bool:
+        return self.subscribed and self.credit > 0
+
+    def delivered(self, message_id: str, enqueued_at: float = None):
+        with self._cond:
+            self.unacked.add(message_id)
+            if self.pull:
+                self.pull_credit -= 1
+            if enqueued_at:
+                self.delivery_lag = time.time() - enqueued_at
+
+    def release(self, message_id: str) -> bool:
+        '''
+        Hands back the credit of a delivered message once it is acked, expired or dead lettered.
+        '''
+        with self._cond:
+            if message_id not in self.unacked:
+                return False
+            self.unacked.discard(message_id)
+            self._changed()
+            return True
+
+    def _changed(self):
+        # Called with the lock held whenever credit, subscription or closed state changed
+        self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._changed()
+
+
+class AsyncConsumerStream(ConsumerStream):
+    '''
+    ConsumerStream for the asyncio server, waiting for credit costs a coroutine
+    instead of a thread. Credit may be handed back from other threads (the expiry
+    worker), so wake-ups are scheduled on the stream's event loop.
+    '''
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        super().__init__()
+        self._loop = loop
+        self._credit_changed = asyncio.Event()
+
+    def _changed(self):
+        super()._changed()
+        self._loop.call_soon_threadsafe(self._credit_changed.set)
+
+    async def wait_for_credit_async(self) -> bool:
+        '''
+        Waits until the stream may receive another message, False once it is closed.
+        '''
+        while True:
+            with self._cond:
+                if self.closed:
+                    return False
+                if self._can_deliver():
+                    return True
+                self._credit_changed.clear()
+            await self._credit_changed.wait()
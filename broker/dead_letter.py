@@ -0,0 +1,107 @@
+import bisect
+import threading
+from typing import Dict, Iterator, List, Tuple
+from uuid import UUID
+
+from broker.models import Message
+
+
+class DeadLetterQueue:
+    '''
+    Dead letter store of one topic, holding at most `max_messages` (unbounded when None);
+    adding beyond that drops the oldest messages.
+    Messages are numbered in the order they arrive. The number is their position in
+    listings, so a listing resumes at the right place while messages are added, redriven
+    or dropped. Adding, removing and finding a message by id are O(1), reading n messages
+    after a position is O(log size + n).
+    '''
+    COMPACT_MIN = 1024  # removed positions kept in the order list before it is rebuilt
+
+    def __init__(self, max_messages: int = None):
+        self.max_messages = max_messages
+        self._messages: Dict[int, Message] = {}   # position -> message, in position order
+        self._positions: Dict[UUID, int] = {}
+        # Positions in ascending order for seeking. Removed ones are skipped and only
+        # dropped once they outnumber the live ones; everything before _head is removed.
+        self._order: List[int] = []
+        self._head = 0
+        self._next_position = 1
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __contains__(self, message_id: UUID) -> bool:
+        return message_id in self._positions
+
+    def __iter__(self) -> Iterator[Message]:
+        with self._lock:
+            return iter(list(self._messages.values()))
+
+    def add(self, message: Message) -> List[Message] | None:
+        '''
+        Appends a message. Returns the oldest messages dropped to stay within
+        max_messages, None if the message is already in the queue.
+        '''
+        with self._lock:
+            if message.id in self._positions:
+                return None
+            position = self._next_position
+            self._next_position += 1
+            self._messages[position] = message
+            self._positions[message.id] = position
+            self._order.append(position)
+            dropped = []
+            while self.max_messages and len(self._messages) > self.max_messages:
+                dropped.append(self._pop(self._oldest()))
+            self._compact()
+            return dropped
+
+    def remove(self, message_id: UUID) -> Message | None:
+        with self._lock:
+            position = self._positions.get(message_id)
+            if position is None:
+                return None
+            message = self._pop(position)
+            self._compact()
+            return message
+
+    def take(self, count: int) -> List[Message]:
+        '''
+        Removes and returns up to `count` messages, oldest first.
+        '''
+        with self._lock:
+            taken = []
+            while len(taken) < count and self._messages:
+                taken.append(self._pop(self._oldest()))
+            self._compact()
+            return taken
+
+    def after(self, position: int, count: int) -> List[Tuple[int, Message]]:
+        '''
+        Up to `count` (position, message) pairs following `position`, in order.
+        '''
+        with self._lock:
+            i = bisect.bisect_right(self._order, position, self._head)
+            found = []
+            while i < len(self._order) and len(found) < count:
+                message = self._messages.get(self._order[i])
+                if message is not None:
+                    found.append((self._order[i], message))
+                i += 1
+            return found
+
+    def _pop(self, position: int) -> Message:
+        message = self._messages.pop(position)
+        del self._positions[message.id]
+        return message
+
+    def _oldest(self) -> int:
+        while self._order[self._head] not in self._messages:
+            self._head += 1
+        return self._order[self._head]
+
+    def _compact(self):
+        if len(self._order) > max(2 * len(self._messages), self.COMPACT_MIN):
+            self._order = [position for position in self._order[self._head:] if position in self._messages]
+            self._head = 0
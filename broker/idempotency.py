@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+from typing import Tuple
+from uuid import UUID
+
+
+class IdempotencyCache:
+    '''
+    Message ids of recent publishes by (topic, idempotency key), so a producer that
+    retries a publish gets the first publish's id back instead of a duplicate.
+    A key is remembered for `window` seconds after its publish; at most `max_keys`
+    are kept, the least recently used going first. Lookups, inserts and evictions are
+    O(1): entries are kept in recency order and only the oldest end is ever trimmed.
+    '''
+    def __init__(self, window: float, max_keys: int):
+        self.window = window
+        self.max_keys = max_keys
+        # (topic, key) -> (message id, published at), least recently used first
+        self._entries: OrderedDict[Tuple[str, str], Tuple[UUID, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0   # keys dropped for room before their window ended
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def claim(self, topic: str, key: str, message_id: UUID, now: float) -> UUID:
+        '''
+        Records `message_id` as the publish of the key unless the key was published within
+        the window, and returns the id that owns the key: `message_id` or the earlier one.
+        '''
+        with self._lock:
+            entry = self._entries.get((topic, key))
+            if entry is not None and entry[1] > now - self.window:
+                self._entries.move_to_end((topic, key))
+                return entry[0]
+            self._insert(topic, key, message_id, now)
+            self._trim(now)
+            return message_id
+
+    def restore(self, topic: str, key: str, message_id: UUID, published_at: float):
+        '''
+        Adds a key published earlier, e.g. reloaded from persistence after a restart.
+        Keys should be restored oldest first.
+        '''
+        with self._lock:
+            self._insert(topic, key, message_id, published_at)
+            self._trim(published_at)
+
+    def _insert(self, topic: str, key: str, message_id: UUID, published_at: float):
+        self._entries[(topic, key)] = (message_id, published_at)
+        self._entries.move_to_end((topic, key))
+
+    def _trim(self, now: float):
+        while self._entries:
+            _, published_at = next(iter(self._entries.values()))
+            if published_at > now - self.window and len(self._entries) <= self.max_keys:
+                return
+            if published_at > now - self.window:
+                self.evicted += 1
+            self._entries.popitem(last=False)
@@ -0,0 +1,49 @@
+from typing import Iterable, Iterator, List, Tuple
+from urllib.parse import quote, unquote
+
+from broker.models import Message
+
+# Listings (StreamDeadLetter, StreamAllMessages) walk topics in name order. A cursor
+# is "<quoted topic>:<position>" and resumes the listing after that position of the
+# topic; what a position counts is up to the listing.
+
+
+def encode_cursor(topic: str, position: int) -> str:
+    return f"{quote(topic, safe='')}:{position}"
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    '''
+    (topic, position) of a cursor, ("", 0) for the empty cursor.
+    Raises ValueError for anything that is not a cursor.
+    '''
+    if not cursor:
+        return "", 0
+    topic, sep, position = cursor.rpartition(":")
+    if not sep or not position.isdigit():
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return unquote(topic), int(position)
+
+
+def paginate(entries: Iterable[Tuple[str, Message]], cursor: str, page_size: int,
+             limit: int = None) -> Iterator[Tuple[List[Message], str, bool]]:
+    '''
+    Groups (cursor, message) entries, each cursor resuming after its message, into pages
+    of up to page_size messages, yielded as (messages, next_cursor, end). end is True on
+    the page after which there were no entries left. Stops after `limit` messages when
+    given. Reads one entry ahead and always yields at least one, possibly empty, page.
+    '''
+    entries = iter(entries)
+    item = next(entries, None)
+    remaining = limit or None
+    while True:
+        page = []
+        while item is not None and len(page) < page_size and remaining != 0:
+            cursor, message = item
+            page.append(message)
+            if remaining is not None:
+                remaining -= 1
+            item = next(entries, None)
+        yield page, cursor, item is None
+        if item is None or remaining == 0:
+            return
@@ -1,72 +1,635 @@
+from broker.compression import DEFAULT_THRESHOLD, IDENTITY, CompressionPolicy
+from broker.idempotency import IdempotencyCache
+from broker.listing import decode_cursor, paginate
 from broker.message_storage import MessageStorage
-from broker.models import Message
+from broker.metrics import MetricsRegistry
+from broker.models import DEFAULT_TOPIC, MAX_PRIORITY, Message, MessageState
 from broker.persistence_service import PersistenceService
-from uuid import uuid4, UUID
+from broker.retention import RetentionPolicies
+from broker.segment_log import LogPersistenceService
+from broker.sharding import new_message_id
+from collections import Counter
+from dataclasses import dataclass
+from typing import Tuple
+from uuid import UUID
+import logging
 import time
 
 import threading
 
+logger = logging.getLogger(__name__)
+
+PERSISTENCE_BACKENDS = {
+    "sqlite": PersistenceService,
+    "log": LogPersistenceService,
+}
+
+
+@dataclass
+class RecoveryProgress:
+    '''
+    Progress of replaying the persisted backlog into storage after a restart. A backlog
+    paged in on demand is done once every topic is loaded up to its memory budget,
+    `replayed` keeps counting as the rest comes in.
+    '''
+    total: int = 0          # unacknowledged messages found when the replay started
+    replayed: int = 0
+    started_at: float = None
+    finished_at: float = None
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def to_dict(self):
+        return {
+            "total": self.total,
+            "replayed": self.replayed,
+            "done": self.done,
+            "seconds": ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0,
+        }
+
+
 class MessageService:
-    REQUEUE_TIMEOUT = 30  # seconds
+    REQUEUE_TIMEOUT = 30  # seconds, default visibility timeout of a delivered message
     MAX_RETRIES = 3
+    RETRY_BACKOFF = 1.0  # seconds before the first redelivery, doubled with every retry
+    RETRY_BACKOFF_MAX = 60.0
+
+    REPLAY_BATCH = 1000  # messages enqueued at a time while replaying the backlog
+    REPLAY_LOG_INTERVAL = 5.0  # seconds between recovery progress log lines
+    PAGE_IN_BATCH = 100  # messages of a paged backlog read at a time, small enough to stay within budget
+    REPLAY_ROOM_WAIT = 1.0  # seconds a paged backlog waits for consumers before re-checking for room
+
+    MAX_DEAD_LETTER = 100000  # dead messages kept per topic, the oldest are dropped beyond
+    REDRIVE_BATCH = 1000      # dead messages moved back and persisted at a time
+    LIST_PAGE = 100           # default page size of listings
+    MAX_LIST_PAGE = 1000
+
+    DEDUP_WINDOW = 300.0      # seconds a publish's idempotency key deduplicates retries
+    DEDUP_MAX_KEYS = 100000   # idempotency keys kept in memory, least recently used dropped beyond
+
+    TTL_SWEEP_INTERVAL = 1.0  # seconds between sweeps dropping expired messages from the ready queues
 
-    def __init__(self):
-        self.storage = MessageStorage()
-        self.persistence_service = PersistenceService(is_async=True)
-        # Load unacknowledged messages from persistence
-        unacknowledged_messages = self.persistence_service.get_unacknowledged_messages()
-        for msg in unacknowledged_messages:
-            self.storage.enqueue(msg)
+    def __init__(self, persistence_backend: str = "sqlite", data_path: str = None, compact_storage: bool = False,
+                 max_queue_bytes: int = None, spill_dir: str = MessageStorage.SPILL_DIR,
+                 background_replay: bool = True, compression: str = IDENTITY,
+                 compression_threshold: int = DEFAULT_THRESHOLD, topic_compression: dict = None,
+                 partitions: int = 1, shard: int = None, replay: bool = True,
+                 max_dead_letter: int = MAX_DEAD_LETTER, dedup_window: float = DEDUP_WINDOW,
+                 dedup_max_keys: int = DEDUP_MAX_KEYS, retention: str = "", topic_retention: dict = None):
+        # Index of this broker in a multi-process broker, encoded into every message id
+        self.shard = shard
+        self.storage = MessageStorage(
+            compact=compact_storage, max_queue_bytes=max_queue_bytes, spill_dir=spill_dir, partitions=partitions,
+            max_dead_letter=max_dead_letter or None,
+        )
+        # Payloads are compressed once here and stay compressed in storage, persistence and delivery
+        self.compression = CompressionPolicy(compression, compression_threshold, topic_compression)
+        # Publishes with an idempotency key seen within the window return the first message's id
+        self.idempotency = IdempotencyCache(dedup_window, dedup_max_keys)
+        # What persistence keeps of acknowledged messages and the default TTL of each topic
+        self.retention = RetentionPolicies(retention, topic_retention)
+        self.metrics = MetricsRegistry()
+        self._setup_metrics()
+        persistence_class = PERSISTENCE_BACKENDS[persistence_backend]
+        if data_path:
+            # sqlite database file or segment log directory
+            self.persistence_service = persistence_class(
+                True, data_path, metrics=self.metrics, key_retention=dedup_window, retention=self.retention
+            )
+        else:
+            self.persistence_service = persistence_class(
+                is_async=True, metrics=self.metrics, key_retention=dedup_window, retention=self.retention
+            )
+        self.storage.ttl_listeners.append(self._drop_expired)
+        self.recovery = RecoveryProgress()
+        self._recovered = threading.Event()
+        # Replicas only load the backlog once they become the leader (see broker.replication)
+        if replay:
+            self.recover(background_replay)
+        # Called with the message id whenever an in-flight message expires
+        self.expiry_listeners = []
         self.requeue_thread = threading.Thread(target=self._requeue_worker, daemon=True)
         self.requeue_thread.start()
-        
+        self.delay_thread = threading.Thread(target=self._delay_worker, daemon=True, name="delay")
+        self.delay_thread.start()
+        self.ttl_thread = threading.Thread(target=self._ttl_worker, daemon=True, name="ttl")
+        self.ttl_thread.start()
+
+    def _setup_metrics(self):
+        self.metrics.gauge(
+            "broker_recovery_messages", "Backlog replay after a restart: total and replayed messages", ["stage"],
+            callback=lambda: {("total",): self.recovery.total, ("replayed",): self.recovery.replayed},
+        )
+        self.metrics.gauge(
+            "broker_recovery_done", "1 once the persisted backlog has been replayed",
+            callback=lambda: {(): int(self.recovery.done)},
+        )
+        self._published = self.metrics.counter(
+            "broker_messages_published_total", "Messages enqueued by producers", ["topic"]
+        )
+        self._delivered = self.metrics.counter(
+            "broker_messages_delivered_total", "Messages handed to consumers", ["topic"]
+        )
+        self._acked = self.metrics.counter(
+            "broker_messages_acked_total", "Acknowledgements of in-flight messages"
+        )
+        self._requeued = self.metrics.counter(
+            "broker_messages_requeued_total", "In-flight messages requeued after their visibility timeout", ["topic"]
+        )
+        self._released = self.metrics.counter(
+            "broker_messages_released_total", "Deliveries handed back unused by pull consumers"
+        )
+        self._dead_lettered = self.metrics.counter(
+            "broker_messages_dead_lettered_total", "Messages moved to the dead letter queue", ["topic"]
+        )
+        self._dead_letter_dropped = self.metrics.counter(
+            "broker_dead_letter_dropped_total", "Oldest dead messages dropped to keep the queue in bounds", ["topic"]
+        )
+        self._expired = self.metrics.counter(
+            "broker_messages_expired_total", "Messages dropped undelivered once their time to live ran out", ["topic"]
+        )
+        self._redriven = self.metrics.counter(
+            "broker_messages_redriven_total", "Dead messages moved back to their topic's queue", ["topic"]
+        )
+        self._duplicates = self.metrics.counter(
+            "broker_publish_duplicates_total", "Publishes answered with the id of an earlier one with the same key",
+            ["topic"],
+        )
+        self.metrics.gauge(
+            "broker_idempotency_keys", "Idempotency keys held for deduplication",
+            callback=lambda: {(): len(self.idempotency)},
+        )
+        self.metrics.gauge(
+            "broker_idempotency_evicted_keys", "Idempotency keys dropped for room before their window ended",
+            callback=lambda: {(): self.idempotency.evicted},
+        )
+        self._delivery_lag = self.metrics.histogram(
+            "broker_delivery_lag_seconds", "Time from enqueue until a message is delivered", ["topic"]
+        )
+        self._compressed = self.metrics.counter(
+            "broker_messages_compressed_total", "Published payloads stored compressed", ["encoding"]
+        )
+        self._compression_raw_bytes = self.metrics.counter(
+            "broker_compression_raw_bytes_total", "Size of compressed payloads before compression", ["encoding"]
+        )
+        self._compression_stored_bytes = self.metrics.counter(
+            "broker_compression_stored_bytes_total", "Size of compressed payloads as stored", ["encoding"]
+        )
+        self.metrics.gauge(
+            "broker_compression_ratio", "Stored / raw bytes of compressed payloads", ["encoding"],
+            callback=lambda: {
+                (encoding,): self._compression_stored_bytes.value(encoding=encoding) / raw
+                for (encoding,), raw in self._compression_raw_bytes.values().items() if raw
+            },
+        )
+        # Sizes are read from storage when metrics are collected, not tracked per operation
+        self.metrics.gauge(
+            "broker_queue_depth", "Messages waiting to be delivered", ["topic"],
+            callback=lambda: {(name,): t.ready_count() for name, t in list(self.storage.topics.items())},
+        )
+        self.metrics.gauge(
+            "broker_spilled_messages", "Queued messages paged out to disk", ["topic"],
+            callback=lambda: {
+                (name,): t.spilled_count() for name, t in list(self.storage.topics.items())
+                if self.storage.max_queue_bytes
+            },
+        )
+        self.metrics.gauge(
+            "broker_delayed_messages", "Messages scheduled for later delivery", ["topic"],
+            callback=lambda: {(name,): t.delayed for name, t in list(self.storage.topics.items())},
+        )
+        self.metrics.gauge(
+            "broker_inflight_messages", "Delivered messages waiting for an ack", ["topic"],
+            callback=lambda: {(name,): t.in_flight_count() for name, t in list(self.storage.topics.items())},
+        )
+        self.metrics.gauge(
+            "broker_dead_letter_messages", "Messages in the dead letter queue", ["topic"],
+            callback=lambda: {(name,): len(t.dead_letter) for name, t in list(self.storage.topics.items())},
+        )
+
+    def recover(self, background: bool = True):
+        '''
+        Reloads the idempotency keys of recent publishes, then replays unacknowledged
+        messages from persistence in batches. In the background the broker serves publishes
+        and consumers while the backlog is still loading, the replay only covers what was
+        persisted before this point.
+        With a memory budget (max_queue_bytes) and a backend that reads each topic's backlog
+        on its own, a topic is only replayed while its ready queues have room, the rest of
+        it stays in persistence and is paged in as its consumers catch up.
+        '''
+        # Keys are loaded before anything is served, a retry right after a restart is still caught
+        for topic, key, message_id, published_at in self.persistence_service.iter_idempotency_keys():
+            self.idempotency.restore(topic, key, message_id, published_at)
+        self.recovery = RecoveryProgress(
+            total=self.persistence_service.count_unacknowledged_messages(), started_at=time.time()
+        )
+        self._next_replay_log = time.monotonic() + self.REPLAY_LOG_INTERVAL
+        backlogs = None
+        if self.storage.max_queue_bytes:
+            backlogs = self.persistence_service.iter_topic_backlogs(self.PAGE_IN_BATCH)
+        if backlogs is not None:
+            # Never finishes while a topic's tail waits for room, so always on its own thread
+            self.replay_thread = threading.Thread(
+                target=self._replay_backlogs, args=(backlogs,), daemon=True, name="replay"
+            )
+            self.replay_thread.start()
+            if not background:
+                self._recovered.wait()
+            return
+        batches = self.persistence_service.iter_unacknowledged_batches(self.REPLAY_BATCH)
+        if background:
+            self.replay_thread = threading.Thread(target=self._replay, args=(batches,), daemon=True, name="replay")
+            self.replay_thread.start()
+        else:
+            self._replay(batches)
+
+    def _replay(self, batches):
+        logger.info("Replaying %d unacknowledged messages", self.recovery.total)
+        for batch in batches:
+            self._replay_batch(batch)
+        self._finish_recovery()
+
+    def _replay_backlogs(self, backlogs):
+        '''
+        Replays every topic from its own cursor, a batch at a time while the topic has room.
+        Recovery counts as finished once every topic is loaded up to its memory budget.
+        '''
+        logger.info("Replaying %d unacknowledged messages of %d topics", self.recovery.total, len(backlogs))
+        for topic in backlogs:
+            self.storage.topic(topic).backlog = True
+        while backlogs:
+            progressed = False
+            for topic, batches in list(backlogs.items()):
+                queue = self.storage.topic(topic)
+                while queue.has_room():
+                    batch = next(batches, None)
+                    if batch is None:
+                        queue.backlog = False
+                        del backlogs[topic]
+                        break
+                    self._replay_batch(batch)
+                    progressed = True
+            if backlogs and not progressed:
+                if not self._recovered.is_set():
+                    self._finish_recovery()
+                    logger.info("Paging in the rest of %d topics as they are consumed", len(backlogs))
+                self.storage.wait_for_room(self.REPLAY_ROOM_WAIT)
+        if not self._recovered.is_set():
+            self._finish_recovery()
+
+    def _replay_batch(self, batch):
+        live = []
+        for message in batch:
+            if message.state == MessageState.DEAD_LETTERED.value:
+                self._drop_dead(message.topic, self.storage.add_to_dead_letter(message))
+            else:
+                live.append(message)
+        self.storage.enqueue_many(live)
+        self.recovery.replayed += len(batch)
+        if time.monotonic() >= self._next_replay_log:
+            self._next_replay_log = time.monotonic() + self.REPLAY_LOG_INTERVAL
+            logger.info("Recovery progress: %d/%d messages replayed", self.recovery.replayed, self.recovery.total)
+
+    def _finish_recovery(self):
+        self.recovery.finished_at = time.time()
+        self._recovered.set()
+        logger.info(
+            "Recovery finished: %d messages replayed in %.1fs",
+            self.recovery.replayed, self.recovery.finished_at - self.recovery.started_at,
+        )
+
+    def wait_for_recovery(self, timeout: float = None) -> bool:
+        '''
+        Blocks until the persisted backlog has been replayed, False if the timeout expired first.
+        '''
+        return self._recovered.wait(timeout)
+
     def _requeue_worker(self):
-        print("Requeue worker started")
+        '''
+        Sleeps until the earliest in-flight deadline and handles exactly the messages
+        that expired: requeued for another attempt, or dead lettered once they ran
+        out of retries.
+        '''
+        logger.debug("Requeue worker started")
         while True:
-            self._bg_requeue_inflight()
-            self._bg_cleanup_inflight()
-            time.sleep(5)
-    
-    def produce(self, data: object) -> UUID:
-        message = Message(id=uuid4(), data=data, enqueued_at=time.time())
+            for msg_id in self.storage.wait_for_expired():
+                self._expire_inflight(msg_id)
+
+    def _delay_worker(self):
+        '''
+        Sleeps until the earliest scheduled delivery and moves the due messages to their
+        topics' ready queues.
+        '''
+        logger.debug("Delay worker started")
+        while True:
+            self.storage.enqueue_many(self.storage.wait_for_due())
+
+    def _ttl_worker(self):
+        '''
+        Drops expired messages from the heads of the ready queues every TTL_SWEEP_INTERVAL,
+        so they do not sit in memory until a consumer comes along.
+        '''
+        logger.debug("TTL worker started")
+        while True:
+            time.sleep(self.TTL_SWEEP_INTERVAL)
+            self.storage.expire_ready()
+
+    def _drop_expired(self, messages):
+        # Expired messages are gone for good, they are persisted like acks
+        self.persistence_service.ack_messages([str(message.id) for message in messages])
+        for topic, count in Counter(message.topic for message in messages).items():
+            self._expired.inc(count, topic=topic)
+            logger.debug("Dropped %d expired messages of topic %s", count, topic)
+
+    def _new_message(self, data: object, topic: str, enqueued_at: float, compression: str = None,
+                     priority: int = 0, deliver_at: float = None, partition_key: str = None,
+                     idempotency_key: str = None, ttl: float = None) -> Message:
+        topic = topic or DEFAULT_TOPIC
+        if not 0 <= priority <= MAX_PRIORITY:
+            raise ValueError(f"Priority must be between 0 and {MAX_PRIORITY}, got {priority}")
+        if ttl is not None and ttl < 0:
+            raise ValueError(f"TTL must not be negative, got {ttl}")
+        ttl = self.retention.ttl_for(topic, ttl)
+        data, encoding, raw_size = self.compression.apply(data, topic, compression)
+        if encoding:
+            self._compressed.inc(encoding=encoding)
+            self._compression_raw_bytes.inc(raw_size, encoding=encoding)
+            self._compression_stored_bytes.inc(len(data), encoding=encoding)
+        if deliver_at is not None and deliver_at <= enqueued_at:
+            deliver_at = None
+        return Message(
+            id=new_message_id(self.shard), data=data, enqueued_at=enqueued_at, topic=topic, encoding=encoding,
+            priority=priority, deliver_at=deliver_at, partition_key=partition_key or "",
+            idempotency_key=idempotency_key or "", expires_at=enqueued_at + ttl if ttl is not None else None,
+        )
+
+    def _claim(self, message: Message) -> UUID:
+        '''
+        Id the publish of `message` resolves to: its own, or that of an earlier publish
+        with the same idempotency key, in which case the message must not be enqueued.
+        '''
+        if not message.idempotency_key:
+            return message.id
+        owner = self.idempotency.claim(message.topic, message.idempotency_key, message.id, message.enqueued_at)
+        if owner != message.id:
+            self._duplicates.inc(topic=message.topic)
+        return owner
+
+    def produce(self, data: object, topic: str = DEFAULT_TOPIC, wait_for_commit: bool = False,
+                compression: str = None, priority: int = 0, deliver_at: float = None,
+                partition_key: str = None, idempotency_key: str = None, ttl: float = None) -> UUID:
+        '''
+        Enqueue a new message on a topic. With wait_for_commit the call only returns once the
+        message has been committed by the persistence writer.
+        compression overrides the topic's codec for this message ("none" to store it as is).
+        Messages of a higher priority (0..MAX_PRIORITY) are delivered first; with deliver_at
+        (epoch seconds) the message is held back until then. Messages with the same
+        partition_key go to the same partition and are delivered in publish order.
+        A publish with the idempotency_key of another one on the topic within the dedup
+        window enqueues nothing and returns the earlier message's id.
+        A message still undelivered ttl seconds (default: the topic's retention ttl) after
+        the publish is dropped; ttl=0 publishes it without a time to live.
+        '''
+        return self.publish(
+            data, topic, wait_for_commit, compression, priority, deliver_at, partition_key, idempotency_key, ttl
+        )[0]
+
+    def publish(self, data: object, topic: str = DEFAULT_TOPIC, wait_for_commit: bool = False,
+                compression: str = None, priority: int = 0, deliver_at: float = None,
+                partition_key: str = None, idempotency_key: str = None, ttl: float = None) -> Tuple[UUID, int | None]:
+        '''
+        produce() that also returns the position the persistence backend logged the message
+        at (see ReplicatedPersistence), None when nothing was written, e.g. for a duplicate.
+        '''
+        message = self._new_message(
+            data, topic, time.time(), compression, priority, deliver_at, partition_key, idempotency_key, ttl
+        )
+        owner = self._claim(message)
+        if owner != message.id:
+            if wait_for_commit:
+                self.persistence_service.flush()
+            return owner, None
+        # Logged before it is deliverable, so its ack can never reach the writer ahead of it
+        position = self.persistence_service.log_message(message)
         self.storage.enqueue(message)
-        self.persistence_service.log_message(message)
-        return message.id
-    
-    def consume(self):
-        message = self.storage.dequeue()
-        self.persistence_service.update_message(message)
+        self._published.inc(topic=message.topic)
+        if wait_for_commit:
+            self.persistence_service.flush()
+        return message.id, position
+
+    def produce_batch(self, items, wait_for_commit: bool = False) -> list[UUID]:
+        '''
+        Enqueue several (data, topic) or (data, topic, options) tuples with one storage
+        operation and one persistence transaction, options being a dict of produce()'s
+        compression, priority, deliver_at, partition_key, idempotency_key and ttl. Returns the
+        ids in order, for duplicates the id of the earlier message.
+        '''
+        return self.publish_batch(items, wait_for_commit)[0]
+
+    def publish_batch(self, items, wait_for_commit: bool = False) -> Tuple[list[UUID], int | None]:
+        '''
+        produce_batch() that also returns the persistence position of the batch, see publish().
+        '''
+        now = time.time()
+        created = [
+            self._new_message(item[0], item[1], now, **(item[2] if len(item) > 2 else {}))
+            for item in items
+        ]
+        ids = [self._claim(message) for message in created]
+        messages = [message for message, message_id in zip(created, ids) if message_id == message.id]
+        position = self.persistence_service.log_messages(messages) if messages else None
+        self.storage.enqueue_many(messages)
+        for topic, count in Counter(message.topic for message in messages).items():
+            self._published.inc(count, topic=topic)
+        if wait_for_commit:
+            self.persistence_service.flush()
+        return ids, position
+
+    def consume(self, topic: str = DEFAULT_TOPIC, visibility_timeout: float = None, partitions: list = None):
+        message = self.storage.dequeue(topic, visibility_timeout or self.REQUEUE_TIMEOUT, partitions)
+        if message:
+            self.persistence_service.update_message(message)
+            self._delivered.inc(topic=message.topic)
+            # Delayed messages are late from their delivery time on, not from when they were published
+            ready_at = message.deliver_at or message.enqueued_at
+            if ready_at:
+                self._delivery_lag.observe(time.time() - ready_at, topic=message.topic)
 
         return message
 
-    def acknowledge(self, message_id: UUID) -> bool:
+    def wait_for_messages(self, topic: str = DEFAULT_TOPIC, timeout: float = None, partitions: list = None) -> bool:
+        return self.storage.wait_for_messages(topic, timeout, partitions)
+
+    def acknowledge(self, message_id: UUID | str) -> bool:
+        try:
+            message_id = UUID(str(message_id))
+        except ValueError:
+            return False
         self.persistence_service.ack_message(str(message_id))
-        return self.storage.acknowledge(message_id)
+        acked = self.storage.acknowledge(message_id)
+        if acked:
+            self._acked.inc()
+        return acked
     
-    def get_dead_letter(self):
-        return self.storage.dead_letter
+    def acknowledge_batch(self, message_ids) -> list[bool]:
+        '''
+        Acknowledge several messages with one persistence transaction.
+        Returns one result per id, False for unknown, invalid or not in-flight ids.
+        '''
+        results = []
+        acked = []
+        for message_id in message_ids:
+            try:
+                message_id = UUID(str(message_id))
+            except ValueError:
+                results.append(False)
+                continue
+            acked.append(str(message_id))
+            results.append(self.storage.acknowledge(message_id))
+        self.persistence_service.ack_messages(acked)
+        self._acked.inc(sum(results))
+        return results
+
+    def release(self, message_id: UUID | str) -> bool:
+        '''
+        Queues an in-flight message again right away without counting the delivery
+        against MAX_RETRIES, for a consumer that received it but never used it.
+        '''
+        try:
+            message_id = UUID(str(message_id))
+        except ValueError:
+            return False
+        released = self.storage.release(message_id)
+        if released:
+            self._released.inc()
+        return released
+
+    def touch(self, message_id: UUID | str, visibility_timeout: float = None) -> bool:
+        '''
+        Extends the lease of an in-flight message so it is not redelivered while
+        a long running consumer is still working on it.
+        '''
+        try:
+            message_id = UUID(str(message_id))
+        except ValueError:
+            return False
+        return self.storage.touch(message_id, visibility_timeout)
+
+    def get_dead_letter(self, topic: str = None):
+        return self.storage.get_dead_letter(topic)
     
-    def get_all_messages(self):
-        return self.storage.get_all_messages()
-
-    def _bg_requeue_inflight(self, timeout: int = REQUEUE_TIMEOUT):
-        current_time = time.time()
-        to_requeue = []
-        for msg_id, inflight in list(self.storage.in_flight.items()):
-            if current_time - inflight.processing_started_at > timeout:
-                to_requeue.append(msg_id)
-        
-        for msg_id in to_requeue:
-            self.storage.requeue_from_inflight(msg_id)
-            
-    def _bg_cleanup_inflight(self):
-        '''
-        Removes messages which have been retried too many times and are in inflight queue
-        '''
-        to_remove = []
-        for msg_id, inflight in self.storage.in_flight.items():
-            if inflight.too_many_retries(self.MAX_RETRIES):
-                to_remove.append(msg_id)
-
-        for msg_id in to_remove:
-            self.storage.add_to_dead_letter(inflight.message)
+    def get_all_messages(self, topic: str = None):
+        return self.storage.get_all_messages(topic)
+
+    def list_dead_letter(self, topic: str = None, cursor: str = "", page_size: int = None, limit: int = None):
+        '''
+        Dead messages after `cursor`, oldest first and topic by topic, as pages of
+        (messages, next_cursor, end) produced one at a time (see broker.listing).
+        Raises ValueError for an invalid cursor.
+        '''
+        decode_cursor(cursor)
+        return paginate(self.storage.iter_dead_letter(topic, cursor), cursor, self._page_size(page_size), limit)
+
+    def list_messages(self, topic: str = None, cursor: str = "", page_size: int = None, limit: int = None):
+        '''
+        Queued, in-flight and delayed messages after `cursor` as pages, like list_dead_letter.
+        '''
+        decode_cursor(cursor)
+        return paginate(self.storage.iter_messages(topic, cursor), cursor, self._page_size(page_size), limit)
+
+    def _page_size(self, page_size: int = None) -> int:
+        return min(page_size or self.LIST_PAGE, self.MAX_LIST_PAGE)
+
+    def redrive_dead_letter(self, topic: str = None, message_ids=None, limit: int = None) -> int:
+        '''
+        Moves dead messages back to the end of their topic's queue with their retries
+        reset: the given ids, or the oldest of the topic (of every topic when None), at
+        most `limit` in both cases. Works through REDRIVE_BATCH messages at a time, each
+        persisted in one transaction before it is enqueued. Returns the number moved.
+        '''
+        if message_ids is not None:
+            valid = []
+            for message_id in message_ids:
+                try:
+                    valid.append(UUID(str(message_id)))
+                except ValueError:
+                    continue
+            valid = valid[:limit] if limit else valid
+            batches = (
+                self.storage.take_dead_letter(topic, message_ids=valid[i:i + self.REDRIVE_BATCH])
+                for i in range(0, len(valid), self.REDRIVE_BATCH)
+            )
+        else:
+            batches = self._oldest_dead(topic, limit)
+        redriven = 0
+        for batch in batches:
+            for message in batch:
+                message.state = MessageState.ENQUEUED.value
+                message.retries = 0
+                message.deliver_at = None
+            self.persistence_service.update_messages(batch)
+            self.storage.enqueue_many(batch)
+            for name, count in Counter(message.topic for message in batch).items():
+                self._redriven.inc(count, topic=name)
+            redriven += len(batch)
+        if redriven:
+            logger.info("Redrove %d dead lettered messages", redriven)
+        return redriven
+
+    def _oldest_dead(self, topic: str = None, limit: int = None):
+        remaining = limit
+        while remaining is None or remaining > 0:
+            count = self.REDRIVE_BATCH if remaining is None else min(remaining, self.REDRIVE_BATCH)
+            batch = self.storage.take_dead_letter(topic, limit=count)
+            if not batch:
+                return
+            if remaining is not None:
+                remaining -= len(batch)
+            yield batch
+
+    def get_topics(self):
+        return list(self.storage.topics)
+
+    def get_stats(self) -> str:
+        '''
+        Current metrics in the Prometheus text exposition format.
+        '''
+        return self.metrics.render()
+
+    def _expire_inflight(self, msg_id: UUID):
+        # Taken out atomically, an ack or touch that got there first wins
+        inflight = self.storage.pop_expired(msg_id)
+        if inflight is None:
+            return
+        topic = inflight.message.topic
+        if inflight.too_many_retries(self.MAX_RETRIES):
+            self._dead_letter(inflight.message)
+            logger.info("Message %s of topic %s dead lettered after %d retries", msg_id, topic, inflight.message.retries)
+        else:
+            # Exponential backoff so a failing message does not spin between consumers
+            delay = min(self.RETRY_BACKOFF * 2 ** inflight.message.retries, self.RETRY_BACKOFF_MAX)
+            self.storage.requeue(inflight.message, delay)
+            self._requeued.inc(topic=topic)
+        for listener in self.expiry_listeners:
+            listener(str(msg_id))
+
+    def _dead_letter(self, message: Message):
+        # Only ever called by the one caller that took the message out of in_flight, and
+        # persisted first so a redrive that follows is also persisted after it
+        message.state = MessageState.DEAD_LETTERED.value
+        self.persistence_service.update_message(message)
+        dropped = self.storage.add_to_dead_letter(message)
+        if dropped is None:
+            return
+        self._dead_lettered.inc(topic=message.topic)
+        self._drop_dead(message.topic, dropped)
+
+    def _drop_dead(self, topic: str, dropped):
+        # Dropped messages are gone for good, they are persisted like acks
+        if not dropped:
+            return
+        self.persistence_service.ack_messages([str(message.id) for message in dropped])
+        self._dead_letter_dropped.inc(len(dropped), topic=topic)
+        logger.debug("Dead letter queue of topic %s is full, dropped %d oldest messages", topic, len(dropped))
@@ -1,50 +1,647 @@
-from broker.models import Message, MessageState, InflightMessage
+from broker.compact_queue import CompactMessageQueue
+from broker.dead_letter import DeadLetterQueue
+from broker.listing import decode_cursor, encode_cursor
+from broker.models import DEFAULT_TOPIC, MAX_PRIORITY, Message, MessageState, InflightMessage
+from broker.paged_queue import PageInWorker, PagedMessageQueue
 from collections import deque
-from typing import Deque, Dict
+from typing import Callable, Deque, Dict, Iterator, List, Tuple
+from urllib.parse import quote
 from uuid import UUID
+import heapq
+import itertools
+import os
+import threading
 import time
+import zlib
 
-class MessageStorage:
-    def __init__(self):
-        self.queue: Deque[Message] = deque()
+
+class PriorityReadyQueue:
+    '''
+    Ready queue of one topic partition made of a FIFO per priority level (0..MAX_PRIORITY).
+    Supports the same deque operations as the level queues; popleft takes from the
+    highest non-empty level, so it costs O(MAX_PRIORITY) and order within a level is FIFO.
+    Levels are created by `make_level(priority)` on first use.
+    '''
+    def __init__(self, make_level: Callable[[int], Deque[Message]]):
+        self._make_level = make_level
+        self._levels: List[Deque[Message] | None] = [None] * (MAX_PRIORITY + 1)
+        self._lock = threading.Lock()
+
+    def _level(self, priority: int) -> Deque[Message]:
+        priority = min(max(priority, 0), MAX_PRIORITY)
+        level = self._levels[priority]
+        if level is None:
+            with self._lock:
+                level = self._levels[priority]
+                if level is None:
+                    level = self._levels[priority] = self._make_level(priority)
+        return level
+
+    def _active(self) -> List[Deque[Message]]:
+        # Highest priority first
+        return [level for level in reversed(self._levels) if level is not None]
+
+    def __len__(self) -> int:
+        return sum(len(level) for level in self._active())
+
+    def __bool__(self) -> bool:
+        return any(level for level in self._active())
+
+    def __getitem__(self, index: int) -> Message:
+        if index != 0:
+            raise IndexError("only the head of a priority queue can be indexed")
+        for level in self._active():
+            if level:
+                return level[0]
+        raise IndexError("queue index out of range")
+
+    def __iter__(self) -> Iterator[Message]:
+        return itertools.chain.from_iterable(list(level) for level in self._active())
+
+    @property
+    def spilled(self) -> int:
+        return sum(getattr(level, "spilled", 0) for level in self._active())
+
+    @property
+    def has_room(self) -> bool:
+        # Levels without a memory budget always have room
+        return all(getattr(level, "has_room", True) for level in self._active())
+
+    def append(self, message: Message):
+        self._level(message.priority).append(message)
+
+    def extend(self, messages: List[Message]):
+        by_priority: Dict[int, List[Message]] = {}
+        for message in messages:
+            by_priority.setdefault(message.priority, []).append(message)
+        for priority, batch in by_priority.items():
+            self._level(priority).extend(batch)
+
+    def popleft(self) -> Message:
+        for level in self._active():
+            if level:
+                try:
+                    return level.popleft()
+                except IndexError:
+                    # Emptied by a concurrent consumer, try the next level
+                    continue
+        raise IndexError("pop from an empty queue")
+
+    def expire(self, now: float) -> List[Message]:
+        '''
+        Pops the messages whose expires_at is not after `now` from the head of every level.
+        A message stuck behind one that lives longer waits until it reaches the head.
+        '''
+        expired = []
+        for level in self._active():
+            while level and level[0].expires_at is not None and level[0].expires_at <= now:
+                expired.append(level.popleft())
+        return expired
+
+
+class Partition:
+    '''
+    Ready queue and in-flight map of one partition of a topic.
+    Partitions are the unit of locking: `lock` guards in_flight and taking messages off
+    the ready queue, so consumers and the TTL sweep never pop the same head. Appends go
+    to the ready queue without it, it is thread safe on its own.
+    The ready queue holds one FIFO per priority level (see PriorityReadyQueue).
+    With compact=True the level queues are array backed (see CompactMessageQueue), the
+    in-flight map stays object based since it is bounded by consumer prefetch.
+    With a `paging` (max_bytes, directory, pager) each level keeps at most max_bytes
+    in memory and pages the rest out to disk (see PagedMessageQueue).
+    '''
+    def __init__(self, topic: str, index: int, compact: bool = False, paging: tuple = None):
+        self.topic = topic
+        self.index = index
+        self.compact = compact
+        self.paging = paging
+        self.queue = PriorityReadyQueue(self._make_level)
         self.in_flight: Dict[UUID, InflightMessage] = {}
-        self.dead_letter: Deque[Message] = deque()
-        
+        self.lock = threading.Lock()
+
+    def _make_level(self, priority: int) -> Deque[Message]:
+        level = CompactMessageQueue(self.topic, priority, self.index) if self.compact else deque()
+        if self.paging is not None:
+            max_bytes, directory, pager = self.paging
+            level = PagedMessageQueue(
+                self.topic, level, max_bytes,
+                os.path.join(directory, f"partition-{self.index}", f"priority-{priority}"), pager,
+            )
+        return level
+
+
+class TopicQueue:
+    '''
+    Partitions and dead letter queue of a single topic.
+    Messages with a partition key always land on the same partition (crc32 of the key),
+    the others are spread round robin. Consumers take from all partitions or, in a
+    consumer group, from the partitions assigned to them.
+    '''
+    def __init__(self, name: str, partitions: int = 1, compact: bool = False, paging: tuple = None,
+                 max_dead_letter: int = None):
+        self.name = name
+        self.partitions = [Partition(name, index, compact, paging) for index in range(partitions)]
+        # Messages of this topic waiting in the storage's delay heap
+        self.delayed = 0
+        # Set once a message with a time to live was queued, only such topics are swept
+        self.expiring = False
+        # Set while part of the topic's persisted backlog still waits to be paged in,
+        # consumers taking messages then signal MessageStorage.room_changed
+        self.backlog = False
+        self.dead_letter = DeadLetterQueue(max_dead_letter)
+        # Signalled whenever a message becomes available so consumers can block instead of polling
+        self.available = threading.Condition()
+        # Consumers blocked on `available`, enqueues skip the condition while there are none
+        self.waiters = 0
+        self._round_robin = itertools.count()
+        self._rotation = itertools.count()
+
+    def partition_for(self, message: Message) -> Partition:
+        if len(self.partitions) == 1:
+            return self.partitions[0]
+        if message.partition_key:
+            index = zlib.crc32(message.partition_key.encode("utf-8"))
+        else:
+            index = next(self._round_robin)
+        return self.partitions[index % len(self.partitions)]
+
+    def select(self, partitions: List[int] = None) -> List[Partition]:
+        '''
+        The given partitions (all when None), starting at a different one on every call
+        so no partition is starved.
+        '''
+        selected = self.partitions if partitions is None else [
+            self.partitions[index] for index in partitions if 0 <= index < len(self.partitions)
+        ]
+        if len(selected) <= 1:
+            return selected
+        start = next(self._rotation) % len(selected)
+        return selected[start:] + selected[:start]
+
+    def has_ready(self, partitions: List[int] = None) -> bool:
+        return any(partition.queue for partition in self.select(partitions))
+
+    def ready_count(self) -> int:
+        return sum(len(partition.queue) for partition in self.partitions)
+
+    def in_flight_count(self) -> int:
+        return sum(len(partition.in_flight) for partition in self.partitions)
+
+    def spilled_count(self) -> int:
+        return sum(partition.queue.spilled for partition in self.partitions)
+
+    def has_room(self) -> bool:
+        '''
+        True when no ready queue of the topic is over half of its memory budget.
+        '''
+        return all(partition.queue.has_room for partition in self.partitions)
+
+
+class MessageStorage:
+    SPILL_DIR = "./message_spill"
+    LIST_CHUNK = 256  # dead messages read from a topic's queue at a time by listings
+
+    def __init__(self, compact: bool = False, max_queue_bytes: int = None, spill_dir: str = SPILL_DIR,
+                 partitions: int = 1, max_dead_letter: int = None):
+        self.compact = compact
+        # Memory budget of each partition's ready queue, unbounded when None
+        self.max_queue_bytes = max_queue_bytes
+        self.spill_dir = spill_dir
+        # Partitions of every topic
+        self.partitions = max(partitions, 1)
+        # Bound of each topic's dead letter queue, unbounded when None
+        self.max_dead_letter = max_dead_letter
+        self._pager = PageInWorker() if max_queue_bytes else None
+        self.topics: Dict[str, TopicQueue] = {}
+        self._topics_lock = threading.Lock()
+        # Partition of every in-flight message, acks and touches only carry the message id.
+        # Entries are added and removed under the partition's lock.
+        self.inflight_partitions: Dict[UUID, Partition] = {}
+        # Min-heap of (deadline, message_id) for in-flight messages. Entries are never removed
+        # eagerly, an entry is stale once its message left in_flight or got a newer deadline.
+        self.deadlines: List[Tuple[float, UUID]] = []
+        self.deadline_changed = threading.Condition()
+        # Min-heap of (deliver_at, seq, message) for messages scheduled in the future,
+        # they only reach their topic's ready queue once due
+        self.delayed: List[Tuple[float, int, Message]] = []
+        self.delay_changed = threading.Condition()
+        self._delay_seq = itertools.count()
+        # Notified when messages are taken from a topic with a backlog still to page in
+        self.room_changed = threading.Condition()
+        # Callables invoked as listener(topic, partition, count) after messages are enqueued,
+        # from whichever thread enqueued them. wake() passes partition=None and count=None
+        # to wake every consumer of the topic.
+        self.listeners = []
+        # Callables invoked as listener(messages) with queued messages that were dropped
+        # because they expired before being delivered
+        self.ttl_listeners = []
+
+    def topic(self, name: str = DEFAULT_TOPIC) -> TopicQueue:
+        topic = self.topics.get(name)
+        if topic is None:
+            with self._topics_lock:
+                topic = self.topics.get(name)
+                if topic is None:
+                    topic = self.topics[name] = TopicQueue(
+                        name, self.partitions, self.compact, self._paging(name), self.max_dead_letter
+                    )
+        return topic
+
+    def _paging(self, name: str) -> tuple | None:
+        if not self.max_queue_bytes:
+            return None
+        return self.max_queue_bytes, os.path.join(self.spill_dir, "topic-" + quote(name, safe="")), self._pager
+
     def enqueue(self, item: Message):
-        self.queue.append(item)
-        
-    def dequeue(self) -> Message | None:
-        if self.queue:
-            item = self.queue.popleft()
-            item.state = MessageState.INFLIGHT
-            self.in_flight[item.id] = InflightMessage(message=item, processing_started_at=time.time())
-            return item
-        return None
+        now = time.time()
+        if item.expires_at is not None and item.expires_at <= now:
+            self._drop_expired([item])
+            return
+        if item.deliver_at is not None and item.deliver_at > now:
+            self._delay([item])
+            return
+        topic = self.topic(item.topic)
+        if item.expires_at is not None:
+            topic.expiring = True
+        partition = topic.partition_for(item)
+        partition.queue.append(item)
+        self._notify(topic, partition.index, 1)
+
+    def enqueue_many(self, items: List[Message]):
+        '''
+        Enqueues a batch, waking each topic's consumers once per partition. Messages that
+        already expired are dropped instead.
+        '''
+        by_partition: Dict[Tuple[str, int], List[Message]] = {}
+        delayed = []
+        expired = []
+        now = time.time()
+        for item in items:
+            if item.expires_at is not None and item.expires_at <= now:
+                expired.append(item)
+            elif item.deliver_at is not None and item.deliver_at > now:
+                delayed.append(item)
+            else:
+                topic = self.topic(item.topic)
+                if item.expires_at is not None:
+                    topic.expiring = True
+                partition = topic.partition_for(item)
+                by_partition.setdefault((item.topic, partition.index), []).append(item)
+        if expired:
+            self._drop_expired(expired)
+        if delayed:
+            self._delay(delayed)
+        for (name, index), messages in by_partition.items():
+            topic = self.topic(name)
+            topic.partitions[index].queue.extend(messages)
+            self._notify(topic, index, len(messages))
+
+    def _notify(self, topic: TopicQueue, partition: int | None, count: int | None):
+        # Waiters register under the condition before re-checking the queue, so a message
+        # appended before this read is either seen by them or they are counted here
+        if topic.waiters:
+            with topic.available:
+                topic.available.notify_all()
+        for listener in self.listeners:
+            listener(topic.name, partition, count)
+
+    def wake(self, topic: str = DEFAULT_TOPIC):
+        '''
+        Wakes every consumer waiting on the topic, e.g. after its partitions were reassigned.
+        '''
+        self._notify(self.topic(topic), None, None)
+
+    def wait_for_messages(self, topic: str = DEFAULT_TOPIC, timeout: float = None,
+                          partitions: List[int] = None) -> bool:
+        '''
+        Blocks until one of the given partitions (all when None) of the topic has a
+        message or the timeout expires.
+        '''
+        queue = self.topic(topic)
+        with queue.available:
+            queue.waiters += 1
+            try:
+                return queue.available.wait_for(lambda: queue.has_ready(partitions), timeout)
+            finally:
+                queue.waiters -= 1
+
+    def _delay(self, items: List[Message]):
+        with self.delay_changed:
+            earliest = self.delayed[0][0] if self.delayed else None
+            for item in items:
+                heapq.heappush(self.delayed, (item.deliver_at, next(self._delay_seq), item))
+                self.topic(item.topic).delayed += 1
+            # Only wake the scheduler when the earliest delivery time moved
+            if earliest is None or self.delayed[0][0] < earliest:
+                self.delay_changed.notify_all()
+
+    def wait_for_due(self) -> List[Message]:
+        '''
+        Blocks until at least one delayed message is due and returns the due messages,
+        ready to be enqueued. Sleeps until the earliest delivery time in between.
+        '''
+        with self.delay_changed:
+            while True:
+                now = time.time()
+                due = []
+                while self.delayed and self.delayed[0][0] <= now:
+                    item = heapq.heappop(self.delayed)[2]
+                    self.topic(item.topic).delayed -= 1
+                    due.append(item)
+                if due:
+                    return due
+                timeout = self.delayed[0][0] - now if self.delayed else None
+                self.delay_changed.wait(timeout)
+
+    def dequeue(self, topic: str = DEFAULT_TOPIC, visibility_timeout: float = 30,
+                partitions: List[int] = None) -> Message | None:
+        '''
+        Takes the next message of the given partitions (all when None) and marks it in-flight.
+        Expired messages found at the head on the way are dropped.
+        '''
+        item = None
+        expired = []
+        queue = self.topic(topic)
+        for partition in queue.select(partitions):
+            if partition.queue:
+                item = self._take(partition, visibility_timeout, expired)
+                if item is not None:
+                    break
+        if expired:
+            self._drop_expired(expired)
+        if queue.backlog and (item is not None or expired):
+            with self.room_changed:
+                self.room_changed.notify_all()
+        return item
+
+    def wait_for_room(self, timeout: float = None):
+        '''
+        Blocks until messages were taken from a topic with a backlog, or the timeout expired.
+        '''
+        with self.room_changed:
+            self.room_changed.wait(timeout)
+
+    def _take(self, partition: Partition, visibility_timeout: float, expired: List[Message]) -> Message | None:
+        now = time.time()
+        with partition.lock:
+            while True:
+                try:
+                    item = partition.queue.popleft()
+                except IndexError:
+                    return None
+                if item.expires_at is None or item.expires_at > now:
+                    break
+                expired.append(item)
+            item.state = MessageState.INFLIGHT.value
+            item.partition = partition.index
+            inflight = InflightMessage(
+                message=item,
+                processing_started_at=now,
+                visibility_timeout=visibility_timeout,
+                deadline=now + visibility_timeout,
+            )
+            partition.in_flight[item.id] = inflight
+            self.inflight_partitions[item.id] = partition
+        self._schedule(item.id, inflight.deadline)
+        return item
+
+    def expire_ready(self, now: float = None) -> int:
+        '''
+        Drops the expired messages at the heads of the ready queues of every topic that
+        has messages with a time to live. Returns the number dropped.
+        '''
+        now = now or time.time()
+        expired = []
+        for queue in list(self.topics.values()):
+            if not queue.expiring:
+                continue
+            for partition in queue.partitions:
+                if partition.queue:
+                    with partition.lock:
+                        expired.extend(partition.queue.expire(now))
+        if expired:
+            self._drop_expired(expired)
+        return len(expired)
+
+    def _drop_expired(self, messages: List[Message]):
+        for listener in self.ttl_listeners:
+            listener(messages)
+
+    def get_inflight(self, message_id: UUID) -> InflightMessage | None:
+        partition = self.inflight_partitions.get(message_id)
+        if partition is None:
+            return None
+        return partition.in_flight.get(message_id)
 
-    def peek(self) -> Message | None:
-        if self.queue:
-            return self.queue[0]
+    def _pop_inflight(self, message_id: UUID, expired_at: float = None) -> InflightMessage | None:
+        '''
+        Removes an in-flight message; with expired_at only if its deadline is not after it.
+        Exactly one caller gets the message when acks, expiries and requeues race.
+        '''
+        partition = self.inflight_partitions.get(message_id)
+        if partition is None:
+            return None
+        with partition.lock:
+            inflight = partition.in_flight.get(message_id)
+            if inflight is None or (expired_at is not None and inflight.deadline > expired_at):
+                return None
+            del partition.in_flight[message_id]
+            del self.inflight_partitions[message_id]
+            return inflight
+
+    def pop_expired(self, message_id: UUID) -> InflightMessage | None:
+        '''
+        Takes an in-flight message out if it is still past its deadline, so a message
+        touched after wait_for_expired returned it keeps its lease.
+        '''
+        return self._pop_inflight(message_id, time.time())
+
+    def touch(self, message_id: UUID, visibility_timeout: float = None) -> bool:
+        '''
+        Pushes the deadline of an in-flight message to now + visibility_timeout
+        (the message's own timeout if not given).
+        '''
+        partition = self.inflight_partitions.get(message_id)
+        if partition is None:
+            return False
+        with partition.lock:
+            inflight = partition.in_flight.get(message_id)
+            if inflight is None:
+                return False
+            if visibility_timeout:
+                inflight.visibility_timeout = visibility_timeout
+            deadline = inflight.deadline = time.time() + inflight.visibility_timeout
+        self._schedule(message_id, deadline)
+        return True
+
+    def _schedule(self, message_id: UUID, deadline: float):
+        with self.deadline_changed:
+            heapq.heappush(self.deadlines, (deadline, message_id))
+            # Only wake the timer when the earliest deadline moved
+            if self.deadlines[0][1] == message_id:
+                self.deadline_changed.notify_all()
+
+    def wait_for_expired(self) -> List[UUID]:
+        '''
+        Blocks until at least one in-flight message passed its deadline and returns the
+        expired ids. Cost is proportional to the number of entries popped.
+        '''
+        with self.deadline_changed:
+            while True:
+                now = time.time()
+                expired = []
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    deadline, message_id = heapq.heappop(self.deadlines)
+                    inflight = self.get_inflight(message_id)
+                    if inflight is not None and inflight.deadline == deadline:
+                        expired.append(message_id)
+                if expired:
+                    return expired
+                timeout = self.deadlines[0][0] - now if self.deadlines else None
+                self.deadline_changed.wait(timeout)
+
+    def peek(self, topic: str = DEFAULT_TOPIC) -> Message | None:
+        for partition in self.topic(topic).partitions:
+            if partition.queue:
+                return partition.queue[0]
         return None
-    
+
     def acknowledge(self, message_id: UUID) -> bool:
-        if message_id in self.in_flight:
-            msg = self.in_flight.pop(message_id)
-            msg.message.state = MessageState.ACKNOWLEDGED
+        inflight = self._pop_inflight(message_id)
+        if inflight is not None:
+            inflight.message.state = MessageState.ACKNOWLEDGED.value
             return True
         return False
-    
-    def requeue_from_inflight(self, message_id: UUID) -> bool:
-        if message_id in self.in_flight:
-            inflight = self.in_flight.pop(message_id)
-            inflight.message.retries += 1
-            inflight.message.state = MessageState.RETRIED
-            self.enqueue(inflight.message)
+
+    def requeue_from_inflight(self, message_id: UUID, delay: float = 0) -> bool:
+        '''
+        Puts an in-flight message back, after `delay` seconds if given.
+        '''
+        inflight = self._pop_inflight(message_id)
+        if inflight is not None:
+            self.requeue(inflight.message, delay)
             return True
         return False
 
-    def get_all_messages(self):
-        all_messages = list(self.queue) + list(self.in_flight.values())
+    def release(self, message_id: UUID) -> bool:
+        '''
+        Puts an in-flight message back as if it had not been delivered, without counting
+        an attempt. For deliveries the consumer gave back unused.
+        '''
+        inflight = self._pop_inflight(message_id)
+        if inflight is None:
+            return False
+        inflight.message.state = MessageState.ENQUEUED.value
+        self.enqueue(inflight.message)
+        return True
+
+    def requeue(self, message: Message, delay: float = 0):
+        '''
+        Puts a message taken out of in_flight back for another attempt.
+        '''
+        message.retries += 1
+        message.state = MessageState.RETRIED.value
+        if delay > 0:
+            message.deliver_at = time.time() + delay
+        self.enqueue(message)
+
+    def get_all_messages(self, topic: str = None) -> List[Message]:
+        topics = [self.topic(topic)] if topic is not None else list(self.topics.values())
+        all_messages = []
+        for queue in topics:
+            for partition in queue.partitions:
+                all_messages.extend(partition.queue)
+                with partition.lock:
+                    all_messages.extend(inflight.message for inflight in partition.in_flight.values())
+        names = {queue.name for queue in topics}
+        with self.delay_changed:
+            all_messages.extend(item for _, _, item in self.delayed if item.topic in names)
         return all_messages
 
-    def add_to_dead_letter(self, message: Message):
-        self.dead_letter.append(message)
\ No newline at end of file
+    def get_dead_letter(self, topic: str = None) -> List[Message]:
+        topics = [self.topic(topic)] if topic is not None else list(self.topics.values())
+        dead_letter = []
+        for queue in topics:
+            dead_letter.extend(queue.dead_letter)
+        return dead_letter
+
+    def add_to_dead_letter(self, message: Message) -> List[Message] | None:
+        '''
+        Moves a message that left the ready queues and in_flight into its topic's dead
+        letter queue. Returns the oldest dead messages dropped to keep the queue within
+        max_dead_letter, None if the message was already dead lettered.
+        '''
+        message.state = MessageState.DEAD_LETTERED.value
+        return self.topic(message.topic).dead_letter.add(message)
+
+    def take_dead_letter(self, topic: str = None, message_ids: List[UUID] = None,
+                         limit: int = None) -> List[Message]:
+        '''
+        Removes messages from the dead letter queues: the given ids (those found), or the
+        oldest up to `limit` of the topic, of every topic in name order when None.
+        '''
+        if topic:
+            queues = [self.topics[topic]] if topic in self.topics else []
+        else:
+            queues = [self.topics[name] for name in sorted(self.topics)]
+        if message_ids is not None:
+            taken = []
+            for message_id in message_ids:
+                for queue in queues:
+                    message = queue.dead_letter.remove(message_id)
+                    if message is not None:
+                        taken.append(message)
+                        break
+            return taken
+        taken = []
+        for queue in queues:
+            taken.extend(queue.dead_letter.take(limit - len(taken) if limit else len(queue.dead_letter)))
+            if limit and len(taken) >= limit:
+                break
+        return taken
+
+    # ---- listings ----
+    def _listed_topics(self, topic: str, cursor: str) -> Iterator[Tuple[TopicQueue, int]]:
+        # Topics of a listing from the cursor's on, with the position to continue after in each
+        start, position = decode_cursor(cursor)
+        names = [topic] if topic else sorted(name for name in self.topics if name >= start)
+        for name in names:
+            queue = self.topics.get(name)
+            if queue is not None:
+                yield queue, position if name == start else 0
+
+    def iter_dead_letter(self, topic: str = None, cursor: str = "") -> Iterator[Tuple[str, Message]]:
+        '''
+        (cursor, message) for every dead message after `cursor`, oldest first within a
+        topic. The queues are read LIST_CHUNK messages at a time, no lock is held in between.
+        '''
+        for queue, position in self._listed_topics(topic, cursor):
+            while True:
+                chunk = queue.dead_letter.after(position, self.LIST_CHUNK)
+                if not chunk:
+                    break
+                for position, message in chunk:
+                    yield encode_cursor(queue.name, position), message
+
+    def iter_messages(self, topic: str = None, cursor: str = "") -> Iterator[Tuple[str, Message]]:
+        '''
+        (cursor, message) for every queued, in-flight and delayed message after `cursor`.
+        A position counts the messages of the topic in that order, so it is only exact
+        while the topic does not change; each partition's queue is copied when reached.
+        '''
+        for queue, position in self._listed_topics(topic, cursor):
+            messages = itertools.islice(self._topic_messages(queue), position, None)
+            for position, message in enumerate(messages, position + 1):
+                yield encode_cursor(queue.name, position), message
+
+    def _topic_messages(self, queue: TopicQueue) -> Iterator[Message]:
+        for partition in queue.partitions:
+            yield from partition.queue
+        for partition in queue.partitions:
+            with partition.lock:
+                in_flight = [inflight.message for inflight in partition.in_flight.values()]
+            yield from in_flight
+        with self.delay_changed:
+            delayed = [item for _, _, item in self.delayed if item.topic == queue.name]
+        yield from delayed
@@ -2,12 +2,16 @@ from dataclasses import dataclass
 from uuid import UUID
 from enum import Enum
 
+DEFAULT_TOPIC = "default"
+MAX_PRIORITY = 9
+
 class MessageState(Enum):
     ENQUEUED = 0      # Message is in queue, not yet processed
     PROCESSING = 1    # Message is currently being processed
     INFLIGHT = 2      # Message has been sent to a consumer but not yet acknowledged
     ACKNOWLEDGED = 3  # Message has been successfully processed
     RETRIED = 4       # Message has been retried after a failure
+    DEAD_LETTERED = 5 # Message ran out of retries and sits in its topic's dead letter queue
     
     @classmethod
     def get_name(cls, value):
@@ -17,25 +21,36 @@ class MessageState(Enum):
                 return state.name
         return f"UNKNOWN({value})"
 
-@dataclass
+@dataclass(slots=True)
 class Message:
     id: UUID
     data: object
     enqueued_at: float = None
     retries: int = 0
     state: MessageState = MessageState.ENQUEUED.value
-    
+    topic: str = DEFAULT_TOPIC
+    encoding: str = ""  # compression codec of data (see broker.compression), "" = as published
+    priority: int = 0   # 0 (lowest) to MAX_PRIORITY, higher priorities are delivered first
+    deliver_at: float = None  # not delivered before this time, None = right away
+    partition_key: str = ""   # messages with the same key share a partition and keep their order
+    partition: int = 0        # partition the message was queued on, set by MessageStorage
+    idempotency_key: str = ""  # producer supplied, repeated publishes with it return this message's id
+    expires_at: float = None  # dropped if still undelivered at this time, None = never
+
     def to_dict(self):
         return {
             "id": str(self.id),
+            "topic": self.topic,
             "data": self.data,
             "enqueued_at": self.enqueued_at
         }
     
-@dataclass
+@dataclass(slots=True)
 class InflightMessage:
     message: Message
     processing_started_at: float
+    visibility_timeout: float = 30
+    deadline: float = None  # processing_started_at + visibility_timeout, moved forward by touch
 
     def too_many_retries(self, threshold: int) -> bool:
         return self.message.retries >= threshold
\ No newline at end of file
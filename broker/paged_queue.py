@@ -0,0 +1,224 @@
+import logging
+import os
+import queue
+import re
+import threading
+from collections import deque
+from typing import Deque, Iterator, List
+
+from broker.models import Message
+from broker.segment_log import RECORD_HEADER, decode_body, encode_message
+
+logger = logging.getLogger(__name__)
+
+SPILL_SUFFIX = ".spill"
+SPILL_NAME = re.compile(r"\d{20}" + re.escape(SPILL_SUFFIX))   # see PagedMessageQueue._path
+
+
+class PageInWorker:
+    '''
+    Background thread paging spilled messages back into memory ahead of consumers.
+    Queues ask for a refill once their in-memory part drops below the low watermark.
+    '''
+    def __init__(self):
+        self._requests: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="page-in")
+        self._thread.start()
+
+    def request(self, paged_queue: "PagedMessageQueue"):
+        self._requests.put(paged_queue)
+
+    def _run(self):
+        while True:
+            paged_queue = self._requests.get()
+            try:
+                paged_queue.page_in()
+            except OSError as e:
+                logger.error("Paging in topic %s failed: %s", paged_queue.topic, e)
+
+
+class PagedMessageQueue:
+    '''
+    Ready queue of one topic with a memory budget.
+    The head of the queue is kept in `memory` (a deque or CompactMessageQueue) as long
+    as its estimated size stays within `max_bytes`. Once it is over budget, newly
+    enqueued messages are appended to spill segments on disk instead, and once anything
+    is spilled every later message is spilled as well so FIFO order holds.
+    Spilled messages are read back READ_AHEAD at a time when the in-memory part runs
+    low, by the page-in worker or inline if a consumer finds memory empty.
+    Spill files are a cache of the persisted backlog, they are not synced. Spill files
+    an earlier run left in the directory are removed when the queue is created, nothing
+    else in it is touched.
+    '''
+    READ_AHEAD = 512                    # messages paged in at once
+    SEGMENT_BYTES = 16 * 1024 * 1024    # spill files are rolled at this size
+    MESSAGE_OVERHEAD = 200              # estimated bytes of a queued message besides its payload
+
+    def __init__(self, topic: str, memory, max_bytes: int, directory: str, pager: PageInWorker = None):
+        self.topic = topic
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._memory = memory
+        self._memory_bytes = 0
+        self._spilled = 0
+        self._segments: Deque[int] = deque()
+        self._write_file = None
+        self._read_file = None
+        self._pager = pager
+        self._page_in_requested = False
+        self._lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if SPILL_NAME.fullmatch(name):
+                os.remove(os.path.join(directory, name))
+
+    def __len__(self) -> int:
+        return len(self._memory) + self._spilled
+
+    def __bool__(self) -> bool:
+        return bool(self._memory) or self._spilled > 0
+
+    def __getitem__(self, index: int) -> Message:
+        if index != 0:
+            raise IndexError("only the head of a paged queue can be indexed")
+        with self._lock:
+            if not self._memory and self._spilled:
+                self.page_in()
+            return self._memory[0]
+
+    def __iter__(self) -> Iterator[Message]:
+        with self._lock:
+            messages = list(self._memory)
+            if self._spilled:
+                self._flush_writes()
+                messages.extend(self._read_spilled())
+        return iter(messages)
+
+    @property
+    def spilled(self) -> int:
+        return self._spilled
+
+    @property
+    def has_room(self) -> bool:
+        # Nothing spilled and at most half of the memory budget used
+        return not self._spilled and self._memory_bytes <= self.max_bytes // 2
+
+    @property
+    def memory_bytes(self) -> int:
+        return self._memory_bytes
+
+    def append(self, message: Message):
+        with self._lock:
+            self._push(message)
+
+    def extend(self, messages: List[Message]):
+        with self._lock:
+            for message in messages:
+                self._push(message)
+
+    def popleft(self) -> Message:
+        with self._lock:
+            if not self._memory and self._spilled:
+                self.page_in()
+            message = self._memory.popleft()
+            self._memory_bytes -= self._size(message)
+            if self._spilled and len(self._memory) < self.READ_AHEAD // 2:
+                self._request_page_in()
+            return message
+
+    def _size(self, message: Message) -> int:
+        data = message.data
+        return self.MESSAGE_OVERHEAD + (len(data) if isinstance(data, (str, bytes, bytearray)) else 0)
+
+    def _push(self, message: Message):
+        size = self._size(message)
+        if self._spilled or (self._memory and self._memory_bytes + size > self.max_bytes):
+            self._spill(message)
+            return
+        self._memory.append(message)
+        self._memory_bytes += size
+
+    # ---- spill files ----
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:020d}{SPILL_SUFFIX}")
+
+    def _spill(self, message: Message):
+        if self._write_file is None or self._write_file.tell() >= self.SEGMENT_BYTES:
+            if self._write_file is not None:
+                self._write_file.close()
+            segment = self._segments[-1] + 1 if self._segments else 0
+            self._segments.append(segment)
+            self._write_file = open(self._path(segment), "ab")
+        self._write_file.write(encode_message(message))
+        self._spilled += 1
+
+    def _flush_writes(self):
+        if self._write_file is not None:
+            self._write_file.flush()
+
+    def _read_record(self, f) -> Message | None:
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return None
+        length, _ = RECORD_HEADER.unpack(header)
+        return decode_body(f.read(length))[2]
+
+    def _read_spilled(self) -> Iterator[Message]:
+        '''
+        Reads every spilled message without moving the page-in position.
+        '''
+        for segment in list(self._segments):
+            with open(self._path(segment), "rb") as f:
+                if segment == self._segments[0] and self._read_file is not None:
+                    f.seek(self._read_file.tell())
+                while (message := self._read_record(f)) is not None:
+                    yield message
+
+    def _request_page_in(self):
+        if self._pager is None:
+            self.page_in()
+        elif not self._page_in_requested:
+            self._page_in_requested = True
+            self._pager.request(self)
+
+    def page_in(self) -> int:
+        '''
+        Moves up to READ_AHEAD spilled messages into memory, within the memory budget
+        (always at least one when memory is empty). Returns the number paged in.
+        '''
+        with self._lock:
+            self._page_in_requested = False
+            self._flush_writes()
+            paged = 0
+            while self._spilled and paged < self.READ_AHEAD:
+                if self._read_file is None:
+                    self._read_file = open(self._path(self._segments[0]), "rb")
+                position = self._read_file.tell()
+                message = self._read_record(self._read_file)
+                if message is None:
+                    if len(self._segments) == 1:
+                        break
+                    # End of a rolled segment, the next one holds the rest
+                    self._read_file.close()
+                    self._read_file = None
+                    os.remove(self._path(self._segments.popleft()))
+                    continue
+                size = self._size(message)
+                if self._memory and self._memory_bytes + size > self.max_bytes:
+                    self._read_file.seek(position)
+                    break
+                self._memory.append(message)
+                self._memory_bytes += size
+                self._spilled -= 1
+                paged += 1
+            if not self._spilled:
+                self._reset_spill()
+            return paged
+
+    def _reset_spill(self):
+        for f in (self._read_file, self._write_file):
+            if f is not None:
+                f.close()
+        self._read_file = self._write_file = None
+        while self._segments:
+            os.remove(self._path(self._segments.popleft()))
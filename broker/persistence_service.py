@@ -1,90 +1,642 @@
+import logging
+import os
+import queue
 import sqlite3
-from broker.models import Message, MessageState
 import threading
+import time
+from typing import Dict, Iterator, List
+from uuid import UUID
+
+from broker.metrics import SIZE_BUCKETS, MetricsRegistry
+from broker.models import Message, MessageState
+from broker.retention import RetentionPolicies
+
+logger = logging.getLogger(__name__)
 
 MESSAGE_SCHEMA = (
     "CREATE TABLE IF NOT EXISTS messages ("
     "id TEXT PRIMARY KEY,"
-    "data TEXT NOT NULL,"
-    "state INTEGER NOT NULL DEFAULT 0,"  # 0=ENQUEUED, 1=PROCESSING, 2=INFLIGHT, 3=ACKNOWLEDGED, 4=RETRIED
+    "data BLOB NOT NULL,"                 # text or binary payload, stored as given
+    "state INTEGER NOT NULL DEFAULT 0,"  # 0=ENQUEUED, 1=PROCESSING, 2=INFLIGHT, 3=ACKNOWLEDGED, 4=RETRIED, 5=DEAD_LETTERED
     "enqueued_at REAL NOT NULL,"
-    "retries INTEGER DEFAULT 0"
+    "retries INTEGER DEFAULT 0,"
+    "topic TEXT NOT NULL DEFAULT 'default',"
+    "encoding TEXT NOT NULL DEFAULT '',"  # compression codec of data, '' = uncompressed
+    "priority INTEGER NOT NULL DEFAULT 0,"
+    "deliver_at REAL,"                    # NULL = deliver right away
+    "partition_key TEXT NOT NULL DEFAULT '',"
+    "idempotency_key TEXT NOT NULL DEFAULT '',"
+    "expires_at REAL"                     # NULL = never expires
     ")"
 )
 
+# Columns added after the first release, created on databases that predate them
+MESSAGE_MIGRATIONS = {
+    "topic": "TEXT NOT NULL DEFAULT 'default'",
+    "encoding": "TEXT NOT NULL DEFAULT ''",
+    "priority": "INTEGER NOT NULL DEFAULT 0",
+    "deliver_at": "REAL",
+    "partition_key": "TEXT NOT NULL DEFAULT ''",
+    "idempotency_key": "TEXT NOT NULL DEFAULT ''",
+    "expires_at": "REAL",
+}
+
+MESSAGE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_messages_topic_state ON messages (topic, state)",
+    # Replay order of the backlog, acknowledged rows are left out so replay does not
+    # walk the acked history
+    "CREATE INDEX IF NOT EXISTS idx_messages_replay ON messages (enqueued_at, id) WHERE state != 3",
+    # The same per topic, for brokers that page each topic's backlog in on demand
+    "CREATE INDEX IF NOT EXISTS idx_messages_topic_replay ON messages (topic, enqueued_at, id) WHERE state != 3",
+    # Idempotency keys of recent publishes, reloaded into the deduplication cache on start
+    "CREATE INDEX IF NOT EXISTS idx_messages_idempotency ON messages (enqueued_at) WHERE idempotency_key != ''",
+    # Acknowledged history of each topic, oldest first, walked by the retention compactor
+    "CREATE INDEX IF NOT EXISTS idx_messages_acked ON messages (topic, enqueued_at) WHERE state = 3",
+)
+
+# Next topic with acknowledged history, a seek on the partial index instead of a scan
+# past the topic's unacknowledged rows in idx_messages_topic_state
+ACKED_TOPIC = (
+    "SELECT topic FROM messages INDEXED BY idx_messages_acked WHERE state = 3 AND topic > ? "
+    "ORDER BY topic LIMIT 1"
+)
+
+# Newest first, for summing up the size of a topic's acknowledged history
+ACKED_SIZE_PAGE = (
+    "SELECT rowid, enqueued_at, length(CAST(data AS BLOB)) AS size FROM messages "
+    "WHERE state = 3 AND topic = ? AND (enqueued_at, rowid) < (?, ?) "
+    "ORDER BY enqueued_at DESC, rowid DESC LIMIT ?"
+)
+
+# Rows with an idempotency key stay until key retention is over. The newest row is
+# never deleted so its rowid is not handed out again while a replay is bounded by it.
+DELETE_ACKED = (
+    "DELETE FROM messages WHERE rowid IN ("
+    "SELECT rowid FROM messages WHERE state = 3 AND topic = ? AND enqueued_at <= ? "
+    "AND (idempotency_key = '' OR enqueued_at < ?) AND rowid < (SELECT MAX(rowid) FROM messages) "
+    "LIMIT ?)"
+)
+
+REPLAY_PAGE = (
+    "SELECT * FROM messages WHERE state != 3 AND rowid <= ? AND (enqueued_at, id) > (?, ?) "
+    "ORDER BY enqueued_at, id LIMIT ?"
+)
+
+# Next topic with a backlog, see ACKED_TOPIC
+BACKLOG_TOPIC = (
+    "SELECT topic FROM messages INDEXED BY idx_messages_topic_replay WHERE state != 3 AND topic > ? "
+    "ORDER BY topic LIMIT 1"
+)
+
+# Dead messages are bounded by the dead letter queue size and always loaded in one go
+DEAD_TOPIC = "SELECT * FROM messages WHERE topic = ? AND state = 5 AND rowid <= ? ORDER BY rowid"
+
+TOPIC_REPLAY_PAGE = (
+    "SELECT * FROM messages INDEXED BY idx_messages_topic_replay "
+    "WHERE state != 3 AND topic = ? AND state != 5 AND rowid <= ? AND (enqueued_at, id) > (?, ?) "
+    "ORDER BY enqueued_at, id LIMIT ?"
+)
+
+# Operation kinds carried through the write-behind queue
+_INSERT = "insert"
+_UPDATE = "update"
+_ACK = "ack"
+_BATCH = "batch"      # group of operations that must land in the same transaction
+_BARRIER = "barrier"
+_STOP = "stop"
+
+
+def _row_message(row) -> Message:
+    return Message(**{**dict(row), "id": UUID(row["id"])})
+
+
+def _state_value(state) -> int:
+    return state.value if isinstance(state, MessageState) else int(state)
+
+
+class WriteBehindQueue:
+    '''
+    Single long-lived writer draining a bounded queue of operations.
+    Operations are grouped into batches which are handed to `apply_batch` in order,
+    a batch is cut when it reaches `batch_size` or after `flush_interval` seconds.
+    Queue entries carry their submit time so the writer can report how long the oldest
+    operation of each batch waited before it was committed.
+    '''
+    def __init__(self, apply_batch, batch_size: int, flush_interval: float, max_pending: int, name: str,
+                 metrics: MetricsRegistry = None):
+        self._apply_batch = apply_batch
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._ops = queue.Queue(maxsize=max_pending)
+        metrics = metrics or MetricsRegistry()
+        self._batch_ops = metrics.histogram(
+            "broker_persistence_batch_ops", "Operations committed per persistence batch", buckets=SIZE_BUCKETS
+        )
+        self._batch_latency = metrics.histogram(
+            "broker_persistence_batch_latency_seconds",
+            "Time from submitting the oldest operation of a batch until the batch was committed",
+        )
+        self._commit_time = metrics.histogram(
+            "broker_persistence_commit_seconds", "Time spent writing and committing one persistence batch"
+        )
+        metrics.gauge(
+            "broker_persistence_pending_ops", "Operations waiting for the persistence writer",
+            callback=lambda: {(): self._ops.qsize()},
+        )
+        self._thread = threading.Thread(target=self._run, daemon=True, name=name)
+        self._thread.start()
+
+    def put(self, op):
+        # Blocks when the queue is full, applying backpressure to producers
+        self._ops.put((op, time.monotonic()))
+
+    def put_many(self, ops):
+        '''
+        Queues several operations as one entry so they are committed in the same batch.
+        '''
+        self._ops.put(((_BATCH, ops), time.monotonic()))
+
+    def flush(self, timeout: float = None) -> bool:
+        '''
+        Durability barrier: returns once every operation submitted before this call is committed.
+        '''
+        done = threading.Event()
+        self._ops.put(((_BARRIER, done), time.monotonic()))
+        return done.wait(timeout)
+
+    def close(self, timeout: float = None):
+        self._ops.put(((_STOP, None), time.monotonic()))
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            op, submitted_at = self._ops.get()
+            batch = [op]
+            deadline = time.monotonic() + self._flush_interval
+            while len(batch) < self._batch_size and batch[-1][0] not in (_BARRIER, _STOP):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._ops.get(timeout=remaining)[0])
+                except queue.Empty:
+                    break
+
+            barriers = [arg for kind, arg in batch if kind == _BARRIER]
+            writes = []
+            for op in batch:
+                if op[0] == _BATCH:
+                    writes.extend(op[1])
+                elif op[0] not in (_BARRIER, _STOP):
+                    writes.append(op)
+            if writes:
+                started = time.monotonic()
+                self._apply_batch(writes)
+                committed = time.monotonic()
+                self._batch_ops.observe(len(writes))
+                self._commit_time.observe(committed - started)
+                self._batch_latency.observe(committed - submitted_at)
+            for done in barriers:
+                done.set()
+            if batch[-1][0] == _STOP:
+                return
+
+
 class PersistenceService:
-    def __init__(self, is_async: bool):
-        self.db = "./message_queue.db"
+    '''
+    sqlite backed persistence. Acknowledged messages stay in the table as history until
+    a background compactor deletes them according to their topic's retention policy, a
+    small batch per transaction so the writer is never held up for long. Freed pages
+    are handed back to the file system with incremental vacuums and the write-ahead log
+    is checkpointed after every pass, so the database file stays the size of what is kept.
+    '''
+    BATCH_SIZE = 500          # max operations committed in a single transaction
+    FLUSH_INTERVAL = 0.01     # seconds the writer waits for more operations before committing
+    MAX_PENDING = 10000       # bound on operations waiting for the writer
+    REPLAY_BATCH = 1000       # rows fetched at a time when replaying the backlog
+    KEY_RETENTION = 300.0     # seconds idempotency keys of published messages are looked up for
+
+    COMPACT_INTERVAL = 5.0       # seconds between passes of the retention compactor
+    COMPACT_BATCH = 500          # rows deleted (or sized up) per statement
+    COMPACT_PAUSE = 0.005        # seconds between delete batches, lets the writer take the lock
+    SIZE_CHECK_INTERVAL = 60.0   # seconds between max_bytes checks, they read the whole kept history
+    VACUUM_PAGES = 1000          # free pages given back to the file system per incremental vacuum
+    JOURNAL_SIZE_LIMIT = 64 * 1024 * 1024   # bytes the write-ahead log is truncated to once checkpointed
+
+    def __init__(self, is_async: bool, db: str = "./message_queue.db", metrics: MetricsRegistry = None,
+                 key_retention: float = KEY_RETENTION, retention: RetentionPolicies = None):
+        self.db = db
+        self.key_retention = key_retention
+        self.retention = retention or RetentionPolicies()
         self.conn = self._get_connection()
         self.lock = threading.Lock()
         self._is_async = is_async
         self._setup_db()
+        self.metrics = metrics or MetricsRegistry()
+        self._errors = self.metrics.counter(
+            "broker_persistence_errors_total", "Persistence operations that could not be written"
+        )
+        self._retention_deleted = self.metrics.counter(
+            "broker_retention_deleted_total", "Acknowledged messages deleted by their topic's retention policy",
+            ["topic"],
+        )
+        self.metrics.gauge(
+            "broker_persistence_disk_bytes", "Size of the database and its write-ahead log",
+            callback=lambda: {(): self.disk_bytes()},
+        )
+        self._writer = None
+        if self._is_async:
+            self._writer = WriteBehindQueue(
+                self._write_batch,
+                batch_size=self.BATCH_SIZE,
+                flush_interval=self.FLUSH_INTERVAL,
+                max_pending=self.MAX_PENDING,
+                name="persistence-writer",
+                metrics=self.metrics,
+            )
+        self._closed = threading.Event()
+        self._next_size_check = 0.0
+        self._compactor = threading.Thread(target=self._compact_worker, daemon=True, name="persistence-compactor")
+        self._compactor.start()
 
     def _get_connection(self):
         conn = sqlite3.connect(self.db, check_same_thread=False)
         conn.row_factory = sqlite3.Row
         return conn
-    
+
     def _setup_db(self):
         '''
         Sets up db if not done already
         '''
+        # Only takes effect on a new database, older ones reuse freed pages but do not shrink
+        self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # Readers (replay, compactor) do not block the writer and commits append to the log
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute(f"PRAGMA journal_size_limit = {self.JOURNAL_SIZE_LIMIT}")
         with self.conn:
             self.conn.execute(MESSAGE_SCHEMA)
+            columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(messages)")}
+            for column, definition in MESSAGE_MIGRATIONS.items():
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE messages ADD COLUMN {column} {definition}")
+            if self._column_type("data") == "TEXT":
+                self._rebuild_messages()
+            for index in MESSAGE_INDEXES:
+                self.conn.execute(index)
+        self._incremental_vacuum = self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+    def _column_type(self, column: str) -> str:
+        types = {row["name"]: row["type"] for row in self.conn.execute("PRAGMA table_info(messages)")}
+        return types[column].upper()
+
+    def _rebuild_messages(self):
+        '''
+        Recreates the messages table of a database that declared data as TEXT, SQLite cannot
+        change a column's type in place. Rows keep their rowid, so replay order is unchanged;
+        the old table's indexes go with it and are created again by _setup_db.
+        '''
+        logger.info("Migrating the messages table to binary payloads")
+        columns = ", ".join(["rowid"] + [row["name"] for row in self.conn.execute("PRAGMA table_info(messages)")])
+        self.conn.execute("ALTER TABLE messages RENAME TO messages_text")
+        self.conn.execute(MESSAGE_SCHEMA)
+        self.conn.execute(f"INSERT INTO messages ({columns}) SELECT {columns} FROM messages_text")
+        self.conn.execute("DROP TABLE messages_text")
 
     def log_message(self, message: Message):
         '''
-        Log a message to the database. This will be done asynchronously by default in a new thread.
+        Log a message to the database. By default this is queued for the background writer
+        and committed together with other pending operations.
         Sync version will block until the message is logged. This will be slow.
         '''
-        if self._is_async:
-            threading.Thread(target=self._log_message, args=(message,)).start()
-        else:
-            self._log_message(message)
-            
-    def ack_message(self, message_id: Message):
-        if self._is_async:
-            threading.Thread(target=self._ack_message, args=(message_id,)).start()
-        else:
-            self._ack_message(message_id)
+        self._submit((_INSERT, message))
+
+    def log_messages(self, messages):
+        '''
+        Logs several messages in a single transaction.
+        '''
+        self._submit_many([(_INSERT, message) for message in messages])
+
+    def ack_message(self, message_id: str):
+        self._submit((_ACK, str(message_id)))
+
+    def ack_messages(self, message_ids):
+        self._submit_many([(_ACK, str(message_id)) for message_id in message_ids])
 
     def update_message(self, message: Message):
-        if self._is_async:
-            threading.Thread(target=self._update_message, args=(message,)).start()
-        else:
-            self._update_message(message)
+        self._submit((_UPDATE, message))
 
-    def _update_message(self, message: Message):
-        with self.lock:
-            with self.conn:
-                self.conn.execute(
-                    "UPDATE messages SET data = ?, state = ? WHERE id = ?",
-                    (message.data, message.state, message.id)
-                )
+    def update_messages(self, messages):
+        self._submit_many([(_UPDATE, message) for message in messages])
+
+    def flush(self, timeout: float = None) -> bool:
+        '''
+        Blocks until every operation submitted so far has been committed.
+        Returns False if the timeout expired first.
+        '''
+        if self._writer is None:
+            return True
+        return self._writer.flush(timeout)
 
-    def _log_message(self, message: Message):
+    def clear(self):
+        '''
+        Deletes every message, pending operations included. Used by replicas before they
+        load a snapshot of the leader's backlog.
+        '''
+        self.flush()
         with self.lock:
             with self.conn:
-                print(message.id, message.data, message.state, message.enqueued_at)
-                self.conn.execute(
-                    "INSERT INTO messages (id, data, state, enqueued_at) VALUES (?, ?, ?, ?)",
-                    (str(message.id), message.data, message.state, message.enqueued_at)
-                )
+                self.conn.execute("DELETE FROM messages")
 
-    def _ack_message(self, message_id: str):
+    def close(self):
+        self._closed.set()
+        if self._writer is not None:
+            self._writer.close()
         with self.lock:
-            with self.conn:
-                self.conn.execute(
-                    "UPDATE messages SET state = ? WHERE id = ?",
-                    (MessageState.ACKNOWLEDGED.value, message_id)
-                )
+            self.conn.close()
+
+    def disk_bytes(self) -> int:
+        size = 0
+        for path in (self.db, self.db + "-wal"):
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def _submit(self, op):
+        if self._writer is not None:
+            self._writer.put(op)
+        else:
+            self._write_batch([op])
+
+    def _submit_many(self, ops):
+        if not ops:
+            return
+        if self._writer is not None:
+            self._writer.put_many(ops)
+        else:
+            self._write_batch(ops)
+
+    def _write_batch(self, ops):
+        '''
+        Commits a batch of operations in one transaction. Consecutive operations of the same
+        kind are written with a single executemany, keeping the original order.
+        If the transaction fails the operations are retried one by one so a single bad
+        row does not drop the rest of the batch.
+        '''
+        try:
+            with self.lock:
+                with self.conn:
+                    self._execute_ops(ops)
+        except sqlite3.Error as e:
+            if len(ops) == 1:
+                logger.error("Failed to persist %s operation: %s", ops[0][0], e)
+                self._errors.inc()
+                return
+            for op in ops:
+                self._write_batch([op])
+
+    def _execute_ops(self, ops):
+        start = 0
+        while start < len(ops):
+            kind = ops[start][0]
+            end = start
+            while end < len(ops) and ops[end][0] == kind:
+                end += 1
+            self.conn.executemany(*self._statement(kind, [arg for _, arg in ops[start:end]]))
+            start = end
+
+    def _statement(self, kind, args):
+        if kind == _INSERT:
+            return (
+                # A replica can receive a message again, the latest copy wins as in the log backend
+                "INSERT OR REPLACE INTO messages "
+                "(id, data, state, enqueued_at, retries, topic, encoding, priority, deliver_at, partition_key, "
+                "idempotency_key, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        str(m.id), m.data, _state_value(m.state), m.enqueued_at, m.retries, m.topic, m.encoding,
+                        m.priority, m.deliver_at, m.partition_key, m.idempotency_key, m.expires_at,
+                    )
+                    for m in args
+                ],
+            )
+        if kind == _UPDATE:
+            return (
+                # Payloads never change after publish, only the delivery state is written
+                "UPDATE messages SET state = ?, retries = ? WHERE id = ?",
+                [(_state_value(m.state), m.retries, str(m.id)) for m in args],
+            )
+        if kind == _ACK:
+            return (
+                "UPDATE messages SET state = ? WHERE id = ?",
+                [(MessageState.ACKNOWLEDGED.value, message_id) for message_id in args],
+            )
+        raise ValueError(f"Unknown persistence operation: {kind}")
+
+    def count_unacknowledged_messages(self) -> int:
+        conn = self._get_connection()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM messages WHERE state != 3").fetchone()[0]
+        finally:
+            conn.close()
+
+    def iter_unacknowledged_batches(self, batch_size: int = REPLAY_BATCH):
+        '''
+        Replays unacknowledged messages in enqueue order as lists of up to batch_size messages.
+        Each batch is one keyset query on idx_messages_replay through a separate connection,
+        so no lock or cursor is held between batches and the writer keeps committing.
+        Rows inserted after this call (new publishes) are not part of the replay.
+        '''
+        conn = self._get_connection()
+        last_rowid = conn.execute("SELECT MAX(rowid) FROM messages").fetchone()[0] or 0
+        return self._replay_pages(conn, last_rowid, batch_size)
+
+    def _replay_pages(self, conn, last_rowid: int, batch_size: int):
+        position = (float("-inf"), "")
+        try:
+            while True:
+                rows = conn.execute(REPLAY_PAGE, (last_rowid, *position, batch_size)).fetchall()
+                if not rows:
+                    return
+                position = (rows[-1]["enqueued_at"], rows[-1]["id"])
+                yield [_row_message(row) for row in rows]
+        finally:
+            conn.close()
+
+    def iter_topic_backlogs(self, batch_size: int = REPLAY_BATCH) -> Dict[str, Iterator[List[Message]]]:
+        '''
+        Backlog of every topic as its own lazy iterator of batches: the topic's dead
+        messages first, then its other unacknowledged messages in enqueue order. Each batch
+        is one keyset query on idx_messages_topic_replay, run only when it is asked for,
+        so a topic's tail can stay on disk until its consumers catch up. Rows inserted
+        after this call are not part of the replay.
+        '''
+        conn = self._get_connection()
+        try:
+            last_rowid = conn.execute("SELECT MAX(rowid) FROM messages").fetchone()[0] or 0
+            topics = list(self._backlog_topics(conn))
+        finally:
+            conn.close()
+        return {topic: self._topic_pages(topic, last_rowid, batch_size) for topic in topics}
+
+    def _backlog_topics(self, conn):
+        topic = ""
+        while True:
+            row = conn.execute(BACKLOG_TOPIC, (topic,)).fetchone()
+            if row is None:
+                return
+            topic = row["topic"]
+            yield topic
+
+    def _topic_pages(self, topic: str, last_rowid: int, batch_size: int):
+        # A connection per batch, nothing is held open while the topic waits for room
+        conn = self._get_connection()
+        try:
+            dead = conn.execute(DEAD_TOPIC, (topic, last_rowid)).fetchall()
+        finally:
+            conn.close()
+        # A dead message redriven before the cursor got to it is back to ready in its row
+        loaded = {row["id"] for row in dead}
+        for start in range(0, len(dead), batch_size):
+            yield [_row_message(row) for row in dead[start:start + batch_size]]
+        position = (float("-inf"), "")
+        while True:
+            conn = self._get_connection()
+            try:
+                rows = conn.execute(TOPIC_REPLAY_PAGE, (topic, last_rowid, *position, batch_size)).fetchall()
+            finally:
+                conn.close()
+            if not rows:
+                return
+            position = (rows[-1]["enqueued_at"], rows[-1]["id"])
+            yield [_row_message(row) for row in rows if row["id"] not in loaded]
+
+    def iter_idempotency_keys(self, since: float = None):
+        '''
+        (topic, idempotency key, message id, enqueued_at) of the keyed messages published
+        since `since` (default: within key_retention), acknowledged ones included, oldest first.
+        '''
+        if since is None:
+            since = time.time() - self.key_retention
+        conn = self._get_connection()
+        try:
+            rows = conn.execute(
+                "SELECT topic, idempotency_key, id, enqueued_at FROM messages "
+                "WHERE idempotency_key != '' AND enqueued_at >= ? ORDER BY enqueued_at",
+                (since,),
+            )
+            for row in rows:
+                yield row["topic"], row["idempotency_key"], UUID(row["id"]), row["enqueued_at"]
+        finally:
+            conn.close()
 
     def get_unacknowledged_messages(self):
-       '''
-       Used to replay unacknowledged messages in case of failure.
-       This will run once at startup of the messaging service.
-       '''
-       with self.lock:
-           with self.conn:
-               cursor = self.conn.execute("SELECT * FROM messages WHERE state != ? ORDER BY enqueued_at", (MessageState.ACKNOWLEDGED.value,))
-               return [Message(**row) for row in cursor.fetchall()]
+        '''
+        Every unacknowledged message in enqueue order, as one list.
+        '''
+        return [message for batch in self.iter_unacknowledged_batches() for message in batch]
+
+    # ---- retention ----
+    def _compact_worker(self):
+        while not self._closed.wait(self.COMPACT_INTERVAL):
+            try:
+                self.compact()
+            except sqlite3.Error as e:
+                if self._closed.is_set():
+                    return
+                logger.error("Retention compaction failed: %s", e)
+
+    def compact(self) -> int:
+        '''
+        One compactor pass: deletes the acknowledged rows their topic's retention policy no
+        longer keeps, COMPACT_BATCH rows per transaction, then vacuums the freed pages and
+        checkpoints the write-ahead log. Returns the number of rows deleted.
+        '''
+        now = time.time()
+        check_sizes = now >= self._next_size_check
+        if check_sizes:
+            self._next_size_check = now + self.SIZE_CHECK_INTERVAL
+        deleted = 0
+        conn = self._get_connection()
+        try:
+            for topic in self._acked_topics(conn):
+                policy = self.retention.for_topic(topic)
+                cutoffs = []
+                if policy.keep_for is not None:
+                    cutoffs.append(now - policy.keep_for)
+                if check_sizes and policy.max_bytes is not None:
+                    cutoffs.append(self._size_cutoff(conn, topic, policy.max_bytes))
+                cutoffs = [cutoff for cutoff in cutoffs if cutoff is not None]
+                if cutoffs:
+                    deleted += self._delete_acked(topic, max(cutoffs), now - self.key_retention)
+        finally:
+            conn.close()
+        if deleted:
+            self._vacuum()
+        with self.lock:
+            if not self._closed.is_set():
+                self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+        return deleted
+
+    def _acked_topics(self, conn):
+        # Skips from topic to topic on idx_messages_acked instead of grouping the history
+        topic = ""
+        while True:
+            row = conn.execute(ACKED_TOPIC, (topic,)).fetchone()
+            if row is None:
+                return
+            topic = row["topic"]
+            yield topic
+
+    def _size_cutoff(self, conn, topic: str, max_bytes: int) -> float:
+        '''
+        enqueued_at of the newest acknowledged message of a topic that no longer fits into
+        max_bytes together with the ones after it, None if the whole history fits.
+        '''
+        position = (float("inf"), 0)
+        total = 0
+        while True:
+            rows = conn.execute(ACKED_SIZE_PAGE, (topic, *position, self.COMPACT_BATCH)).fetchall()
+            if not rows:
+                return None
+            for row in rows:
+                total += row["size"] or 0
+                if total > max_bytes:
+                    return row["enqueued_at"]
+            position = (rows[-1]["enqueued_at"], rows[-1]["rowid"])
+
+    def _delete_acked(self, topic: str, cutoff: float, keys_since: float) -> int:
+        deleted = 0
+        while True:
+            with self.lock:
+                if self._closed.is_set():
+                    break
+                with self.conn:
+                    count = self.conn.execute(
+                        DELETE_ACKED, (topic, cutoff, keys_since, self.COMPACT_BATCH)
+                    ).rowcount
+            deleted += count
+            if count < self.COMPACT_BATCH:
+                break
+            time.sleep(self.COMPACT_PAUSE)
+        if deleted:
+            self._retention_deleted.inc(deleted, topic=topic)
+            logger.debug("Deleted %d acknowledged messages of topic %s", deleted, topic)
+        return deleted
+
+    def _vacuum(self):
+        # Frees VACUUM_PAGES pages per transaction. Databases created without incremental
+        # auto vacuum keep their free pages for new rows instead.
+        if not self._incremental_vacuum:
+            return
+        while True:
+            with self.lock:
+                if self._closed.is_set():
+                    return
+                # executescript steps the pragma to completion, execute frees a single page
+                self.conn.executescript(f"PRAGMA incremental_vacuum({self.VACUUM_PAGES})")
+                free = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free:
+                return
+            time.sleep(self.COMPACT_PAUSE)
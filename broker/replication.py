@@ -0,0 +1,714 @@
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+import zlib
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Sequence, Tuple
+from uuid import UUID
+
+import grpc
+
+from broker.metrics import SIZE_BUCKETS
+from broker.models import Message
+from broker.persistence_service import _state_value
+from broker.segment_log import (
+    RECORD_HEADER,
+    RECORD_MESSAGE,
+    RECORD_UPDATE,
+    decode_body,
+    encode_ack,
+    encode_message,
+    encode_update,
+)
+from proto import broker_pb2, broker_pb2_grpc
+
+logger = logging.getLogger(__name__)
+
+LEADER = "leader"
+FOLLOWER = "follower"
+CANDIDATE = "candidate"
+
+# Exit status of a broker that lost its leadership, see ReplicationNode.deposed
+EXIT_DEPOSED = 3
+
+
+class ReplicationError(ValueError):
+    pass
+
+
+def split_records(data: bytes) -> List[bytes]:
+    '''
+    Bodies of a buffer of framed segment log records, raises ReplicationError on a corrupt one.
+    '''
+    bodies = []
+    offset = 0
+    while offset < len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        body = data[start:start + length]
+        if len(body) < length or zlib.crc32(body) != crc:
+            raise ReplicationError(f"Corrupt replication record at offset {offset}")
+        bodies.append(body)
+        offset = start + length
+    return bodies
+
+
+@dataclass
+class ReplicaState:
+    '''
+    Election state and log position of a replica. Kept in a small JSON file so a restarted
+    broker neither votes twice in a term nor claims records it did not commit.
+    '''
+    term: int = 0
+    voted_for: str = ""
+    log_term: int = 0      # term of the leader the local backlog came from
+    applied_seq: int = 0   # log position the local backlog is committed up to
+
+    @classmethod
+    def load(cls, path: str = None) -> "ReplicaState":
+        if path is None or not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    def save(self, path: str = None):
+        if path is None:
+            return
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(asdict(self), f)
+        os.replace(tmp, path)
+
+
+class ReplicationLog:
+    '''
+    Tail of the leader's persistence operations as numbered segment log records, read by
+    the followers' senders. Positions continue from the leader's position when it took
+    over. Records every follower has are dropped, and beyond RETAIN records the oldest
+    are dropped regardless; a follower that falls behind that gets a snapshot instead.
+    Also tracks the position each follower has committed, for the publish quorum.
+    '''
+    RETAIN = 50000
+    TRIM_CHUNK = 4096   # records are dropped in chunks so trimming the list stays cheap
+
+    def __init__(self, last_seq: int, quorum: int, followers: Sequence[str]):
+        self.first_seq = last_seq + 1   # position of records[0]
+        self.last_seq = last_seq
+        self.quorum = quorum
+        self.followers = list(followers)
+        self.matched: Dict[str, int] = {}
+        self.records: List[bytes] = []
+        self.closed = False
+        lock = threading.Lock()
+        self.appended = threading.Condition(lock)
+        self.committed = threading.Condition(lock)
+
+    def append(self, records: List[bytes]) -> int:
+        '''
+        Appends records and returns the position of the last one.
+        '''
+        with self.appended:
+            self.records.extend(records)
+            self.last_seq += len(records)
+            self._trim()
+            self.appended.notify_all()
+            if self.quorum == 1:
+                self.committed.notify_all()
+            return self.last_seq
+
+    def _trim(self):
+        floor = min((self.matched.get(follower, 0) for follower in self.followers), default=self.last_seq)
+        drop = max(floor + 1 - self.first_seq, len(self.records) - self.RETAIN)
+        if drop >= self.TRIM_CHUNK:
+            del self.records[:drop]
+            self.first_seq += drop
+
+    def read(self, after: int, max_records: int, max_bytes: int, timeout: float) -> Tuple[int, List[bytes]] | None:
+        '''
+        Records following position `after`, waiting up to `timeout` for one to be appended.
+        Returns (position of the first record, records), None if they were dropped already.
+        '''
+        with self.appended:
+            if after >= self.last_seq and not self.closed:
+                self.appended.wait(timeout)
+            if after + 1 < self.first_seq:
+                return None
+            start = after + 1 - self.first_seq
+            records = []
+            size = 0
+            for record in self.records[start:start + max_records]:
+                if records and size + len(record) > max_bytes:
+                    break
+                records.append(record)
+                size += len(record)
+            return after + 1, records
+
+    def ack(self, follower: str, seq: int):
+        with self.committed:
+            if seq > self.matched.get(follower, 0):
+                self.matched[follower] = seq
+                self.committed.notify_all()
+
+    def lag(self) -> Dict[str, int]:
+        with self.committed:
+            return {follower: self.last_seq - self.matched.get(follower, 0) for follower in self.followers}
+
+    def _quorum_seq(self) -> int:
+        # Highest position held by `quorum` nodes, the leader counting as one
+        positions = sorted([self.last_seq] + [self.matched.get(f, 0) for f in self.followers], reverse=True)
+        return positions[self.quorum - 1]
+
+    def wait_for_quorum(self, seq: int, timeout: float = None) -> bool:
+        with self.committed:
+            return self.committed.wait_for(lambda: self.closed or self._quorum_seq() >= seq, timeout) and not self.closed
+
+    def close(self):
+        with self.appended:
+            self.closed = True
+            self.appended.notify_all()
+            self.committed.notify_all()
+
+
+class ReplicatedPersistence:
+    '''
+    Persistence backend of a replica's MessageService. Operations go to the local
+    backend and, while the broker is the leader, are appended to the replication log
+    as segment log records. Everything else is the backend's.
+    '''
+    def __init__(self, backend, node: "ReplicationNode"):
+        self.backend = backend
+        self.node = node
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def _replicate(self, records: List[bytes]) -> int | None:
+        # Log position of the records, for the publish quorum; None when not leading
+        log = self.node.log
+        if log is not None and records:
+            return log.append(records)
+        return None
+
+    def log_message(self, message: Message) -> int | None:
+        self.backend.log_message(message)
+        return self._replicate([encode_message(message)])
+
+    def log_messages(self, messages) -> int | None:
+        self.backend.log_messages(messages)
+        return self._replicate([encode_message(message) for message in messages])
+
+    def ack_message(self, message_id: str):
+        self.backend.ack_message(message_id)
+        self._replicate([encode_ack(UUID(str(message_id)))])
+
+    def ack_messages(self, message_ids):
+        self.backend.ack_messages(message_ids)
+        self._replicate([encode_ack(UUID(str(message_id))) for message_id in message_ids])
+
+    def update_message(self, message: Message):
+        self.backend.update_message(message)
+        self._replicate([encode_update(message.id, _state_value(message.state), message.retries)])
+
+    def update_messages(self, messages):
+        self.backend.update_messages(messages)
+        self._replicate([
+            encode_update(message.id, _state_value(message.state), message.retries) for message in messages
+        ])
+
+
+class ReplicationNode:
+    '''
+    One broker of a replicated cluster.
+
+    Brokers elect a leader among themselves: a follower that heard nothing from a leader
+    for ELECTION_TIMEOUT starts a new term and asks its peers for their vote. Peers vote
+    once per term, and only for a candidate whose log is at least as far as their own
+    (compared by the term it came from, then position), so a broker elected by a
+    majority holds every publish a majority confirmed.
+
+    The leader's persistence operations are appended to a ReplicationLog, one sender
+    thread per follower streams them in batches of whatever accumulated since the last
+    one, with up to MAX_INFLIGHT_BATCHES batches on the wire before the follower's
+    answers come back. A publish is acknowledged once `quorum` brokers, the leader
+    included, have committed it: followers answer a batch only after their backend's
+    writer flushed it, and the leader waits for its own writer alongside. Followers whose position the leader's log cannot continue (new followers,
+    followers of an earlier leader, or ones too far behind) first get a snapshot of the
+    leader's backlog.
+
+    Followers keep their backlog in persistence only and load it into storage when they
+    are elected. A leader that learns of a newer term sets `deposed` and has to be
+    restarted, after which it rejoins as a follower.
+    '''
+    HEARTBEAT_INTERVAL = 0.2       # seconds between batches of an idle leader
+    ELECTION_TIMEOUT = (1.0, 2.0)  # seconds without a leader before standing for election, randomised
+    RPC_TIMEOUT = 0.5
+    RECONNECT_INTERVAL = 0.5       # seconds before a sender retries an unreachable follower
+    QUORUM_TIMEOUT = 5.0           # seconds a publish waits for the quorum before failing
+    STATE_SAVE_INTERVAL = 1.0      # seconds between saves of the committed log position
+    MAX_INFLIGHT_BATCHES = 4       # batches sent to a follower and not answered yet
+    MAX_BATCH_RECORDS = 2000
+    MAX_BATCH_BYTES = 1024 * 1024
+    SNAPSHOT_BATCH = 1000          # messages per snapshot chunk
+
+    def __init__(self, service, node: str, peers: Sequence[str], quorum: int = None, state_path: str = None):
+        self.service = service
+        self.node = node
+        self.peers = [peer for peer in peers if peer != node]
+        self.cluster_size = len(self.peers) + 1
+        self.quorum = quorum or self.cluster_size // 2 + 1
+        if not 1 <= self.quorum <= self.cluster_size:
+            raise ValueError(f"Quorum must be between 1 and {self.cluster_size}, got {self.quorum}")
+        self.state_path = state_path
+        self.state = ReplicaState.load(state_path)
+        # Position applied to the local persistence queue, state.applied_seq trails it with
+        # the position known to be committed
+        self.applied_seq = self.state.applied_seq
+        self.role = FOLLOWER
+        self.leader = ""
+        self.log: ReplicationLog | None = None
+        # Set when this broker was the leader and another one took over
+        self.deposed = threading.Event()
+        self.lock = threading.RLock()
+        self._apply_lock = threading.Lock()
+        self.backend = service.persistence_service
+        self.persistence = service.persistence_service = ReplicatedPersistence(self.backend, self)
+        self._stubs = {peer: broker_pb2_grpc.ReplicationStub(grpc.insecure_channel(peer)) for peer in self.peers}
+        self._last_contact = time.monotonic()
+        self._election_timeout = random.uniform(*self.ELECTION_TIMEOUT)
+        self._stopped = threading.Event()
+        self._setup_metrics(service.metrics)
+
+    def _setup_metrics(self, metrics):
+        metrics.gauge(
+            "broker_replication_leader", "1 while this broker is the leader of its cluster",
+            callback=lambda: {(): int(self.is_leader())},
+        )
+        metrics.gauge("broker_replication_term", "Current election term", callback=lambda: {(): self.state.term})
+        metrics.gauge(
+            "broker_replication_follower_lag_records", "Log records the leader has that a follower has not committed",
+            ["follower"], callback=lambda: {(f,): lag for f, lag in (self.log.lag() if self.log else {}).items()},
+        )
+        self._elections = metrics.counter("broker_replication_elections_total", "Elections this broker stood in")
+        self._batch_records = metrics.histogram(
+            "broker_replication_batch_records", "Log records per replication batch sent", buckets=SIZE_BUCKETS
+        )
+        self._quorum_wait = metrics.histogram(
+            "broker_replication_quorum_seconds", "Time a publish waited for the quorum"
+        )
+        self._quorum_failures = metrics.counter(
+            "broker_replication_quorum_failures_total", "Publishes not confirmed by a quorum in time"
+        )
+
+    def start(self):
+        threading.Thread(target=self._election_worker, daemon=True, name="replication-election").start()
+        threading.Thread(target=self._state_worker, daemon=True, name="replication-state").start()
+
+    def stop(self):
+        self._stopped.set()
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+
+    # ---- state ----
+    def is_leader(self) -> bool:
+        return self.role == LEADER and not self.deposed.is_set()
+
+    def position(self) -> int:
+        log = self.log
+        return log.last_seq if log is not None else self.applied_seq
+
+    def status(self) -> broker_pb2.ReplicaStatus:
+        with self.lock:
+            return broker_pb2.ReplicaStatus(
+                node=self.node, role=self.role, term=self.state.term, log_term=self.state.log_term,
+                applied_seq=self.position(), leader=self.leader,
+            )
+
+    def _save(self):
+        self.state.save(self.state_path)
+
+    def _observe_term(self, term: int):
+        '''
+        Moves to a newer term seen on a request or response; a leader steps down.
+        '''
+        with self.lock:
+            if term <= self.state.term:
+                return
+            if self.role == LEADER:
+                self.applied_seq = self.position()
+                self._step_down(term)
+            self.state.term = term
+            self.state.voted_for = ""
+            self.role = FOLLOWER
+            self.leader = ""
+            self._save()
+
+    def _step_down(self, term: int):
+        logger.error("Leadership of term %d lost to term %d, this broker has to restart", self.state.term, term)
+        self.log.close()
+        self.log = None
+        self.deposed.set()
+
+    # ---- election ----
+    def _election_worker(self):
+        while not self._stopped.wait(self.HEARTBEAT_INTERVAL / 2):
+            with self.lock:
+                due = (
+                    self.role != LEADER and not self.deposed.is_set()
+                    and time.monotonic() - self._last_contact >= self._election_timeout
+                )
+            if due:
+                self._stand_for_election()
+
+    def _stand_for_election(self):
+        with self.lock:
+            self.role = CANDIDATE
+            self.leader = ""
+            self.state.term += 1
+            self.state.voted_for = self.node
+            self._save()
+            term = self.state.term
+            self._last_contact = time.monotonic()
+            self._election_timeout = random.uniform(*self.ELECTION_TIMEOUT)
+            request = broker_pb2.VoteRequest(
+                term=term, candidate=self.node, log_term=self.state.log_term, applied_seq=self.applied_seq,
+            )
+        self._elections.inc()
+        logger.info("Standing for election in term %d", term)
+        calls = [stub.RequestVote.future(request, timeout=self.RPC_TIMEOUT) for stub in self._stubs.values()]
+        votes = 1
+        for call in calls:
+            try:
+                response = call.result()
+            except grpc.RpcError:
+                continue
+            if response.term > term:
+                self._observe_term(response.term)
+                return
+            votes += response.granted
+        with self.lock:
+            if self.role == CANDIDATE and self.state.term == term and votes * 2 > self.cluster_size:
+                self._become_leader()
+
+    def vote(self, request: broker_pb2.VoteRequest) -> broker_pb2.VoteResponse:
+        with self.lock:
+            # The log is compared before a leader steps down, its position is not saved yet
+            position = (self.state.log_term, self.position())
+            self._observe_term(request.term)
+            granted = (
+                request.term == self.state.term
+                and self.state.voted_for in ("", request.candidate)
+                and (request.log_term, request.applied_seq) >= position
+            )
+            if granted:
+                self.state.voted_for = request.candidate
+                self._save()
+                self._last_contact = time.monotonic()
+            return broker_pb2.VoteResponse(term=self.state.term, granted=granted)
+
+    def _become_leader(self):
+        term = self.state.term
+        logger.info("Elected leader of term %d at log position %d", term, self.applied_seq)
+        self.role = LEADER
+        self.leader = self.node
+        self.log = ReplicationLog(self.applied_seq, self.quorum, self.peers)
+        self.state.log_term = term
+        self._save()
+        # The replicated backlog becomes this broker's queues
+        self.service.recover()
+        for peer in self.peers:
+            threading.Thread(
+                target=self._replicate_to, args=(peer, term, self.log), daemon=True, name=f"replicate-{peer}"
+            ).start()
+
+    def _leading(self, term: int) -> bool:
+        return self.is_leader() and self.state.term == term and not self._stopped.is_set()
+
+    def _state_worker(self):
+        # Only positions the local backend committed are claimed in elections after a restart
+        while not self._stopped.wait(self.STATE_SAVE_INTERVAL):
+            with self.lock:
+                seq, log_term = self.position(), self.state.log_term
+            if seq == self.state.applied_seq:
+                continue
+            self.backend.flush()
+            with self.lock:
+                # A snapshot started in between resets the position
+                if self.state.log_term == log_term and not self.deposed.is_set():
+                    self.state.applied_seq = seq
+                    self._save()
+
+    # ---- leader ----
+    def wait_for_quorum(self, seq: int, timeout: float = None) -> bool:
+        '''
+        Blocks until `quorum` brokers committed the log up to `seq`, the position returned
+        by the publish's persistence call. False if that took longer than QUORUM_TIMEOUT
+        or this broker is no longer the leader.
+        '''
+        log = self.log
+        if log is None:
+            return False
+        timeout = self.QUORUM_TIMEOUT if timeout is None else timeout
+        started = time.monotonic()
+        # The leader's own copy counts once its writer committed it, as the followers' do
+        committed = self.backend.flush(timeout) and log.wait_for_quorum(
+            seq, max(0.0, timeout - (time.monotonic() - started))
+        )
+        self._quorum_wait.observe(time.monotonic() - started)
+        if not committed:
+            self._quorum_failures.inc()
+        return committed
+
+    def _replicate_to(self, peer: str, term: int, log: ReplicationLog):
+        stub = self._stubs[peer]
+        while self._leading(term):
+            try:
+                status = stub.GetReplicaStatus(broker_pb2.Empty(), timeout=self.RPC_TIMEOUT)
+                if status.term > term:
+                    self._observe_term(status.term)
+                    return
+                window = threading.Semaphore(self.MAX_INFLIGHT_BATCHES)
+                for ack in stub.Replicate(self._batches(term, log, status, window)):
+                    window.release()
+                    if ack.term > term:
+                        self._observe_term(ack.term)
+                        return
+                    log.ack(peer, ack.applied_seq)
+            except grpc.RpcError as e:
+                logger.debug("Replication to %s interrupted: %s", peer, e)
+            self._stopped.wait(self.RECONNECT_INTERVAL)
+
+    def _send_slot(self, term: int, window: threading.Semaphore) -> bool:
+        # Waits for a free slot in the window of unanswered batches; records keep
+        # accumulating in the log meanwhile and go out together in the next batch.
+        # Checked before every batch, so a stopped or deposed leader stops heartbeats too.
+        while self._leading(term):
+            if window.acquire(timeout=self.HEARTBEAT_INTERVAL):
+                return True
+        return False
+
+    def _batches(self, term: int, log: ReplicationLog, status: broker_pb2.ReplicaStatus,
+                 window: threading.Semaphore):
+        if status.log_term == term and log.first_seq - 1 <= status.applied_seq <= log.last_seq:
+            position = status.applied_seq
+        else:
+            position = yield from self._snapshot(term, log, window)
+        while self._send_slot(term, window):
+            read = log.read(position, self.MAX_BATCH_RECORDS, self.MAX_BATCH_BYTES, self.HEARTBEAT_INTERVAL)
+            if read is None:
+                window.release()
+                position = yield from self._snapshot(term, log, window)
+                continue
+            first_seq, records = read
+            if records:
+                self._batch_records.observe(len(records))
+            # An empty batch is the heartbeat
+            yield broker_pb2.ReplicationBatch(
+                term=term, leader=self.node, first_seq=first_seq, records=b"".join(records),
+            )
+            position = first_seq + len(records) - 1
+
+    def _snapshot(self, term: int, log: ReplicationLog, window: threading.Semaphore):
+        '''
+        Streams the leader's backlog as snapshot chunks and returns the log position it
+        covers. Operations logged while it is read may be in the snapshot and are sent
+        again afterwards, replicas apply them idempotently.
+        '''
+        seq = log.last_seq
+        self.backend.flush()
+        reset = True
+        count = 0
+        for messages in self.backend.iter_unacknowledged_batches(self.SNAPSHOT_BATCH):
+            if not self._send_slot(term, window):
+                return seq
+            yield broker_pb2.ReplicationBatch(
+                term=term, leader=self.node, snapshot=True, reset=reset,
+                records=b"".join(encode_message(message) for message in messages),
+            )
+            reset = False
+            count += len(messages)
+        if not self._send_slot(term, window):
+            return seq
+        yield broker_pb2.ReplicationBatch(term=term, leader=self.node, snapshot=True, reset=reset, first_seq=seq + 1)
+        logger.info("Sent a snapshot of %d messages at log position %d", count, seq)
+        return seq
+
+    # ---- follower ----
+    def apply(self, batch: broker_pb2.ReplicationBatch) -> broker_pb2.ReplicationAck:
+        '''
+        Applies a batch from the leader to the local backend and answers with the position
+        committed so far, once the backend's writer flushed the batch. Batches of an outdated leader are answered with the current term.
+        '''
+        with self._apply_lock:
+            with self.lock:
+                if batch.term < self.state.term or (batch.term == self.state.term and self.role == LEADER):
+                    return broker_pb2.ReplicationAck(term=self.state.term, applied_seq=self.applied_seq)
+                self._observe_term(batch.term)
+                self.role = FOLLOWER
+                self.leader = batch.leader
+                self._last_contact = time.monotonic()
+            records = split_records(batch.records)
+            if batch.snapshot:
+                self._apply_snapshot(batch, records)
+            elif records:
+                if self.state.log_term != batch.term:
+                    raise ReplicationError(f"Log records of term {batch.term} without a snapshot")
+                skip = self.applied_seq + 1 - batch.first_seq
+                if skip < 0:
+                    raise ReplicationError(f"Gap in the log: at {self.applied_seq}, got {batch.first_seq}")
+                self._apply_records(records[skip:])
+                self.backend.flush()
+                with self.lock:
+                    self.applied_seq = max(self.applied_seq, batch.first_seq + len(records) - 1)
+            return broker_pb2.ReplicationAck(term=self.state.term, applied_seq=self.applied_seq)
+
+    def _apply_snapshot(self, batch: broker_pb2.ReplicationBatch, records: List[bytes]):
+        if batch.reset:
+            logger.info("Loading a snapshot from %s", batch.leader)
+            with self.lock:
+                # Nothing is claimed until the snapshot is complete
+                self.state.log_term = 0
+                self.state.applied_seq = self.applied_seq = 0
+                self._save()
+            self.backend.clear()
+        self._apply_records(records)
+        if batch.first_seq:
+            self.backend.flush()
+            with self.lock:
+                self.state.log_term = batch.term
+                self.state.applied_seq = self.applied_seq = batch.first_seq - 1
+                self._save()
+
+    def _apply_records(self, records: List[bytes]):
+        decoded = [decode_body(body) for body in records]
+        for record_type, group in itertools.groupby(decoded, key=lambda record: record[0]):
+            group = list(group)
+            if record_type == RECORD_MESSAGE:
+                self.backend.log_messages([message for _, _, message in group])
+            elif record_type == RECORD_UPDATE:
+                self.backend.update_messages([
+                    Message(id=message_id, data=None, state=state, retries=retries)
+                    for _, message_id, (state, retries) in group
+                ])
+            else:
+                self.backend.ack_messages([message_id for _, message_id, _ in group])
+
+
+class ReplicationServicer(broker_pb2_grpc.ReplicationServicer):
+    """
+    Replication service of a broker in a cluster, served next to the Broker service.
+    """
+
+    def __init__(self, node: ReplicationNode):
+        self.node = node
+
+    def Replicate(self, request_iterator, context):
+        for batch in request_iterator:
+            try:
+                yield self.node.apply(batch)
+            except ReplicationError as e:
+                context.abort(grpc.StatusCode.FAILED_PRECONDITION, str(e))
+
+    def RequestVote(self, request, context):
+        return self.node.vote(request)
+
+    def GetReplicaStatus(self, request, context):
+        return self.node.status()
+
+
+class ReplicatedBrokerStub:
+    '''
+    BrokerStub over the brokers of a replicated cluster that sends every call to the
+    leader. Calls turned away with UNAVAILABLE (by a follower, a failed leader or a
+    publish the quorum did not confirm) are retried on the leader found through
+    GetReplicaStatus, for up to LEADER_WAIT seconds while a new one is elected.
+    A retried publish may have been stored by the failed leader as well, so delivery
+    stays at least once unless the publish carries an idempotency key.
+    Has the same call signatures as BrokerStub, so clients only swap the stub.
+    '''
+    LEADER_WAIT = 10.0
+    RETRY_INTERVAL = 0.2
+
+    def __init__(self, channels: Sequence[grpc.Channel]):
+        self.stubs = [broker_pb2_grpc.BrokerStub(channel) for channel in channels]
+        self.replicas = [broker_pb2_grpc.ReplicationStub(channel) for channel in channels]
+        self._leader = 0
+
+    def find_leader(self) -> int | None:
+        '''
+        Index of the broker that currently is the leader, None during an election.
+        '''
+        order = [self._leader] + [i for i in range(len(self.replicas)) if i != self._leader]
+        for i in order:
+            try:
+                status = self.replicas[i].GetReplicaStatus(broker_pb2.Empty(), timeout=1.0)
+            except grpc.RpcError:
+                continue
+            if status.role == LEADER:
+                self._leader = i
+                return i
+        return None
+
+    def _wait_for_leader(self, deadline: float):
+        while self.find_leader() is None and time.monotonic() < deadline:
+            time.sleep(self.RETRY_INTERVAL)
+
+    def _call(self, method: str, request, **kwargs):
+        deadline = time.monotonic() + self.LEADER_WAIT
+        while True:
+            try:
+                return getattr(self.stubs[self._leader], method)(request, **kwargs)
+            except grpc.RpcError as e:
+                if e.code() != grpc.StatusCode.UNAVAILABLE or time.monotonic() >= deadline:
+                    raise
+            self._wait_for_leader(deadline)
+
+    # ---- Producer API ----
+    def Publish(self, request, **kwargs):
+        return self._call("Publish", request, **kwargs)
+
+    def PublishBatch(self, request, **kwargs):
+        return self._call("PublishBatch", request, **kwargs)
+
+    # ---- Streaming API ----
+    def MessageStream(self, request_iterator, **kwargs):
+        # Streams cannot be replayed, a stream opened on a follower fails and the caller reconnects
+        self.find_leader()
+        return self.stubs[self._leader].MessageStream(request_iterator, **kwargs)
+
+    # ---- Control plane ----
+    def Ack(self, request, **kwargs):
+        return self._call("Ack", request, **kwargs)
+
+    def AckBatch(self, request, **kwargs):
+        return self._call("AckBatch", request, **kwargs)
+
+    def Touch(self, request, **kwargs):
+        return self._call("Touch", request, **kwargs)
+
+    def GetDeadLetter(self, request, **kwargs):
+        return self._call("GetDeadLetter", request, **kwargs)
+
+    def GetAllMessages(self, request, **kwargs):
+        return self._call("GetAllMessages", request, **kwargs)
+
+    def StreamDeadLetter(self, request, **kwargs):
+        self.find_leader()
+        return self.stubs[self._leader].StreamDeadLetter(request, **kwargs)
+
+    def StreamAllMessages(self, request, **kwargs):
+        self.find_leader()
+        return self.stubs[self._leader].StreamAllMessages(request, **kwargs)
+
+    def RedriveDeadLetter(self, request, **kwargs):
+        return self._call("RedriveDeadLetter", request, **kwargs)
+
+    def ListTopics(self, request, **kwargs):
+        return self._call("ListTopics", request, **kwargs)
+
+    def GetStats(self, request, **kwargs):
+        return self._call("GetStats", request, **kwargs)
@@ -0,0 +1,106 @@
+from dataclasses import dataclass
+from typing import Dict, List
+
+DEFAULT_MAX_AGE = None  # seconds acknowledged messages are kept in the store, None = no limit
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+SIZE_UNITS = {"b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+UNLIMITED = ("", "none", "inf", "unlimited")
+
+
+def parse_duration(value: str) -> float:
+    '''
+    Seconds of "90", "90s", "15m", "1h", "7d" or "2w"; None for "none" (no limit).
+    '''
+    value = value.strip().lower()
+    if value in UNLIMITED:
+        return None
+    unit = DURATION_UNITS.get(value[-1])
+    seconds = float(value[:-1] if unit else value) * (unit or 1)
+    if seconds < 0:
+        raise ValueError(f"Negative duration: {value}")
+    return seconds
+
+
+def parse_size(value: str) -> int:
+    '''
+    Bytes of "4096", "512K", "100M" or "1G" (powers of 1024); None for "none" (no limit).
+    '''
+    value = value.strip().lower().removesuffix("b") or "b"
+    if value in UNLIMITED:
+        return None
+    unit = SIZE_UNITS.get(value[-1])
+    size = int(float(value[:-1] if unit else value) * (unit or 1))
+    if size < 0:
+        raise ValueError(f"Negative size: {value}")
+    return size
+
+
+@dataclass
+class RetentionPolicy:
+    '''
+    What the store keeps of a topic. Acknowledged messages are deleted once they are
+    older than max_age, or once the topic's acknowledged history grows past max_bytes
+    (oldest first), or right away with delete_on_ack. ttl is the default time to live
+    of the topic's messages: ones still undelivered when it runs out are dropped
+    unconsumed. None means no limit, the default: history is only deleted by opting in.
+    max_age and max_bytes apply to the sqlite backend, the log keeps no history at all.
+    '''
+    max_age: float = DEFAULT_MAX_AGE
+    max_bytes: int = None
+    delete_on_ack: bool = False
+    ttl: float = None
+
+    @property
+    def keep_for(self) -> float:
+        # Age at which acknowledged messages are deleted, None = kept until max_bytes is hit
+        return 0.0 if self.delete_on_ack else self.max_age
+
+    @classmethod
+    def parse(cls, spec: str) -> "RetentionPolicy":
+        '''
+        Policy of a comma separated spec such as "max_age=7d,max_bytes=1G,ttl=1h" or
+        "delete_on_ack"; settings that are left out keep their defaults.
+        '''
+        policy = cls()
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            name, _, value = item.partition("=")
+            name = name.strip().lower().replace("-", "_")
+            if name == "delete_on_ack":
+                policy.delete_on_ack = value.strip().lower() not in ("0", "false", "no")
+            elif name == "max_age":
+                policy.max_age = parse_duration(value)
+            elif name == "max_bytes":
+                policy.max_bytes = parse_size(value)
+            elif name == "ttl":
+                policy.ttl = parse_duration(value) or None
+            else:
+                raise ValueError(f"Unknown retention setting: {name}")
+        return policy
+
+
+class RetentionPolicies:
+    '''
+    Retention policy of every topic: its own one if it has one, else the default.
+    Specs are parsed with RetentionPolicy.parse.
+    '''
+    def __init__(self, default: str = "", topics: Dict[str, str] = None):
+        self.default = RetentionPolicy.parse(default or "")
+        self.topics = {topic: RetentionPolicy.parse(spec) for topic, spec in (topics or {}).items()}
+
+    def for_topic(self, topic: str) -> RetentionPolicy:
+        return self.topics.get(topic, self.default)
+
+    def ttl_for(self, topic: str, requested: float = None) -> float:
+        # Time to live of a message: the one it was published with, else (None) the
+        # topic's. An explicit 0 publishes without one, whatever the topic's is.
+        if requested is not None:
+            return requested or None
+        return self.for_topic(topic).ttl
+
+    def keeping_history(self) -> List[str]:
+        # Topics whose policy limits acknowledged history by age or size, "*" for the default
+        policies = {"*": self.default, **self.topics}
+        return sorted(
+            topic for topic, policy in policies.items() if policy.max_age is not None or policy.max_bytes is not None
+        )
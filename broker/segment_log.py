@@ -0,0 +1,645 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Set, Tuple
+from uuid import UUID
+
+from broker.compression import IDENTITY, LZMA, ZLIB
+from broker.metrics import MetricsRegistry
+from broker.models import Message
+from broker.persistence_service import (
+    WriteBehindQueue,
+    _ACK,
+    _INSERT,
+    _UPDATE,
+    _state_value,
+)
+from broker.retention import RetentionPolicies
+
+# Every record is framed as: length (u32) | crc32 of body (u32) | body
+# and the body starts with a one byte record type.
+RECORD_HEADER = struct.Struct("<II")
+RECORD_MESSAGE = 1   # full message: id, enqueued_at, retries, state, topic, data
+RECORD_UPDATE = 2    # state change: id, state, retries
+RECORD_ACK = 3       # tombstone: id
+RECORD_SCHEDULED = 4 # full message with a priority and/or deliver_at, otherwise like RECORD_MESSAGE
+RECORD_KEYED = 5     # full message with a partition key, also carries priority and deliver_at
+RECORD_IDEMPOTENT = 6  # full message with an idempotency key, otherwise like RECORD_KEYED
+RECORD_EXPIRING = 7    # full message with a time to live, otherwise like RECORD_IDEMPOTENT
+MESSAGE_RECORDS = (RECORD_MESSAGE, RECORD_SCHEDULED, RECORD_KEYED, RECORD_IDEMPOTENT, RECORD_EXPIRING)
+
+MESSAGE_BODY = struct.Struct("<B16sdIBBH")  # type, id, enqueued_at, retries, state, data kind, topic length
+SCHEDULE_BODY = struct.Struct("<Bd")        # priority, deliver_at, follows MESSAGE_BODY in RECORD_SCHEDULED
+KEYED_BODY = struct.Struct("<BdH")          # priority, deliver_at, key length, then the key in RECORD_KEYED
+IDEMPOTENT_BODY = struct.Struct("<BdHH")    # as KEYED_BODY plus the idempotency key's length, then both keys
+EXPIRING_BODY = struct.Struct("<BdHHd")     # as IDEMPOTENT_BODY plus expires_at, then both keys
+UPDATE_BODY = struct.Struct("<B16sIB")      # type, id, retries, state
+ACK_BODY = struct.Struct("<B16s")           # type, id
+
+DATA_STR = 0
+DATA_BYTES = 1
+DATA_ZLIB = 2   # compressed payloads are bytes, the kind records the codec
+DATA_LZMA = 3
+
+COMPRESSED_KINDS = {ZLIB: DATA_ZLIB, LZMA: DATA_LZMA}
+KIND_CODECS = {kind: codec for codec, kind in COMPRESSED_KINDS.items()}
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".log"
+
+
+def _encode_data(data, encoding: str = IDENTITY) -> Tuple[int, bytes]:
+    if encoding:
+        return COMPRESSED_KINDS[encoding], bytes(data)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return DATA_BYTES, bytes(data)
+    return DATA_STR, str(data).encode("utf-8")
+
+
+def _decode_data(kind: int, raw: bytes) -> Tuple[object, str]:
+    if kind == DATA_STR:
+        return raw.decode("utf-8"), IDENTITY
+    return raw, KIND_CODECS.get(kind, IDENTITY)
+
+
+def _frame(body: bytes) -> bytes:
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def encode_message(message: Message) -> bytes:
+    kind, raw = _encode_data(message.data, message.encoding)
+    topic = message.topic.encode("utf-8")
+    key = message.partition_key.encode("utf-8")
+    idempotency_key = message.idempotency_key.encode("utf-8")
+    scheduled = bool(message.priority or message.deliver_at)
+    if message.expires_at:
+        record_type = RECORD_EXPIRING
+    elif idempotency_key:
+        record_type = RECORD_IDEMPOTENT
+    else:
+        record_type = RECORD_KEYED if key else RECORD_SCHEDULED if scheduled else RECORD_MESSAGE
+    body = MESSAGE_BODY.pack(
+        record_type,
+        message.id.bytes,
+        message.enqueued_at or 0.0,
+        message.retries,
+        _state_value(message.state),
+        kind,
+        len(topic),
+    )
+    if message.expires_at:
+        body += EXPIRING_BODY.pack(
+            message.priority, message.deliver_at or 0.0, len(key), len(idempotency_key), message.expires_at
+        ) + key + idempotency_key
+    elif idempotency_key:
+        body += IDEMPOTENT_BODY.pack(
+            message.priority, message.deliver_at or 0.0, len(key), len(idempotency_key)
+        ) + key + idempotency_key
+    elif key:
+        body += KEYED_BODY.pack(message.priority, message.deliver_at or 0.0, len(key)) + key
+    elif scheduled:
+        body += SCHEDULE_BODY.pack(message.priority, message.deliver_at or 0.0)
+    return _frame(body + topic + raw)
+
+
+def encode_update(message_id: UUID, state: int, retries: int) -> bytes:
+    return _frame(UPDATE_BODY.pack(RECORD_UPDATE, message_id.bytes, retries, state))
+
+
+def encode_ack(message_id: UUID) -> bytes:
+    return _frame(ACK_BODY.pack(RECORD_ACK, message_id.bytes))
+
+
+def decode_body(body: bytes):
+    '''
+    Decodes a record body into (type, id, payload) where payload is a Message for
+    message records, a (state, retries) tuple for updates and None for acks.
+    '''
+    record_type = body[0]
+    if record_type in MESSAGE_RECORDS:
+        _, raw_id, enqueued_at, retries, state, kind, topic_length = MESSAGE_BODY.unpack_from(body)
+        message_id = UUID(bytes=raw_id)
+        topic_start = MESSAGE_BODY.size
+        priority, deliver_at, key, idempotency_key, expires_at = 0, None, "", "", None
+        if record_type == RECORD_SCHEDULED:
+            priority, deliver_at = SCHEDULE_BODY.unpack_from(body, topic_start)
+            topic_start += SCHEDULE_BODY.size
+        elif record_type == RECORD_KEYED:
+            priority, deliver_at, key_length = KEYED_BODY.unpack_from(body, topic_start)
+            key_start = topic_start + KEYED_BODY.size
+            topic_start = key_start + key_length
+            key = body[key_start:topic_start].decode("utf-8")
+        elif record_type in (RECORD_IDEMPOTENT, RECORD_EXPIRING):
+            if record_type == RECORD_EXPIRING:
+                priority, deliver_at, key_length, idempotency_length, expires_at = EXPIRING_BODY.unpack_from(
+                    body, topic_start
+                )
+                key_start = topic_start + EXPIRING_BODY.size
+            else:
+                priority, deliver_at, key_length, idempotency_length = IDEMPOTENT_BODY.unpack_from(body, topic_start)
+                key_start = topic_start + IDEMPOTENT_BODY.size
+            idempotency_start = key_start + key_length
+            topic_start = idempotency_start + idempotency_length
+            key = body[key_start:idempotency_start].decode("utf-8")
+            idempotency_key = body[idempotency_start:topic_start].decode("utf-8")
+        data_start = topic_start + topic_length
+        topic = body[topic_start:data_start].decode("utf-8")
+        data, encoding = _decode_data(kind, body[data_start:])
+        return RECORD_MESSAGE, message_id, Message(
+            id=message_id, data=data, enqueued_at=enqueued_at, retries=retries, state=state, topic=topic,
+            encoding=encoding, priority=priority, deliver_at=deliver_at or None, partition_key=key,
+            idempotency_key=idempotency_key, expires_at=expires_at,
+        )
+    if record_type == RECORD_UPDATE:
+        _, raw_id, retries, state = UPDATE_BODY.unpack_from(body)
+        return record_type, UUID(bytes=raw_id), (state, retries)
+    if record_type == RECORD_ACK:
+        _, raw_id = ACK_BODY.unpack_from(body)
+        return record_type, UUID(bytes=raw_id), None
+    raise ValueError(f"Unknown record type: {record_type}")
+
+
+class SegmentLog:
+    '''
+    Append-only log split into numbered segment files.
+    Records are length-prefixed and CRC-checked, the active segment rolls over once it
+    grows past `segment_bytes`. Not thread safe, callers serialise access.
+    '''
+    def __init__(self, directory: str, segment_bytes: int, fsync: bool = True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._fsync = fsync
+        os.makedirs(self.directory, exist_ok=True)
+        self.segments: List[int] = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        if not self.segments:
+            self.segments.append(0)
+        self._active = None
+        self._active_size = 0
+
+    @property
+    def active_segment(self) -> int:
+        return self.segments[-1]
+
+    def path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:020d}{SEGMENT_SUFFIX}")
+
+    def open(self):
+        self._active = open(self.path(self.active_segment), "ab")
+        self._active_size = self._active.tell()
+
+    def append(self, records: List[bytes]) -> List[int]:
+        '''
+        Appends framed records and returns the segment each one landed in.
+        The write is made durable before returning.
+        '''
+        placed = []
+        buffer = bytearray()
+        for record in records:
+            if self._active_size + len(buffer) >= self.segment_bytes and (self._active_size or buffer):
+                self._write(buffer)
+                buffer = bytearray()
+                self._roll()
+            buffer += record
+            placed.append(self.active_segment)
+        self._write(buffer)
+        return placed
+
+    def sync(self):
+        self._active.flush()
+        if self._fsync:
+            os.fsync(self._active.fileno())
+
+    def _write(self, buffer: bytearray):
+        if buffer:
+            self._active.write(buffer)
+            self._active_size += len(buffer)
+        self.sync()
+
+    def _roll(self):
+        self._active.close()
+        self.segments.append(self.active_segment + 1)
+        self._active = open(self.path(self.active_segment), "ab")
+        self._active_size = 0
+
+    def read(self, segment: int, repair: bool = False) -> Iterator[bytes]:
+        '''
+        Yields record bodies of a segment in order. Reading stops at the first torn
+        or corrupt record, with `repair` the segment is truncated at that point.
+        '''
+        path = self.path(segment)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as f:
+            good = 0
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, crc = RECORD_HEADER.unpack(header)
+                body = f.read(length)
+                if len(body) < length or zlib.crc32(body) != crc:
+                    break
+                good = f.tell()
+                yield body
+        if repair and good < os.path.getsize(path):
+            logger.warning("Truncating corrupt tail of segment %s at offset %s", segment, good)
+            with open(path, "r+b") as f:
+                f.truncate(good)
+
+    def delete(self, segment: int):
+        self.segments.remove(segment)
+        os.remove(self.path(segment))
+
+    def truncate(self):
+        '''
+        Deletes every segment and continues in a new, empty one.
+        '''
+        self.close()
+        next_segment = self.active_segment + 1
+        for segment in list(self.segments):
+            self.delete(segment)
+        self.segments.append(next_segment)
+        self.open()
+
+    def close(self):
+        if self._active is not None:
+            self._active.close()
+            self._active = None
+
+
+@dataclass
+class _LiveEntry:
+    home: int                      # segment holding the latest full message record
+    state: int
+    retries: int
+    segments: Set[int] = field(default_factory=set)
+
+
+class LogPersistenceService:
+    '''
+    Persistence backend built on an append-only segment log, a drop in alternative
+    to the sqlite backed PersistenceService.
+
+    Messages are appended as full records, state changes as small update records and
+    acks as tombstones. Segments are only ever removed from the oldest end, so a
+    tombstone can never outlive a segment still holding the record it cancels.
+    A background compactor deletes the oldest segment once it has no live messages,
+    or copies its few remaining live messages forward when most of it is dead.
+    Acknowledged messages go with their segment: the log keeps no acknowledged history,
+    so the max_age and max_bytes of retention policies (see broker.retention) do not
+    apply to it, acknowledged messages are dropped as with delete_on_ack once their
+    segment is compacted. Message TTLs are enforced by the MessageService either way.
+    '''
+    BATCH_SIZE = 500
+    FLUSH_INTERVAL = 0.01
+    MAX_PENDING = 10000
+    REPLAY_BATCH = 1000
+    SEGMENT_BYTES = 64 * 1024 * 1024
+    COMPACT_INTERVAL = 10      # seconds between compaction passes
+    COMPACT_LIVE_RATIO = 0.1   # copy live messages forward when at most this share of a segment is live
+    KEY_RETENTION = 300.0      # seconds idempotency keys of published messages are looked up for
+
+    def __init__(self, is_async: bool, directory: str = "./message_log", segment_bytes: int = SEGMENT_BYTES,
+                 metrics: MetricsRegistry = None, key_retention: float = KEY_RETENTION,
+                 retention: RetentionPolicies = None):
+        self.directory = directory
+        self.key_retention = key_retention
+        self.retention = retention or RetentionPolicies()
+        limited = self.retention.keeping_history()
+        if limited:
+            logger.warning(
+                "The log backend keeps no acknowledged history, max_age and max_bytes are ignored "
+                "(retention policies of: %s)", ", ".join(limited)
+            )
+        self.lock = threading.Lock()
+        self.log = SegmentLog(directory, segment_bytes)
+        self._live: Dict[UUID, _LiveEntry] = {}
+        self._segment_live: Dict[int, int] = {}
+        self._segment_records: Dict[int, int] = {}
+        # Newest enqueued_at of a message with an idempotency key in each segment. Compaction
+        # keeps a segment until its keys are out of key_retention, acknowledged or not.
+        self._segment_keys: Dict[int, float] = {}
+        self._replays = 0   # running replays, compaction waits for them to finish
+        self._recover()
+        self.log.open()
+        self.metrics = metrics or MetricsRegistry()
+        self._errors = self.metrics.counter(
+            "broker_persistence_errors_total", "Persistence operations that could not be written"
+        )
+        self.metrics.gauge(
+            "broker_log_segments", "Segment files in the message log", callback=lambda: {(): len(self.log.segments)}
+        )
+        self.metrics.gauge(
+            "broker_log_live_messages", "Unacknowledged messages tracked by the log index",
+            callback=lambda: {(): len(self._live)},
+        )
+        self._writer = None
+        if is_async:
+            self._writer = WriteBehindQueue(
+                self._write_batch,
+                batch_size=self.BATCH_SIZE,
+                flush_interval=self.FLUSH_INTERVAL,
+                max_pending=self.MAX_PENDING,
+                name="log-persistence-writer",
+                metrics=self.metrics,
+            )
+        self._closed = threading.Event()
+        self._compactor = threading.Thread(target=self._compact_worker, daemon=True, name="log-compactor")
+        self._compactor.start()
+
+    # ---- same interface as PersistenceService ----
+    def log_message(self, message: Message):
+        self._submit((_INSERT, message))
+
+    def log_messages(self, messages):
+        self._submit_many([(_INSERT, message) for message in messages])
+
+    def ack_message(self, message_id: str):
+        self._submit((_ACK, UUID(str(message_id))))
+
+    def ack_messages(self, message_ids):
+        self._submit_many([(_ACK, UUID(str(message_id))) for message_id in message_ids])
+
+    def update_message(self, message: Message):
+        self._submit((_UPDATE, message))
+
+    def update_messages(self, messages):
+        self._submit_many([(_UPDATE, message) for message in messages])
+
+    def flush(self, timeout: float = None) -> bool:
+        if self._writer is None:
+            return True
+        return self._writer.flush(timeout)
+
+    def clear(self):
+        '''
+        Deletes every message, pending operations included. Used by replicas before they
+        load a snapshot of the leader's backlog.
+        '''
+        self.flush()
+        with self.lock:
+            self.log.truncate()
+            self._live.clear()
+            self._segment_live.clear()
+            self._segment_records.clear()
+            self._segment_keys.clear()
+
+    def close(self):
+        self._closed.set()
+        if self._writer is not None:
+            self._writer.close()
+        with self.lock:
+            self.log.close()
+
+    def get_unacknowledged_messages(self):
+        '''
+        Sequentially replays the log and returns every live message with its latest state.
+        '''
+        with self.lock:
+            live = {message_id: (entry.state, entry.retries) for message_id, entry in self._live.items()}
+            segments = list(self.log.segments)
+        messages = {}
+        for segment in segments:
+            for body in self.log.read(segment):
+                if body[0] not in MESSAGE_RECORDS:
+                    continue
+                _, message_id, message = decode_body(body)
+                if message_id in live:
+                    message.state, message.retries = live[message_id]
+                    messages[message_id] = message
+        return sorted(messages.values(), key=lambda m: m.enqueued_at)
+
+    def count_unacknowledged_messages(self) -> int:
+        with self.lock:
+            return len(self._live)
+
+    def iter_unacknowledged_batches(self, batch_size: int = REPLAY_BATCH):
+        '''
+        Streams live messages in log order as lists of up to batch_size messages, without
+        collecting them first. Each message is yielded from its home segment, so one copied
+        forward by compaction comes out at its new position rather than strictly by
+        enqueued_at. Messages logged after this call are not part of the replay.
+        '''
+        with self.lock:
+            live = {message_id: (entry.home, entry.state, entry.retries) for message_id, entry in self._live.items()}
+            segments = list(self.log.segments)
+            self._replays += 1
+        return self._replay_segments(live, segments, batch_size)
+
+    def iter_topic_backlogs(self, batch_size: int = REPLAY_BATCH):
+        '''
+        None, the log has no per topic index. Its backlog is replayed in one pass by
+        iter_unacknowledged_batches, ready queues over their memory budget spill the rest.
+        '''
+        return None
+
+    def iter_idempotency_keys(self, since: float = None):
+        '''
+        (topic, idempotency key, message id, enqueued_at) of the keyed messages published
+        since `since` (default: within key_retention), acknowledged ones included, in log
+        order. Only segments holding such keys are read.
+        '''
+        if since is None:
+            since = time.time() - self.key_retention
+        with self.lock:
+            segments = [segment for segment in self.log.segments if self._segment_keys.get(segment, 0.0) >= since]
+            self._replays += 1
+        return self._read_keys(segments, since)
+
+    def _read_keys(self, segments: List[int], since: float):
+        try:
+            for segment in segments:
+                for body in self.log.read(segment):
+                    if body[0] not in (RECORD_IDEMPOTENT, RECORD_EXPIRING):
+                        continue
+                    _, message_id, message = decode_body(body)
+                    if message.idempotency_key and message.enqueued_at >= since:
+                        yield message.topic, message.idempotency_key, message_id, message.enqueued_at
+        finally:
+            with self.lock:
+                self._replays -= 1
+
+    def _replay_segments(self, live, segments: List[int], batch_size: int):
+        try:
+            yield from self._read_live(live, segments, batch_size)
+        finally:
+            with self.lock:
+                self._replays -= 1
+
+    def _read_live(self, live, segments: List[int], batch_size: int):
+        batch = []
+        for segment in segments:
+            for body in self.log.read(segment):
+                if body[0] not in MESSAGE_RECORDS:
+                    continue
+                _, message_id, message = decode_body(body)
+                entry = live.get(message_id)
+                if entry is not None and entry[0] == segment:
+                    del live[message_id]
+                    message.state, message.retries = entry[1], entry[2]
+                    batch.append(message)
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+        if batch:
+            yield batch
+
+    # ---- writing ----
+    def _submit(self, op):
+        if self._writer is not None:
+            self._writer.put(op)
+        else:
+            self._write_batch([op])
+
+    def _submit_many(self, ops):
+        if not ops:
+            return
+        if self._writer is not None:
+            self._writer.put_many(ops)
+        else:
+            self._write_batch(ops)
+
+    def _write_batch(self, ops):
+        with self.lock:
+            records = []
+            applied = []
+            keyed = []   # message of each record that has an idempotency key, else None
+            inserted = set()   # not in the live index until the batch is applied
+            for kind, arg in ops:
+                if kind == _INSERT:
+                    inserted.add(arg.id)
+                    records.append(encode_message(arg))
+                    applied.append((RECORD_MESSAGE, arg.id, (_state_value(arg.state), arg.retries)))
+                    keyed.append(arg if arg.idempotency_key else None)
+                elif kind == _UPDATE:
+                    if arg.id not in self._live and arg.id not in inserted:
+                        continue
+                    state = _state_value(arg.state)
+                    records.append(encode_update(arg.id, state, arg.retries))
+                    applied.append((RECORD_UPDATE, arg.id, (state, arg.retries)))
+                    keyed.append(None)
+                elif kind == _ACK:
+                    if arg not in self._live and arg not in inserted:
+                        continue
+                    records.append(encode_ack(arg))
+                    applied.append((RECORD_ACK, arg, None))
+                    keyed.append(None)
+            try:
+                placed = self.log.append(records)
+            except OSError as e:
+                logger.error("Failed to append %d records to the log: %s", len(records), e)
+                self._errors.inc(len(records))
+                return
+            for (record_type, message_id, value), segment in zip(applied, placed):
+                self._apply(record_type, message_id, value, segment)
+            for message, segment in zip(keyed, placed):
+                if message is not None:
+                    self._keyed(message, segment)
+
+    def _apply(self, record_type: int, message_id: UUID, value, segment: int):
+        '''
+        Applies a record to the in-memory live index, used both when writing and on recovery.
+        '''
+        self._segment_records[segment] = self._segment_records.get(segment, 0) + 1
+        entry = self._live.get(message_id)
+        if record_type == RECORD_ACK:
+            if entry is not None:
+                del self._live[message_id]
+                for s in entry.segments:
+                    self._segment_live[s] -= 1
+            return
+        if record_type == RECORD_MESSAGE:
+            if entry is None:
+                entry = self._live[message_id] = _LiveEntry(home=segment, state=0, retries=0)
+            entry.home = segment
+        elif entry is None:
+            return
+        entry.state, entry.retries = value
+        if segment not in entry.segments:
+            entry.segments.add(segment)
+            self._segment_live[segment] = self._segment_live.get(segment, 0) + 1
+
+    def _keyed(self, message: Message, segment: int):
+        if message.enqueued_at and message.enqueued_at > self._segment_keys.get(segment, 0.0):
+            self._segment_keys[segment] = message.enqueued_at
+
+    # ---- recovery ----
+    def _recover(self):
+        for segment in self.log.segments:
+            repair = segment == self.log.active_segment
+            for body in self.log.read(segment, repair=repair):
+                try:
+                    record_type, message_id, value = decode_body(body)
+                except (ValueError, struct.error) as e:
+                    logger.warning("Skipping undecodable record in segment %s: %s", segment, e)
+                    continue
+                if record_type == RECORD_MESSAGE:
+                    if value.idempotency_key:
+                        self._keyed(value, segment)
+                    value = (_state_value(value.state), value.retries)
+                self._apply(record_type, message_id, value, segment)
+
+    # ---- compaction ----
+    def _compact_worker(self):
+        while not self._closed.wait(self.COMPACT_INTERVAL):
+            try:
+                self.compact()
+            except OSError as e:
+                logger.error("Log compaction failed: %s", e)
+
+    def compact(self) -> int:
+        '''
+        Removes old segments from the head of the log. Returns the number of segments removed.
+        Skipped while a replay is reading the segments, stops at a segment with idempotency
+        keys still within key_retention.
+        '''
+        removed = 0
+        keys_since = time.time() - self.key_retention
+        with self.lock:
+            while len(self.log.segments) > 1 and not self._replays:
+                oldest = self.log.segments[0]
+                live = self._segment_live.get(oldest, 0)
+                total = self._segment_records.get(oldest, 0)
+                if live and live > total * self.COMPACT_LIVE_RATIO:
+                    break
+                if self._segment_keys.get(oldest, 0.0) >= keys_since:
+                    break
+                if live:
+                    self._copy_forward(oldest)
+                self.log.delete(oldest)
+                self._segment_live.pop(oldest, None)
+                self._segment_records.pop(oldest, None)
+                self._segment_keys.pop(oldest, None)
+                removed += 1
+        return removed
+
+    def _copy_forward(self, segment: int):
+        '''
+        Rewrites the live messages whose full record is in `segment` at the end of the log,
+        carrying their latest state, and drops every other live reference to the segment.
+        '''
+        moved = []
+        for body in self.log.read(segment):
+            if body[0] not in MESSAGE_RECORDS:
+                continue
+            _, message_id, message = decode_body(body)
+            entry = self._live.get(message_id)
+            if entry is not None and entry.home == segment:
+                message.state, message.retries = entry.state, entry.retries
+                moved.append(message)
+        for entry in self._live.values():
+            if segment in entry.segments:
+                entry.segments.discard(segment)
+        placed = self.log.append([encode_message(m) for m in moved])
+        for message, new_segment in zip(moved, placed):
+            entry = self._live[message.id]
+            self._apply(RECORD_MESSAGE, message.id, (entry.state, entry.retries), new_segment)
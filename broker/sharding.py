@@ -0,0 +1,272 @@
+import itertools
+import logging
+import zlib
+from concurrent import futures
+from typing import Dict, List, Sequence
+from uuid import UUID, uuid4
+
+import grpc
+
+from broker.listing import decode_cursor
+from broker.metrics import render_samples
+from broker.models import DEFAULT_TOPIC
+from proto import broker_pb2, broker_pb2_grpc
+
+logger = logging.getLogger(__name__)
+
+# A sharded broker stores its shard index in the low bits of every message id, so
+# acks and touches, which only carry the id, can be routed back to the owning shard
+SHARD_MASK = 0xFFFF
+
+
+def shard_for_topic(topic: str, shards: int) -> int:
+    return zlib.crc32((topic or DEFAULT_TOPIC).encode("utf-8")) % shards
+
+
+def new_message_id(shard: int = None) -> UUID:
+    message_id = uuid4()
+    if shard is None:
+        return message_id
+    return UUID(int=(message_id.int & ~SHARD_MASK) | shard)
+
+
+def shard_of_message(message_id: str, shards: int) -> int | None:
+    try:
+        shard = UUID(str(message_id)).int & SHARD_MASK
+    except ValueError:
+        return None
+    return shard if shard < shards else None
+
+
+class ShardedBrokerStub:
+    '''
+    BrokerStub over the shards of a multi-process broker (see broker.supervisor).
+    Every topic lives on one shard, picked by crc32 of its name; publishes and streams go
+    to the topic's shard, acks and touches to the shard encoded in the message id, and
+    calls that are not about one topic are fanned out and merged.
+    Has the same call signatures as BrokerStub, so clients only swap the stub.
+    '''
+    def __init__(self, channels: Sequence[grpc.Channel]):
+        self.stubs = [broker_pb2_grpc.BrokerStub(channel) for channel in channels]
+
+    def for_topic(self, topic: str):
+        return self.stubs[shard_for_topic(topic, len(self.stubs))]
+
+    def _group(self, items, shard_of) -> Dict[int, List[int]]:
+        # shard -> indexes of the items it owns, in order
+        groups: Dict[int, List[int]] = {}
+        for i, item in enumerate(items):
+            groups.setdefault(shard_of(item), []).append(i)
+        return groups
+
+    # ---- Producer API ----
+    def Publish(self, request, **kwargs):
+        return self.for_topic(request.topic).Publish(request, **kwargs)
+
+    def PublishBatch(self, request, **kwargs):
+        messages = list(request.messages)
+        results = [None] * len(messages)
+        for shard, indexes in self._group(messages, lambda m: shard_for_topic(m.topic, len(self.stubs))).items():
+            response = self.stubs[shard].PublishBatch(
+                broker_pb2.PublishBatchRequest(messages=[messages[i] for i in indexes]), **kwargs
+            )
+            for i, result in zip(indexes, response.results):
+                results[i] = result
+        return broker_pb2.PublishBatchResponse(results=results)
+
+    # ---- Streaming API ----
+    def MessageStream(self, request_iterator, **kwargs):
+        # The stream goes to the shard of the topic in its first (subscribe) frame
+        requests = iter(request_iterator)
+        first = next(requests, None)
+        topic = first.subscribe.topic if first is not None and first.HasField("subscribe") else DEFAULT_TOPIC
+        head = [first] if first is not None else []
+        return self.for_topic(topic).MessageStream(itertools.chain(head, requests), **kwargs)
+
+    # ---- Control plane ----
+    def Ack(self, request, **kwargs):
+        shard = shard_of_message(request.message_id, len(self.stubs))
+        if shard is None:
+            return broker_pb2.AckResponse(success=False)
+        return self.stubs[shard].Ack(request, **kwargs)
+
+    def AckBatch(self, request, **kwargs):
+        message_ids = list(request.message_ids)
+        results = [broker_pb2.AckResult(message_id=message_id, success=False) for message_id in message_ids]
+        for shard, indexes in self._group(message_ids, lambda m: shard_of_message(m, len(self.stubs))).items():
+            if shard is None:
+                continue
+            response = self.stubs[shard].AckBatch(
+                broker_pb2.AckBatchRequest(message_ids=[message_ids[i] for i in indexes]), **kwargs
+            )
+            for i, result in zip(indexes, response.results):
+                results[i] = result
+        return broker_pb2.AckBatchResponse(results=results)
+
+    def Touch(self, request, **kwargs):
+        shard = shard_of_message(request.message_id, len(self.stubs))
+        if shard is None:
+            return broker_pb2.TouchResponse(success=False)
+        return self.stubs[shard].Touch(request, **kwargs)
+
+    def _topic_or_all(self, request):
+        return [self.for_topic(request.topic)] if request.topic else self.stubs
+
+    def GetDeadLetter(self, request, **kwargs):
+        messages = [m for stub in self._topic_or_all(request) for m in stub.GetDeadLetter(request, **kwargs).messages]
+        return broker_pb2.DeadLetterResponse(messages=messages)
+
+    def GetAllMessages(self, request, **kwargs):
+        messages = [m for stub in self._topic_or_all(request) for m in stub.GetAllMessages(request, **kwargs).messages]
+        return broker_pb2.AllMessagesResponse(messages=messages)
+
+    def StreamDeadLetter(self, request, **kwargs):
+        return self._listing("StreamDeadLetter", request, **kwargs)
+
+    def StreamAllMessages(self, request, **kwargs):
+        return self._listing("StreamAllMessages", request, **kwargs)
+
+    def _listing(self, method: str, request, **kwargs):
+        '''
+        Pages of every shard, one shard after the other. A cursor names the topic it is
+        in, so a listing resumes on that topic's shard and continues with the next ones.
+        '''
+        if request.topic:
+            yield from getattr(self.for_topic(request.topic), method)(request, **kwargs)
+            return
+        topic, _ = decode_cursor(request.cursor)
+        first = shard_for_topic(topic, len(self.stubs)) if request.cursor else 0
+        remaining = request.limit
+        for shard in range(first, len(self.stubs)):
+            last_shard = shard == len(self.stubs) - 1
+            shard_request = broker_pb2.ListRequest(
+                cursor=request.cursor if shard == first else "", page_size=request.page_size, limit=remaining,
+            )
+            end = True
+            for page in getattr(self.stubs[shard], method)(shard_request, **kwargs):
+                end = page.end
+                remaining -= len(page.messages) if request.limit else 0
+                if not last_shard and page.end:
+                    # The listing goes on with the next shard; an empty last page has no cursor to resume at
+                    if not page.messages:
+                        continue
+                    page.end = False
+                yield page
+            if not end or (request.limit and remaining <= 0):
+                return
+
+    def RedriveDeadLetter(self, request, **kwargs):
+        if request.topic:
+            return self.for_topic(request.topic).RedriveDeadLetter(request, **kwargs)
+        redriven = 0
+        if request.message_ids:
+            message_ids = list(request.message_ids)[:request.limit or None]
+            for shard, indexes in self._group(message_ids, lambda m: shard_of_message(m, len(self.stubs))).items():
+                if shard is None:
+                    continue
+                redriven += self.stubs[shard].RedriveDeadLetter(
+                    broker_pb2.RedriveRequest(message_ids=[message_ids[i] for i in indexes]), **kwargs
+                ).redriven
+            return broker_pb2.RedriveResponse(redriven=redriven)
+        for stub in self.stubs:
+            if request.limit and redriven >= request.limit:
+                break
+            redriven += stub.RedriveDeadLetter(
+                broker_pb2.RedriveRequest(limit=request.limit - redriven if request.limit else 0), **kwargs
+            ).redriven
+        return broker_pb2.RedriveResponse(redriven=redriven)
+
+    def ListTopics(self, request, **kwargs):
+        return broker_pb2.TopicsResponse(
+            topics=[topic for stub in self.stubs for topic in stub.ListTopics(request, **kwargs).topics]
+        )
+
+    def GetStats(self, request, **kwargs):
+        # Samples of every shard, told apart by a shard label
+        samples = [
+            broker_pb2.MetricSample(name=sample.name, labels={**sample.labels, "shard": str(shard)}, value=sample.value)
+            for shard, stub in enumerate(self.stubs)
+            for sample in stub.GetStats(request, **kwargs).samples
+        ]
+        text = render_samples((sample.name, dict(sample.labels), sample.value) for sample in samples)
+        return broker_pb2.StatsResponse(text=text, samples=samples)
+
+
+class RouterServicer(broker_pb2_grpc.BrokerServicer):
+    """
+    Broker service that forwards every call to the owning shard, for clients that
+    connect to a single address. Clients that can use ShardedBrokerStub themselves
+    skip this hop.
+    """
+
+    def __init__(self, shard_addresses: Sequence[str]):
+        self.channels = [grpc.insecure_channel(address) for address in shard_addresses]
+        self.stub = ShardedBrokerStub(self.channels)
+
+    def _forward(self, method: str, request, context):
+        try:
+            return getattr(self.stub, method)(request)
+        except grpc.RpcError as e:
+            context.abort(e.code(), e.details())
+
+    def Publish(self, request, context):
+        return self._forward("Publish", request, context)
+
+    def PublishBatch(self, request, context):
+        return self._forward("PublishBatch", request, context)
+
+    def MessageStream(self, request_iterator, context):
+        call = self.stub.MessageStream(request_iterator)
+        context.add_callback(call.cancel)
+        try:
+            yield from call
+        except grpc.RpcError as e:
+            if e.code() != grpc.StatusCode.CANCELLED:
+                context.abort(e.code(), e.details())
+
+    def Ack(self, request, context):
+        return self._forward("Ack", request, context)
+
+    def AckBatch(self, request, context):
+        return self._forward("AckBatch", request, context)
+
+    def Touch(self, request, context):
+        return self._forward("Touch", request, context)
+
+    def GetDeadLetter(self, request, context):
+        return self._forward("GetDeadLetter", request, context)
+
+    def GetAllMessages(self, request, context):
+        return self._forward("GetAllMessages", request, context)
+
+    def StreamDeadLetter(self, request, context):
+        yield from self._forward_pages("StreamDeadLetter", request, context)
+
+    def StreamAllMessages(self, request, context):
+        yield from self._forward_pages("StreamAllMessages", request, context)
+
+    def _forward_pages(self, method: str, request, context):
+        try:
+            yield from getattr(self.stub, method)(request)
+        except ValueError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        except grpc.RpcError as e:
+            context.abort(e.code(), e.details())
+
+    def RedriveDeadLetter(self, request, context):
+        return self._forward("RedriveDeadLetter", request, context)
+
+    def ListTopics(self, request, context):
+        return self._forward("ListTopics", request, context)
+
+    def GetStats(self, request, context):
+        return self._forward("GetStats", request, context)
+
+
+def serve_router(shard_addresses: Sequence[str], port: int = 50051, max_workers: int = 32):
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+    broker_pb2_grpc.add_BrokerServicer_to_server(RouterServicer(shard_addresses), server)
+    server.add_insecure_port(f"[::]:{port}")
+    server.start()
+    logger.info("Broker router started on :%s for %d shards", port, len(shard_addresses))
+    return server
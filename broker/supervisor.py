@@ -0,0 +1,135 @@
+import argparse
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import List
+
+from broker.sharding import serve_router
+
+logger = logging.getLogger(__name__)
+
+
+class Supervisor:
+    '''
+    Runs a multi-process broker: `shards` worker processes, each a complete broker
+    (python -m broker.broker) with its own storage and persistence file, listening on
+    base_port + 1 + shard. A worker owns the topics whose name hashes to its index
+    (see broker.sharding), so workers share nothing and each uses its own core.
+    Workers that exit are restarted with backoff; the persisted backlog of the shard
+    is replayed by the new process.
+    '''
+    RESTART_BACKOFF = 1.0   # seconds, doubled up to MAX_BACKOFF while a worker keeps failing
+    MAX_BACKOFF = 30.0
+    STABLE_AFTER = 30.0     # seconds a worker must run before its backoff is reset
+    WORKER = "Shard"        # what the workers are called in log lines
+
+    def __init__(self, shards: int, base_port: int = 50051, data_dir: str = "./shards",
+                 storage: str = "sqlite", worker_args: List[str] = None):
+        self.shards = shards
+        self.base_port = base_port
+        self.data_dir = data_dir
+        self.storage = storage
+        self.worker_args = list(worker_args or [])
+        self._processes: List[subprocess.Popen | None] = [None] * shards
+        self._started_at = [0.0] * shards
+        self._backoff = [self.RESTART_BACKOFF] * shards
+        self._stopping = threading.Event()
+
+    def port(self, shard: int) -> int:
+        return self.base_port + 1 + shard
+
+    @property
+    def addresses(self) -> List[str]:
+        return [f"localhost:{self.port(shard)}" for shard in range(self.shards)]
+
+    def _command(self, shard: int) -> List[str]:
+        suffix = ".db" if self.storage == "sqlite" else ""
+        return [
+            sys.executable, "-m", "broker.broker",
+            *self.worker_args,
+            "--storage", self.storage,
+            "--port", str(self.port(shard)),
+            "--data-path", os.path.join(self.data_dir, f"shard-{shard}{suffix}"),
+            "--spill-dir", os.path.join(self.data_dir, f"shard-{shard}.spill"),
+            "--shard", str(shard),
+        ]
+
+    def _launch(self, shard: int):
+        self._processes[shard] = subprocess.Popen(self._command(shard))
+        self._started_at[shard] = time.monotonic()
+        logger.info(
+            "%s %d started on :%d (pid %d)", self.WORKER, shard, self.port(shard), self._processes[shard].pid
+        )
+
+    def start(self):
+        os.makedirs(self.data_dir, exist_ok=True)
+        for shard in range(self.shards):
+            self._launch(shard)
+
+    def monitor(self, interval: float = 1.0):
+        '''
+        Restarts workers that exited until stop() is called.
+        '''
+        while not self._stopping.wait(interval):
+            for shard, process in enumerate(self._processes):
+                if process is None or process.poll() is None:
+                    continue
+                if time.monotonic() - self._started_at[shard] >= self.STABLE_AFTER:
+                    self._backoff[shard] = self.RESTART_BACKOFF
+                logger.warning(
+                    "%s %d exited with code %s, restarting in %.1fs",
+                    self.WORKER, shard, process.returncode, self._backoff[shard],
+                )
+                if self._stopping.wait(self._backoff[shard]):
+                    return
+                self._backoff[shard] = min(self._backoff[shard] * 2, self.MAX_BACKOFF)
+                self._launch(shard)
+
+    def stop(self, timeout: float = 10.0):
+        self._stopping.set()
+        for process in self._processes:
+            if process is not None and process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        for process in self._processes:
+            if process is None:
+                continue
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Multi-process broker: one broker process per shard plus a router on --port. "
+                    "Arguments not listed here (e.g. --compact-storage) are passed on to every shard.",
+    )
+    parser.add_argument("--shards", type=int, default=os.cpu_count() or 1,
+                        help="number of broker processes (default: number of cores)")
+    parser.add_argument("--port", type=int, default=50051,
+                        help="router port, shards listen on the following ports")
+    parser.add_argument("--data-dir", default="./shards", help="directory for the shards' persistence files")
+    parser.add_argument("--storage", choices=["sqlite", "log"], default="sqlite")
+    parser.add_argument("--no-router", action="store_true",
+                        help="only run the shards, for clients that route themselves (BROKER_SHARDS)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"])
+    args, worker_args = parser.parse_known_args()
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    supervisor = Supervisor(args.shards, args.port, args.data_dir, args.storage,
+                            worker_args + ["--log-level", args.log_level])
+    supervisor.start()
+    router = None if args.no_router else serve_router(supervisor.addresses, args.port)
+    logger.info("Shard addresses: BROKER_SHARDS=%s", ",".join(supervisor.addresses))
+    try:
+        supervisor.monitor()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if router is not None:
+            router.stop(0)
+        supervisor.stop()
@@ -24,37 +24,91 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0c\x62roker.proto\x12\x06\x62roker\"0\n\x0ePublishRequest\x12\r\n\x05topic\x18\x01 \x01(\t\x12\x0f\n\x07payload\x18\x02 \x01(\t\"%\n\x0fPublishResponse\x12\x12\n\nmessage_id\x18\x01 \x01(\t\"\xa7\x01\n\rBrokerMessage\x12\x12\n\nmessage_id\x18\x01 \x01(\t\x12\r\n\x05topic\x18\x02 \x01(\t\x12\x0c\n\x04\x64\x61ta\x18\x03 \x01(\t\x12\x13\n\x0b\x65nqueued_at\x18\x04 \x01(\x01\x12\x0f\n\x07retries\x18\x05 \x01(\x05\x12#\n\x05state\x18\x06 \x01(\x0e\x32\x14.broker.MessageState\x12\x1a\n\x12visibility_timeout\x18\x07 \x01(\x03\"\\\n\x0bNodeMessage\x12\x1a\n\x03\x61\x63k\x18\x01 \x01(\x0b\x32\x0b.broker.AckH\x00\x12&\n\theartbeat\x18\x02 \x01(\x0b\x32\x11.broker.HeartbeatH\x00\x42\t\n\x07payload\"\x19\n\x03\x41\x63k\x12\x12\n\nmessage_id\x18\x01 \x01(\t\" \n\nAckRequest\x12\x12\n\nmessage_id\x18\x01 \x01(\t\"\x1e\n\x0b\x41\x63kResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\"=\n\x12\x44\x65\x61\x64LetterResponse\x12\'\n\x08messages\x18\x01 \x03(\x0b\x32\x15.broker.BrokerMessage\">\n\x13\x41llMessagesResponse\x12\'\n\x08messages\x18\x01 \x03(\x0b\x32\x15.broker.BrokerMessage\"\x07\n\x05\x45mpty\"\x1e\n\tHeartbeat\x12\x11\n\ttimestamp\x18\x01 \x01(\x03*Y\n\x0cMessageState\x12\x0c\n\x08\x45NQUEUED\x10\x00\x12\x0e\n\nPROCESSING\x10\x01\x12\x0c\n\x08INFLIGHT\x10\x02\x12\x10\n\x0c\x41\x43KNOWLEDGED\x10\x03\x12\x0b\n\x07RETRIED\x10\x04\x32\xaf\x02\n\x06\x42roker\x12:\n\x07Publish\x12\x16.broker.PublishRequest\x1a\x17.broker.PublishResponse\x12?\n\rMessageStream\x12\x13.broker.NodeMessage\x1a\x15.broker.BrokerMessage(\x01\x30\x01\x12.\n\x03\x41\x63k\x12\x12.broker.AckRequest\x1a\x13.broker.AckResponse\x12:\n\rGetDeadLetter\x12\r.broker.Empty\x1a\x1a.broker.DeadLetterResponse\x12<\n\x0eGetAllMessages\x12\r.broker.Empty\x1a\x1b.broker.AllMessagesResponseb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0c\x62roker.proto\x12\x06\x62roker\"\xea\x01\n\x0ePublishRequest\x12\r\n\x05topic\x18\x01 \x01(\t\x12\x11\n\x07payload\x18\x02 \x01(\tH\x00\x12\x17\n\rpayload_bytes\x18\x03 \x01(\x0cH\x00\x12\x13\n\x0b\x63ompression\x18\x04 \x01(\t\x12\x10\n\x08priority\x18\x05 \x01(\x05\x12\x12\n\ndeliver_at\x18\x06 \x01(\x01\x12\x15\n\rdelay_seconds\x18\x07 \x01(\x01\x12\x15\n\rpartition_key\x18\x08 \x01(\t\x12\x17\n\x0fidempotency_key\x18\t \x01(\t\x12\x13\n\x0bttl_seconds\x18\n \x01(\x01\x42\x06\n\x04\x62ody\"%\n\x0fPublishResponse\x12\x12\n\nmessage_id\x18\x01 \x01(\t\"?\n\x13PublishBatchRequest\x12(\n\x08messages\x18\x01 \x03(\x0b\x32\x16.broker.PublishRequest\"@\n\x14PublishBatchResponse\x12(\n\x07results\x18\x01 \x03(\x0b\x32\x17.broker.PublishResponse\"\x95\x02\n\rBrokerMessage\x12\x12\n\nmessage_id\x18\x01 \x01(\t\x12\r\n\x05topic\x18\x02 \x01(\t\x12\x0e\n\x04\x64\x61ta\x18\x03 \x01(\tH\x00\x12\x14\n\ndata_bytes\x18\x08 \x01(\x0cH\x00\x12\x13\n\x0b\x65nqueued_at\x18\x04 \x01(\x01\x12\x0f\n\x07retries\x18\x05 \x01(\x05\x12#\n\x05state\x18\x06 \x01(\x0e\x32\x14.broker.MessageState\x12\x1a\n\x12visibility_timeout\x18\x07 \x01(\x03\x12\x10\n\x08\x65ncoding\x18\t \x01(\t\x12\x10\n\x08priority\x18\n \x01(\x05\x12\x11\n\tpartition\x18\x0b \x01(\x05\x12\x15\n\rpartition_key\x18\x0c \x01(\tB\x06\n\x04\x62ody\"\xe6\x01\n\x0bNodeMessage\x12\x1a\n\x03\x61\x63k\x18\x01 \x01(\x0b\x32\x0b.broker.AckH\x00\x12&\n\theartbeat\x18\x02 \x01(\x0b\x32\x11.broker.HeartbeatH\x00\x12&\n\tsubscribe\x18\x03 \x01(\x0b\x32\x11.broker.SubscribeH\x00\x12\x1e\n\x05touch\x18\x04 \x01(\x0b\x32\r.broker.TouchH\x00\x12\x1c\n\x04pull\x18\x05 \x01(\x0b\x32\x0c.broker.PullH\x00\x12\"\n\x07release\x18\x06 \x01(\x0b\x32\x0f.broker.ReleaseH\x00\x42\t\n\x07payload\"n\n\tSubscribe\x12\x10\n\x08prefetch\x18\x01 \x01(\x05\x12\x1a\n\x12visibility_timeout\x18\x02 \x01(\x03\x12\r\n\x05topic\x18\x03 \x01(\t\x12\x16\n\x0e\x63onsumer_group\x18\x04 \x01(\t\x12\x0c\n\x04pull\x18\x05 \x01(\x08\"\x16\n\x04Pull\x12\x0e\n\x06\x63redit\x18\x01 \x01(\x05\"\x1d\n\x07Release\x12\x12\n\nmessage_id\x18\x01 \x01(\t\"\x19\n\x03\x41\x63k\x12\x12\n\nmessage_id\x18\x01 \x01(\t\" \n\nAckRequest\x12\x12\n\nmessage_id\x18\x01 \x01(\t\"\x1e\n\x0b\x41\x63kResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\"&\n\x0f\x41\x63kBatchRequest\x12\x13\n\x0bmessage_ids\x18\x01 \x03(\t\"6\n\x10\x41\x63kBatchResponse\x12\"\n\x07results\x18\x01 \x03(\x0b\x32\x11.broker.AckResult\"0\n\tAckResult\x12\x12\n\nmessage_id\x18\x01 \x01(\t\x12\x0f\n\x07success\x18\x02 \x01(\x08\"7\n\x05Touch\x12\x12\n\nmessage_id\x18\x01 \x01(\t\x12\x1a\n\x12visibility_timeout\x18\x02 \x01(\x03\">\n\x0cTouchRequest\x12\x12\n\nmessage_id\x18\x01 \x01(\t\x12\x1a\n\x12visibility_timeout\x18\x02 \x01(\x03\" \n\rTouchResponse\x12\x0f\n\x07success\x18\x01 \x01(\x08\"=\n\x12\x44\x65\x61\x64LetterResponse\x12\'\n\x08messages\x18\x01 \x03(\x0b\x32\x15.broker.BrokerMessage\">\n\x13\x41llMessagesResponse\x12\'\n\x08messages\x18\x01 \x03(\x0b\x32\x15.broker.BrokerMessage\"N\n\x0bListRequest\x12\r\n\x05topic\x18\x01 \x01(\t\x12\x0e\n\x06\x63ursor\x18\x02 \x01(\t\x12\x11\n\tpage_size\x18\x03 \x01(\x05\x12\r\n\x05limit\x18\x04 \x01(\x05\"X\n\x0bMessagePage\x12\'\n\x08messages\x18\x01 \x03(\x0b\x32\x15.broker.BrokerMessage\x12\x13\n\x0bnext_cursor\x18\x02 \x01(\t\x12\x0b\n\x03\x65nd\x18\x03 \x01(\x08\"C\n\x0eRedriveRequest\x12\r\n\x05topic\x18\x01 \x01(\t\x12\x13\n\x0bmessage_ids\x18\x02 \x03(\t\x12\r\n\x05limit\x18\x03 \x01(\x05\"#\n\x0fRedriveResponse\x12\x10\n\x08redriven\x18\x01 \x01(\x03\"\x07\n\x05\x45mpty\"\x1d\n\x0cTopicRequest\x12\r\n\x05topic\x18\x01 \x01(\t\" \n\x0eTopicsResponse\x12\x0e\n\x06topics\x18\x01 \x03(\t\"\x8c\x01\n\x0cMetricSample\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x30\n\x06labels\x18\x02 \x03(\x0b\x32 .broker.MetricSample.LabelsEntry\x12\r\n\x05value\x18\x03 \x01(\x01\x1a-\n\x0bLabelsEntry\x12\x0b\n\x03key\x18\x01 \x01(\t\x12\r\n\x05value\x18\x02 \x01(\t:\x02\x38\x01\"D\n\rStatsResponse\x12\x0c\n\x04text\x18\x01 \x01(\t\x12%\n\x07samples\x18\x02 \x03(\x0b\x32\x14.broker.MetricSample\"\x1e\n\tHeartbeat\x12\x11\n\ttimestamp\x18\x01 \x01(\x03\"u\n\x10ReplicationBatch\x12\x0c\n\x04term\x18\x01 \x01(\x04\x12\x0e\n\x06leader\x18\x02 \x01(\t\x12\x11\n\tfirst_seq\x18\x03 \x01(\x04\x12\x0f\n\x07records\x18\x04 \x01(\x0c\x12\x10\n\x08snapshot\x18\x05 \x01(\x08\x12\r\n\x05reset\x18\x06 \x01(\x08\"3\n\x0eReplicationAck\x12\x0c\n\x04term\x18\x01 \x01(\x04\x12\x13\n\x0b\x61pplied_seq\x18\x02 \x01(\x04\"U\n\x0bVoteRequest\x12\x0c\n\x04term\x18\x01 \x01(\x04\x12\x11\n\tcandidate\x18\x02 \x01(\t\x12\x10\n\x08log_term\x18\x03 \x01(\x04\x12\x13\n\x0b\x61pplied_seq\x18\x04 \x01(\x04\"-\n\x0cVoteResponse\x12\x0c\n\x04term\x18\x01 \x01(\x04\x12\x0f\n\x07granted\x18\x02 \x01(\x08\"p\n\rReplicaStatus\x12\x0c\n\x04node\x18\x01 \x01(\t\x12\x0c\n\x04role\x18\x02 \x01(\t\x12\x0c\n\x04term\x18\x03 \x01(\x04\x12\x10\n\x08log_term\x18\x04 \x01(\x04\x12\x13\n\x0b\x61pplied_seq\x18\x05 \x01(\x04\x12\x0e\n\x06leader\x18\x06 \x01(\t*l\n\x0cMessageState\x12\x0c\n\x08\x45NQUEUED\x10\x00\x12\x0e\n\nPROCESSING\x10\x01\x12\x0c\n\x08INFLIGHT\x10\x02\x12\x10\n\x0c\x41\x43KNOWLEDGED\x10\x03\x12\x0b\n\x07RETRIED\x10\x04\x12\x11\n\rDEAD_LETTERED\x10\x05\x32\xab\x06\n\x06\x42roker\x12:\n\x07Publish\x12\x16.broker.PublishRequest\x1a\x17.broker.PublishResponse\x12I\n\x0cPublishBatch\x12\x1b.broker.PublishBatchRequest\x1a\x1c.broker.PublishBatchResponse\x12?\n\rMessageStream\x12\x13.broker.NodeMessage\x1a\x15.broker.BrokerMessage(\x01\x30\x01\x12.\n\x03\x41\x63k\x12\x12.broker.AckRequest\x1a\x13.broker.AckResponse\x12=\n\x08\x41\x63kBatch\x12\x17.broker.AckBatchRequest\x1a\x18.broker.AckBatchResponse\x12\x34\n\x05Touch\x12\x14.broker.TouchRequest\x1a\x15.broker.TouchResponse\x12\x41\n\rGetDeadLetter\x12\x14.broker.TopicRequest\x1a\x1a.broker.DeadLetterResponse\x12\x43\n\x0eGetAllMessages\x12\x14.broker.TopicRequest\x1a\x1b.broker.AllMessagesResponse\x12\x33\n\nListTopics\x12\r.broker.Empty\x1a\x16.broker.TopicsResponse\x12>\n\x10StreamDeadLetter\x12\x13.broker.ListRequest\x1a\x13.broker.MessagePage0\x01\x12?\n\x11StreamAllMessages\x12\x13.broker.ListRequest\x1a\x13.broker.MessagePage0\x01\x12\x44\n\x11RedriveDeadLetter\x12\x16.broker.RedriveRequest\x1a\x17.broker.RedriveResponse\x12\x30\n\x08GetStats\x12\r.broker.Empty\x1a\x15.broker.StatsResponse2\xc4\x01\n\x0bReplication\x12\x41\n\tReplicate\x12\x18.broker.ReplicationBatch\x1a\x16.broker.ReplicationAck(\x01\x30\x01\x12\x38\n\x0bRequestVote\x12\x13.broker.VoteRequest\x1a\x14.broker.VoteResponse\x12\x38\n\x10GetReplicaStatus\x12\r.broker.Empty\x1a\x15.broker.ReplicaStatusb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'broker_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
-  _globals['_MESSAGESTATE']._serialized_start=638
-  _globals['_MESSAGESTATE']._serialized_end=727
-  _globals['_PUBLISHREQUEST']._serialized_start=24
-  _globals['_PUBLISHREQUEST']._serialized_end=72
-  _globals['_PUBLISHRESPONSE']._serialized_start=74
-  _globals['_PUBLISHRESPONSE']._serialized_end=111
-  _globals['_BROKERMESSAGE']._serialized_start=114
-  _globals['_BROKERMESSAGE']._serialized_end=281
-  _globals['_NODEMESSAGE']._serialized_start=283
-  _globals['_NODEMESSAGE']._serialized_end=375
-  _globals['_ACK']._serialized_start=377
-  _globals['_ACK']._serialized_end=402
-  _globals['_ACKREQUEST']._serialized_start=404
-  _globals['_ACKREQUEST']._serialized_end=436
-  _globals['_ACKRESPONSE']._serialized_start=438
-  _globals['_ACKRESPONSE']._serialized_end=468
-  _globals['_DEADLETTERRESPONSE']._serialized_start=470
-  _globals['_DEADLETTERRESPONSE']._serialized_end=531
-  _globals['_ALLMESSAGESRESPONSE']._serialized_start=533
-  _globals['_ALLMESSAGESRESPONSE']._serialized_end=595
-  _globals['_EMPTY']._serialized_start=597
-  _globals['_EMPTY']._serialized_end=604
-  _globals['_HEARTBEAT']._serialized_start=606
-  _globals['_HEARTBEAT']._serialized_end=636
-  _globals['_BROKER']._serialized_start=730
-  _globals['_BROKER']._serialized_end=1033
+  _globals['_METRICSAMPLE_LABELSENTRY']._loaded_options = None
+  _globals['_METRICSAMPLE_LABELSENTRY']._serialized_options = b'8\001'
+  _globals['_MESSAGESTATE']._serialized_start=2647
+  _globals['_MESSAGESTATE']._serialized_end=2755
+  _globals['_PUBLISHREQUEST']._serialized_start=25
+  _globals['_PUBLISHREQUEST']._serialized_end=259
+  _globals['_PUBLISHRESPONSE']._serialized_start=261
+  _globals['_PUBLISHRESPONSE']._serialized_end=298
+  _globals['_PUBLISHBATCHREQUEST']._serialized_start=300
+  _globals['_PUBLISHBATCHREQUEST']._serialized_end=363
+  _globals['_PUBLISHBATCHRESPONSE']._serialized_start=365
+  _globals['_PUBLISHBATCHRESPONSE']._serialized_end=429
+  _globals['_BROKERMESSAGE']._serialized_start=432
+  _globals['_BROKERMESSAGE']._serialized_end=709
+  _globals['_NODEMESSAGE']._serialized_start=712
+  _globals['_NODEMESSAGE']._serialized_end=942
+  _globals['_SUBSCRIBE']._serialized_start=944
+  _globals['_SUBSCRIBE']._serialized_end=1054
+  _globals['_PULL']._serialized_start=1056
+  _globals['_PULL']._serialized_end=1078
+  _globals['_RELEASE']._serialized_start=1080
+  _globals['_RELEASE']._serialized_end=1109
+  _globals['_ACK']._serialized_start=1111
+  _globals['_ACK']._serialized_end=1136
+  _globals['_ACKREQUEST']._serialized_start=1138
+  _globals['_ACKREQUEST']._serialized_end=1170
+  _globals['_ACKRESPONSE']._serialized_start=1172
+  _globals['_ACKRESPONSE']._serialized_end=1202
+  _globals['_ACKBATCHREQUEST']._serialized_start=1204
+  _globals['_ACKBATCHREQUEST']._serialized_end=1242
+  _globals['_ACKBATCHRESPONSE']._serialized_start=1244
+  _globals['_ACKBATCHRESPONSE']._serialized_end=1298
+  _globals['_ACKRESULT']._serialized_start=1300
+  _globals['_ACKRESULT']._serialized_end=1348
+  _globals['_TOUCH']._serialized_start=1350
+  _globals['_TOUCH']._serialized_end=1405
+  _globals['_TOUCHREQUEST']._serialized_start=1407
+  _globals['_TOUCHREQUEST']._serialized_end=1469
+  _globals['_TOUCHRESPONSE']._serialized_start=1471
+  _globals['_TOUCHRESPONSE']._serialized_end=1503
+  _globals['_DEADLETTERRESPONSE']._serialized_start=1505
+  _globals['_DEADLETTERRESPONSE']._serialized_end=1566
+  _globals['_ALLMESSAGESRESPONSE']._serialized_start=1568
+  _globals['_ALLMESSAGESRESPONSE']._serialized_end=1630
+  _globals['_LISTREQUEST']._serialized_start=1632
+  _globals['_LISTREQUEST']._serialized_end=1710
+  _globals['_MESSAGEPAGE']._serialized_start=1712
+  _globals['_MESSAGEPAGE']._serialized_end=1800
+  _globals['_REDRIVEREQUEST']._serialized_start=1802
+  _globals['_REDRIVEREQUEST']._serialized_end=1869
+  _globals['_REDRIVERESPONSE']._serialized_start=1871
+  _globals['_REDRIVERESPONSE']._serialized_end=1906
+  _globals['_EMPTY']._serialized_start=1908
+  _globals['_EMPTY']._serialized_end=1915
+  _globals['_TOPICREQUEST']._serialized_start=1917
+  _globals['_TOPICREQUEST']._serialized_end=1946
+  _globals['_TOPICSRESPONSE']._serialized_start=1948
+  _globals['_TOPICSRESPONSE']._serialized_end=1980
+  _globals['_METRICSAMPLE']._serialized_start=1983
+  _globals['_METRICSAMPLE']._serialized_end=2123
+  _globals['_METRICSAMPLE_LABELSENTRY']._serialized_start=2078
+  _globals['_METRICSAMPLE_LABELSENTRY']._serialized_end=2123
+  _globals['_STATSRESPONSE']._serialized_start=2125
+  _globals['_STATSRESPONSE']._serialized_end=2193
+  _globals['_HEARTBEAT']._serialized_start=2195
+  _globals['_HEARTBEAT']._serialized_end=2225
+  _globals['_REPLICATIONBATCH']._serialized_start=2227
+  _globals['_REPLICATIONBATCH']._serialized_end=2344
+  _globals['_REPLICATIONACK']._serialized_start=2346
+  _globals['_REPLICATIONACK']._serialized_end=2397
+  _globals['_VOTEREQUEST']._serialized_start=2399
+  _globals['_VOTEREQUEST']._serialized_end=2484
+  _globals['_VOTERESPONSE']._serialized_start=2486
+  _globals['_VOTERESPONSE']._serialized_end=2531
+  _globals['_REPLICASTATUS']._serialized_start=2533
+  _globals['_REPLICASTATUS']._serialized_end=2645
+  _globals['_BROKER']._serialized_start=2758
+  _globals['_BROKER']._serialized_end=3569
+  _globals['_REPLICATION']._serialized_start=3572
+  _globals['_REPLICATION']._serialized_end=3768
 # @@protoc_insertion_point(module_scope)
@@ -5,7 +5,7 @@ import warnings
 
 import proto.broker_pb2 as broker__pb2
 
-GRPC_GENERATED_VERSION = '1.74.0'
+GRPC_GENERATED_VERSION = '1.75.0'
 GRPC_VERSION = grpc.__version__
 _version_not_supported = False
 
@@ -39,6 +39,11 @@ class BrokerStub(object):
                 request_serializer=broker__pb2.PublishRequest.SerializeToString,
                 response_deserializer=broker__pb2.PublishResponse.FromString,
                 _registered_method=True)
+        self.PublishBatch = channel.unary_unary(
+                '/broker.Broker/PublishBatch',
+                request_serializer=broker__pb2.PublishBatchRequest.SerializeToString,
+                response_deserializer=broker__pb2.PublishBatchResponse.FromString,
+                _registered_method=True)
         self.MessageStream = channel.stream_stream(
                 '/broker.Broker/MessageStream',
                 request_serializer=broker__pb2.NodeMessage.SerializeToString,
@@ -49,16 +54,51 @@ class BrokerStub(object):
                 request_serializer=broker__pb2.AckRequest.SerializeToString,
                 response_deserializer=broker__pb2.AckResponse.FromString,
                 _registered_method=True)
+        self.AckBatch = channel.unary_unary(
+                '/broker.Broker/AckBatch',
+                request_serializer=broker__pb2.AckBatchRequest.SerializeToString,
+                response_deserializer=broker__pb2.AckBatchResponse.FromString,
+                _registered_method=True)
+        self.Touch = channel.unary_unary(
+                '/broker.Broker/Touch',
+                request_serializer=broker__pb2.TouchRequest.SerializeToString,
+                response_deserializer=broker__pb2.TouchResponse.FromString,
+                _registered_method=True)
         self.GetDeadLetter = channel.unary_unary(
                 '/broker.Broker/GetDeadLetter',
-                request_serializer=broker__pb2.Empty.SerializeToString,
+                request_serializer=broker__pb2.TopicRequest.SerializeToString,
                 response_deserializer=broker__pb2.DeadLetterResponse.FromString,
                 _registered_method=True)
         self.GetAllMessages = channel.unary_unary(
                 '/broker.Broker/GetAllMessages',
-                request_serializer=broker__pb2.Empty.SerializeToString,
+                request_serializer=broker__pb2.TopicRequest.SerializeToString,
                 response_deserializer=broker__pb2.AllMessagesResponse.FromString,
                 _registered_method=True)
+        self.ListTopics = channel.unary_unary(
+                '/broker.Broker/ListTopics',
+                request_serializer=broker__pb2.Empty.SerializeToString,
+                response_deserializer=broker__pb2.TopicsResponse.FromString,
+                _registered_method=True)
+        self.StreamDeadLetter = channel.unary_stream(
+                '/broker.Broker/StreamDeadLetter',
+                request_serializer=broker__pb2.ListRequest.SerializeToString,
+                response_deserializer=broker__pb2.MessagePage.FromString,
+                _registered_method=True)
+        self.StreamAllMessages = channel.unary_stream(
+                '/broker.Broker/StreamAllMessages',
+                request_serializer=broker__pb2.ListRequest.SerializeToString,
+                response_deserializer=broker__pb2.MessagePage.FromString,
+                _registered_method=True)
+        self.RedriveDeadLetter = channel.unary_unary(
+                '/broker.Broker/RedriveDeadLetter',
+                request_serializer=broker__pb2.RedriveRequest.SerializeToString,
+                response_deserializer=broker__pb2.RedriveResponse.FromString,
+                _registered_method=True)
+        self.GetStats = channel.unary_unary(
+                '/broker.Broker/GetStats',
+                request_serializer=broker__pb2.Empty.SerializeToString,
+                response_deserializer=broker__pb2.StatsResponse.FromString,
+                _registered_method=True)
 
 
 class BrokerServicer(object):
@@ -71,6 +111,12 @@ class BrokerServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def PublishBatch(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def MessageStream(self, request_iterator, context):
         """API nodes -> open bidirectional stream for delivery + acks
         """
@@ -85,6 +131,18 @@ class BrokerServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def AckBatch(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Touch(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def GetDeadLetter(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -97,6 +155,40 @@ class BrokerServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def ListTopics(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def StreamDeadLetter(self, request, context):
+        """Listings of any size, streamed one page per response and resumable from the
+        cursor of any page
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def StreamAllMessages(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def RedriveDeadLetter(self, request, context):
+        """Moves dead lettered messages back to their topic's queue
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GetStats(self, request, context):
+        """Metrics (queue depth, rates, persistence and delivery latencies)
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_BrokerServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -105,6 +197,11 @@ def add_BrokerServicer_to_server(servicer, server):
                     request_deserializer=broker__pb2.PublishRequest.FromString,
                     response_serializer=broker__pb2.PublishResponse.SerializeToString,
             ),
+            'PublishBatch': grpc.unary_unary_rpc_method_handler(
+                    servicer.PublishBatch,
+                    request_deserializer=broker__pb2.PublishBatchRequest.FromString,
+                    response_serializer=broker__pb2.PublishBatchResponse.SerializeToString,
+            ),
             'MessageStream': grpc.stream_stream_rpc_method_handler(
                     servicer.MessageStream,
                     request_deserializer=broker__pb2.NodeMessage.FromString,
@@ -115,16 +212,51 @@ def add_BrokerServicer_to_server(servicer, server):
                     request_deserializer=broker__pb2.AckRequest.FromString,
                     response_serializer=broker__pb2.AckResponse.SerializeToString,
             ),
+            'AckBatch': grpc.unary_unary_rpc_method_handler(
+                    servicer.AckBatch,
+                    request_deserializer=broker__pb2.AckBatchRequest.FromString,
+                    response_serializer=broker__pb2.AckBatchResponse.SerializeToString,
+            ),
+            'Touch': grpc.unary_unary_rpc_method_handler(
+                    servicer.Touch,
+                    request_deserializer=broker__pb2.TouchRequest.FromString,
+                    response_serializer=broker__pb2.TouchResponse.SerializeToString,
+            ),
             'GetDeadLetter': grpc.unary_unary_rpc_method_handler(
                     servicer.GetDeadLetter,
-                    request_deserializer=broker__pb2.Empty.FromString,
+                    request_deserializer=broker__pb2.TopicRequest.FromString,
                     response_serializer=broker__pb2.DeadLetterResponse.SerializeToString,
             ),
             'GetAllMessages': grpc.unary_unary_rpc_method_handler(
                     servicer.GetAllMessages,
-                    request_deserializer=broker__pb2.Empty.FromString,
+                    request_deserializer=broker__pb2.TopicRequest.FromString,
                     response_serializer=broker__pb2.AllMessagesResponse.SerializeToString,
             ),
+            'ListTopics': grpc.unary_unary_rpc_method_handler(
+                    servicer.ListTopics,
+                    request_deserializer=broker__pb2.Empty.FromString,
+                    response_serializer=broker__pb2.TopicsResponse.SerializeToString,
+            ),
+            'StreamDeadLetter': grpc.unary_stream_rpc_method_handler(
+                    servicer.StreamDeadLetter,
+                    request_deserializer=broker__pb2.ListRequest.FromString,
+                    response_serializer=broker__pb2.MessagePage.SerializeToString,
+            ),
+            'StreamAllMessages': grpc.unary_stream_rpc_method_handler(
+                    servicer.StreamAllMessages,
+                    request_deserializer=broker__pb2.ListRequest.FromString,
+                    response_serializer=broker__pb2.MessagePage.SerializeToString,
+            ),
+            'RedriveDeadLetter': grpc.unary_unary_rpc_method_handler(
+                    servicer.RedriveDeadLetter,
+                    request_deserializer=broker__pb2.RedriveRequest.FromString,
+                    response_serializer=broker__pb2.RedriveResponse.SerializeToString,
+            ),
+            'GetStats': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetStats,
+                    request_deserializer=broker__pb2.Empty.FromString,
+                    response_serializer=broker__pb2.StatsResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'broker.Broker', rpc_method_handlers)
@@ -163,6 +295,33 @@ class Broker(object):
             metadata,
             _registered_method=True)
 
+    @staticmethod
+    def PublishBatch(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/broker.Broker/PublishBatch',
+            broker__pb2.PublishBatchRequest.SerializeToString,
+            broker__pb2.PublishBatchResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
     @staticmethod
     def MessageStream(request_iterator,
             target,
@@ -217,6 +376,60 @@ class Broker(object):
             metadata,
             _registered_method=True)
 
+    @staticmethod
+    def AckBatch(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/broker.Broker/AckBatch',
+            broker__pb2.AckBatchRequest.SerializeToString,
+            broker__pb2.AckBatchResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def Touch(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/broker.Broker/Touch',
+            broker__pb2.TouchRequest.SerializeToString,
+            broker__pb2.TouchResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
     @staticmethod
     def GetDeadLetter(request,
             target,
@@ -232,7 +445,7 @@ class Broker(object):
             request,
             target,
             '/broker.Broker/GetDeadLetter',
-            broker__pb2.Empty.SerializeToString,
+            broker__pb2.TopicRequest.SerializeToString,
             broker__pb2.DeadLetterResponse.FromString,
             options,
             channel_credentials,
@@ -259,7 +472,7 @@ class Broker(object):
             request,
             target,
             '/broker.Broker/GetAllMessages',
-            broker__pb2.Empty.SerializeToString,
+            broker__pb2.TopicRequest.SerializeToString,
             broker__pb2.AllMessagesResponse.FromString,
             options,
             channel_credentials,
@@ -270,3 +483,304 @@ class Broker(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def ListTopics(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/broker.Broker/ListTopics',
+            broker__pb2.Empty.SerializeToString,
+            broker__pb2.TopicsResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def StreamDeadLetter(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/broker.Broker/StreamDeadLetter',
+            broker__pb2.ListRequest.SerializeToString,
+            broker__pb2.MessagePage.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def StreamAllMessages(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/broker.Broker/StreamAllMessages',
+            broker__pb2.ListRequest.SerializeToString,
+            broker__pb2.MessagePage.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def RedriveDeadLetter(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/broker.Broker/RedriveDeadLetter',
+            broker__pb2.RedriveRequest.SerializeToString,
+            broker__pb2.RedriveResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def GetStats(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/broker.Broker/GetStats',
+            broker__pb2.Empty.SerializeToString,
+            broker__pb2.StatsResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+
+class ReplicationStub(object):
+    """Replication between the brokers of a cluster (see broker.replication)
+    """
+
+    def __init__(self, channel):
+        """Constructor.
+
+        Args:
+            channel: A grpc.Channel.
+        """
+        self.Replicate = channel.stream_stream(
+                '/broker.Replication/Replicate',
+                request_serializer=broker__pb2.ReplicationBatch.SerializeToString,
+                response_deserializer=broker__pb2.ReplicationAck.FromString,
+                _registered_method=True)
+        self.RequestVote = channel.unary_unary(
+                '/broker.Replication/RequestVote',
+                request_serializer=broker__pb2.VoteRequest.SerializeToString,
+                response_deserializer=broker__pb2.VoteResponse.FromString,
+                _registered_method=True)
+        self.GetReplicaStatus = channel.unary_unary(
+                '/broker.Replication/GetReplicaStatus',
+                request_serializer=broker__pb2.Empty.SerializeToString,
+                response_deserializer=broker__pb2.ReplicaStatus.FromString,
+                _registered_method=True)
+
+
+class ReplicationServicer(object):
+    """Replication between the brokers of a cluster (see broker.replication)
+    """
+
+    def Replicate(self, request_iterator, context):
+        """Leader -> follower: batches of persistence log records, answered with the
+        log position the follower has made durable. Batches are sent without waiting
+        for the previous answer.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def RequestVote(self, request, context):
+        """Candidate -> peers when the leader stopped sending
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GetReplicaStatus(self, request, context):
+        """Role and log position of a broker, used by the leader and by clients looking for it
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+
+def add_ReplicationServicer_to_server(servicer, server):
+    rpc_method_handlers = {
+            'Replicate': grpc.stream_stream_rpc_method_handler(
+                    servicer.Replicate,
+                    request_deserializer=broker__pb2.ReplicationBatch.FromString,
+                    response_serializer=broker__pb2.ReplicationAck.SerializeToString,
+            ),
+            'RequestVote': grpc.unary_unary_rpc_method_handler(
+                    servicer.RequestVote,
+                    request_deserializer=broker__pb2.VoteRequest.FromString,
+                    response_serializer=broker__pb2.VoteResponse.SerializeToString,
+            ),
+            'GetReplicaStatus': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetReplicaStatus,
+                    request_deserializer=broker__pb2.Empty.FromString,
+                    response_serializer=broker__pb2.ReplicaStatus.SerializeToString,
+            ),
+    }
+    generic_handler = grpc.method_handlers_generic_handler(
+            'broker.Replication', rpc_method_handlers)
+    server.add_generic_rpc_handlers((generic_handler,))
+    server.add_registered_method_handlers('broker.Replication', rpc_method_handlers)
+
+
+ # This class is part of an EXPERIMENTAL API.
+class Replication(object):
+    """Replication between the brokers of a cluster (see broker.replication)
+    """
+
+    @staticmethod
+    def Replicate(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(
+            request_iterator,
+            target,
+            '/broker.Replication/Replicate',
+            broker__pb2.ReplicationBatch.SerializeToString,
+            broker__pb2.ReplicationAck.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def RequestVote(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/broker.Replication/RequestVote',
+            broker__pb2.VoteRequest.SerializeToString,
+            broker__pb2.VoteResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def GetReplicaStatus(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/broker.Replication/GetReplicaStatus',
+            broker__pb2.Empty.SerializeToString,
+            broker__pb2.ReplicaStatus.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
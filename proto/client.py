@@ -0,0 +1,389 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List
+from uuid import uuid4
+
+import grpc
+
+from broker.compression import decompress
+from proto import broker_pb2, broker_pb2_grpc
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOPIC = "default"
+
+# Failures worth another attempt, anything else fails the batch right away
+RETRYABLE = (
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+    grpc.StatusCode.ABORTED,
+)
+
+
+def _stub(target):
+    # (stub, channel to close or None) for an address or a ready stub: BrokerStub,
+    # ShardedBrokerStub or ReplicatedBrokerStub
+    if isinstance(target, str):
+        channel = grpc.insecure_channel(target)
+        return broker_pb2_grpc.BrokerStub(channel), channel
+    return target, None
+
+
+def payload(message: broker_pb2.BrokerMessage):
+    '''
+    Payload of a delivered message: str for text, bytes for binary payloads,
+    decompressed if the broker stored it compressed. Compressed binary payloads that
+    happen to be valid UTF-8 come back as str.
+    '''
+    if message.WhichOneof("body") != "data_bytes":
+        return message.data
+    if not message.encoding:
+        return message.data_bytes
+    data = decompress(message.data_bytes, message.encoding)
+    # Compressed payloads may have been published as text, which comes back as UTF-8
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data
+
+
+class _Batch:
+    def __init__(self, topic: str, deadline: float):
+        self.topic = topic
+        self.deadline = deadline
+        self.requests: List[broker_pb2.PublishRequest] = []
+        self.futures: List[Future] = []
+        self.size = 0
+
+
+class Producer:
+    '''
+    Publishes messages in batches. send() returns right away with a Future of the
+    message id; messages are collected per topic and a topic's batch is published with
+    one PublishBatch call once it holds max_batch_bytes or its oldest message waited
+    linger_ms. A topic has one batch in flight at a time, so its messages are stored in
+    send order, and its next batch keeps filling (up to max_batch_bytes) meanwhile.
+    All calls share one long-lived channel (an HTTP/2 connection multiplexing the
+    calls), at most max_in_flight batches of different topics are published at once and
+    send() blocks while max_buffer_bytes of messages wait unpublished.
+    Batches that fail with a transient error are retried with exponential backoff up to
+    `retries` times. A retried batch may already have been stored by the broker; with
+    idempotent=True every message gets an idempotency key so the broker drops such
+    duplicates.
+    Works on any broker stub (BrokerStub, ShardedBrokerStub, ReplicatedBrokerStub) or
+    an address; for asyncio code, asyncio.wrap_future turns the results into awaitables.
+    '''
+    LINGER_MS = 5
+    MAX_BATCH_BYTES = 1 << 20
+    MAX_IN_FLIGHT = 4
+    MAX_BUFFER_BYTES = 32 << 20
+    RETRIES = 5
+    RETRY_BACKOFF = 0.1   # seconds before the first retry, doubled up to MAX_BACKOFF
+    MAX_BACKOFF = 5.0
+    REQUEST_TIMEOUT = 30.0
+
+    def __init__(self, target, linger_ms: float = LINGER_MS, max_batch_bytes: int = MAX_BATCH_BYTES,
+                 max_in_flight: int = MAX_IN_FLIGHT, max_buffer_bytes: int = MAX_BUFFER_BYTES,
+                 retries: int = RETRIES, idempotent: bool = False, request_timeout: float = REQUEST_TIMEOUT):
+        self.stub, self._channel = _stub(target)
+        self.linger = linger_ms / 1000
+        self.max_batch_bytes = max_batch_bytes
+        self.max_buffer_bytes = max_buffer_bytes
+        self.retries = retries
+        self.idempotent = idempotent
+        self.request_timeout = request_timeout
+        self._batches: Dict[str, _Batch] = {}   # topic -> batch being filled
+        self._ready: List[_Batch] = []          # batches to publish, oldest first
+        self._sending = set()                   # topics with a batch in flight
+        self._buffered = 0     # bytes of messages not yet published
+        self._unfinished = 0   # messages whose future is not done
+        self._flushing = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._slots = threading.Semaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_in_flight, thread_name_prefix="producer-publish")
+        self._sender = threading.Thread(target=self._run, daemon=True, name="producer-sender")
+        self._sender.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, data, topic: str = DEFAULT_TOPIC, priority: int = 0, delay_seconds: float = 0,
+             deliver_at: float = 0, partition_key: str = "", idempotency_key: str = "",
+             compression: str = "", ttl_seconds: float = 0) -> Future:
+        '''
+        Queues a message (str or bytes) for publishing. The Future resolves to its message
+        id, or to the grpc.RpcError its batch finally failed with.
+        '''
+        request = broker_pb2.PublishRequest(
+            topic=topic, compression=compression, priority=priority, delay_seconds=delay_seconds,
+            deliver_at=deliver_at, partition_key=partition_key, idempotency_key=idempotency_key,
+            ttl_seconds=ttl_seconds,
+        )
+        if isinstance(data, bytes):
+            request.payload_bytes = data
+        else:
+            request.payload = data
+        if self.idempotent and not idempotency_key:
+            request.idempotency_key = str(uuid4())
+        size = request.ByteSize()
+        future = Future()
+        with self._cond:
+            # Backpressure: wait for published batches to make room
+            while self._buffered and self._buffered + size > self.max_buffer_bytes and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                raise RuntimeError("Producer is closed")
+            batch = self._batches.get(topic)
+            # The sender only needs waking for a new deadline or a batch to publish
+            wake = batch is None
+            if batch is not None and batch.size + size > self.max_batch_bytes:
+                self._cut(batch)
+                batch, wake = None, True
+            if batch is None:
+                batch = self._batches[topic] = _Batch(topic, time.monotonic() + self.linger)
+            batch.requests.append(request)
+            batch.futures.append(future)
+            batch.size += size
+            self._buffered += size
+            self._unfinished += 1
+            if batch.size >= self.max_batch_bytes:
+                self._cut(batch)
+                wake = True
+            if wake:
+                self._cond.notify_all()
+        return future
+
+    def flush(self, timeout: float = None) -> bool:
+        '''
+        Publishes the open batches without waiting for their linger and returns once every
+        message sent so far is published or failed; False if that took over timeout.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._unfinished:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                return True
+            finally:
+                self._flushing -= 1
+
+    def close(self, timeout: float = None):
+        '''
+        Publishes what was sent and stops the producer.
+        '''
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._sender.join(timeout)
+        self._executor.shutdown(wait=False)
+        if self._channel is not None:
+            self._channel.close()
+
+    def _cut(self, batch: _Batch):
+        # Closes a topic's batch for publishing, later messages start a new one
+        del self._batches[batch.topic]
+        self._ready.append(batch)
+
+    def _next_batch(self) -> _Batch | None:
+        # Called with the condition held; waits for a batch that is due
+        while True:
+            now = time.monotonic()
+            for batch in list(self._batches.values()):
+                due = self._flushing or self._closed or batch.deadline <= now
+                if due and batch.topic not in self._sending:
+                    self._cut(batch)
+            for i, batch in enumerate(self._ready):
+                if batch.topic not in self._sending:
+                    self._sending.add(batch.topic)
+                    return self._ready.pop(i)
+            if self._closed and not self._ready and not self._batches:
+                return None
+            deadlines = [batch.deadline for batch in self._batches.values() if batch.topic not in self._sending]
+            self._cond.wait(min(deadlines) - now if deadlines else None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._next_batch()
+            if batch is None:
+                return
+            # Bounds the batches in flight, a full window holds back the next one
+            self._slots.acquire()
+            self._executor.submit(self._publish, batch)
+
+    def _publish(self, batch: _Batch):
+        try:
+            request = broker_pb2.PublishBatchRequest(messages=batch.requests)
+            backoff = self.RETRY_BACKOFF
+            for attempt in range(self.retries + 1):
+                try:
+                    response = self.stub.PublishBatch(request, timeout=self.request_timeout)
+                except grpc.RpcError as e:
+                    if e.code() not in RETRYABLE or attempt == self.retries:
+                        for future in batch.futures:
+                            future.set_exception(e)
+                        return
+                    logger.warning("Publishing %d messages to %s failed: %s, retrying in %.1fs",
+                                   len(batch.requests), batch.topic, e.code(), backoff)
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, self.MAX_BACKOFF)
+                    continue
+                for future, result in zip(batch.futures, response.results):
+                    future.set_result(result.message_id)
+                return
+        except Exception as e:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._slots.release()
+            with self._cond:
+                self._sending.discard(batch.topic)
+                self._buffered -= batch.size
+                self._unfinished -= len(batch.futures)
+                self._cond.notify_all()
+
+
+class Consumer:
+    '''
+    Receives the messages of a topic over one long-lived MessageStream, reconnecting
+    with backoff if the broker goes away. The broker pushes up to `prefetch`
+    unacknowledged messages ahead, so receiving rarely waits on the network.
+    Acks are collected and sent with one AckBatch call once ack_batch of them are
+    waiting or ack_interval_ms after the first; every ack returns credit to the stream.
+    With auto_ack, iterating the consumer acks each message when the next one is
+    requested, i.e. after the loop body handled it; the message a loop breaks out of
+    is left unacknowledged.
+    '''
+    PREFETCH = 100
+    ACK_BATCH = 100
+    ACK_INTERVAL_MS = 50
+    RECONNECT_BACKOFF = 0.5   # seconds, doubled up to MAX_BACKOFF on repeated failures
+    MAX_BACKOFF = 10.0
+    REQUEST_TIMEOUT = 30.0
+
+    def __init__(self, target, topic: str = DEFAULT_TOPIC, prefetch: int = PREFETCH,
+                 visibility_timeout: int = 0, consumer_group: str = "", auto_ack: bool = True,
+                 ack_batch: int = ACK_BATCH, ack_interval_ms: float = ACK_INTERVAL_MS):
+        self.stub, self._channel = _stub(target)
+        self.topic = topic
+        self.subscribe = broker_pb2.Subscribe(
+            topic=topic, prefetch=prefetch, visibility_timeout=visibility_timeout, consumer_group=consumer_group,
+        )
+        self.auto_ack = auto_ack
+        self.ack_batch = ack_batch
+        self.ack_interval = ack_interval_ms / 1000
+        self._messages = queue.Queue()
+        self._acks: List[str] = []
+        self._acks_due = None   # monotonic time the waiting acks are sent at
+        self._cond = threading.Condition()
+        self._call = None
+        self._closed = threading.Event()
+        self._reader = threading.Thread(target=self._read, daemon=True, name=f"consumer-stream-{topic}")
+        self._acker = threading.Thread(target=self._send_acks, daemon=True, name=f"consumer-acks-{topic}")
+        self._reader.start()
+        self._acker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        '''
+        Yields messages until the consumer is closed.
+        '''
+        while not self._closed.is_set():
+            message = self.receive(timeout=self.RECONNECT_BACKOFF)
+            if message is None:
+                continue
+            yield message
+            if self.auto_ack:
+                self.ack(message.message_id)
+
+    def receive(self, timeout: float = None) -> broker_pb2.BrokerMessage | None:
+        '''
+        Next message, None if none arrived within timeout.
+        '''
+        try:
+            return self._messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def ack(self, message_id: str):
+        with self._cond:
+            self._acks.append(message_id)
+            if self._acks_due is None:
+                self._acks_due = time.monotonic() + self.ack_interval
+                self._cond.notify()
+            elif len(self._acks) >= self.ack_batch:
+                self._cond.notify()
+
+    def close(self):
+        '''
+        Sends the waiting acks and closes the stream. Messages received but not
+        acknowledged are redelivered once their visibility timeout expires.
+        '''
+        self._closed.set()
+        with self._cond:
+            self._cond.notify()
+        self._acker.join()
+        if self._call is not None:
+            self._call.cancel()
+        if self._channel is not None:
+            self._channel.close()
+
+    def _node_messages(self):
+        yield broker_pb2.NodeMessage(subscribe=self.subscribe)
+        # Credit comes back through AckBatch, the stream sends nothing else
+        self._closed.wait()
+
+    def _read(self):
+        backoff = self.RECONNECT_BACKOFF
+        while not self._closed.is_set():
+            self._call = self.stub.MessageStream(self._node_messages())
+            try:
+                for message in self._call:
+                    backoff = self.RECONNECT_BACKOFF
+                    self._messages.put(message)
+            except grpc.RpcError as e:
+                if self._closed.is_set():
+                    return
+                logger.warning("Stream for topic %s failed: %s, reconnecting", self.topic, e.code())
+            self._closed.wait(backoff)
+            backoff = min(backoff * 2, self.MAX_BACKOFF)
+
+    def _send_acks(self):
+        while True:
+            with self._cond:
+                while not self._closed.is_set() and len(self._acks) < self.ack_batch:
+                    now = time.monotonic()
+                    if self._acks_due is not None and self._acks_due <= now:
+                        break
+                    self._cond.wait(None if self._acks_due is None else self._acks_due - now)
+                acks, self._acks, self._acks_due = self._acks[:self.ack_batch], self._acks[self.ack_batch:], None
+                if self._acks:
+                    self._acks_due = time.monotonic()
+            if acks:
+                try:
+                    self.stub.AckBatch(broker_pb2.AckBatchRequest(message_ids=acks), timeout=self.REQUEST_TIMEOUT)
+                except grpc.RpcError as e:
+                    # The messages are redelivered after their visibility timeout
+                    logger.warning("Acknowledging %d messages failed: %s", len(acks), e.code())
+            if self._closed.is_set() and not self._acks:
+                return
@@ -0,0 +1,70 @@
+from concurrent import futures
+
+import grpc
+import pytest
+
+from broker.broker import BrokerServicer
+from broker.message_service import MessageService
+from proto import broker_pb2_grpc
+
+
+class RunningBroker:
+    '''
+    A BrokerServicer served on a free local port, with a stub connected to it.
+    '''
+    def __init__(self, data_path: str, **service_options):
+        self.servicer = BrokerServicer(data_path=data_path, **service_options)
+        self.service = self.servicer.message_service
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
+        broker_pb2_grpc.add_BrokerServicer_to_server(self.servicer, self.server)
+        self.port = self.server.add_insecure_port("127.0.0.1:0")
+        self.server.start()
+        self.channel = grpc.insecure_channel(f"127.0.0.1:{self.port}")
+        self.stub = broker_pb2_grpc.BrokerStub(self.channel)
+
+    def stop(self):
+        self.channel.close()
+        self.server.stop(0)
+        self.service.persistence_service.close()
+
+
+@pytest.fixture
+def broker(tmp_path):
+    running = RunningBroker(str(tmp_path / "broker.db"))
+    yield running
+    running.stop()
+
+
+class ServiceFactory:
+    '''
+    MessageServices persisting under a temporary directory, closed after the test.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self._open = {}   # service -> (data path, options)
+
+    def __call__(self, name: str = "broker.db", **options) -> MessageService:
+        data_path = str(self.directory / name)
+        service = MessageService(data_path=data_path, **options)
+        self._open[service] = (data_path, options)
+        return service
+
+    def restart(self, service: MessageService) -> MessageService:
+        # A new service on the same data, with the backlog replayed before it returns
+        data_path, options = self._open.pop(service)
+        service.persistence_service.close()
+        restarted = MessageService(data_path=data_path, **{**options, "background_replay": False})
+        self._open[restarted] = (data_path, options)
+        return restarted
+
+    def close(self):
+        for service in self._open:
+            service.persistence_service.close()
+        self._open.clear()
+
+
+@pytest.fixture
+def make_service(tmp_path):
+    factory = ServiceFactory(tmp_path)
+    yield factory
+    factory.close()
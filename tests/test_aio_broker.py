@@ -0,0 +1,86 @@
+import asyncio
+import threading
+
+import grpc
+
+from broker.aio_broker import AsyncBrokerServicer
+from proto import broker_pb2, broker_pb2_grpc
+
+
+def run_with_broker(data_path: str, scenario):
+    '''
+    Runs scenario(servicer, stub) against an AsyncBrokerServicer served on a free port.
+    '''
+    async def main():
+        server = grpc.aio.server()
+        servicer = AsyncBrokerServicer(data_path=data_path)
+        broker_pb2_grpc.add_BrokerServicer_to_server(servicer, server)
+        port = server.add_insecure_port("127.0.0.1:0")
+        await server.start()
+        try:
+            async with grpc.aio.insecure_channel(f"127.0.0.1:{port}") as channel:
+                return await scenario(servicer, broker_pb2_grpc.BrokerStub(channel))
+        finally:
+            await server.stop(0)
+            servicer.message_service.persistence_service.close()
+
+    return asyncio.run(main())
+
+
+def test_publish_stream_and_ack(tmp_path):
+    async def scenario(servicer, stub):
+        published = await stub.Publish(broker_pb2.PublishRequest(topic="orders", payload="hello"))
+        frames = asyncio.Queue()
+        await frames.put(broker_pb2.NodeMessage(subscribe=broker_pb2.Subscribe(topic="orders", prefetch=1)))
+
+        async def node_messages():
+            while (frame := await frames.get()) is not None:
+                yield frame
+
+        call = stub.MessageStream(node_messages())
+        message = await asyncio.wait_for(call.read(), 5)
+        assert message.message_id == published.message_id
+        assert message.data == "hello"
+        assert (await stub.Ack(broker_pb2.AckRequest(message_id=message.message_id))).success
+        await frames.put(None)
+        call.cancel()
+        return servicer.message_service.storage.topic("orders").in_flight_count()
+
+    assert run_with_broker(str(tmp_path / "broker.db"), scenario) == 0
+
+
+def test_invalid_publish_is_rejected(tmp_path):
+    async def scenario(servicer, stub):
+        try:
+            await stub.Publish(broker_pb2.PublishRequest(topic="orders", payload="x", priority=99))
+        except grpc.aio.AioRpcError as e:
+            return e.code()
+
+    assert run_with_broker(str(tmp_path / "broker.db"), scenario) == grpc.StatusCode.INVALID_ARGUMENT
+
+
+def test_publish_blocked_on_persistence_does_not_stall_the_loop(tmp_path):
+    # A full persistence queue blocks the writer of a publish, other RPCs keep being served
+    release = threading.Event()
+
+    async def scenario(servicer, stub):
+        persistence = servicer.message_service.persistence_service
+        log_message = persistence.log_message
+
+        def blocking_log_message(message):
+            release.wait(10)
+            log_message(message)
+
+        persistence.log_message = blocking_log_message
+        publish = asyncio.ensure_future(stub.Publish(broker_pb2.PublishRequest(topic="orders", payload="x")))
+        await asyncio.sleep(0.2)
+        topics = await asyncio.wait_for(stub.ListTopics(broker_pb2.Empty()), 2)
+        assert not publish.done()
+        release.set()
+        return topics, await asyncio.wait_for(publish, 5)
+
+    try:
+        _, published = run_with_broker(str(tmp_path / "broker.db"), scenario)
+    finally:
+        release.set()
+    assert published.message_id
@@ -0,0 +1,73 @@
+import asyncio
+
+from api_node.aio_pool import AsyncBrokerStreamPool, AsyncPooledStream, BrokerChannelPool
+from proto import broker_pb2
+
+
+def run_with_pool(broker, scenario):
+    '''
+    Runs scenario(pool) with an AsyncBrokerStreamPool connected to the broker.
+    '''
+    async def main():
+        channels = BrokerChannelPool(f"127.0.0.1:{broker.port}", channels=1)
+        pool = AsyncBrokerStreamPool(channels)
+        try:
+            return await scenario(pool)
+        finally:
+            await pool.close()
+            await channels.close()
+
+    return asyncio.run(main())
+
+
+def publish(broker, *payloads, topic="orders"):
+    return [
+        broker.stub.Publish(broker_pb2.PublishRequest(topic=topic, payload_bytes=payload)).message_id
+        for payload in payloads
+    ]
+
+
+def test_get_returns_messages_in_order(broker):
+    ids = publish(broker, *(f"m{i}".encode() for i in range(20)))
+
+    async def scenario(pool):
+        received = [(await pool.get("orders", 5)).message_id for _ in ids]
+        return received, await pool.get("orders", 0.2)
+
+    assert run_with_pool(broker, scenario) == (ids, None)
+
+
+def test_get_many_stops_at_max_messages(broker):
+    ids = publish(broker, *(f"m{i}".encode() for i in range(10)))
+
+    async def scenario(pool):
+        first = [msg.message_id async for msg in pool.get_many("orders", 4, 5)]
+        rest = [msg.message_id async for msg in pool.get_many("orders", 10, 0.5)]
+        return first, rest
+
+    assert run_with_pool(broker, scenario) == (ids[:4], ids[4:])
+
+
+def test_unclaimed_messages_go_back_before_their_visibility_timeout(broker, monkeypatch):
+    # Only waiting requests get credit, and messages that arrive after their request
+    # gave up are released instead of coming back later as retried duplicates
+    monkeypatch.setattr(AsyncPooledStream, "HOLD", 0.2)
+    broker.service.REQUEUE_TIMEOUT = 1
+    ids = publish(broker, *(f"m{i}".encode() for i in range(5)))
+
+    async def scenario(pool):
+        for _ in range(50):
+            await pool.get("orders", 0)
+        await asyncio.sleep(2.5)
+        in_flight = broker.service.storage.topic("orders").in_flight_count()
+        received = []
+        while (msg := await pool.get("orders", 0.5)) is not None:
+            received.append(msg)
+            assert broker.stub.Ack(broker_pb2.AckRequest(message_id=msg.message_id)).success
+        return in_flight, received
+
+    in_flight, received = run_with_pool(broker, scenario)
+    assert in_flight == 0
+    assert sorted(msg.message_id for msg in received) == sorted(ids)
+    assert all(msg.retries == 0 for msg in received)
+    assert not broker.service.get_dead_letter("orders")
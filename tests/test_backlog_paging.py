@@ -0,0 +1,58 @@
+import os
+
+from broker.message_service import MessageService
+from broker.paged_queue import PagedMessageQueue
+
+BUDGET = 64 * 1024
+
+
+def persist_backlog(data_path: str, spill_dir: str) -> tuple[list, str]:
+    '''
+    Publishes a large backlog on "big", a small one on "small" and dead letters one
+    message of "big", then stops the service. Returns the ids of "big" in order.
+    '''
+    service = MessageService(data_path=data_path, spill_dir=spill_dir)
+    big = [service.produce(f"{i:0100d}", topic="big") for i in range(3000)]
+    for i in range(10):
+        service.produce(f"small {i}", topic="small")
+    dead = service.consume("big")
+    service._dead_letter(service.storage._pop_inflight(dead.id).message)
+    service.persistence_service.flush()
+    service.persistence_service.close()
+    return big[1:], str(dead.id)
+
+
+def test_backlog_over_budget_stays_in_persistence(tmp_path):
+    data_path, spill_dir = str(tmp_path / "broker.db"), str(tmp_path / "spill")
+    big, dead = persist_backlog(data_path, spill_dir)
+
+    service = MessageService(data_path=data_path, max_queue_bytes=BUDGET, spill_dir=spill_dir,
+                             background_replay=False)
+    assert service.recovery.done
+    # Only what fits into memory was replayed, nothing was written to spill files
+    assert service.storage.topic("small").ready_count() == 10
+    assert 0 < service.storage.topic("big").ready_count() < 1000
+    assert service.storage.topic("big").spilled_count() == 0
+    assert not [name for _, _, files in os.walk(spill_dir) for name in files]
+    # Dead messages of a topic still waiting for room are listed right away
+    assert [str(m.id) for m in service.get_dead_letter("big")] == [dead]
+
+    consumed = []
+    while (message := service.consume("big")) is not None or service.storage.topic("big").backlog:
+        if message is None:
+            service.wait_for_messages("big", timeout=2)
+            continue
+        consumed.append(message.id)
+        assert service.acknowledge(message.id)
+    assert consumed == big
+    assert service.storage.topic("big").spilled_count() == 0
+    service.persistence_service.close()
+
+
+def test_spill_directory_keeps_foreign_files(tmp_path):
+    directory = tmp_path / "spill"
+    directory.mkdir()
+    (directory / "notes.txt").write_text("keep me")
+    (directory / f"{0:020d}.spill").write_bytes(b"left over")
+    PagedMessageQueue("orders", [], 1024, str(directory))
+    assert sorted(os.listdir(directory)) == ["notes.txt"]
@@ -0,0 +1,37 @@
+import grpc
+import pytest
+
+from proto import broker_pb2
+
+
+def publish_batch(broker, *payloads, **options):
+    return broker.stub.PublishBatch(broker_pb2.PublishBatchRequest(messages=[
+        broker_pb2.PublishRequest(topic="orders", payload=payload, **options) for payload in payloads
+    ]))
+
+
+def test_publish_batch_returns_ids_in_order(broker):
+    response = publish_batch(broker, "a", "b", "c")
+    ids = [result.message_id for result in response.results]
+    assert len(set(ids)) == 3
+    delivered = [broker.service.consume("orders") for _ in range(3)]
+    assert [(str(m.id), m.data) for m in delivered] == list(zip(ids, ["a", "b", "c"]))
+
+
+def test_invalid_batches_publish_nothing(broker):
+    with pytest.raises(grpc.RpcError) as raised:
+        broker.stub.PublishBatch(broker_pb2.PublishBatchRequest(messages=[
+            broker_pb2.PublishRequest(topic="orders", payload="a"),
+            broker_pb2.PublishRequest(topic="orders", payload="b", priority=99),
+        ]))
+    assert raised.value.code() == grpc.StatusCode.INVALID_ARGUMENT
+    assert broker.service.consume("orders") is None
+
+
+def test_ack_batch_reports_each_id(broker):
+    ids = [result.message_id for result in publish_batch(broker, "a", "b").results]
+    broker.service.consume("orders")
+    response = broker.stub.AckBatch(broker_pb2.AckBatchRequest(message_ids=[ids[0], ids[1], "nope"]))
+    # Only the delivered message was in flight
+    assert [(r.message_id, r.success) for r in response.results] == [(ids[0], True), (ids[1], False), ("nope", False)]
+    assert str(broker.service.consume("orders").id) == ids[1]
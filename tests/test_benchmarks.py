@@ -0,0 +1,24 @@
+import pytest
+
+from benchmarks import broker_bench, storage_stress
+
+
+@pytest.mark.parametrize("storage,publish_batch", [("sqlite", 1), ("log", 10)])
+def test_broker_bench_completes_a_small_run(storage, publish_batch):
+    config = broker_bench.WorkloadConfig(
+        storage=storage, messages=200, producers=2, consumers=2, publish_batch=publish_batch, max_duration=30
+    )
+    report = broker_bench.run(config)
+    assert report["complete"]
+    assert (report["published"], report["acked"], report["errors"]) == (200, 200, 0)
+    assert report["publish_to_ack"]["p50_ms"] <= report["publish_to_ack"]["max_ms"]
+
+
+def test_broker_bench_options_map_to_the_config():
+    config, output = broker_bench.parse_args(["--messages", "5", "--storage", "log", "--compact-storage"])
+    assert (config.messages, config.storage, config.compact_storage, output) == (5, "log", True, None)
+
+
+def test_storage_stress_loses_and_duplicates_nothing():
+    report = storage_stress.run(storage_stress.StressConfig(messages=2000, max_duration=30), threads=4)
+    assert (report["lost"], report["duplicated"]) == (0, 0)
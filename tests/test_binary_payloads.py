@@ -0,0 +1,54 @@
+import sqlite3
+import time
+import uuid
+
+import pytest
+
+from broker.message_service import MessageService
+from proto import broker_pb2
+
+PAYLOAD = bytes(range(256))
+
+
+def test_binary_payloads_round_trip_through_the_broker(broker):
+    published = broker.stub.Publish(broker_pb2.PublishRequest(topic="blobs", payload_bytes=PAYLOAD))
+    text = broker.stub.Publish(broker_pb2.PublishRequest(topic="blobs", payload="plain"))
+
+    messages = {m.message_id: m for m in broker.stub.GetAllMessages(broker_pb2.TopicRequest(topic="blobs")).messages}
+    binary = messages[published.message_id]
+    assert (binary.WhichOneof("body"), binary.data_bytes) == ("data_bytes", PAYLOAD)
+    assert messages[text.message_id].data == "plain"
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "log"])
+def test_binary_payloads_survive_a_restart(make_service, backend):
+    service = make_service(persistence_backend=backend)
+    binary_id = service.produce(PAYLOAD, topic="blobs", wait_for_commit=True)
+    text_id = service.produce("plain", topic="blobs", wait_for_commit=True)
+
+    restarted = make_service.restart(service)
+    payloads = {m.id: m.data for m in restarted.get_all_messages("blobs")}
+    assert payloads == {binary_id: PAYLOAD, text_id: "plain"}
+
+
+def test_text_payload_databases_are_migrated(tmp_path):
+    # Schema of the first release, payloads in a TEXT column
+    data_path = str(tmp_path / "broker.db")
+    old_id = uuid.uuid4()
+    conn = sqlite3.connect(data_path)
+    conn.execute(
+        "CREATE TABLE messages (id TEXT PRIMARY KEY, data TEXT NOT NULL, state INTEGER NOT NULL DEFAULT 0,"
+        " enqueued_at REAL NOT NULL, retries INTEGER DEFAULT 0)"
+    )
+    conn.execute("INSERT INTO messages (id, data, enqueued_at) VALUES (?, ?, ?)", (str(old_id), "old", time.time()))
+    conn.commit()
+    conn.close()
+
+    service = MessageService(data_path=data_path, background_replay=False)
+    try:
+        columns = {row[1]: row[2] for row in service.persistence_service.conn.execute("PRAGMA table_info(messages)")}
+        assert columns["data"] == "BLOB"
+        new_id = service.produce(PAYLOAD, wait_for_commit=True)
+        assert {m.id: m.data for m in service.get_all_messages()} == {old_id: "old", new_id: PAYLOAD}
+    finally:
+        service.persistence_service.close()
@@ -0,0 +1,138 @@
+import threading
+import time
+
+import grpc
+import pytest
+
+from proto import broker_pb2
+from proto.client import Consumer, Producer
+
+
+class FakeRpcError(grpc.RpcError):
+    def __init__(self, code):
+        self._code = code
+
+    def code(self):
+        return self._code
+
+
+class FakeStub:
+    '''
+    Answers PublishBatch with made up ids, after failing the first calls with `failures`
+    and holding every call while `gate` is cleared.
+    '''
+    def __init__(self, failures=()):
+        self.failures = list(failures)
+        self.calls = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.in_flight = {}
+        self.max_in_flight = {}
+        self._lock = threading.Lock()
+        self._ids = 0
+
+    def PublishBatch(self, request, timeout=None):
+        topic = request.messages[0].topic
+        with self._lock:
+            self.calls.append(request)
+            self.in_flight[topic] = self.in_flight.get(topic, 0) + 1
+            self.max_in_flight[topic] = max(self.max_in_flight.get(topic, 0), self.in_flight[topic])
+            failure = self.failures.pop(0) if self.failures else None
+        try:
+            self.gate.wait()
+            if failure is not None:
+                raise FakeRpcError(failure)
+            with self._lock:
+                ids = [f"id-{self._ids + i}" for i in range(len(request.messages))]
+                self._ids += len(ids)
+            return broker_pb2.PublishBatchResponse(results=[broker_pb2.PublishResponse(message_id=i) for i in ids])
+        finally:
+            with self._lock:
+                self.in_flight[topic] -= 1
+
+
+def test_messages_are_batched_per_topic():
+    stub = FakeStub()
+    with Producer(stub, linger_ms=100) as producer:
+        orders = [producer.send(f"o{i}", topic="orders") for i in range(10)]
+        payments = [producer.send(f"p{i}", topic="payments") for i in range(5)]
+        assert producer.flush(5)
+
+    assert sorted(len(call.messages) for call in stub.calls) == [5, 10]
+    batch = next(call for call in stub.calls if call.messages[0].topic == "orders")
+    assert [m.payload for m in batch.messages] == [f"o{i}" for i in range(10)]
+    assert len({f.result() for f in orders + payments}) == 15
+
+
+def test_full_batches_go_out_in_order_one_at_a_time_per_topic():
+    stub = FakeStub()
+    with Producer(stub, linger_ms=1000, max_batch_bytes=200) as producer:
+        futures = [producer.send("x" * 20, topic="orders") for _ in range(30)]
+        assert producer.flush(5)
+
+    assert len(stub.calls) > 1
+    assert stub.max_in_flight["orders"] == 1
+    # Ids are handed out in call order, so send order survived the split
+    assert [f.result() for f in futures] == [f"id-{i}" for i in range(30)]
+
+
+def test_transient_failures_are_retried_with_the_same_keys(monkeypatch):
+    monkeypatch.setattr(Producer, "RETRY_BACKOFF", 0.01)
+    stub = FakeStub(failures=[grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED])
+    with Producer(stub, idempotent=True) as producer:
+        future = producer.send("x", topic="orders")
+        assert future.result(5) == "id-0"
+
+    keys = [call.messages[0].idempotency_key for call in stub.calls]
+    assert len(keys) == 3 and keys[0] and len(set(keys)) == 1
+
+
+def test_permanent_failures_fail_the_batch():
+    stub = FakeStub(failures=[grpc.StatusCode.INVALID_ARGUMENT])
+    with Producer(stub) as producer:
+        future = producer.send("x", topic="orders", priority=99)
+        with pytest.raises(grpc.RpcError) as raised:
+            future.result(5)
+    assert raised.value.code() == grpc.StatusCode.INVALID_ARGUMENT
+    assert len(stub.calls) == 1
+
+
+def test_send_blocks_while_the_buffer_is_full():
+    stub = FakeStub()
+    stub.gate.clear()
+    producer = Producer(stub, linger_ms=0, max_buffer_bytes=100)
+    try:
+        producer.send("x" * 60, topic="orders")
+        sent = threading.Event()
+        threading.Thread(target=lambda: (producer.send("y" * 60, topic="orders"), sent.set()), daemon=True).start()
+        assert not sent.wait(0.3)
+
+        # The first batch is published, which makes room for the second message
+        stub.gate.set()
+        assert sent.wait(5)
+        assert producer.flush(5)
+    finally:
+        stub.gate.set()
+        producer.close(5)
+
+
+def test_producer_and_consumer_against_a_broker(broker):
+    with Producer(broker.stub, linger_ms=10) as producer:
+        futures = [producer.send(f"m{i}" if i % 2 else f"m{i}".encode(), topic="orders") for i in range(40)]
+        producer.flush(5)
+    ids = [f.result() for f in futures]
+
+    received = []
+    with Consumer(broker.stub, topic="orders", prefetch=8, ack_interval_ms=10) as consumer:
+        for message in consumer:
+            received.append(message.message_id)
+            if len(received) == len(ids):
+                break
+        # The loop broke out of the last message, it is the only one left unacknowledged
+        consumer.ack(received[-1])
+    assert received == ids
+
+    deadline = time.monotonic() + 5
+    while broker.service.storage.topic("orders").in_flight_count() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert broker.service.storage.topic("orders").in_flight_count() == 0
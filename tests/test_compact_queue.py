@@ -0,0 +1,54 @@
+import time
+from uuid import uuid4
+
+from broker.compact_queue import CompactMessageQueue
+from broker.models import Message
+
+FIELDS = ("id", "data", "enqueued_at", "retries", "state", "topic", "encoding", "priority", "deliver_at",
+          "partition_key", "partition", "idempotency_key", "expires_at")
+
+
+def fields(message: Message) -> tuple:
+    return tuple(getattr(message, name) for name in FIELDS)
+
+
+def sample(i: int) -> Message:
+    now = time.time()
+    return Message(
+        id=uuid4(),
+        data=[f"text {i}", f"bytes {i}".encode(), {"n": i}][i % 3],
+        enqueued_at=now,
+        retries=i % 4,
+        topic="orders",
+        priority=3,
+        partition=2,
+        encoding="zlib" if i % 5 == 0 else "",
+        # Set on some messages only
+        deliver_at=now - 1 if i % 2 else None,
+        partition_key=f"customer-{i}" if i % 3 else "",
+        idempotency_key=f"order-{i}" if i % 4 else "",
+        expires_at=now + 60 if i % 7 else None,
+    )
+
+
+def test_messages_round_trip_every_field():
+    queue = CompactMessageQueue("orders", priority=3, partition=2)
+    messages = [sample(i) for i in range(50)]
+    queue.extend(messages)
+    assert [fields(m) for m in queue] == [fields(m) for m in messages]
+    assert fields(queue[10]) == fields(messages[10])
+    assert [fields(queue.popleft()) for _ in messages] == [fields(m) for m in messages]
+    assert not queue
+
+
+def test_fields_survive_compaction():
+    queue = CompactMessageQueue("orders", priority=3, partition=2)
+    messages = [sample(i) for i in range(3 * CompactMessageQueue.COMPACT_MIN)]
+    for message in messages:
+        queue.append(message)
+    popped = [queue.popleft() for _ in range(2 * CompactMessageQueue.COMPACT_MIN)]
+    assert [fields(m) for m in popped] == [fields(m) for m in messages[:len(popped)]]
+    rest = messages[len(popped):]
+    assert [fields(m) for m in queue] == [fields(m) for m in rest]
+    # Popped entries leave nothing behind in the sparse columns
+    assert all(len(values) <= len(rest) for values in queue._sparse.values())
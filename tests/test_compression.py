@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from broker.compression import IDENTITY, LZMA, ZLIB, CompressionPolicy, compress, decompress, parse_codec
+from proto import broker_pb2
+from proto.client import payload
+from tests.conftest import RunningBroker
+
+TEXT = "order line, " * 500
+BINARY = bytes(range(256)) * 20
+
+
+@pytest.mark.parametrize("codec", [ZLIB, LZMA])
+def test_codecs_round_trip(codec):
+    compressed = compress(BINARY, codec)
+    assert len(compressed) < len(BINARY)
+    assert decompress(compressed, codec) == BINARY
+    assert parse_codec(codec.upper()) == codec
+
+
+def test_codec_names():
+    assert [parse_codec(name) for name in ("", "none", "Identity")] == [IDENTITY] * 3
+    with pytest.raises(ValueError):
+        parse_codec("snappy")
+    with pytest.raises(ValueError):
+        compress(b"x", "snappy")
+
+
+def test_policy_picks_the_codec_and_skips_small_or_incompressible_payloads():
+    policy = CompressionPolicy(ZLIB, threshold=100, topic_codecs={"logs": "lzma", "raw": "none"})
+    data, codec, raw_size = policy.apply(TEXT, "orders")
+    assert (codec, raw_size, decompress(data, codec).decode("utf-8")) == (ZLIB, len(TEXT), TEXT)
+    assert policy.apply(TEXT, "logs")[1] == LZMA
+    assert policy.apply(TEXT, "raw")[1] == IDENTITY
+    # A codec requested with the message wins over the topic's
+    assert policy.apply(TEXT, "raw", requested="lzma")[1] == LZMA
+    assert policy.apply("short", "orders") == ("short", IDENTITY, 5)
+    noise = os.urandom(4096)
+    assert policy.apply(noise, "orders") == (noise, IDENTITY, 4096)
+
+
+@pytest.mark.parametrize("codec", [ZLIB, LZMA])
+def test_compressed_payloads_come_back_as_published(tmp_path, codec):
+    broker = RunningBroker(str(tmp_path / "broker.db"), compression=codec, compression_threshold=100)
+    try:
+        text = broker.stub.Publish(broker_pb2.PublishRequest(topic="orders", payload=TEXT))
+        binary = broker.stub.Publish(broker_pb2.PublishRequest(topic="orders", payload_bytes=BINARY))
+        plain = broker.stub.Publish(broker_pb2.PublishRequest(topic="orders", payload=TEXT, compression="none"))
+
+        messages = {m.message_id: m for m in broker.stub.GetAllMessages(broker_pb2.TopicRequest(topic="orders")).messages}
+        assert [messages[r.message_id].encoding for r in (text, binary, plain)] == [codec, codec, ""]
+        assert len(messages[text.message_id].data_bytes) < len(TEXT)
+        assert [payload(messages[r.message_id]) for r in (text, binary, plain)] == [TEXT, BINARY, TEXT]
+    finally:
+        broker.stop()
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "log"])
+def test_compressed_payloads_survive_a_restart(make_service, backend):
+    service = make_service(persistence_backend=backend, compression=LZMA, compression_threshold=100)
+    message_id = service.produce(BINARY, topic="orders", wait_for_commit=True)
+
+    restarted = make_service.restart(service)
+    message = restarted.consume("orders")
+    assert (message.id, message.encoding) == (message_id, LZMA)
+    assert decompress(message.data, message.encoding) == BINARY
@@ -0,0 +1,52 @@
+import uuid
+
+from broker.consumer_groups import ConsumerGroups
+from broker.consumer_stream import ConsumerStream
+from broker.message_storage import MessageStorage
+from broker.models import Message
+
+
+def owned(streams):
+    return sorted(p for stream in streams for p in stream.partitions)
+
+
+def test_members_share_every_partition_once():
+    groups = ConsumerGroups(partitions=6)
+    streams = [ConsumerStream() for _ in range(4)]
+    for count, stream in enumerate(streams, 1):
+        groups.join(stream, "orders", "billing")
+        assert owned(streams[:count]) == list(range(6))
+    assert [len(stream.partitions) for stream in streams] == [2, 2, 1, 1]
+    groups.leave(streams[0])
+    assert streams[0].partitions is None
+    assert owned(streams[1:]) == list(range(6))
+    assert groups.members() == {("orders", "billing"): 3}
+
+
+def test_member_moving_to_another_group_hands_its_partitions_back():
+    rebalanced = []
+    groups = ConsumerGroups(partitions=4, on_rebalance=lambda topic, group: rebalanced.append((topic, group)))
+    first, second = ConsumerStream(), ConsumerStream()
+    groups.join(first, "orders", "billing")
+    groups.join(second, "orders", "billing")
+    rebalanced.clear()
+    groups.join(second, "orders", "shipping")
+    assert first.partitions == [0, 1, 2, 3]
+    assert second.partitions == [0, 1, 2, 3]
+    assert set(rebalanced) == {("orders", "billing"), ("orders", "shipping")}
+    # Re-subscribing to the same group keeps it as it is
+    groups.join(second, "orders", "shipping")
+    assert groups.members() == {("orders", "billing"): 1, ("orders", "shipping"): 1}
+
+
+def test_keyed_messages_stay_on_one_partition_in_order():
+    storage = MessageStorage(partitions=4)
+    for i in range(20):
+        storage.enqueue(Message(id=uuid.uuid4(), data=f"m{i}", topic="orders", partition_key=f"key-{i % 2}"))
+    seen = {}
+    for partition in range(4):
+        while (message := storage.dequeue("orders", 30, [partition])) is not None:
+            seen.setdefault(message.partition_key, []).append((partition, message.data))
+    for key, messages in seen.items():
+        assert len({partition for partition, _ in messages}) == 1
+        assert [data for _, data in messages] == [f"m{i}" for i in range(20) if f"key-{i % 2}" == key]
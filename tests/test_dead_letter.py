@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+from broker.models import MessageState
+
+
+def dead_letter(service, topic, count):
+    '''
+    Publishes count messages, delivers each once and lets its visibility timeout run
+    out, which dead letters it. Returns their ids, oldest first.
+    '''
+    service.MAX_RETRIES = 0
+    ids = [service.produce(f"m{i}", topic=topic, wait_for_commit=True) for i in range(count)]
+    for _ in ids:
+        service.consume(topic, visibility_timeout=0.05)
+    deadline = time.monotonic() + 10
+    while service.storage.topic(topic).in_flight_count() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    service.persistence_service.flush()
+    return ids
+
+
+def dead_ids(service, topic):
+    return [message.id for message in service.get_dead_letter(topic)]
+
+
+def test_dead_letter_queue_keeps_the_newest_messages(make_service):
+    service = make_service(max_dead_letter=3)
+    ids = dead_letter(service, "orders", 5)
+    assert dead_ids(service, "orders") == ids[2:]
+    # Dropped messages are gone for good, the kept ones are still dead after a restart
+    service = make_service.restart(service)
+    assert dead_ids(service, "orders") == ids[2:]
+    assert service.consume("orders") is None
+
+
+def test_listing_pages_through_the_dead_letter_queue(make_service):
+    service = make_service()
+    ids = dead_letter(service, "orders", 5)
+    listed, cursor = [], ""
+    while True:
+        pages = list(service.list_dead_letter("orders", cursor, page_size=2, limit=2))
+        messages, cursor, end = pages[-1]
+        listed.extend(message.id for page in pages for message in page[0])
+        if end or not cursor:
+            break
+    assert listed == ids
+    with pytest.raises(ValueError):
+        service.list_dead_letter("orders", "not a cursor")
+
+
+def test_redrive_by_id_and_by_topic(make_service):
+    service = make_service()
+    ids = dead_letter(service, "orders", 4)
+    assert service.redrive_dead_letter(message_ids=[str(ids[1]), "not an id"]) == 1
+    message = service.consume("orders")
+    assert (message.id, message.retries) == (ids[1], 0)
+    assert service.acknowledge(message.id)
+
+    assert service.redrive_dead_letter("orders", limit=2) == 2
+    assert dead_ids(service, "orders") == [ids[3]]
+    service.persistence_service.flush()
+    # Redriven messages are queued again after a restart, not dead
+    service = make_service.restart(service)
+    assert dead_ids(service, "orders") == [ids[3]]
+    redriven = [service.consume("orders") for _ in range(2)]
+    assert sorted(message.id for message in redriven) == sorted([ids[0], ids[2]])
+    assert all(message.state != MessageState.DEAD_LETTERED.value for message in redriven)
@@ -0,0 +1,198 @@
+import asyncio
+import json
+import threading
+import uuid
+from urllib.parse import urlencode
+
+import pytest
+
+from api_node.gateway import Gateway, broker_address
+from api_node.stream_pool import BrokerStreamPool
+
+
+class FlaskClient:
+    '''
+    The Flask app on its test client, talking to the broker.
+    '''
+    def __init__(self, broker, monkeypatch):
+        from api_node import app as flask_app
+        self.stream_pool = BrokerStreamPool(broker.stub)
+        monkeypatch.setattr(flask_app, "stub", broker.stub)
+        monkeypatch.setattr(flask_app, "stream_pool", self.stream_pool)
+        self.client = flask_app.app.test_client()
+
+    def request(self, method, path, query=None, headers=None, body=b""):
+        resp = self.client.open(path, method=method, query_string=query, headers=headers, data=body)
+        return resp.status_code, {name.lower(): value for name, value in resp.headers.items()}, resp.get_data()
+
+    def close(self):
+        self.stream_pool.close()
+
+
+class GatewayClient:
+    '''
+    The ASGI gateway called directly, on an event loop of its own.
+    '''
+    def __init__(self, broker):
+        self.gateway = Gateway(f"127.0.0.1:{broker.port}", channels=1, request_timeout=10)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def request(self, method, path, query=None, headers=None, body=b""):
+        return asyncio.run_coroutine_threadsafe(self._request(method, path, query, headers, body), self.loop).result(30)
+
+    async def _request(self, method, path, query, headers, body):
+        scope = {
+            "type": "http",
+            "method": method,
+            "path": path,
+            "query_string": urlencode(query or {}).encode("latin-1"),
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in (headers or {}).items()],
+        }
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": body}
+
+        async def send(message):
+            sent.append(message)
+
+        await self.gateway(scope, receive, send)
+        start = sent[0]
+        return (
+            start["status"],
+            {name.decode("latin-1"): value.decode("latin-1") for name, value in start["headers"]},
+            b"".join(message.get("body", b"") for message in sent[1:]),
+        )
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.gateway.close(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+@pytest.fixture(params=["flask", "gateway"])
+def api(request, broker, monkeypatch):
+    client = FlaskClient(broker, monkeypatch) if request.param == "flask" else GatewayClient(broker)
+    yield client
+    client.close()
+
+
+def post_json(api, path, value, headers=None):
+    status, _, body = api.request("POST", path, headers={"Content-Type": "application/json", **(headers or {})},
+                                  body=json.dumps(value).encode("utf-8"))
+    return status, json.loads(body)
+
+
+def test_produce_consume_acknowledge(api):
+    status, produced = post_json(api, "/produce", {"topic": "orders", "data": "hello"}, {"Idempotency-Key": "k1"})
+    assert status == 200
+    # A retried publish gets the first one's message_id back
+    assert post_json(api, "/produce", {"topic": "orders", "data": "hello"}, {"Idempotency-Key": "k1"}) == (200, produced)
+
+    status, _, body = api.request("GET", "/consume", {"topic": "orders", "wait_seconds": 5})
+    message = json.loads(body)
+    assert status == 200
+    assert (message["message_id"], message["payload"]) == (produced["message_id"], "hello")
+
+    assert post_json(api, "/acknowledge", {"message_id": message["message_id"]}) == (200, {"status": "acknowledged"})
+    assert post_json(api, "/acknowledge", {"message_id": message["message_id"]})[0] == 404
+    status, _, body = api.request("GET", "/consume", {"topic": "orders", "wait_seconds": 0.2})
+    assert json.loads(body) == {"message": None}
+
+
+def test_raw_produce_and_consume(api):
+    payload = bytes(range(256))
+    status, _, body = api.request("POST", "/produce", {"topic": "blobs", "priority": 3},
+                                  {"Content-Type": "application/octet-stream"}, payload)
+    assert status == 200
+    message_id = json.loads(body)["message_id"]
+
+    status, headers, body = api.request("GET", "/consume", {"topic": "blobs", "wait_seconds": 5},
+                                        {"Accept": "application/octet-stream"})
+    assert status == 200
+    assert body == payload
+    assert headers["x-message-id"] == message_id
+    assert headers["x-priority"] == "3"
+    status, _, body = api.request("GET", "/consume", {"topic": "blobs", "wait_seconds": 0.2},
+                                  {"Accept": "application/octet-stream"})
+    assert (status, body) == (204, b"")
+
+
+def test_consume_stream(api):
+    status, results = post_json(api, "/produce_batch", {"messages": [
+        {"topic": "orders", "data": f"m{i}"} for i in range(3)
+    ] + [{"topic": "orders"}]})
+    assert status == 200
+    assert results["results"][3] == {"error": "No data provided"}
+
+    status, headers, body = api.request("GET", "/consume_stream", {"topic": "orders", "max_messages": 3, "wait_seconds": 5})
+    assert status == 200
+    assert headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in body.decode("utf-8").splitlines()]
+    assert [line["payload"] for line in lines] == ["m0", "m1", "m2"]
+    assert api.request("GET", "/consume_stream", {"max_messages": 0})[0] == 400
+
+
+def test_errors(api):
+    assert api.request("GET", "/nowhere")[:1] == (404,)
+    status, headers, _ = api.request("GET", "/produce")
+    assert status == 405 and "POST" in headers["allow"]
+    status, _, body = api.request("POST", "/produce", headers={"Content-Type": "application/json"}, body=b"{")
+    assert (status, json.loads(body)) == (400, {"error": "Invalid JSON body"})
+    assert post_json(api, "/acknowledge", {"message_id": "nope"}) == (400, {"error": "Invalid UUID format"})
+    assert post_json(api, "/touch", {"message_id": str(uuid.uuid4()), "visibility_timeout": "x"})[0] == 400
+    # Rejected by the broker
+    assert post_json(api, "/produce", {"data": "x", "compression": "nope"})[0] == 400
+    assert api.request("GET", "/dead_letter", {"limit": -1})[0] == 400
+    status, _, body = api.request("GET", "/dead_letter", {"cursor": "garbage"})
+    assert (status, json.loads(body)) == (400, {"error": "Invalid cursor: 'garbage'"})
+
+
+def test_dead_letter_and_topics(api):
+    post_json(api, "/produce", {"topic": "orders", "data": "x"})
+    status, _, body = api.request("GET", "/dead_letter", {"topic": "orders"})
+    assert (status, json.loads(body)) == (200, [])
+    assert post_json(api, "/dead_letter/redrive", {"topic": "orders"}) == (200, {"redriven": 0})
+    status, _, body = api.request("GET", "/topics")
+    assert "orders" in json.loads(body)
+    status, headers, body = api.request("GET", "/metrics")
+    assert (status, headers["content-type"].split(";")[0]) == (200, "text/plain")
+    assert 'broker_messages_published_total{topic="orders"} 1.0' in body.decode("utf-8").splitlines()
+
+
+def test_non_string_fields_are_rejected(api):
+    error = {"error": "data, topic and compression must be strings"}
+    for data in (42, {"a": 1}, [1, 2]):
+        assert post_json(api, "/produce", {"data": data}) == (400, error)
+    assert post_json(api, "/produce", {"data": "x", "topic": 7}) == (400, error)
+
+    status, results = post_json(api, "/produce_batch", {"messages": [{"data": "ok"}, {"data": 3.5}]})
+    assert status == 200
+    assert "message_id" in results["results"][0]
+    assert results["results"][1] == error
+
+
+def test_batch_produce_and_acknowledge(api):
+    status, produced = post_json(api, "/produce_batch", {"messages": [
+        {"topic": "orders", "data": "a"}, {"topic": "orders", "data": "b", "priority": 5},
+    ]})
+    assert status == 200
+    ids = [result["message_id"] for result in produced["results"]]
+
+    # The higher priority message comes first
+    status, _, body = api.request("GET", "/consume_stream", {"topic": "orders", "max_messages": 2, "wait_seconds": 5})
+    assert [json.loads(line)["message_id"] for line in body.decode("utf-8").splitlines()] == [ids[1], ids[0]]
+
+    status, acked = post_json(api, "/acknowledge_batch", {"message_ids": ids + [str(uuid.uuid4())]})
+    assert status == 200
+    assert [result["acknowledged"] for result in acked["results"]] == [True, True, False]
+    assert post_json(api, "/acknowledge_batch", {"message_ids": []})[0] == 400
+
+
+@pytest.mark.parametrize("name", ["BROKER_SHARDS", "BROKER_REPLICAS"])
+def test_gateway_refuses_client_side_routing(monkeypatch, name):
+    monkeypatch.setenv("BROKER_ADDRESS", "broker:50051")
+    assert broker_address() == "broker:50051"
+    monkeypatch.setenv(name, "a:1,b:2")
+    with pytest.raises(ValueError, match=name):
+        broker_address()
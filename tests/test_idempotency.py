@@ -0,0 +1,58 @@
+import time
+import uuid
+
+from broker.idempotency import IdempotencyCache
+
+
+def test_cache_returns_the_first_publish_within_the_window():
+    cache = IdempotencyCache(window=10, max_keys=100)
+    first, second = uuid.uuid4(), uuid.uuid4()
+    assert cache.claim("orders", "k", first, 100.0) == first
+    assert cache.claim("orders", "k", second, 105.0) == first
+    # Same key on another topic, or after the window, is a new publish
+    assert cache.claim("events", "k", second, 105.0) == second
+    assert cache.claim("orders", "k", second, 111.0) == second
+
+
+def test_cache_drops_least_recently_used_keys_beyond_max_keys():
+    cache = IdempotencyCache(window=60, max_keys=2)
+    ids = [uuid.uuid4() for _ in range(3)]
+    cache.claim("t", "a", ids[0], 1.0)
+    cache.claim("t", "b", ids[1], 2.0)
+    cache.claim("t", "a", uuid.uuid4(), 3.0)  # a is now the most recently used
+    cache.claim("t", "c", ids[2], 4.0)
+    assert len(cache) == 2
+    assert cache.evicted == 1
+    assert cache.claim("t", "a", uuid.uuid4(), 5.0) == ids[0]
+    assert cache.claim("t", "b", ids[1], 5.0) == ids[1]  # forgotten, claimed anew
+
+
+def test_retried_publish_enqueues_once(make_service):
+    service = make_service()
+    first = service.produce("x", topic="orders", idempotency_key="k", wait_for_commit=True)
+    assert service.produce("x", topic="orders", idempotency_key="k", wait_for_commit=True) == first
+    ids = service.produce_batch([
+        ("x", "orders", {"idempotency_key": "k"}),
+        ("y", "orders", {"idempotency_key": "k2"}),
+        ("y", "orders", {"idempotency_key": "k2"}),
+    ])
+    assert ids[0] == first and ids[1] == ids[2] != first
+    assert len(service.get_all_messages("orders")) == 2
+
+
+def test_keys_survive_a_restart(make_service):
+    service = make_service()
+    first = service.produce("x", topic="orders", idempotency_key="k", wait_for_commit=True)
+    # Acknowledged messages still deduplicate retries within the window
+    assert service.acknowledge(service.consume("orders").id)
+    service.persistence_service.flush()
+    service = make_service.restart(service)
+    assert service.produce("x", topic="orders", idempotency_key="k") == first
+    assert service.consume("orders") is None
+
+
+def test_keys_expire_after_the_window(make_service):
+    service = make_service(dedup_window=0.2)
+    first = service.produce("x", topic="orders", idempotency_key="k")
+    time.sleep(0.3)
+    assert service.produce("x", topic="orders", idempotency_key="k") != first
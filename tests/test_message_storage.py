@@ -0,0 +1,131 @@
+import random
+import threading
+import time
+from uuid import uuid4
+
+import pytest
+
+from broker.message_storage import MessageStorage
+from broker.models import Message
+
+MESSAGES = 6000
+THREADS = 4
+TOPICS = ["orders", "events"]
+
+
+def exercise(storage: MessageStorage, requeue_rate: float = 0.05) -> tuple[list, int]:
+    '''
+    Concurrent producers and consumers on one storage, consumers requeueing some
+    deliveries instead of acking them, while a reader keeps listing the queues.
+    Returns the data of every acked message and the number of deliveries.
+    '''
+    acked = [[] for _ in range(THREADS)]
+    deliveries = [0] * THREADS
+    produced = threading.Event()
+    stop = threading.Event()
+    errors = []
+
+    def produce(worker: int):
+        rng = random.Random(worker)
+        for i in range(worker, MESSAGES, THREADS):
+            storage.enqueue(Message(id=uuid4(), data=f"{i}", topic=rng.choice(TOPICS)))
+
+    def consume(worker: int):
+        rng = random.Random(-worker - 1)
+        while True:
+            idle = True
+            for topic in TOPICS:
+                message = storage.dequeue(topic)
+                if message is None:
+                    continue
+                idle = False
+                deliveries[worker] += 1
+                if rng.random() < requeue_rate:
+                    storage.requeue_from_inflight(message.id)
+                elif storage.acknowledge(message.id):
+                    acked[worker].append(message.data)
+            if idle and produced.is_set() and not any(
+                storage.topic(topic).has_ready() or storage.topic(topic).in_flight_count() for topic in TOPICS
+            ):
+                return
+
+    def snapshot():
+        try:
+            while not stop.is_set():
+                storage.get_all_messages()
+                storage.get_dead_letter()
+                time.sleep(0.001)
+        except Exception as e:
+            errors.append(e)
+
+    producers = [threading.Thread(target=produce, args=(i,)) for i in range(THREADS)]
+    consumers = [threading.Thread(target=consume, args=(i,)) for i in range(THREADS)]
+    reader = threading.Thread(target=snapshot)
+    for thread in producers + consumers + [reader]:
+        thread.start()
+    for thread in producers:
+        thread.join()
+    produced.set()
+    for thread in consumers:
+        thread.join(60)
+    stop.set()
+    reader.join()
+    assert not any(thread.is_alive() for thread in consumers), "consumers did not drain the storage"
+    assert not errors, errors
+    return [data for worker in acked for data in worker], sum(deliveries)
+
+
+@pytest.mark.parametrize("compact", [False, True], ids=["objects", "compact"])
+@pytest.mark.parametrize("partitions", [1, 3])
+def test_concurrent_produce_consume_ack_is_exactly_once(compact, partitions):
+    storage = MessageStorage(compact=compact, partitions=partitions)
+    acked, deliveries = exercise(storage)
+    assert len(acked) == MESSAGES, "messages were acked twice or lost"
+    assert set(acked) == {str(i) for i in range(MESSAGES)}
+    # Every requeue is one more delivery of the same message
+    assert deliveries >= MESSAGES
+    assert not storage.get_all_messages()
+
+
+def test_concurrent_acks_of_one_delivery_succeed_once():
+    storage = MessageStorage()
+    for i in range(500):
+        storage.enqueue(Message(id=uuid4(), data=i))
+    delivered = [storage.dequeue() for _ in range(500)]
+    results = [[] for _ in range(THREADS)]
+    barrier = threading.Barrier(THREADS)
+
+    def ack(worker: int):
+        barrier.wait()
+        for message in delivered:
+            results[worker].append(storage.acknowledge(message.id))
+
+    threads = [threading.Thread(target=ack, args=(i,)) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(sum(worker) for worker in results) == len(delivered)
+
+
+def test_requeue_races_ack_without_duplicates():
+    storage = MessageStorage()
+    message = Message(id=uuid4(), data="x")
+    for _ in range(200):
+        storage.enqueue(message)
+        taken = storage.dequeue()
+        outcomes = []
+        threads = [
+            threading.Thread(target=lambda: outcomes.append(("ack", storage.acknowledge(taken.id)))),
+            threading.Thread(target=lambda: outcomes.append(("requeue", storage.requeue_from_inflight(taken.id)))),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Exactly one of them owns the delivery
+        assert sum(ok for _, ok in outcomes) == 1
+        if dict(outcomes)["requeue"]:
+            assert storage.dequeue() is not None
+            assert storage.acknowledge(taken.id)
+        assert storage.dequeue() is None
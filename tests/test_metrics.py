@@ -0,0 +1,56 @@
+from broker.metrics import MetricsRegistry, render_samples
+from proto import broker_pb2
+
+
+def test_registry_renders_the_text_format():
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "Requests", ["path"])
+    requests.inc(path="/a")
+    requests.inc(2, path='say "hi"')
+    registry.gauge("depth", "Queue depth", ["topic"], callback=lambda: {("orders",): 3})
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    latency.observe(0.05)
+    latency.observe(0.5)
+    # Registering a name again returns the existing metric
+    assert registry.counter("requests_total", "Requests", ["path"]) is requests
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{path="/a"} 1.0',
+        'requests_total{path="say \\"hi\\""} 2.0',
+        "# HELP depth Queue depth",
+        "# TYPE depth gauge",
+        'depth{topic="orders"} 3.0',
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1.0',
+        'latency_seconds_bucket{le="1.0"} 2.0',
+        'latency_seconds_bucket{le="+Inf"} 2.0',
+        "latency_seconds_sum 0.55",
+        "latency_seconds_count 2.0",
+    ]
+    assert render_samples([("up", {}, 1)]) == "up 1.0\n"
+
+
+def test_service_counts_its_traffic(make_service):
+    service = make_service()
+    message_id = service.produce("a", topic="orders")
+    service.produce("b", topic="orders")
+    service.consume("orders")
+    service.acknowledge(message_id)
+
+    samples = {(name, tuple(sorted(labels.items()))): value for name, labels, value in service.metrics.collect()}
+    assert samples[("broker_messages_published_total", (("topic", "orders"),))] == 2
+    assert samples[("broker_messages_delivered_total", (("topic", "orders"),))] == 1
+    assert samples[("broker_messages_acked_total", ())] == 1
+    assert samples[("broker_queue_depth", (("topic", "orders"),))] == 1
+    assert samples[("broker_delivery_lag_seconds_count", (("topic", "orders"),))] == 1
+
+
+def test_get_stats_returns_text_and_samples(broker):
+    broker.stub.Publish(broker_pb2.PublishRequest(topic="orders", payload="a"))
+    stats = broker.stub.GetStats(broker_pb2.Empty())
+    assert 'broker_messages_published_total{topic="orders"} 1.0' in stats.text.splitlines()
+    published = [s for s in stats.samples if s.name == "broker_messages_published_total"]
+    assert [(dict(s.labels), s.value) for s in published] == [({"topic": "orders"}, 1.0)]
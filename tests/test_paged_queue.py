@@ -0,0 +1,64 @@
+import os
+import uuid
+from collections import deque
+
+import pytest
+
+from broker.compact_queue import CompactMessageQueue
+from broker.models import Message
+from broker.paged_queue import PagedMessageQueue
+
+
+def messages(count: int, size: int = 100):
+    return [Message(id=uuid.uuid4(), data=f"{i:>{size}}", topic="big", enqueued_at=float(i)) for i in range(count)]
+
+
+def spill_files(directory) -> list:
+    return sorted(name for name in os.listdir(directory) if name.endswith(".spill"))
+
+
+@pytest.mark.parametrize("memory", [deque, lambda: CompactMessageQueue("big")], ids=["deque", "compact"])
+def test_over_budget_messages_spill_and_come_back_in_order(tmp_path, memory, monkeypatch):
+    monkeypatch.setattr(PagedMessageQueue, "READ_AHEAD", 8)
+    monkeypatch.setattr(PagedMessageQueue, "SEGMENT_BYTES", 2048)
+    queue = PagedMessageQueue("big", memory(), max_bytes=10 * 300, directory=str(tmp_path))
+    published = messages(50)
+    queue.extend(published[:30])
+    for message in published[30:]:
+        queue.append(message)
+
+    assert len(queue) == 50
+    assert queue.spilled == 40 and queue.memory_bytes <= queue.max_bytes
+    assert len(spill_files(tmp_path)) > 1
+    # Iterating reads the spilled tail without consuming it
+    assert [m.id for m in queue] == [m.id for m in published]
+
+    taken = [queue.popleft() for _ in range(50)]
+    assert [(m.id, m.data) for m in taken] == [(m.id, m.data) for m in published]
+    assert not queue and queue.spilled == 0
+    assert spill_files(tmp_path) == []
+
+
+def test_page_in_stays_within_the_budget(tmp_path):
+    queue = PagedMessageQueue("big", deque(), max_bytes=3 * 300, directory=str(tmp_path))
+    queue.extend(messages(10))
+    assert queue.spilled == 7
+
+    # Without a page-in worker every pop refills memory inline, never past the budget
+    for _ in range(3):
+        queue.popleft()
+    assert (queue.spilled, queue.memory_bytes) == (4, 3 * 300)
+    assert queue.page_in() == 0
+    assert not queue.has_room
+
+
+def test_service_delivers_a_spilled_backlog_in_order(make_service, tmp_path):
+    service = make_service(max_queue_bytes=20 * 300, spill_dir=str(tmp_path / "spill"))
+    ids = [service.produce(f"{i:>100}", topic="big") for i in range(100)]
+    assert service.storage.topic("big").spilled_count() > 0
+
+    delivered = []
+    while (message := service.consume("big")) is not None:
+        delivered.append(message.id)
+        service.acknowledge(message.id)
+    assert delivered == ids
@@ -0,0 +1,88 @@
+import queue
+import threading
+
+from proto import broker_pb2
+
+
+class Stream:
+    '''
+    A MessageStream call fed from a queue of NodeMessages, with the delivered messages
+    collected by a reader thread.
+    '''
+    def __init__(self, stub, subscribe: broker_pb2.Subscribe):
+        self.frames = queue.Queue()
+        self.frames.put(broker_pb2.NodeMessage(subscribe=subscribe))
+        self.received = queue.Queue()
+        self.call = stub.MessageStream(iter(self.frames.get, None))
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        try:
+            for message in self.call:
+                self.received.put(message)
+        except Exception:
+            pass
+
+    def send(self, **frame):
+        self.frames.put(broker_pb2.NodeMessage(**frame))
+
+    def take(self, count: int, timeout: float = 5):
+        return [self.received.get(timeout=timeout) for _ in range(count)]
+
+    def idle(self, wait: float = 0.3) -> bool:
+        try:
+            self.received.get(timeout=wait)
+        except queue.Empty:
+            return True
+        return False
+
+    def close(self):
+        self.frames.put(None)
+        self.call.cancel()
+
+
+def publish(broker, topic, count):
+    return [
+        broker.stub.Publish(broker_pb2.PublishRequest(topic=topic, payload=f"m{i}")).message_id
+        for i in range(count)
+    ]
+
+
+def test_messages_are_pushed_up_to_the_prefetch_window(broker):
+    ids = publish(broker, "orders", 5)
+    stream = Stream(broker.stub, broker_pb2.Subscribe(topic="orders", prefetch=3))
+    try:
+        # Three are pushed without any further frame, then the window is full
+        first = stream.take(3)
+        assert [m.message_id for m in first] == ids[:3]
+        assert stream.idle()
+
+        for message in first:
+            stream.send(ack=broker_pb2.Ack(message_id=message.message_id))
+        assert [m.message_id for m in stream.take(2)] == ids[3:]
+    finally:
+        stream.close()
+
+
+def test_messages_published_later_are_pushed(broker):
+    stream = Stream(broker.stub, broker_pb2.Subscribe(topic="orders", prefetch=10))
+    try:
+        assert stream.idle()
+        ids = publish(broker, "orders", 2)
+        assert [m.message_id for m in stream.take(2)] == ids
+    finally:
+        stream.close()
+
+
+def test_pull_streams_get_one_message_per_credit(broker):
+    ids = publish(broker, "orders", 3)
+    stream = Stream(broker.stub, broker_pb2.Subscribe(topic="orders", pull=True))
+    try:
+        assert stream.idle()
+        stream.send(pull=broker_pb2.Pull(credit=2))
+        assert [m.message_id for m in stream.take(2)] == ids[:2]
+        assert stream.idle()
+        stream.send(pull=broker_pb2.Pull(credit=1))
+        assert [m.message_id for m in stream.take(1)] == ids[2:]
+    finally:
+        stream.close()
@@ -0,0 +1,36 @@
+import pytest
+
+from broker.message_service import MessageService
+
+BACKLOG = 2500
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "log"])
+def test_backlog_is_streamed_in_batches(make_service, backend):
+    service = make_service(persistence_backend=backend)
+    ids = service.produce_batch([(f"m{i}", "orders") for i in range(300)], wait_for_commit=True)
+    for message_id in ids[:100]:
+        service.acknowledge(message_id)
+    service.persistence_service.flush()
+
+    batches = list(service.persistence_service.iter_unacknowledged_batches(batch_size=64))
+    assert all(len(batch) <= 64 for batch in batches)
+    assert sorted(m.id for batch in batches for m in batch) == sorted(ids[100:])
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "log"])
+def test_background_replay_serves_while_loading(make_service, monkeypatch, backend):
+    monkeypatch.setattr(MessageService, "REPLAY_BATCH", 100)
+    service = make_service(persistence_backend=backend)
+    ids = [service.produce(f"m{i}", topic="orders") for i in range(BACKLOG)]
+    service.persistence_service.close()
+
+    restarted = make_service(persistence_backend=backend)
+    # Publishes are taken before the replay finished, the replay only covers the old backlog
+    late = restarted.produce("late", topic="orders")
+    assert restarted.wait_for_recovery(10)
+    assert (restarted.recovery.total, restarted.recovery.replayed) == (BACKLOG, BACKLOG)
+    assert [value for name, _, value in restarted.metrics.collect() if name == "broker_recovery_done"] == [1]
+
+    queued = {m.id for m in restarted.get_all_messages("orders")}
+    assert queued == set(ids) | {late}
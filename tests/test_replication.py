@@ -0,0 +1,118 @@
+import time
+from concurrent import futures
+
+import grpc
+import pytest
+
+from broker.broker import BrokerServicer
+from broker.replication import ReplicatedBrokerStub, ReplicationNode, ReplicationServicer
+from proto import broker_pb2, broker_pb2_grpc
+
+
+class Cluster:
+    '''
+    A cluster of replicated brokers served on free local ports, with a ReplicatedBrokerStub.
+    '''
+    def __init__(self, directory, size: int = 3):
+        self.servers = [grpc.server(futures.ThreadPoolExecutor(max_workers=16)) for _ in range(size)]
+        self.addresses = [f"127.0.0.1:{server.add_insecure_port('127.0.0.1:0')}" for server in self.servers]
+        self.servicers = []
+        for i, (server, address) in enumerate(zip(self.servers, self.addresses)):
+            servicer = BrokerServicer(data_path=str(directory / f"broker{i}.db"), replication=dict(
+                node=address, peers=self.addresses, state_path=str(directory / f"broker{i}.replica.json"),
+            ))
+            broker_pb2_grpc.add_BrokerServicer_to_server(servicer, server)
+            broker_pb2_grpc.add_ReplicationServicer_to_server(ReplicationServicer(servicer.replication), server)
+            server.start()
+            servicer.replication.start()
+            self.servicers.append(servicer)
+        self.running = set(range(size))
+        self.channels = [grpc.insecure_channel(address) for address in self.addresses]
+        self.stub = ReplicatedBrokerStub(self.channels)
+
+    def stop(self, i: int):
+        self.running.discard(i)
+        self.servers[i].stop(0)
+        self.servicers[i].replication.stop()
+        self.servicers[i].message_service.persistence_service.close()
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+        for i in list(self.running):
+            self.stop(i)
+
+
+@pytest.fixture
+def cluster(tmp_path, monkeypatch):
+    monkeypatch.setattr(ReplicationNode, "ELECTION_TIMEOUT", (0.3, 0.6))
+    running = Cluster(tmp_path)
+    yield running
+    running.close()
+
+
+def all_payloads(cluster, topic):
+    return sorted(m.data for m in cluster.stub.GetAllMessages(broker_pb2.TopicRequest(topic=topic)).messages)
+
+
+def test_confirmed_publishes_survive_the_leader(cluster):
+    first = cluster.stub.Publish(broker_pb2.PublishRequest(topic="orders", payload="a", idempotency_key="k"))
+    cluster.stub.PublishBatch(broker_pb2.PublishBatchRequest(messages=[
+        broker_pb2.PublishRequest(topic="orders", payload=payload) for payload in ("b", "c")
+    ]))
+    old_leader = cluster.stub.find_leader()
+    cluster.stop(old_leader)
+
+    # The stub waits for the remaining brokers to elect a new leader
+    assert cluster.stub.Publish(broker_pb2.PublishRequest(topic="orders", payload="d")).message_id
+    new_leader = cluster.stub.find_leader()
+    assert new_leader is not None and new_leader != old_leader
+    assert all_payloads(cluster, "orders") == ["a", "b", "c", "d"]
+    # Idempotency keys were replicated as well, a retry after the failover is no duplicate
+    retried = cluster.stub.Publish(broker_pb2.PublishRequest(topic="orders", payload="a", idempotency_key="k"))
+    assert retried.message_id == first.message_id
+    assert all_payloads(cluster, "orders") == ["a", "b", "c", "d"]
+
+
+def test_followers_turn_clients_away(cluster):
+    leader = cluster.stub.find_leader()
+    follower = next(i for i in range(len(cluster.addresses)) if i != leader)
+    with pytest.raises(grpc.RpcError) as raised:
+        broker_pb2_grpc.BrokerStub(cluster.channels[follower]).Publish(
+            broker_pb2.PublishRequest(topic="orders", payload="x")
+        )
+    assert raised.value.code() == grpc.StatusCode.UNAVAILABLE
+
+
+def test_publish_is_confirmed_once_committed(cluster):
+    cluster.stub.find_leader()
+    for servicer in cluster.servicers:
+        writer = servicer.replication.backend._writer
+        apply_batch = writer._apply_batch
+
+        def slow_apply(writes, apply_batch=apply_batch):
+            time.sleep(0.3)
+            apply_batch(writes)
+
+        writer._apply_batch = slow_apply
+
+    cluster.stub.Publish(broker_pb2.PublishRequest(topic="orders", payload="a"))
+    # Leader and at least one follower have it committed, not just queued for their writer
+    committed = [servicer.replication.backend.count_unacknowledged_messages() for servicer in cluster.servicers]
+    assert committed.count(1) >= 2
+
+
+def test_duplicate_publish_does_not_wait_for_the_quorum(cluster):
+    first = cluster.stub.Publish(broker_pb2.PublishRequest(topic="orders", payload="a", idempotency_key="k"))
+    leader = cluster.stub.find_leader()
+    for i in range(len(cluster.addresses)):
+        if i != leader:
+            cluster.stop(i)
+    stub = broker_pb2_grpc.BrokerStub(cluster.channels[leader])
+
+    # Nothing new was written, the earlier publish was already confirmed
+    retried = stub.Publish(broker_pb2.PublishRequest(topic="orders", payload="a", idempotency_key="k"))
+    assert retried.message_id == first.message_id
+    with pytest.raises(grpc.RpcError) as raised:
+        stub.Publish(broker_pb2.PublishRequest(topic="orders", payload="b"), timeout=10)
+    assert raised.value.code() == grpc.StatusCode.UNAVAILABLE
@@ -0,0 +1,57 @@
+import logging
+import time
+
+import pytest
+
+from broker.retention import RetentionPolicies, RetentionPolicy
+from broker.segment_log import LogPersistenceService
+
+
+def test_history_is_kept_unless_a_policy_limits_it():
+    policies = RetentionPolicies(topics={"audit": "max_age=7d", "jobs": "delete_on_ack"})
+    assert policies.for_topic("orders").keep_for is None
+    assert policies.for_topic("audit").keep_for == 7 * 86400
+    assert policies.for_topic("jobs").keep_for == 0.0
+    assert RetentionPolicy.parse("max_bytes=1G").max_bytes == 1024 ** 3
+
+
+def test_ttl_for():
+    policies = RetentionPolicies("ttl=1h", {"events": "ttl=none"})
+    assert policies.ttl_for("orders") == 3600
+    assert policies.ttl_for("orders", 5) == 5
+    # An explicit 0 means no time to live, not the topic's
+    assert policies.ttl_for("orders", 0) is None
+    assert policies.ttl_for("events") is None
+
+
+def test_expired_messages_are_dropped(make_service):
+    service = make_service(topic_retention={"orders": "ttl=0.2"})
+    service.produce("default ttl", topic="orders", wait_for_commit=True)
+    kept = service.produce("no ttl", topic="orders", ttl=0, wait_for_commit=True)
+    service.produce("short ttl", topic="events", ttl=0.2, wait_for_commit=True)
+    time.sleep(0.3)
+    service.storage.expire_ready()
+    assert service.consume("orders").id == kept
+    assert service.consume("orders") is None
+    assert service.consume("events") is None
+    with pytest.raises(ValueError):
+        service.produce("x", ttl=-1)
+
+
+def test_compaction_deletes_acknowledged_history_by_policy(make_service):
+    service = make_service(topic_retention={"jobs": "max_age=0"})
+    for topic in ("jobs", "orders"):
+        service.produce("x", topic=topic, wait_for_commit=True)
+        assert service.acknowledge(service.consume(topic).id)
+    service.persistence_service.flush()
+    assert service.persistence_service.compact() == 1
+    # Topics without a max_age keep their history
+    assert service.persistence_service.compact() == 0
+
+
+def test_log_backend_warns_about_history_limits(tmp_path, caplog):
+    with caplog.at_level(logging.WARNING, logger="broker.segment_log"):
+        LogPersistenceService(False, str(tmp_path / "quiet"), retention=RetentionPolicies("ttl=1h")).close()
+        assert not caplog.records
+        LogPersistenceService(False, str(tmp_path / "log"), retention=RetentionPolicies(topics={"audit": "max_age=7d"})).close()
+    assert "audit" in caplog.text
@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+from broker.message_service import MessageService
+from proto import broker_pb2
+
+
+def consume_within(service, topic: str, timeout: float, **options):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        message = service.consume(topic, **options)
+        if message is not None:
+            return message
+        service.wait_for_messages(topic, timeout=0.05)
+    return None
+
+
+def test_higher_priorities_are_delivered_first(make_service):
+    service = make_service()
+    low = service.produce("low", topic="jobs")
+    first = service.produce("first", topic="jobs", priority=5)
+    urgent = service.produce("urgent", topic="jobs", priority=9)
+    second = service.produce("second", topic="jobs", priority=5)
+
+    # Within a priority messages keep their publish order
+    assert [service.consume("jobs").id for _ in range(4)] == [urgent, first, second, low]
+    with pytest.raises(ValueError):
+        service.produce("x", topic="jobs", priority=10)
+
+
+def test_delayed_messages_wait_for_their_time(make_service):
+    service = make_service()
+    later = service.produce("later", topic="jobs", deliver_at=time.time() + 0.3)
+    now = service.produce("now", topic="jobs")
+
+    assert service.consume("jobs").id == now
+    assert service.consume("jobs") is None
+    assert {m.id for m in service.get_all_messages("jobs")} == {now, later}
+    assert consume_within(service, "jobs", 2).id == later
+
+
+def test_retries_back_off(make_service, monkeypatch):
+    monkeypatch.setattr(MessageService, "RETRY_BACKOFF", 0.4)
+    service = make_service()
+    message_id = service.produce("flaky", topic="jobs")
+    service.consume("jobs", visibility_timeout=0.1)
+
+    # Expired after 0.1s, then held back for RETRY_BACKOFF before the redelivery
+    assert consume_within(service, "jobs", 0.3) is None
+    retried = consume_within(service, "jobs", 2)
+    assert (retried.id, retried.retries) == (message_id, 1)
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "log"])
+def test_schedule_survives_a_restart(make_service, backend):
+    service = make_service(persistence_backend=backend)
+    deliver_at = time.time() + 60
+    delayed = service.produce("delayed", topic="jobs", deliver_at=deliver_at, wait_for_commit=True)
+    urgent = service.produce("urgent", topic="jobs", priority=7, wait_for_commit=True)
+
+    restarted = make_service.restart(service)
+    message = restarted.consume("jobs")
+    assert (message.id, message.priority) == (urgent, 7)
+    assert restarted.consume("jobs") is None
+    assert [(m.id, m.deliver_at) for m in restarted.get_all_messages("jobs") if m.id == delayed] == [
+        (delayed, deliver_at)
+    ]
+
+
+def test_publish_with_a_delay(broker):
+    published = broker.stub.Publish(broker_pb2.PublishRequest(topic="jobs", payload="x", delay_seconds=0.3))
+    assert broker.service.consume("jobs") is None
+    assert str(consume_within(broker.service, "jobs", 2).id) == published.message_id
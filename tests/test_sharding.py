@@ -0,0 +1,71 @@
+import pytest
+
+from broker.sharding import ShardedBrokerStub, shard_for_topic, shard_of_message
+from proto import broker_pb2
+from tests.conftest import RunningBroker
+
+SHARDS = 3
+TOPICS = [f"topic-{i}" for i in range(6)]
+
+
+@pytest.fixture
+def shards(tmp_path):
+    running = [RunningBroker(str(tmp_path / f"shard{i}.db"), shard=i) for i in range(SHARDS)]
+    yield running
+    for shard in running:
+        shard.stop()
+
+
+@pytest.fixture
+def stub(shards):
+    return ShardedBrokerStub([shard.channel for shard in shards])
+
+
+def test_topics_and_ids_route_to_one_shard(shards, stub):
+    assert {shard_for_topic(topic, SHARDS) for topic in TOPICS} == set(range(SHARDS))
+    for topic in TOPICS:
+        message_id = stub.Publish(broker_pb2.PublishRequest(topic=topic, payload="x")).message_id
+        owner = shard_for_topic(topic, SHARDS)
+        assert shard_of_message(message_id, SHARDS) == owner
+        assert [str(m.id) for m in shards[owner].service.get_all_messages(topic)] == [message_id]
+    assert sorted(stub.ListTopics(broker_pb2.Empty()).topics) == TOPICS
+    assert shard_of_message("not an id", SHARDS) is None
+
+
+def test_batches_are_split_by_shard_and_answered_in_order(shards, stub):
+    response = stub.PublishBatch(broker_pb2.PublishBatchRequest(messages=[
+        broker_pb2.PublishRequest(topic=topic, payload=topic) for topic in TOPICS
+    ]))
+    ids = [result.message_id for result in response.results]
+    assert [shard_of_message(message_id, SHARDS) for message_id in ids] == [shard_for_topic(t, SHARDS) for t in TOPICS]
+
+    for topic in TOPICS[:3]:
+        shards[shard_for_topic(topic, SHARDS)].service.consume(topic)
+    acked = stub.AckBatch(broker_pb2.AckBatchRequest(message_ids=ids + ["nope"]))
+    assert [result.success for result in acked.results] == [True] * 3 + [False] * 4
+    assert not stub.Ack(broker_pb2.AckRequest(message_id="nope")).success
+
+
+def listing(stub, **request):
+    return list(stub.StreamAllMessages(broker_pb2.ListRequest(**request)))
+
+
+def test_listing_walks_every_shard_and_resumes_from_any_cursor(stub):
+    stub.PublishBatch(broker_pb2.PublishBatchRequest(messages=[
+        broker_pb2.PublishRequest(topic=topic, payload=f"{topic}/{i}") for topic in TOPICS for i in range(3)
+    ]))
+
+    pages = listing(stub, page_size=4)
+    listed = [m.message_id for page in pages for m in page.messages]
+    assert len(listed) == len(set(listed)) == 3 * len(TOPICS)
+    assert [page.end for page in pages] == [False] * (len(pages) - 1) + [True]
+
+    # Resuming from a page's cursor continues right after it, on whichever shard it left off
+    seen = 0
+    for page in pages[:-1]:
+        seen += len(page.messages)
+        rest = [m.message_id for later in listing(stub, page_size=4, cursor=page.next_cursor) for m in later.messages]
+        assert rest == listed[seen:]
+
+    limited = [m.message_id for page in listing(stub, page_size=4, limit=7) for m in page.messages]
+    assert limited == listed[:7]
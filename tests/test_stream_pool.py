@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+from api_node.stream_pool import BrokerStreamPool, PooledStream
+from proto import broker_pb2
+
+
+@pytest.fixture
+def pool(broker):
+    pool = BrokerStreamPool(broker.stub)
+    yield pool
+    pool.close()
+
+
+def publish(broker, *payloads, topic="orders"):
+    return [
+        broker.stub.Publish(broker_pb2.PublishRequest(topic=topic, payload_bytes=payload)).message_id
+        for payload in payloads
+    ]
+
+
+def test_get_returns_messages_in_order(broker, pool):
+    ids = publish(broker, *(f"m{i}".encode() for i in range(20)))
+    received = [pool.get("orders", 5).message_id for _ in ids]
+    assert received == ids
+    assert pool.get("orders", 0.2) is None
+
+
+def test_nothing_is_held_without_a_waiting_request(broker, pool, monkeypatch):
+    monkeypatch.setattr(PooledStream, "HOLD", 0.2)
+    assert pool.get("orders", 0.1) is None
+    publish(broker, b"a", b"b", b"c")
+    # The request's credit may still be on its way back when the first message is
+    # published, that message is released again
+    time.sleep(1)
+    assert broker.service.storage.topic("orders").ready_count() == 3
+    assert broker.service.storage.topic("orders").in_flight_count() == 0
+
+
+def test_unclaimed_messages_go_back_before_their_visibility_timeout(broker, pool, monkeypatch):
+    # Messages pushed after their request gave up must not sit out their visibility
+    # timeout in the API node and come back as retried, duplicate deliveries
+    monkeypatch.setattr(PooledStream, "HOLD", 0.2)
+    broker.service.REQUEUE_TIMEOUT = 1
+    ids = publish(broker, *(f"m{i}".encode() for i in range(5)))
+    for _ in range(50):
+        # Requests that give up right away, the broker still answers some of them
+        pool.get("orders", 0)
+    time.sleep(2.5)
+    assert broker.service.storage.topic("orders").in_flight_count() == 0
+    received = []
+    while (msg := pool.get("orders", 0.5)) is not None:
+        received.append(msg)
+        assert broker.stub.Ack(broker_pb2.AckRequest(message_id=msg.message_id)).success
+    assert sorted(msg.message_id for msg in received) == sorted(ids)
+    assert all(msg.retries == 0 for msg in received)
+    assert not broker.service.get_dead_letter("orders")
+
+
+def test_get_many_stops_at_max_messages(broker, pool):
+    ids = publish(broker, *(f"m{i}".encode() for i in range(10)))
+    assert [msg.message_id for msg in pool.get_many("orders", 4, 5)] == ids[:4]
+    assert [msg.message_id for msg in pool.get_many("orders", 10, 0.5)] == ids[4:]
@@ -0,0 +1,45 @@
+import pytest
+
+from broker.models import DEFAULT_TOPIC
+from proto import broker_pb2
+
+
+def test_topics_have_separate_queues(make_service):
+    service = make_service()
+    orders = service.produce("o", topic="orders")
+    payments = service.produce("p", topic="payments")
+    plain = service.produce("d")
+
+    assert service.consume("payments").id == payments
+    assert service.consume("payments") is None
+    assert service.consume("orders").id == orders
+    assert service.consume(DEFAULT_TOPIC).id == plain
+    assert {"orders", "payments", DEFAULT_TOPIC} <= set(service.get_topics())
+    assert [m.id for m in service.get_all_messages("orders")] == [orders]
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "log"])
+def test_topics_survive_a_restart(make_service, backend):
+    service = make_service(persistence_backend=backend)
+    orders = service.produce("o", topic="orders", wait_for_commit=True)
+    payments = service.produce("p", topic="payments", wait_for_commit=True)
+
+    restarted = make_service.restart(service)
+    assert restarted.consume("orders").id == orders
+    assert restarted.consume("orders") is None
+    assert restarted.consume("payments").id == payments
+
+
+def test_streams_only_get_their_topic(broker):
+    broker.stub.Publish(broker_pb2.PublishRequest(topic="payments", payload="p"))
+    orders = broker.stub.Publish(broker_pb2.PublishRequest(topic="orders", payload="o"))
+
+    frames = iter([broker_pb2.NodeMessage(subscribe=broker_pb2.Subscribe(topic="orders", prefetch=10))])
+    call = broker.stub.MessageStream(frames)
+    try:
+        message = next(call)
+        assert (message.message_id, message.topic) == (orders.message_id, "orders")
+    finally:
+        call.cancel()
+    assert len(broker.stub.GetAllMessages(broker_pb2.TopicRequest(topic="payments")).messages) == 1
+    assert {"orders", "payments"} <= set(broker.stub.ListTopics(broker_pb2.Empty()).topics)
@@ -0,0 +1,62 @@
+import time
+import uuid
+
+import pytest
+
+from broker.message_service import MessageService
+from broker.message_storage import MessageStorage
+from broker.models import Message
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(MessageService, "RETRY_BACKOFF", 0.0)
+
+
+def consume_within(service, timeout: float, **options):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        message = service.consume("orders", **options)
+        if message is not None:
+            return message
+        service.wait_for_messages("orders", timeout=0.05)
+    return None
+
+
+def test_unacknowledged_messages_are_redelivered(make_service):
+    service = make_service()
+    message_id = service.produce("a", topic="orders")
+    assert service.consume("orders", visibility_timeout=0.2).id == message_id
+    assert service.consume("orders") is None
+
+    redelivered = consume_within(service, 2, visibility_timeout=30)
+    assert (redelivered.id, redelivered.retries) == (message_id, 1)
+    assert service.acknowledge(message_id)
+
+
+def test_touch_extends_the_lease(make_service):
+    service = make_service()
+    message_id = service.produce("a", topic="orders")
+    service.consume("orders", visibility_timeout=0.3)
+    time.sleep(0.2)
+    assert service.touch(message_id, visibility_timeout=0.6)
+
+    # Past the original deadline, the message is still leased
+    assert consume_within(service, 0.3) is None
+    assert consume_within(service, 2).id == message_id
+    assert not service.touch(uuid.uuid4())
+
+
+def test_only_expired_deadlines_are_returned():
+    storage = MessageStorage()
+    for data in ("short", "touched"):
+        storage.enqueue(Message(id=uuid.uuid4(), data=data, enqueued_at=time.time()))
+    short = storage.dequeue(visibility_timeout=0.1)
+    touched = storage.dequeue(visibility_timeout=0.1)
+    storage.touch(touched.id, visibility_timeout=30)
+
+    # The touched message's first deadline is stale and skipped
+    started = time.monotonic()
+    assert storage.wait_for_expired() == [short.id]
+    assert time.monotonic() - started < 1
+    assert storage.pop_expired(touched.id) is None
@@ -0,0 +1,56 @@
+import pytest
+
+from broker.persistence_service import WriteBehindQueue
+
+
+def ack_on_enqueue(service, topic):
+    # A consumer fast enough to ack messages while produce() is still running
+    def listener(name, partition, count):
+        if name == topic:
+            while (message := service.consume(topic)) is not None:
+                assert service.acknowledge(message.id)
+
+    service.storage.listeners.append(listener)
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "log"])
+def test_acked_messages_are_not_replayed(make_service, backend):
+    service = make_service(backend, persistence_backend=backend)
+    ack_on_enqueue(service, "orders")
+    service.produce("single", topic="orders")
+    service.produce_batch([("a", "orders"), ("b", "orders")])
+    assert service.storage.topic("orders").ready_count() == 0
+    service.persistence_service.flush()
+    service = make_service.restart(service)
+    assert service.consume("orders") is None
+    assert service.persistence_service.count_unacknowledged_messages() == 0
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "log"])
+def test_unacked_messages_are_replayed_in_order(make_service, backend):
+    service = make_service(backend, persistence_backend=backend)
+    ids = [service.produce(f"m{i}", topic="orders") for i in range(5)]
+    ids += service.produce_batch([(f"b{i}", "orders") for i in range(5)], wait_for_commit=True)
+    assert service.acknowledge(service.consume("orders").id)
+    service.persistence_service.flush()
+    service = make_service.restart(service)
+    replayed = []
+    while (message := service.consume("orders")) is not None:
+        replayed.append(message.id)
+    assert replayed[:4] == ids[1:5]
+    # A batch shares its enqueued_at, its messages come back together
+    assert sorted(replayed[4:]) == sorted(ids[5:])
+
+
+def test_writer_batches_operations_in_order():
+    batches = []
+    writer = WriteBehindQueue(batches.append, batch_size=10, flush_interval=0.05, max_pending=100, name="test-writer")
+    for i in range(25):
+        writer.put(("insert", i))
+    writer.put_many([("insert", "x"), ("insert", "y")])
+    assert writer.flush(5)
+    writer.close(5)
+    assert all(len(batch) <= 10 for batch in batches[:-1])
+    assert [op[1] for batch in batches for op in batch] == list(range(25)) + ["x", "y"]
+    # Operations queued together are committed together
+    assert any([("insert", "x"), ("insert", "y")] == batch[-2:] for batch in batches)